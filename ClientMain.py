@@ -5,6 +5,8 @@ Top level routine for client side rtfMRI processing
 import os
 import sys
 import time
+import json
+import queue
 import traceback
 import threading
 import logging
@@ -12,14 +14,18 @@ import argparse
 import ServerMain
 from rtAtten.RtAttenClient import RtAttenClient
 from rtfMRI.RtfMRIClient import RtfMRIClient, loadConfigFile
+from rtfMRI.Messaging import RtMessagingClient
 from rtfMRI.BaseClient import BaseClient
 from rtfMRI.Errors import InvocationError
 from rtfMRI.utils import installLoggers
 from rtfMRI.StructDict import StructDict
+from webInterface.WebClientUtils import connectSocketPipe, clientWorkerReady
 
 
 def ClientMain(params):
     installLoggers(logging.INFO, logging.INFO, filename='logs/rtAttenClient.log')
+    if params.worker is True:
+        return ClientWorkerMain(params)
 
     webpipes = None
     if params.webpipe is not None:
@@ -31,8 +37,12 @@ def ClientMain(params):
         webpipes = StructDict()
         webpipes.name_in = params.webpipe + '.toclient'
         webpipes.name_out = params.webpipe + '.fromclient'
-        webpipes.fd_in = open(webpipes.name_in, mode='r')
+        webpipes.fd_in = open(webpipes.name_in, mode='rb')
         webpipes.fd_out = open(webpipes.name_out, mode='w', buffering=1)
+    elif params.websock is not None:
+        # Same as webpipes but using a unix domain socket to the webserver
+        webpipes = connectSocketPipe(params.websock)
+    if webpipes is not None:
         # Create a thread which will detect if the parent process exited by
         #  reading from stdin, when stdin is closed exit this process
         exitThread = threading.Thread(name='exitThread', target=processShouldExitThread, args=(params,))
@@ -52,7 +62,7 @@ def ClientMain(params):
         client = BaseClient()
     elif params.cfg.experiment.model == 'rtAtten':
         client = RtAttenClient()
-        if params.webpipe is not None:
+        if webpipes is not None:
             client.setWeb(webpipes, params.webfilesremote)
     else:
         raise InvocationError("Unsupported model %s" % (params.cfg.experiment.model))
@@ -69,6 +79,75 @@ def ClientMain(params):
     return True
 
 
+def ClientWorkerMain(params):
+    '''Client process started by the webserver ahead of the run requests. Modules are
+    imported and the connections made up front, then each experiment file requested
+    on stdin is run as a session reusing the rtfMRI server connection and clock sync.
+    As for a spawned client, closing stdin exits the process and stops any session.
+    '''
+    if params.websock is None:
+        raise InvocationError("Client worker requires the --websock option")
+    webpipes = connectSocketPipe(params.websock)
+    requestQueue = queue.Queue()  # type: ignore
+    requestThread = threading.Thread(name='requestThread', target=workerRequestThread, args=(requestQueue,))
+    requestThread.setDaemon(True)
+    requestThread.start()
+    if params.run_local is True:
+        startLocalServer(params.port)
+    messaging = None
+    clockSync = None
+    try:
+        messaging = RtMessagingClient(params.addr, params.port)
+    except Exception as err:
+        logging.warning('ClientWorker: server connection failed, retry at session start: {}'.format(err))
+    print(clientWorkerReady, flush=True)
+    while True:
+        request = requestQueue.get()
+        client = None
+        try:
+            cfg = loadConfigFile(request['experiment'])
+            params = mergeParamsConfigs(params, cfg)
+            if params.cfg.experiment.model == 'base':
+                client = BaseClient()
+            elif params.cfg.experiment.model == 'rtAtten':
+                client = RtAttenClient()
+                client.setWeb(webpipes, params.webfilesremote)
+            else:
+                raise InvocationError("Unsupported model %s" % (params.cfg.experiment.model))
+            client.messaging = messaging
+            client.clockSync = clockSync
+            client.runSession(params.addr, params.port, params.cfg, keepConnection=True)
+            messaging = client.messaging
+            clockSync = client.clockSync
+        except Exception as err:
+            print(err)
+            traceback_str = ''.join(traceback.format_tb(err.__traceback__))
+            print(traceback_str)
+            if client is not None:
+                # the connection may be part way through a request, reconnect next session
+                client.close()
+                messaging = None
+                clockSync = None
+        finally:
+            if client is not None:
+                # the client object no longer owns the connection
+                client.messaging = None
+        print(clientWorkerReady, flush=True)
+        # release the session's client while waiting for the next request
+        client = None
+
+
+def workerRequestThread(requestQueue):
+    '''Read session requests from stdin, one JSON line each. When stdin is closed
+    by the webserver exit this process.
+    '''
+    for line in sys.stdin:
+        if line.strip() != '':
+            requestQueue.put(json.loads(line))
+    print('workerRequestThread: stdin closed, exiting', flush=True)
+    os._exit(0)
+
+
 def mergeParamsConfigs(params, cfg):
     if params.runs is not None:
         if params.scans is None:
@@ -133,11 +212,16 @@ if __name__ == "__main__":
                            help='run client and server together locally')
     argParser.add_argument('--webpipe', '-w', default=None, type=str,
                            help='Named pipe to communicate with webServer')
+    argParser.add_argument('--websock', default=None, type=str,
+                           help='Unix socket to communicate with webServer')
     argParser.add_argument('--webfilesremote', '-x', default=False, action='store_true',
                            help='dicom files retrieved from remote server')
+    argParser.add_argument('--worker', default=False, action='store_true',
+                           help='Wait for sessions requested by the webServer on stdin')
     args = argParser.parse_args()
     params = StructDict({'addr': args.addr, 'port': args.port, 'run_local': args.run_local,
                          'model': args.model, 'experiment': args.experiment,
                          'runs': args.runs, 'scans': args.scans,
-                         'webpipe': args.webpipe, 'webfilesremote': args.webfilesremote})
+                         'webpipe': args.webpipe, 'websock': args.websock,
+                         'webfilesremote': args.webfilesremote, 'worker': args.worker})
     ClientMain(params)
@@ -23,6 +23,8 @@ if __name__ == "__main__":
                         help="Allowed directories to server files from - comma separated list")
     parser.add_argument('-f', action="store", dest="allowedFileTypes", default=defaultAllowedTypes,
                         help="Allowed file types - comma separated list")
+    parser.add_argument('-w', '--watcher', action="store", dest="watcherType", default=None,
+                        help="File watcher type: 'polling' for network mounted dirs, otherwise inotify/watchdog")
     parser.add_argument('-u', '--username', action="store", dest="username", default=None,
                         help="rtAtten website username")
     parser.add_argument('-p', '--password', action="store", dest="password", default=None,
@@ -55,4 +57,5 @@ if __name__ == "__main__":
                                         allowedDirs=args.allowedDirs,
                                         allowedTypes=args.allowedFileTypes,
                                         username=args.username,
-                                        password=args.password)
+                                        password=args.password,
+                                        watcherType=args.watcherType)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Reprocess archived sessions offline, e.g. for validation or to sweep the
+FWHM and cutoff parameters. Each session replays its saved patterns data
+(replayMatFileMode) with the model run in the worker process rather than a
+server, and the sessions are run in parallel by a pool of worker processes.
+The masks and patterns data are loaded once before the workers start and
+shared read-only by them. The validate.py comparisons to the matlab outputs
+can be run as a stage after each session, and a summary table is printed.
+Usage:
+  python ReprocessMain.py -e conf/example.toml --fwhm 4,5,6 --cutoff 112,200 -j 4
+  python ReprocessMain.py -g '/data/subject*/day1' -c conf/example.toml --validate
+"""
+import os
+import re
+import csv
+import glob
+import time
+import logging
+import argparse
+import traceback
+import contextlib
+import multiprocessing
+import concurrent.futures
+import numpy as np  # type: ignore
+import rtfMRI.utils as utils
+from rtfMRI.RtfMRIClient import loadConfigFile
+from rtfMRI.RtfMRIServer import LocalMessagingClient
+from rtfMRI.StructDict import StructDict
+from rtfMRI.Errors import InvocationError
+from rtAtten.RtAttenClient import RtAttenClient
+from rtAtten.RtAttenModel import getSubjectDataDir
+from rtAtten.PatternsDesign2Config import prebuildRunSchedules
+import rtAtten.validate as validate
+
+# .mat files loaded before the workers start, by absolute path. Worker processes
+#   forked from this one share the arrays until the session ends.
+sharedMatFiles = {}  # type: ignore
+workerThreadLimits = None
+
+
+def ReprocessMain(params):
+    utils.installLoggers(logging.WARNING, logging.INFO, filename='logs/reprocess.log')
+    jobs = createJobs(params)
+    if len(jobs) == 0:
+        raise InvocationError("No sessions to reprocess")
+    preloadSharedFiles(jobs)
+    stime = time.time()
+    results = []
+    if params.jobs == 1:
+        initWorker(params.threads)
+        for job in jobs:
+            results.append(reprocessSession(job))
+            logResult(results[-1])
+    else:
+        # forked workers share the preloaded files
+        mpContext = None
+        if 'fork' in multiprocessing.get_all_start_methods():
+            mpContext = multiprocessing.get_context('fork')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=params.jobs, mp_context=mpContext,
+                                                    initializer=initWorker,
+                                                    initargs=(params.threads,)) as executor:
+            futures = [executor.submit(reprocessSession, job) for job in jobs]
+            for future in concurrent.futures.as_completed(futures):
+                logResult(future.result())
+            results = [future.result() for future in futures]
+    print("Reprocessed {} sessions in {:.1f}s, {} jobs, {} threads each".format(
+          len(results), time.time() - stime, params.jobs, params.threads))
+    printSummary(results, os.path.join(params.outDir, 'summary.csv'))
+    return results
+
+
+def createJobs(params):
+    '''A job per session and FWHM, cutoff pair. Sessions are the experiment files
+    and the subject/day directories matching the globs, which take their other
+    settings from the base experiment file.
+    '''
+    sessions = []
+    for filename in params.experiments:
+        cfg = loadConfigFile(filename)
+        sessions.append((os.path.splitext(os.path.basename(filename))[0], cfg))
+    cfgName = os.path.splitext(os.path.basename(params.baseConfig))[0]
+    for sessionGlob in params.sessions:
+        for dirname in sorted(glob.glob(sessionGlob)):
+            match = re.search(r'subject(\d+)[/\\]day(\d+)[/\\]?$', dirname)
+            if match is None or not os.path.isdir(dirname):
+                logging.warning("Reprocess: %s is not a subject/day directory", dirname)
+                continue
+            cfg = loadConfigFile(params.baseConfig)
+            cfg.session.dataDir = os.path.dirname(os.path.dirname(os.path.normpath(dirname)))
+            cfg.session.subjectNum = int(match.group(1))
+            cfg.session.subjectDay = int(match.group(2))
+            findSessionFiles(cfg.session, os.path.normpath(dirname))
+            sessions.append((cfgName, cfg))
+    jobs = []
+    labels = {}  # type: ignore
+    for cfgName, cfg in sessions:
+        fwhms = params.fwhm if params.fwhm is not None else [cfg.session.FWHM]
+        cutoffs = params.cutoff if params.cutoff is not None else [cfg.session.cutoff]
+        for fwhm in fwhms:
+            for cutoff in cutoffs:
+                job = StructDict()
+                job.label = '{}_s{}_d{}_fwhm{}_cutoff{}'.format(cfgName, cfg.session.subjectNum,
+                                                                cfg.session.subjectDay, fwhm, cutoff)
+                if job.label in labels:
+                    # e.g. a session both in an experiment file and matching a glob
+                    labels[job.label] += 1
+                    job.label += '_{}'.format(labels[job.label])
+                labels[job.label] = 1
+                job.outDir = os.path.abspath(os.path.join(params.outDir, job.label))
+                job.validate = params.validate
+                job.seed = params.seed
+                job.cfg = reprocessConfig(cfg, fwhm, cutoff, job.outDir)
+                jobs.append(job)
+    return jobs
+
+
+def reprocessConfig(cfg, fwhm, cutoff, outDir):
+    '''The session config to replay the saved patterns data, with the outputs in outDir'''
+    cfg = StructDict({'experiment': cfg.experiment.copy(), 'session': cfg.session.copy()})
+    session = cfg.session
+    session.FWHM = fwhm
+    session.cutoff = cutoff
+    session.rtData = False
+    session.replayMatFileMode = True
+    if session.batchReplay is None:
+        session.batchReplay = True
+    session.getMasksFromControlRoom = False
+    session.getPatternsFromControlRoom = False
+    session.retrieveServerFiles = False
+    session.enforceDeadlines = False
+    session.skipConfirmForReprocess = True
+    session.calcClockSkewIters = 1
+    session.dataDir = os.path.abspath(session.dataDir)
+    session.serverDataDir = outDir
+    session.outputDataDir = outDir
+    session.imgDir = os.path.join(outDir, 'img')
+    session.buildImgPath = False
+    return cfg
+
+
+def findSessionFiles(session, subjectDataDir):
+    '''Set the patterns data and model files to replay for a session found by a glob,
+    the newest for each run in the subject/day directory or its run directories.
+    '''
+    session.findNewestPatterns = True
+    session.validationData = []
+    session.validationModels = []
+    for runId in session.Runs:
+        for field, prefix in (('validationData', 'patternsdata'), ('validationModels', 'trainedModel')):
+            filename = None
+            for pattern in ('{0}_{1}_*.mat', '{0}_{1}.mat', 'run{1}/{0}_{1}_*.mat'):
+                filename = utils.findNewestFile(subjectDataDir, pattern.format(prefix, runId))
+                if filename is not None:
+                    break
+            if filename is None:
+                # a session missing the file fails when the run starts
+                session[field].append('{}_{}.mat'.format(prefix, runId))
+            else:
+                session[field].append(os.path.relpath(filename, subjectDataDir))
+
+
+def preloadSharedFiles(jobs):
+    '''Load the masks and patterns data of the sessions, marked read-only, and
+    parse their patterns design files into the run schedule cache.
+    '''
+    for job in jobs:
+        session = job.cfg.session
+        subjectDataDir = getSubjectDataDir(session.dataDir, session.subjectNum, session.subjectDay)
+        filenames = ['mask_{}_{}.mat'.format(session.subjectNum, session.subjectDay)]
+        filenames += session.validationData
+        for filename in filenames:
+            filename = os.path.abspath(os.path.join(subjectDataDir, filename))
+            if filename in sharedMatFiles:
+                continue
+            try:
+                sharedMatFiles[filename] = setReadOnly(utils.loadMatFile(filename))
+            except Exception as err:
+                logging.warning("Reprocess: %s not preloaded: %r", filename, err)
+        prebuildRunSchedules(session, subjectDataDir)
+
+
+def setReadOnly(value):
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, dict):
+        for val in value.values():
+            setReadOnly(val)
+    return value
+
+
+def initWorker(numThreads):
+    '''Limit the BLAS and OpenMP threads of a worker, the parallelism is across sessions'''
+    global workerThreadLimits
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[var] = str(numThreads)
+    try:
+        # the thread pools of numpy are already loaded
+        from threadpoolctl import threadpool_limits  # type: ignore
+        workerThreadLimits = threadpool_limits(numThreads)
+    except ImportError:
+        logging.warning("Reprocess: threadpoolctl not installed, BLAS threads not limited")
+
+
+def reprocessSession(job):
+    '''Run a session with the model in this process, then its validation stage'''
+    result = StructDict({'label': job.label, 'subjectNum': job.cfg.session.subjectNum,
+                         'subjectDay': job.cfg.session.subjectDay, 'FWHM': job.cfg.session.FWHM,
+                         'cutoff': job.cfg.session.cutoff, 'runs': len(job.cfg.session.Runs),
+                         'status': 'ok', 'sessionTime': None, 'validateTime': None,
+                         'matAUC': None, 'pyAUC': None, 'error': ''})
+    os.makedirs(job.outDir, exist_ok=True)
+    with open(os.path.join(job.outDir, 'reprocess_log.txt'), 'w') as logFile, \
+            contextlib.redirect_stdout(logFile):
+        stage = 'session'
+        try:
+            if job.seed is not None:
+                # the model training solver draws from the global random state
+                np.random.seed(job.seed)
+            stime = time.time()
+            client = RtAttenClient()
+            client.matFileCache = sharedMatFiles
+            client.messaging = LocalMessagingClient()
+            try:
+                client.runSession(None, None, job.cfg)
+            finally:
+                client.ttlPulseClient.close()
+            result.sessionTime = time.time() - stime
+            if job.validate:
+                stage = 'validate'
+                stime = time.time()
+                pyDataDir = getSubjectDataDir(job.outDir, job.cfg.session.subjectNum, job.cfg.session.subjectDay)
+                all_ROC = validate.validateSession(job.cfg, pyDataDir)
+                result.matAUC = float(np.mean(all_ROC[:, 0, :]))
+                result.pyAUC = float(np.mean(all_ROC[:, 1, :]))
+                result.validateTime = time.time() - stime
+        except Exception as err:
+            result.status = '{} failed'.format(stage)
+            result.error = repr(err)
+            print(''.join(traceback.format_exception(type(err), err, err.__traceback__)))
+    return result
+
+
+def logResult(result):
+    logging.warning("Reprocess: %s %s %s", result.label, result.status, result.error)
+
+
+def printSummary(results, filename):
+    columns = ('label', 'subjectNum', 'subjectDay', 'FWHM', 'cutoff', 'runs', 'status',
+               'sessionTime', 'validateTime', 'matAUC', 'pyAUC', 'error')
+
+    def fmt(val):
+        if val is None:
+            return '-'
+        if isinstance(val, float):
+            return '{:.3f}'.format(val)
+        return str(val)
+    rows = [[fmt(result[col]) for col in columns] for result in results]
+    widths = [max([len(col)] + [len(row[i]) for row in rows]) for i, col in enumerate(columns)]
+    print('  '.join(col.rjust(width) for col, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(val.rjust(width) for val, width in zip(row, widths)))
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(columns)
+        writer.writerows(rows)
+    print("Summary saved to {}".format(filename))
+
+
+def parseNumbers(listStr):
+    vals = [float(x) for x in listStr.split(',')]
+    return [int(val) if val.is_integer() else val for val in vals]
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--experiments', '-e', default=[], nargs='+', type=str,
+                           help='experiment files (.json or .toml) of the sessions')
+    argParser.add_argument('--sessions', '-g', default=[], nargs='+', type=str,
+                           help='subject/day directory globs, e.g. "/data/subject*/day1"')
+    argParser.add_argument('--baseConfig', '-c', default='conf/example.toml', type=str,
+                           help='experiment file with the other settings of the --sessions sessions')
+    argParser.add_argument('--fwhm', default=None, type=str, help='comma separated FWHM values to sweep')
+    argParser.add_argument('--cutoff', default=None, type=str, help='comma separated cutoff values to sweep')
+    argParser.add_argument('--jobs', '-j', default=os.cpu_count(), type=int,
+                           help='sessions processed in parallel')
+    argParser.add_argument('--threads', '-t', default=1, type=int, help='BLAS threads of each job')
+    argParser.add_argument('--outDir', '-o', default='data/reprocess', type=str,
+                           help='directory for the outputs, a sub-directory per session')
+    argParser.add_argument('--validate', '-v', default=False, action='store_true',
+                           help='compare the outputs to the matlab outputs with validate.py')
+    argParser.add_argument('--seed', default=None, type=int, help='seed of the model training solver')
+    args = argParser.parse_args()
+    params = StructDict({'experiments': args.experiments, 'sessions': args.sessions,
+                         'baseConfig': args.baseConfig,
+                         'fwhm': None if args.fwhm is None else parseNumbers(args.fwhm),
+                         'cutoff': None if args.cutoff is None else parseNumbers(args.cutoff),
+                         'jobs': args.jobs, 'threads': args.threads, 'outDir': args.outDir,
+                         'validate': args.validate, 'seed': args.seed})
+    ReprocessMain(params)
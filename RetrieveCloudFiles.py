@@ -21,9 +21,10 @@ if __name__ == "__main__":
     client = RtAttenClient()
     client.connect(args.addr, args.port)
     client.initSession(cfg)
-    for runId in args.runs.split(','):
-        print('retrieve files for run {}'.format(runId))
-        client.retrieveRunFiles(runId)
+    # files already retrieved are skipped and interrupted transfers resume
+    runIds = args.runs.split(',')
+    print('retrieve files for runs {}'.format(runIds))
+    client.retrieveSessionFiles(runIds)
 
     client.endSession()
     client.disconnect()
@@ -30,10 +30,19 @@ if __name__ == "__main__":
                            help='experiment file (.json or .toml)')
     argParser.add_argument('--feedbackdir', '-f', default='webInterface/images', type=str,
                            help='Directory with feedback image files')
+    argParser.add_argument('--feedbackCacheMB', '-c', default=None, type=float,
+                           help='Memory budget in MB for decoded feedback images')
+    argParser.add_argument('--userLogInterval', '-i', default=None, type=float,
+                           help='Seconds to batch run output lines sent to the user window')
+    argParser.add_argument('--noClientWorker', default=False, action='store_true',
+                           help='Start a new client process for each run instead of a warm worker')
     args = argParser.parse_args()
     params = StructDict({'rtserver': args.rtserver,
                          'rtlocal': args.rtlocal,
                          'filesremote': args.filesremote,
                          'experiment': args.experiment,
-                         'feedbackdir': args.feedbackdir})
+                         'feedbackdir': args.feedbackdir,
+                         'feedbackCacheMB': args.feedbackCacheMB,
+                         'userLogInterval': args.userLogInterval,
+                         'clientWorker': not args.noClientWorker})
     WebMain(params)
@@ -1,13 +1,45 @@
 """Convert a Matlab patternsDesign file to a config file for rtfMRI"""
 import os
+import struct
+import hashlib
 import logging
+import threading
 import numpy as np  # type: ignore
-from rtfMRI.StructDict import StructDict
+from rtfMRI.StructDict import StructDict, TRView
 from rtfMRI.utils import loadMatFile, findNewestFile
 from rtfMRI.Errors import ValidationError
 
+# per TR fields of the run schedule, one record per volume of the run
+trScheduleDtype = np.dtype([('blkGrpId', np.int32), ('blockId', np.int32), ('trId', np.int32),
+                            ('vol', np.int32), ('attCateg', np.int32), ('stim', np.int32),
+                            ('type', np.int32), ('regressor', np.int32, (2,))])
+# run fields parsed from a patterns design, in run config order
+runScheduleFields = ('disdaqs', 'nBlocksPerPhase', 'TRTime', 'nTRs', 'nTRsFix', 'firstVolPhase1', 'lastVolPhase1',
+                     'nVolsPhase1', 'firstVolPhase2', 'lastVolPhase2', 'nVolsPhase2', 'firstTestTR', 'nVols')
+# header of a saved run schedule: the patterns file size and mtime then the run fields
+runScheduleHeader = struct.Struct('<{}q'.format(2 + len(runScheduleFields)))
+# parsed run schedules are saved here, shared by the user's sessions, reprocessing and validation runs
+runScheduleCacheDir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                                   'rtAttenRunSchedules')
+
 
 def getLocalPatternsFile(session, subjectDataDir, runId):
+    patternsFilename = getLocalPatternsFilename(session, subjectDataDir, runId)
+    # load and parse the pattensDesign file
+    logging.info("Using Local Patterns file: %s", patternsFilename)
+    patterns = loadMatFile(patternsFilename)
+    return patterns, patternsFilename
+
+
+def getLocalRunSchedule(session, subjectDataDir, runId):
+    '''Like getLocalPatternsFile but returns the parsed run schedule, from the schedule cache'''
+    patternsFilename = getLocalPatternsFilename(session, subjectDataDir, runId)
+    logging.info("Using Local Patterns file: %s", patternsFilename)
+    runSchedule = getRunScheduleCache().get(patternsFilename)
+    return runSchedule, patternsFilename
+
+
+def getLocalPatternsFilename(session, subjectDataDir, runId):
     if session.findNewestPatterns:
         # load the newest file patterns
         patternsFilename = findPatternsDesignFile(session, subjectDataDir, runId)
@@ -24,13 +56,29 @@ def getLocalPatternsFile(session, subjectDataDir, runId):
             else:
                 raise ValidationError("Insufficient patternsDesignFiles specified in "
                                       "config file session for run {}".format(runId))
-    # load and parse the pattensDesign file
-    logging.info("Using Local Patterns file: %s", patternsFilename)
-    patterns = loadMatFile(patternsFilename)
-    return patterns, patternsFilename
+    return patternsFilename
+
+
+def prebuildRunSchedules(session, subjectDataDir):
+    '''Parse the patterns design files of the session runs into the schedule cache.
+    Runs whose patterns file isn't there yet are parsed when the run starts.
+    '''
+    for runId in session.Runs:
+        try:
+            patternsFilename = getLocalPatternsFilename(session, subjectDataDir, runId)
+            getRunScheduleCache().get(patternsFilename)
+        except Exception as err:
+            logging.info("prebuildRunSchedules: run %r not prebuilt: %r", runId, err)
 
 
 def createRunConfig(session, patterns, runId, scanNum=-1):
+    return createRunConfigFromSchedule(session, parseRunSchedule(patterns), runId, scanNum)
+
+
+def createRunConfigFromSchedule(session, runSchedule, runId, scanNum=-1):
+    '''Create the run config from a parsed run schedule. The schedule array is
+    shared, the block groups and their TRViews are created for this run.
+    '''
     run = StructDict()
     run.runId = runId
     idx = getRunIndex(session, runId)
@@ -40,7 +88,29 @@ def createRunConfig(session, patterns, runId, scanNum=-1):
         run.scanNum = session.ScanNums[idx]
     else:
         run.scanNum = -1
+    for field in runScheduleFields:
+        run[field] = runSchedule[field]
+    run.schedule = runSchedule.schedule
+
+    blockGroups = []
+
+    blkGrp1 = createBlockGroupConfig(run.schedule[:run.firstVolPhase2])
+    blkGrp1.blkGrpId = 1
+    blkGrp1.nTRs = run.firstVolPhase2
+    blockGroups.append(blkGrp1)
+
+    blkGrp2 = createBlockGroupConfig(run.schedule[run.firstVolPhase2:])
+    blkGrp2.blkGrpId = 2
+    blkGrp2.nTRs = run.nVols - run.firstVolPhase2
+    blockGroups.append(blkGrp2)
 
+    run.blockGroups = blockGroups
+    return run
+
+
+def parseRunSchedule(patterns):
+    '''Parse the run fields and the run schedule from a patterns design'''
+    run = StructDict()
     run.disdaqs = int(patterns.disdaqs)
     run.nBlocksPerPhase = int(patterns.nBlocksPerPhase)
     run.TRTime = int(patterns.TR)
@@ -65,55 +135,153 @@ def createRunConfig(session, patterns, runId, scanNum=-1):
 
     run.nVols = patterns.block.shape[1]
 
-    blockGroups = []
+    run.schedule = createRunSchedule(patterns, run.firstVolPhase2)
+    # shared by the run configs created from it
+    run.schedule.flags.writeable = False
+    return run
 
-    blkGrp1 = createBlockGroupConfig(range(run.firstVolPhase2), patterns)
-    blkGrp1.blkGrpId = 1
-    blkGrp1.nTRs = run.firstVolPhase2
-    blockGroups.append(blkGrp1)
 
-    blkGrp2 = createBlockGroupConfig(range(run.firstVolPhase2, run.nVols), patterns)
-    blkGrp2.blkGrpId = 2
-    blkGrp2.nTRs = run.nVols - run.firstVolPhase2
-    blockGroups.append(blkGrp2)
+class RunScheduleCache():
+    '''Run schedules parsed from patterns design files, keyed by the file path and
+    checked against the file size and mtime. Schedules are kept in memory and saved
+    to cacheDir as a binary file of the file size and mtime and the run fields,
+    followed by the schedule array bytes, so later sessions and reprocessing skip
+    loading the .mat file. Saved schedules are only used from a cacheDir private to
+    the user, that others can't plant or change schedules in.
+    '''
+    def __init__(self, cacheDir=runScheduleCacheDir):
+        self.cacheDir = cacheDir
+        self.schedules = {}  # type: ignore
+        # held while parsing so a run waits for its schedule being prebuilt
+        self.lock = threading.Lock()
+        self.stats = StructDict({'hits': 0, 'diskHits': 0, 'misses': 0})
+
+    def get(self, patternsFilename):
+        patternsFilename = os.path.abspath(patternsFilename)
+        stat = os.stat(patternsFilename)
+        fileKey = (stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            cached = self.schedules.get(patternsFilename)
+            if cached is not None and cached[0] == fileKey:
+                self.stats.hits += 1
+                return cached[1]
+            runSchedule = self.loadSchedule(patternsFilename, fileKey)
+            if runSchedule is not None:
+                self.stats.diskHits += 1
+            else:
+                self.stats.misses += 1
+                runSchedule = parseRunSchedule(loadMatFile(patternsFilename))
+                self.saveSchedule(patternsFilename, fileKey, runSchedule)
+            self.schedules[patternsFilename] = (fileKey, runSchedule)
+            return runSchedule
+
+    def cacheFilename(self, patternsFilename):
+        return os.path.join(self.cacheDir, hashlib.md5(patternsFilename.encode()).hexdigest() + '.bin')
+
+    def loadSchedule(self, patternsFilename, fileKey):
+        cacheFilename = self.cacheFilename(patternsFilename)
+        try:
+            if not isPrivateDir(self.cacheDir):
+                logging.warning("RunScheduleCache: %s is not private to the user, not used", self.cacheDir)
+                return None
+            with open(cacheFilename, 'rb') as fp:
+                data = fp.read()
+            values = runScheduleHeader.unpack_from(data)
+            if tuple(values[:2]) != fileKey:
+                return None
+            runSchedule = StructDict(zip(runScheduleFields, values[2:]))
+            # read only, a view of the file data
+            runSchedule.schedule = np.frombuffer(data, dtype=trScheduleDtype, offset=runScheduleHeader.size)
+            if len(runSchedule.schedule) != runSchedule.nVols:
+                raise ValidationError("schedule of {} TRs, expected {}".format(len(runSchedule.schedule),
+                                                                              runSchedule.nVols))
+        except FileNotFoundError:
+            return None
+        except Exception as err:
+            logging.warning("RunScheduleCache: unable to load %s: %r", cacheFilename, err)
+            return None
+        return runSchedule
+
+    def saveSchedule(self, patternsFilename, fileKey, runSchedule):
+        cacheFilename = self.cacheFilename(patternsFilename)
+        tmpFilename = cacheFilename + '.tmp{}'.format(os.getpid())
+        try:
+            os.makedirs(self.cacheDir, mode=0o700, exist_ok=True)
+            with open(tmpFilename, 'wb') as fp:
+                fp.write(runScheduleHeader.pack(*fileKey, *[runSchedule[field] for field in runScheduleFields]))
+                fp.write(runSchedule.schedule.tobytes())
+            os.replace(tmpFilename, cacheFilename)
+        except Exception as err:
+            # still cached in memory
+            logging.warning("RunScheduleCache: unable to save %s: %r", cacheFilename, err)
+            if os.path.exists(tmpFilename):
+                os.remove(tmpFilename)
+
+
+def isPrivateDir(dirName):
+    '''True if dirName is owned by the user and no one else can write to it'''
+    stat = os.stat(dirName)
+    if hasattr(os, 'getuid') and stat.st_uid != os.getuid():
+        return False
+    return stat.st_mode & 0o022 == 0
 
-    run.blockGroups = blockGroups
-    return run
 
+runScheduleCache = None
+runScheduleCacheLock = threading.Lock()
 
-def createBlockGroupConfig(tr_range, patterns):
+
+def getRunScheduleCache():
+    '''The RunScheduleCache shared in this process'''
+    global runScheduleCache
+    with runScheduleCacheLock:
+        if runScheduleCache is None:
+            runScheduleCache = RunScheduleCache()
+        return runScheduleCache
+
+
+def createRunSchedule(patterns, firstVolPhase2):
+    '''Build the per TR fields of the run from the patterns design in one pass'''
+    nVols = patterns.block.shape[1]
+    vols = np.arange(nVols)
+    schedule = np.zeros(nVols, dtype=trScheduleDtype)
+    schedule['blkGrpId'] = np.where(vols < firstVolPhase2, 1, 2)
+    # TRs between blocks belong to the preceding block
+    blockIds = patterns.block[0, :].astype(np.int32)
+    schedule['blockId'] = blockIds[np.maximum.accumulate(np.where(blockIds > 0, vols, 0))]
+    schedule['trId'] = np.where(vols < firstVolPhase2, vols, vols - firstVolPhase2)
+    schedule['vol'] = vols + 1
+    schedule['attCateg'] = patterns.attCateg[0, :]
+    schedule['stim'] = patterns.stim[0, :]
+    schedule['type'] = patterns.type[0, :]
+    schedule['regressor'] = np.transpose(patterns.regressor[0:2, :])
+    return schedule
+
+
+def createBlockGroupConfig(schedule):
+    '''Create the block group config from its part of the run schedule'''
     blkGrp = StructDict()
     blkGrp.blocks = []
-    blkGrp.type = 0
-    blkGrp.firstVol = tr_range[0]
-    block = StructDict()
-    blockNum = -1
-    for iTR in tr_range:
-        if patterns.block[0, iTR] > 0 and patterns.block[0, iTR] != blockNum:
-            if blockNum >= 0:
-                blkGrp.blocks.append(block)
-            blockNum = int(patterns.block[0, iTR])
-            block = StructDict()
-            block.blockId = blockNum
-            block.TRs = []
-        tr = StructDict()
-        tr.trId = iTR - blkGrp.firstVol
-        tr.vol = iTR + 1
-        tr.attCateg = int(patterns.attCateg[0, iTR])
-        tr.stim = int(patterns.stim[0, iTR])
-        tr.type = int(patterns.type[0, iTR])
-        if tr.type != 0:
-            if blkGrp.type == 0:
-                blkGrp.type = tr.type
-            if blkGrp.type != tr.type:
-                raise ValidationError("createBlockGroupConfig: inconsistent TR types in block group")
-        tr.regressor = [int(patterns.regressor[0, iTR]), int(patterns.regressor[1, iTR])]
-        block.TRs.append(tr)
-    if len(block.TRs) > 0:
+    blkGrp.firstVol = int(schedule['vol'][0]) - 1
+    trTypes = np.unique(schedule['type'][schedule['type'] != 0])
+    if len(trTypes) > 1:
+        raise ValidationError("createBlockGroupConfig: inconsistent TR types in block group")
+    blkGrp.type = int(trTypes[0]) if len(trTypes) > 0 else 0
+    blockStarts = np.flatnonzero(np.diff(schedule['blockId'])) + 1
+    for blockSchedule in np.split(schedule, blockStarts):
+        block = StructDict()
+        block.blockId = int(blockSchedule['blockId'][0])
+        block.TRs = createTRViews(blockSchedule)
         blkGrp.blocks.append(block)
     return blkGrp
 
 
+def createTRViews(schedule):
+    '''A TRView for each record of the schedule, the fields converted to python ints'''
+    return [TRView(*fields) for fields in zip(schedule['trId'].tolist(), schedule['vol'].tolist(),
+                                              schedule['attCateg'].tolist(), schedule['stim'].tolist(),
+                                              schedule['type'].tolist(), schedule['regressor'].tolist())]
+
+
 def getPatternsFileRegex(session, dataDir, runId, addRunDir=False):
     filePattern = 'patternsdesign_' + str(runId) + '*.mat'
     if addRunDir:
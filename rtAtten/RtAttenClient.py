@@ -1,8 +1,11 @@
 '''RtAttenClient - client logic for rtAtten experiment'''
 import os
 import re
+import glob
 import time
+import hashlib
 import datetime
+import threading
 import logging
 import numpy as np  # type: ignore
 from dateutil import parser
@@ -14,13 +17,18 @@ from rtfMRI.MsgTypes import MsgEvent
 from rtfMRI.StructDict import StructDict, copy_toplevel
 from rtfMRI.ReadDicom import readDicomFromFile, applyMask, parseDicomVolume
 from rtfMRI.ttlPulse import TTLPulseClient
-from rtfMRI.utils import dateStr30, DebugLevels, writeFile
+from rtfMRI.utils import dateStr30, DebugLevels
 from rtfMRI.fileWatcher import FileWatcher
 from rtfMRI.Errors import InvocationError, ValidationError, StateError, RequestError, RTError
-from .PatternsDesign2Config import createRunConfig, getRunIndex, getLocalPatternsFile
+from .PatternsDesign2Config import createRunConfig, getRunIndex, getLocalRunSchedule
+from .PatternsDesign2Config import createRunConfigFromSchedule, prebuildRunSchedules
 from .PatternsDesign2Config import getPatternsFileRegex
 from .RtAttenModel import getBlkGrpFilename, getModelFilename, getSubjectDataDir
 
+# RetrieveSession transfers files in chunks of this size with this many requests in flight
+retrieveChunkSize = 4 * 1024**2  # 4 MB
+retrieveInFlight = 4
+
 '''Note: print() command buffers multiple lines before outputting by default.
 To change print() command to unbuffered invoke python with -u option. Or use alias
 import functools; print = functools.partial(print, flush=True)
@@ -39,6 +47,10 @@ class RtAttenClient(RtfMRIClient):
         self.webCommonDir = None
         self.webPatternsDir = None
         self.webUseRemoteFiles = False
+        self.webEdgeMasking = False
+        self.webPushStream = False
+        # read-only .mat files preloaded by path, e.g. shared by reprocessing sessions
+        self.matFileCache = None
 
     def __del__(self):
         # logging.log(DebugLevels.L1, "## Stop Client")
@@ -143,6 +155,11 @@ class RtAttenClient(RtfMRIClient):
             self.webCommonDir = retVals.filename
             self.dirs.dataDir = os.path.normpath(self.webCommonDir + self.dirs.dataDir)
         self.dirs.serverDataDir = getSubjectDataDir(cfg.session.serverDataDir, cfg.session.subjectNum, cfg.session.subjectDay)
+        # the run output files, apart from the session's input files when reprocessing
+        self.dirs.outputDataDir = self.dirs.dataDir
+        if cfg.session.outputDataDir is not None:
+            self.dirs.outputDataDir = getSubjectDataDir(cfg.session.outputDataDir, cfg.session.subjectNum,
+                                                        cfg.session.subjectDay)
         if os.path.abspath(self.dirs.serverDataDir):
             # strip the leading separator to make it a relative path
             self.dirs.serverDataDir = self.dirs.serverDataDir.lstrip(os.sep)
@@ -165,6 +182,8 @@ class RtAttenClient(RtfMRIClient):
         else:
             if not os.path.exists(self.dirs.imgDir):
                 os.makedirs(self.dirs.imgDir)
+            if cfg.session.fileWatcherType not in (None, 'default'):
+                self.fileWatcher = FileWatcher(cfg.session.fileWatcherType)
             if self.fileWatcher is None:
                 raise StateError('initSession: fileWatcher is None')
             self.fileWatcher.initFileNotifier(self.dirs.imgDir,
@@ -186,7 +205,7 @@ class RtAttenClient(RtfMRIClient):
             # read mask locally
             maskFileName = os.path.join(self.dirs.dataDir, maskFileName)
             logging.info("Getting Local Mask file: %s", maskFileName)
-            maskData = utils.loadMatFile(maskFileName)
+            maskData = self.loadMatFile(maskFileName)
             print("Using mask {}".format(maskFileName))
         roi = maskData.mask
         if type(roi) != np.ndarray:
@@ -195,6 +214,23 @@ class RtAttenClient(RtfMRIClient):
         cfg.session.roiInds = utils.find(roi)
         cfg.session.roiDims = roi.shape
         cfg.session.nVoxels = cfg.session.roiInds.size
+        self.webEdgeMasking = False
+        if self.webUseRemoteFiles and cfg.session.edgeMasking:
+            # send the mask to the remote fileWatcher so it only returns roi voxels
+            initWatchCmd = wcutils.initWatchReqStruct(self.dirs.imgDir,
+                                                      cfg.session.watchFilePattern,
+                                                      cfg.session.minExpectedDicomSize,
+                                                      cfg.session.demoStep,
+                                                      roiInds=cfg.session.roiInds,
+                                                      sliceDim=cfg.session.sliceDim)
+            wcutils.clientWebpipeCmd(self.webpipes, initWatchCmd)
+            self.webEdgeMasking = True
+        if not (self.webUseRemoteFiles and cfg.session.getPatternsFromControlRoom):
+            # parse the run schedules while the clock sync runs, so each run starts without loading them
+            prebuildThread = threading.Thread(name='prebuildRunSchedules', target=prebuildRunSchedules,
+                                              args=(cfg.session, self.dirs.dataDir))
+            prebuildThread.setDaemon(True)
+            prebuildThread.start()
         super().initSession(cfg)
 
     def doRuns(self):
@@ -204,7 +240,7 @@ class RtAttenClient(RtfMRIClient):
 
     def runRun(self, runId, scanNum=-1):
         # Setup output directory and output file
-        runDataDir = os.path.join(self.dirs.dataDir, 'run' + str(runId))
+        runDataDir = os.path.join(self.dirs.outputDataDir, 'run' + str(runId))
         if not os.path.exists(runDataDir):
             os.makedirs(runDataDir)
         outputInfo = StructDict()
@@ -222,7 +258,6 @@ class RtAttenClient(RtfMRIClient):
             outputInfo.remoteClassOutputDir = os.path.join(remoteRunDataDir, 'classoutput')
             outputInfo.remoteLogFilename = os.path.join(remoteRunDataDir, 'fileprocessing_py.txt')
         # Get patterns design file for this run
-        patterns = None
         if self.webUseRemoteFiles and self.cfg.session.getPatternsFromControlRoom:
             fileRegex = getPatternsFileRegex(self.cfg.session, self.dirs.remoteDataDir, runId, addRunDir=True)
             getNewestFileCmd = wcutils.getNewestFileReqStruct(fileRegex)
@@ -232,10 +267,12 @@ class RtAttenClient(RtfMRIClient):
             patterns = retVals.data
             logging.info("Using Remote Patterns file: %s", retVals.filename)
             print("Using remote patterns {}".format(retVals.filename))
+            run = createRunConfig(self.cfg.session, patterns, runId, scanNum)
         else:
-            patterns, filename = getLocalPatternsFile(self.cfg.session, self.dirs.dataDir, runId)
+            # parsed by the prebuild at initSession, or from the schedule cache of an earlier session
+            runSchedule, filename = getLocalRunSchedule(self.cfg.session, self.dirs.dataDir, runId)
             print("Using patterns {}".format(filename))
-        run = createRunConfig(self.cfg.session, patterns, runId, scanNum)
+            run = createRunConfigFromSchedule(self.cfg.session, runSchedule, runId, scanNum)
         validateRunCfg(run)
         self.id_fields.runId = run.runId
         logging.log(DebugLevels.L4, "Run: %d, scanNum %d", runId, run.scanNum)
@@ -278,9 +315,68 @@ class RtAttenClient(RtfMRIClient):
 
         if self.cfg.session.replayMatFileMode and not self.cfg.session.rtData:
             # load previous patterns data for this run
-            p = utils.loadMatFile(run.validationDataFile)
+            p = self.loadMatFile(run.validationDataFile)
             run.replay_data = p.patterns.raw
+        batchReplay = (self.cfg.session.batchReplay is True and self.cfg.session.replayMatFileMode and
+                       not self.cfg.session.rtData)
 
+        self.webPushStream = False
+        if self.cfg.session.rtData and self.webUseRemoteFiles and self.cfg.session.pushVolumes:
+            # have the fileWatcher push each volume of the run as soon as it arrives
+            filenames = [self.getDicomFileName(run.scanNum, vol + run.disdaqs // run.TRTime)
+                         for vol in run.schedule['vol'].tolist()]
+            subscribeCmd = wcutils.subscribeReqStruct(filenames, masked=self.webEdgeMasking)
+            try:
+                retVals = wcutils.clientWebpipeCmd(self.webpipes, subscribeCmd)
+                self.webPushStream = (retVals.statusCode == 200)
+            except RequestError as err:
+                # an older fileWatcher doesn't handle subscribe, watch for each file instead
+                logging.warning("runRun: subscribe failed, using watchFile: %r", err)
+
+        try:
+            self.runBlockGroups(run, outputInfo, batchReplay)
+        finally:
+            if self.webPushStream:
+                # stop the pushes of this run's files, also when the run is aborted
+                self.webPushStream = False
+                try:
+                    wcutils.clientWebpipeCmd(self.webpipes, wcutils.unsubscribeReqStruct())
+                except RTError as err:
+                    logging.warning("runRun: unsubscribe failed: %r", err)
+        # End Run
+        if self.webpipes is not None:
+            # send instructions to subject window display
+            cmd = {'cmd': 'subjectDisplay', 'text': 'Waiting for next run to start...'}
+            wcutils.clientWebpipeCmd(self.webpipes, cmd)
+        # Train the model for this Run
+        trainCfg = StructDict()
+        if run.runId == 1:
+            trainCfg.blkGrpRefs = [{'run': 1, 'phase': 1}, {'run': 1, 'phase': 2}]
+        elif run.runId == 2:
+            trainCfg.blkGrpRefs = [{'run': 1, 'phase': 2}, {'run': 2, 'phase': 1}]
+        else:
+            trainCfg.blkGrpRefs = [{'run': run.runId-1, 'phase': 1}, {'run': run.runId, 'phase': 1}]
+        outlns = []
+        outlns.append('*********************************************')
+        outlns.append("Train Model {} {}".format(trainCfg.blkGrpRefs[0], trainCfg.blkGrpRefs[1]))
+        outputReplyLines(outlns, outputInfo)
+        processingStartTime = time.time()
+        reply = self.sendCmdExpectSuccess(MsgEvent.TrainModel, trainCfg)
+        processingEndTime = time.time()
+        # log the model generation time
+        logStr = "Model:{} training time {:.3f}s\n".format(runId, processingEndTime - processingStartTime)
+        logging.log(DebugLevels.L3, logStr)
+        outputReplyLines(reply.fields.outputlns, outputInfo)
+        reply = self.sendCmdExpectSuccess(MsgEvent.EndRun, runCfg)
+        outputReplyLines(reply.fields.outputlns, outputInfo)
+        if self.cfg.session.retrieveServerFiles:
+            self.retrieveRunFiles(runId)
+        del self.id_fields.runId
+        outputInfo.logFileHandle.close()
+
+    def runBlockGroups(self, run, outputInfo, batchReplay):
+        '''Run the block groups of a run, sending each TR's data as it arrives'''
+        runId = run.runId
         # Begin BlockGroups (phases)
         for blockGroup in run.blockGroups:
             self.id_fields.blkGrpId = blockGroup.blkGrpId
@@ -294,7 +390,12 @@ class RtAttenClient(RtfMRIClient):
                 logging.log(DebugLevels.L4, "Blk: %d", block.blockId)
                 reply = self.sendCmdExpectSuccess(MsgEvent.StartBlock, blockCfg)
                 outputReplyLines(reply.fields.outputlns, outputInfo)
-                for TR in block.TRs:
+                blockTRs = block.TRs
+                if batchReplay:
+                    # fast forward, the block's TRs are sent in one message
+                    self.replayBlock(run, block, outputInfo)
+                    blockTRs = []
+                for TR in blockTRs:
                     self.id_fields.trId = TR.trId
                     fileNum = TR.vol + run.disdaqs // run.TRTime
                     logging.log(DebugLevels.L3, "TR: %d, fileNum %d", TR.trId, fileNum)
@@ -309,7 +410,11 @@ class RtAttenClient(RtfMRIClient):
                             TR.data = np.full((self.cfg.session.nVoxels), np.nan)
                             reply = self.sendCmdExpectSuccess(MsgEvent.TRData, TR)
                             continue
-                        TR.data = applyMask(trVolumeData, self.cfg.session.roiInds)
+                        if trVolumeData.ndim == 1:
+                            # already masked by the remote fileWatcher
+                            TR.data = trVolumeData
+                        else:
+                            TR.data = applyMask(trVolumeData, self.cfg.session.roiInds)
                     else:
                         # TR.vol is 1's based to match matlab, so we want vol-1 for zero based indexing
                         TR.data = run.replay_data[TR.vol-1]
@@ -379,47 +484,119 @@ class RtAttenClient(RtfMRIClient):
             outputReplyLines(reply.fields.outputlns, outputInfo)
             # self.retrieveBlkGrp(self.id_fields.sessionId, self.id_fields.runId, self.id_fields.blkGrpId)
         del self.id_fields.blkGrpId
-        # End Run
-        if self.webpipes is not None:
-            # send instructions to subject window display
-            cmd = {'cmd': 'subjectDisplay', 'text': 'Waiting for next run to start...'}
-            wcutils.clientWebpipeCmd(self.webpipes, cmd)
-        # Train the model for this Run
-        trainCfg = StructDict()
-        if run.runId == 1:
-            trainCfg.blkGrpRefs = [{'run': 1, 'phase': 1}, {'run': 1, 'phase': 2}]
-        elif run.runId == 2:
-            trainCfg.blkGrpRefs = [{'run': 1, 'phase': 2}, {'run': 2, 'phase': 1}]
-        else:
-            trainCfg.blkGrpRefs = [{'run': run.runId-1, 'phase': 1}, {'run': run.runId, 'phase': 1}]
-        outlns = []
-        outlns.append('*********************************************')
-        outlns.append("Train Model {} {}".format(trainCfg.blkGrpRefs[0], trainCfg.blkGrpRefs[1]))
-        outputReplyLines(outlns, outputInfo)
+
+    def replayBlock(self, run, block, outputInfo):
+        """Send the replay data of all the TRs of a block in one BatchTRData message"""
+        batch = StructDict()
+        batch.TRs = block.TRs
+        # TR.vol is 1's based to match matlab, so we want vol-1 for zero based indexing
+        batch.data = run.replay_data[[TR.vol - 1 for TR in block.TRs]]
+        self.id_fields.trId = block.TRs[-1].trId
         processingStartTime = time.time()
-        reply = self.sendCmdExpectSuccess(MsgEvent.TrainModel, trainCfg)
-        processingEndTime = time.time()
-        # log the model generation time
-        logStr = "Model:{} training time {:.3f}s\n".format(runId, processingEndTime - processingStartTime)
-        logging.log(DebugLevels.L3, logStr)
-        outputReplyLines(reply.fields.outputlns, outputInfo)
-        reply = self.sendCmdExpectSuccess(MsgEvent.EndRun, runCfg)
+        reply = self.sendCmdExpectSuccess(MsgEvent.BatchTRData, batch)
+        serverProcessTime = time.time() - processingStartTime
+        for predict in reply.fields.predicts:
+            outputPredictionFile(predict, outputInfo)
+        logging.log(DebugLevels.L3, "TRs:%d:%d:%03d-%03d, batch of %d, server_process_time %.3fs",
+                    run.runId, block.blockId, block.TRs[0].trId, block.TRs[-1].trId, len(block.TRs),
+                    serverProcessTime)
         outputReplyLines(reply.fields.outputlns, outputInfo)
-        if self.cfg.session.retrieveServerFiles:
-            self.retrieveRunFiles(runId)
-        del self.id_fields.runId
-        outputInfo.logFileHandle.close()
 
     def retrieveRunFiles(self, runId):
+        self.retrieveSessionFiles([runId])
+
+    def retrieveSessionFiles(self, runIds):
+        """Retrieve the block group and model files of the runs in one pass. The server
+        sends a manifest with the size and md5 of each file and only files that are
+        missing or changed locally are transferred, in chunks with several requests in
+        flight. Chunks are written to a partial file, so an interrupted transfer resumes.
+        """
         if self.messaging.addr == 'localhost':
             print("Skipping file retrieval from localhost")
             return
-        blkGrp1_filename = getBlkGrpFilename(self.id_fields.sessionId, runId, 1)
-        self.retrieveFile(blkGrp1_filename)
-        blkGrp2_filename = getBlkGrpFilename(self.id_fields.sessionId, runId, 2)
-        self.retrieveFile(blkGrp2_filename)
-        model_filename = getModelFilename(self.id_fields.sessionId, runId)
-        self.retrieveFile(model_filename)
+        sessionId = self.id_fields.sessionId
+        filePatterns = []
+        for runId in runIds:
+            filePatterns.append(getBlkGrpFilename(sessionId, runId, 1))
+            filePatterns.append(getBlkGrpFilename(sessionId, runId, 2))
+            filePatterns.append(getModelFilename(sessionId, runId))
+        request = self.retrieveSessionRequest('manifest')
+        request.findNewest = self.cfg.session.useSessionTimestamp is True
+        if request.findNewest:
+            filePatterns = [re.sub(r'T\d{6}', 'T*', pattern) for pattern in filePatterns]
+        request.filePatterns = filePatterns
+        stime = time.time()
+        reply = self.sendCmdExpectSuccess(MsgEvent.RetrieveSession, request)
+        manifest = reply.fields.manifest
+        fetchFiles = [entry for entry in manifest if not self.isFileRetrieved(entry)]
+        chunks = []
+        for entry in fetchFiles:
+            partFile = self.partFilename(entry)
+            for filename in glob.glob(os.path.join(self.dirs.dataDir, entry['filename'] + '.*.part')):
+                if filename != partFile:
+                    # partial transfer of an older version of the file
+                    os.remove(filename)
+            offset = os.path.getsize(partFile) if os.path.exists(partFile) else 0
+            if offset == 0:
+                open(partFile, 'wb').close()
+            for chunkOffset in range(offset, entry['size'], retrieveChunkSize):
+                chunk = self.retrieveSessionRequest('chunk')
+                chunk.filename = entry['filename']
+                chunk.offset = chunkOffset
+                chunk.size = min(retrieveChunkSize, entry['size'] - chunkOffset)
+                chunks.append(chunk)
+        print("Retrieving {} of {} files, {} chunks... ".format(len(fetchFiles), len(manifest), len(chunks)), end='')
+        entries = {entry['filename']: entry for entry in manifest}
+        fh = None
+        try:
+            for chunk, reply in self.sendCmdsPipelined(MsgEvent.RetrieveSession, chunks, retrieveInFlight):
+                # chunks arrive in order, each file's chunks one after the other
+                partFile = self.partFilename(entries[chunk.filename])
+                if fh is None or fh.name != partFile:
+                    if fh is not None:
+                        fh.close()
+                    fh = open(partFile, 'ab')
+                if fh.tell() != chunk.offset or len(reply.data) != chunk.size:
+                    raise StateError("retrieveSessionFiles: chunk mismatch {} offset {} size {}".format(
+                                     chunk.filename, chunk.offset, len(reply.data)))
+                fh.write(reply.data)
+        finally:
+            if fh is not None:
+                fh.close()
+        for entry in fetchFiles:
+            self.completeRetrievedFile(entry)
+        print("took {:.2f} secs".format(time.time() - stime))
+
+    def retrieveSessionRequest(self, op):
+        request = StructDict()
+        request.subjectNum = self.id_fields.subjectNum
+        request.subjectDay = self.id_fields.subjectDay
+        request.op = op
+        return request
+
+    def partFilename(self, entry):
+        return os.path.join(self.dirs.dataDir, '{}.{}.part'.format(entry['filename'], entry['md5']))
+
+    def isFileRetrieved(self, entry):
+        clientFile = os.path.join(self.dirs.dataDir, entry['filename'])
+        if not os.path.exists(clientFile) or os.path.getsize(clientFile) != entry['size']:
+            return False
+        return utils.fileMd5(clientFile) == entry['md5']
+
+    def completeRetrievedFile(self, entry):
+        """Check the partial file against the manifest and move it into place"""
+        partFile = self.partFilename(entry)
+        if utils.fileMd5(partFile) != entry['md5']:
+            os.remove(partFile)
+            raise ValidationError("retrieveSessionFiles: md5 mismatch for {}".format(entry['filename']))
+        clientFile = os.path.join(self.dirs.dataDir, entry['filename'])
+        os.replace(partFile, clientFile)
+        serverFile = os.path.join(self.dirs.serverDataDir, entry['filename'])
+        if not os.path.exists(serverFile):
+            try:
+                os.symlink(clientFile, serverFile)
+            except OSError:
+                logging.error("Unable to link file %s", serverFile)
 
     def retrieveFile(self, filename):
         fileInfo = StructDict()
@@ -432,11 +609,32 @@ class RtAttenClient(RtfMRIClient):
         else:
             print("Retrieving file {}... ".format(filename), end='')
         stime = time.time()
-        reply = self.sendCmdExpectSuccess(MsgEvent.RetrieveData, fileInfo)
-        retFilename = reply.fields.filename
+        replies = self.sendCmdStreamed(MsgEvent.RetrieveData, fileInfo)
+        try:
+            reply = next(replies)
+            retFilename = reply.fields.filename
+            clientFile = os.path.join(self.dirs.dataDir, retFilename)
+            # write the chunks to disk as they arrive and check them against the trailer
+            partFile = clientFile + '.part'
+            md5 = hashlib.md5()
+            try:
+                with open(partFile, 'wb') as fh:
+                    for chunk in replies:
+                        if chunk.fields.trailer is True:
+                            trailer = chunk
+                            break
+                        fh.write(chunk.data)
+                        md5.update(chunk.data)
+                if trailer.fields.size != reply.fields.size or trailer.fields.md5 != md5.hexdigest():
+                    raise ValidationError("retrieveFile: {} size or md5 mismatch".format(retFilename))
+            except Exception:
+                if os.path.exists(partFile):
+                    os.remove(partFile)
+                raise
+        finally:
+            replies.close()
+        os.replace(partFile, clientFile)
         print("took {:.2f} secs".format(time.time() - stime))
-        clientFile = os.path.join(self.dirs.dataDir, retFilename)
-        writeFile(clientFile, reply.data)
         serverFile = os.path.join(self.dirs.serverDataDir, retFilename)
         if not os.path.exists(serverFile):
             try:
@@ -453,12 +651,21 @@ class RtAttenClient(RtfMRIClient):
         if self.webUseRemoteFiles:
             statusCode = 408  # loop while filewatch timeout 408 occurs
             while statusCode == 408:
-                watchCmd = wcutils.watchFileReqStruct(specificFileName)
+                if self.webPushStream:
+                    watchCmd = wcutils.getPushedFileReqStruct(specificFileName, masked=self.webEdgeMasking)
+                else:
+                    watchCmd = wcutils.watchFileReqStruct(specificFileName, masked=self.webEdgeMasking)
                 retVals = wcutils.clientWebpipeCmd(self.webpipes, watchCmd)
                 statusCode = retVals.statusCode
                 data = retVals.data
+            if statusCode == 404:
+                # file missing from the push stream, a later file already arrived
+                return None
             if statusCode != 200:
                 raise StateError('getNextTRData: statusCode not 200: {}'.format(statusCode))
+            if isinstance(data, np.ndarray) and data.ndim == 1:
+                # roi voxels masked by the fileWatcher, pixel values are exact in float32
+                return data.astype(np.float64)
         else:
             self.fileWatcher.waitForFile(specificFileName)
             # Load the file, retry if necessary taking up to 500ms
@@ -496,6 +703,13 @@ class RtAttenClient(RtfMRIClient):
             _ = data.pixel_array
         return data
 
+    def loadMatFile(self, filename):
+        if self.matFileCache is not None:
+            data = self.matFileCache.get(os.path.abspath(filename))
+            if data is not None:
+                return data
+        return utils.loadMatFile(filename)
+
     def getDicomFileName(self, scanNum, fileNum):
         if scanNum < 0:
             raise ValidationError("ScanNumber not supplied of invalid {}".format(scanNum))
@@ -0,0 +1,935 @@
+"""
+RtAttenEngine: The real-time attention fMRI pipeline, independent of the backend
+the requests arrive by.
+
+The engine keeps the session, run and block group state and runs the pipeline
+stages of each TR: ingest, smooth, highpass, z-score, predict, and at the end
+of a run, train and persist. Each request takes its inputs as arguments and
+returns its outputs, the output lines of the request, and raises an RTError
+when it fails. The models are thin adapters of the engine to a backend,
+RtAttenModel to the TCP server messages (also handled in process by
+LocalMessagingClient) and RtAttenModel_Ray to a Ray actor.
+The smoothing, between runs highpass and model training are run by an executor,
+LocalExecutor runs them in this process, an executor with asyncTasks set runs
+them as tasks whose results are collected when needed. Each stage is timed and
+the stage times are reported at the end of each run, the same for all backends.
+"""
+import os
+import re
+import time
+import glob
+import datetime
+import logging
+import contextlib
+import numpy as np  # type: ignore
+from enum import Enum, unique
+import scipy.io as sio  # type: ignore
+from rtfMRI import utils
+from rtfMRI import ValidationUtils as vutils
+from rtfMRI.StructDict import StructDict, MatlabStructDict
+from rtfMRI.spillCache import SpillCache
+from rtfMRI.Errors import StateError, ValidationError, RequestError
+from .smooth import smooth, smoothVolumes
+from .highpassFunc import highPassRealTime, highPassBetweenRuns
+from .Test_L2_RLR_realtime import Test_L2_RLR_realtime
+
+# the pipeline stages timed by the engine
+pipelineStages = ('ingest', 'smooth', 'highpass', 'zscore', 'predict', 'train', 'persist')
+
+
+class RtAttenEngine():
+    def __init__(self, id_fields, executor=None):
+        # the ids of the model's state, set by the model before each request
+        self.id_fields = id_fields
+        self.executor = executor if executor is not None else LocalExecutor()
+        self.timers = StageTimers()
+        self.dirs = StructDict()
+        self.blkGrpCache = SpillCache(cacheMaxMB * 2**20, 'blkGrpCache')
+        self.modelCache = SpillCache(cacheMaxMB * 2**20, 'modelCache')
+        self.session = None
+        self.run = None
+        self.runPatterns = None
+        self.blkGrp = None
+        # executor handle of the roi indices, read by the smoothing
+        self.roiIndsRef = None
+        # deferred smoothing of the block group's training TRs by trId
+        self.smoothRefs = {}  # type: ignore
+        # model trainings not yet collected and the output of collected ones by runId
+        self.pendingModels = {}  # type: ignore
+        self.trainResults = {}  # type: ignore
+
+    def startSession(self, sessionCfg):
+        """Initializes a session comprising multiple runs.
+        Sets up data directories and clears caches
+        """
+        self.session = sessionCfg
+        self.dirs.dataDir = getSubjectDataDir(self.session.serverDataDir, self.session.subjectNum,
+                                              self.session.subjectDay)
+        if not os.path.exists(self.dirs.dataDir):
+            os.makedirs(self.dirs.dataDir)
+        # clear cached items
+        maxBytes = cacheMaxMB * 2**20
+        if self.session.cacheMaxMB is not None:
+            maxBytes = self.session.cacheMaxMB * 2**20
+        self.blkGrpCache.clear()
+        self.modelCache.clear()
+        self.blkGrpCache = SpillCache(maxBytes, 'blkGrpCache')
+        self.modelCache = SpillCache(maxBytes, 'modelCache')
+        self.roiIndsRef = self.executor.put(self.session.roiInds)
+        self.smoothRefs = {}
+        self.pendingModels = {}
+        self.trainResults = {}
+        return []
+
+    def endSession(self):
+        # save the models still training
+        self.collectTrainedModels()
+        self.trainResults = {}
+        self.roiIndsRef = None
+        # drop cached items
+        self.blkGrpCache.clear()
+        self.modelCache.clear()
+        self.runPatterns = None
+        return []
+
+    def startRun(self, run):
+        """Initializes a run
+        Updates caches, inits filecounter, returns header output.
+        """
+        if run.runId != self.id_fields.runId:
+            raise ValidationError("RunId mismatch: msg runId %r != session RunId %r" %
+                                  (run.runId, self.id_fields.runId))
+        logging.info("Using ScanNum: %d", run.scanNum)
+        if run.runId > 1:
+            if len(self.blkGrpCache) > 1:
+                # remove any cache items older than the previous run
+                self.trimCache(run.runId - 1)
+        # the patterns of the previous run are reused for this run
+        self.releaseRunPatterns()
+        run.fileCounter = 0
+        self.timers.reset()
+
+        # Output header
+        outputlns = []
+        now = datetime.datetime.now()
+        outputlns.append('*********************************************')
+        outputlns.append('* rtAttenPenn v.1.0')
+        outputlns.append('* Date/Time: ' + now.isoformat())
+        outputlns.append('* Seed: ' + str(self.session.seed))
+        outputlns.append('* Subject Number: ' + str(self.session.subjectNum))
+        outputlns.append('* Subject Name: ' + str(self.session.subjectName))
+        outputlns.append('* Run Number: ' + str(run.runId))
+        outputlns.append('* Scan Number: ' + str(run.scanNum))
+        outputlns.append('* Real-Time Data: ' + str(self.session.rtData))
+        outputlns.append('*********************************************\n')
+
+        # ** Start Run ** #
+        # prepare for TR sequence
+        outputlns.append('run\tblock\tTR\tbltyp\tblcat\tstim\tfilenum\tloaded\toutput\tavg')
+
+        self.run = run
+        return outputlns
+
+    def endRun(self):
+        runId = self.id_fields.runId
+        self.trimCache(runId)
+        self.blkGrpCache.logStats()
+        self.modelCache.logStats()
+        stageTimes = self.timers.outputLine()
+        logging.info("Run %s %s", runId, stageTimes)
+        return ["End Run {}".format(runId), stageTimes]
+
+    def startBlockGroup(self, blkGrp):
+        """Initialize a block group. A run is comprised of 2 block groups (called phases in Matlab version).
+        Block groups can be of type 1=(Training) or 2=(RealTime Predictions)
+        Initialize the patterns data structure for the block group.
+        If it is a prediction group (type 2) then load the trained model from the
+        previous run and load the patterns data from the previous block group.
+        """
+        run = self.run
+        if blkGrp.nTRs is None:
+            raise ValidationError("StartBlkGrp msg missing nTRs in blockGroup")
+        if self.session.nVoxels is None:
+            raise ValidationError("StartBlkGrp msg missing nVoxels in blockGroup")
+        if self.session.roiInds is None:
+            raise ValidationError("StartBlkGrp msg missing roiInds in blockGroup")
+        if blkGrp.blkGrpId not in (1, 2):
+            raise ValidationError("StartBlkGrp: BlkGrpId {} not valid".format(blkGrp.blkGrpId))
+        outputlns = []
+        blkGrp.legacyRun1Phase2Mode = False
+        if run.runId == 1 and blkGrp.blkGrpId == 2:
+            # Legacy matlab mode is where run1 phase2 is treated as a predict phase
+            # By default use legacy mode for run1 phase2
+            blkGrp.legacyRun1Phase2Mode = True
+            if self.session.legacyRun1Phase2Mode is False:
+                blkGrp.legacyRun1Phase2Mode = False
+            outputlns.append('Legacy mode: {}'.format(blkGrp.legacyRun1Phase2Mode))
+        # the per volume patterns are views of this block group's rows in the run patterns
+        runPatterns = self.getRunPatterns(blkGrp.firstVol, blkGrp.nTRs)
+        i1, i2 = blkGrp.firstVol, blkGrp.firstVol + blkGrp.nTRs
+        blkGrp.patterns = StructDict()
+        blkGrp.patterns.raw = runPatterns.raw[i1:i2]
+        blkGrp.patterns.raw_sm = runPatterns.raw_sm[i1:i2]
+        blkGrp.patterns.raw_sm_filt = runPatterns.raw_sm_filt[i1:i2]
+        blkGrp.patterns.raw_sm_filt_z = runPatterns.raw_sm_filt_z[i1:i2]
+        blkGrp.patterns.phase1Mean = np.full((1, self.session.nVoxels), np.nan)
+        blkGrp.patterns.phase1Y = np.full((1, self.session.nVoxels), np.nan)
+        blkGrp.patterns.phase1Std = np.full((1, self.session.nVoxels), np.nan)
+        blkGrp.patterns.phase1Var = np.full((1, self.session.nVoxels), np.nan)
+        blkGrp.patterns.categoryseparation = runPatterns.categoryseparation[:, i1:i2]  # (matlab: NaN(1,nTRs))
+        blkGrp.patterns.predict = np.full((1, blkGrp.nTRs), np.nan)
+        blkGrp.patterns.activations = np.full((2, blkGrp.nTRs), np.nan)
+        blkGrp.patterns.attCateg = np.full((1, blkGrp.nTRs), np.nan)
+        blkGrp.patterns.stim = np.full((1, blkGrp.nTRs), np.nan)
+        blkGrp.patterns.type = np.full((1, blkGrp.nTRs), np.nan)
+        blkGrp.patterns.regressor = np.full((2, blkGrp.nTRs), np.nan)
+        # blkGrp.patterns.fileAvail = np.zeros((1, blkGrp.nTRs), dtype=np.uint8)
+        blkGrp.patterns.fileload = np.full((1, blkGrp.nTRs), np.nan, dtype=np.uint8)
+        blkGrp.patterns.fileNum = np.full((1, blkGrp.nTRs), np.nan, dtype=np.uint16)
+        blkGrp.FWHM = self.session.FWHM
+        blkGrp.cutoff = self.session.cutoff
+        blkGrp.gitCodeId = utils.getGitCodeId()
+        self.blkGrp = blkGrp
+        self.smoothRefs = {}
+        if self.blkGrp.type == 2 or blkGrp.legacyRun1Phase2Mode:
+            # ** Realtime Feedback Phase ** #
+            try:
+                # get blkGrp from phase 1
+                prev_bg = self.getPrevBlkGrp(self.id_fields.sessionId, self.id_fields.runId, 1)
+            except Exception as err:
+                raise StateError("Error: getPrevBlkGrp(%r, %r, 1): %r" %
+                                 (self.id_fields.sessionId, self.id_fields.runId, err))
+            self.blkGrp.patterns.phase1Mean[0, :] = prev_bg.patterns.phase1Mean[0, :]
+            self.blkGrp.patterns.phase1Y[0, :] = prev_bg.patterns.phase1Y[0, :]
+            self.blkGrp.patterns.phase1Std[0, :] = prev_bg.patterns.phase1Std[0, :]
+            self.blkGrp.patterns.phase1Var[0, :] = prev_bg.patterns.phase1Var[0, :]
+            prevNTRs = prev_bg.patterns.raw_sm.shape[0]
+            if not np.may_share_memory(prev_bg.patterns.raw_sm, runPatterns.raw_sm):
+                # phase 1 was loaded from file or ran with different run patterns
+                runPatterns.raw_sm[0:prevNTRs] = prev_bg.patterns.raw_sm
+                runPatterns.categoryseparation[:, 0:prevNTRs] = prev_bg.patterns.categoryseparation
+            # the phase 1 rows followed by this phase's rows, without a copy
+            self.blkGrp.combined_raw_sm = runPatterns.raw_sm[0:i2]
+            self.blkGrp.combined_catsep = runPatterns.categoryseparation[:, 0:i2]
+
+            if self.id_fields.runId > 1:
+                try:
+                    # get trained model
+                    self.blkGrp.trainedModel = self.getTrainedModel(self.id_fields.sessionId, self.id_fields.runId-1)
+                except Exception as err:
+                    raise StateError("Error: getTrainedModel(%r, %r): %r" %
+                                     (self.id_fields.sessionId, self.id_fields.runId-1, err))
+            outputlns.append('*********************************************')
+            outputlns.append('beginning model testing...')
+            # prepare for TR sequence
+            outputlns.append('run\tblock\tTR\tbltyp\tblcat\tstim\tfilenum\tloaded\tpredict\toutput\tavg')
+        return outputlns
+
+    def endBlockGroup(self):
+        """Finalize block group
+        Complete calculations for the patterns data, do validation or results
+        compared to a previous known run if requested, save the block group
+        patterns data to a file.
+        """
+        patterns = self.blkGrp.patterns
+        i1, i2 = 0, self.blkGrp.nTRs
+        outputlns = []  # type: ignore
+        # set validation indices
+        validation_i1 = self.blkGrp.firstVol
+        validation_i2 = validation_i1 + self.blkGrp.nTRs
+
+        outputlns.append("End Block Group {}".format(self.id_fields.blkGrpId))
+        if self.blkGrp.type == 2 or self.blkGrp.legacyRun1Phase2Mode:  # RT predict
+            runStd = np.nanstd(patterns.raw_sm_filt, axis=0)
+            patterns.runStd = runStd.reshape(1, -1)
+            # Do Validation
+            if self.session.validate:
+                try:
+                    self.validateTestBlkGrp(validation_i1, validation_i2, outputlns)
+                except Exception as err:
+                    # Just log that an error happened during validation
+                    logging.error("validateTestBlkGrp: %r", err)
+                    pass
+
+        elif self.blkGrp.type == 1:  # training
+            outputlns.append('*********************************************')
+            outputlns.append('beginning highpassfilter/zscore...')
+
+            self.collectSmoothedTRs()
+            with self.timers.time('highpass'):
+                patterns.raw_sm_filt[i1:i2, :] = self.executor.highPassBetweenRuns(
+                    patterns.raw_sm[i1:i2, :], self.run.TRTime, self.session.cutoff)
+
+            with self.timers.time('zscore'):
+                patterns.phase1Mean[0, :] = np.mean(patterns.raw_sm_filt[i1:i2, :], axis=0)
+                patterns.phase1Y[0, :] = np.mean(patterns.raw_sm_filt[i1:i2, :]**2, axis=0)
+                patterns.phase1Std[0, :] = np.std(patterns.raw_sm_filt[i1:i2, :], axis=0)
+                patterns.phase1Var[0, :] = patterns.phase1Std[0, :] ** 2
+
+                tileSize = [patterns.raw_sm_filt[i1:i2, :].shape[0], 1]
+                patterns.raw_sm_filt_z[i1:i2, :] = np.divide(
+                    (patterns.raw_sm_filt[i1:i2, :] - np.tile(patterns.phase1Mean, tileSize)),
+                    np.tile(patterns.phase1Std, tileSize))
+                # std dev across all volumes per voxel
+                runStd = np.nanstd(patterns.raw_sm_filt, axis=0)
+                patterns.runStd = runStd.reshape(1, -1)
+            # Do Validation
+            if self.session.validate:
+                try:
+                    self.validateTrainBlkGrp(validation_i1, validation_i2, outputlns)
+                except Exception as err:
+                    # Just log that an error happened during validation
+                    logging.error("validateTrainBlkGrp: %r", err)
+                    pass
+
+            # cache the block group for training the model and predict phase
+            bgKey = getBlkGrpKey(self.id_fields.runId, self.id_fields.blkGrpId)
+            self.blkGrpCache[bgKey] = self.blkGrp
+
+        else:
+            raise ValidationError("Unknown blkGrp type {}".format(self.blkGrp.type))
+
+        # save BlockGroup Data
+        filename = getBlkGrpFilename(self.id_fields.sessionId,
+                                     self.id_fields.runId,
+                                     self.id_fields.blkGrpId)
+        blkGrpFilename = os.path.join(self.dirs.dataDir, filename)
+        with self.timers.time('persist'):
+            try:
+                sio.savemat(blkGrpFilename, self.blkGrp, appendmat=False)
+            except Exception as err:
+                raise StateError("Error: Unable to save blkGrpFile %s: %r" % (blkGrpFilename, err))
+        return outputlns
+
+    def trData(self, TR, data):
+        """Process the data from an fMRI scan.
+        In training case smooth and add the data to the accumulated block in
+        order to later create a ML model
+        In realtime prediction case, do classification based on the loaded model
+        Returns the prediction result, None for a training TR, and the output lines.
+        """
+        self.validateTR(TR)
+        with self.timers.time('ingest'):
+            self.setTRFields(TR, data)
+        patterns = self.blkGrp.patterns
+        with self.timers.time('smooth'):
+            smoothRef = self.executor.smooth(patterns.raw[TR.trId, :], self.session.roiDims,
+                                             self.roiIndsRef, self.session.FWHM)
+            if self.executor.asyncTasks and not self.isPredictTR(TR):
+                # the training TRs' smoothed data is only used at the end of the block group,
+                # collected then so the smoothing overlaps the next TRs
+                self.smoothRefs[TR.trId] = smoothRef
+            else:
+                patterns.raw_sm[TR.trId, :] = self.executor.get(smoothRef)
+        return self.processTR(TR)
+
+    def batchTRData(self, TRs, data):
+        """Process the data of a block of TRs sent in one message, as in replay mode.
+        The TRs' volumes are smoothed as a batch, then each TR is trained on or
+        predicted in order as by trData, so the results are the same as sending
+        the TRs one at a time. Returns the prediction results and the output lines.
+        """
+        if TRs is None or data is None or len(TRs) != data.shape[0]:
+            raise ValidationError("BatchTRData: TRs and data rows don't match")
+        with self.timers.time('ingest'):
+            for TR, trData in zip(TRs, data):
+                self.validateTR(TR)
+                self.setTRFields(TR, trData)
+        patterns = self.blkGrp.patterns
+        trIds = [TR.trId for TR in TRs]
+        with self.timers.time('smooth'):
+            patterns.raw_sm[trIds, :] = self.executor.get(self.executor.smoothVolumes(
+                patterns.raw[trIds, :], self.session.roiDims, self.roiIndsRef, self.session.FWHM))
+        predicts = []
+        outputlns = []  # type: ignore
+        for TR in TRs:
+            self.id_fields.trId = TR.trId
+            predict_result, trOutputlns = self.processTR(TR)
+            predicts.append(predict_result)
+            outputlns.extend(trOutputlns)
+        return predicts, outputlns
+
+    def validateTR(self, TR):
+        """Raises a ValidationError if the TR fields are invalid"""
+        if TR.type not in (0, 1, 2) or self.blkGrp.type not in (1, 2):
+            raise ValidationError("Unknown TR type %r" % (TR.type))
+        if TR.trId is None:
+            raise ValidationError("missing TR.trId")
+        if TR.type != 0 and TR.type != self.blkGrp.type:
+            raise ValidationError("TR.type and blkGrp.type do not agree!!")
+
+    def setTRFields(self, TR, data):
+        """Store the TR's data and fields in the block group patterns"""
+        self.run.fileCounter = self.run.fileCounter + 1
+        patterns = self.blkGrp.patterns
+        setTrData(patterns, TR.trId, data)
+        patterns.attCateg[0, TR.trId] = TR.attCateg
+        patterns.stim[0, TR.trId] = TR.stim
+        patterns.type[0, TR.trId] = TR.type
+        patterns.regressor[:, TR.trId] = TR.regressor[:]
+        patterns.fileNum[0, TR.trId] = TR.vol + self.run.disdaqs // self.run.TRTime
+
+    def isPredictTR(self, TR):
+        return TR.type == 2 or (TR.type == 0 and self.blkGrp.type == 2) or\
+            self.blkGrp.legacyRun1Phase2Mode
+
+    def processTR(self, TR):
+        """Predict or output the training line for a TR whose smoothed data is set"""
+        outputlns = []  # type: ignore
+        predict_result = None
+        patterns = self.blkGrp.patterns
+        if self.isPredictTR(TR):
+            # Testing
+            predict_result, outputlns = self.predict(TR)
+        elif TR.type == 1 or (TR.type == 0 and self.blkGrp.type == 1):
+            # Training
+            output_str = '{:d}\t{:d}\t{:d}\t{:d}\t{:d}\t{:d}\t{}\t{:d}\t{:.3f}\t{:.3f}'.format(
+                self.id_fields.runId, self.id_fields.blockId, TR.trId, TR.type, TR.attCateg, TR.stim,
+                patterns.fileNum[0, TR.trId], patterns.fileload[0, TR.trId], np.nan, np.nan)
+            outputlns.append(output_str)
+        else:
+            raise ValidationError("Process TR, TR.type %r or blkGrp.type %r unexpected" %
+                                  (TR.type, self.blkGrp.type))
+        return predict_result, outputlns
+
+    def predict(self, TR):
+        """Given a scan image (TR) predict the classification of the data (face/scene)
+        """
+        predict_result = StructDict()
+        outputlns = []
+        patterns = self.blkGrp.patterns
+        combined_raw_sm = self.blkGrp.combined_raw_sm
+        combined_TRid = self.blkGrp.firstVol + TR.trId
+
+        with self.timers.time('highpass'):
+            combined_raw_sm[combined_TRid] = patterns.raw_sm[TR.trId]
+            patterns.raw_sm_filt[TR.trId, :] = \
+                highPassRealTime(combined_raw_sm[0:combined_TRid+1, :], self.run.TRTime, self.session.cutoff)
+        with self.timers.time('zscore'):
+            patterns.raw_sm_filt_z[TR.trId, :] = \
+                (patterns.raw_sm_filt[TR.trId, :] - patterns.phase1Mean[0, :]) / patterns.phase1Std[0, :]
+
+        with self.timers.time('predict'):
+            if self.run.rtfeedback:
+                TR_regressor = np.array(TR.regressor)
+                if np.any(TR_regressor):
+                    patterns.predict[0, TR.trId], _, _, patterns.activations[:, TR.trId] = \
+                        Test_L2_RLR_realtime(self.blkGrp.trainedModel, patterns.raw_sm_filt_z[TR.trId, :],
+                                             TR_regressor)
+                    # determine whether expecting face or scene for this TR
+                    categ = np.flatnonzero(TR_regressor)
+                    # the other category will be categ+1 mod 2 since there are only two category types
+                    otherCateg = (categ + 1) % 2
+                    patterns.categoryseparation[0, TR.trId] = \
+                        patterns.activations[categ, TR.trId]-patterns.activations[otherCateg, TR.trId]
+                else:
+                    patterns.categoryseparation[0, TR.trId] = np.nan
+                predict_result.catsep = patterns.categoryseparation[0, TR.trId]
+                predict_result.vol = patterns.fileNum[0, TR.trId]
+            else:
+                patterns.categoryseparation[0, TR.trId] = np.nan
+
+            # print TR results
+            categorysep_mean = np.nan
+            # TODO - do we need to handle 0:TR here to include phase 1 data?
+            if not np.all(np.isnan(patterns.categoryseparation[0, 0:TR.trId+1])):
+                categorysep_mean = np.nanmean(patterns.categoryseparation[0, 0:TR.trId+1])
+            output_str = '{:d}\t{:d}\t{:d}\t{:d}\t{:d}\t{:d}\t{}\t{:d}\t{:.1f}\t{:.3f}\t{:.3f}'.format(
+                self.id_fields.runId, self.id_fields.blockId, TR.trId, TR.type, TR.attCateg, TR.stim,
+                patterns.fileNum[0, TR.trId], patterns.fileload[0, TR.trId], patterns.predict[0, TR.trId],
+                patterns.categoryseparation[0, TR.trId], categorysep_mean)
+            outputlns.append(output_str)
+        return predict_result, outputlns
+
+    def trainModel(self, trainCfg):
+        """Load block group patterns data from this and the previous run and
+        start training the ML model for the next run. With an executor running
+        tasks the training overlaps the next run. trainResult returns the
+        training output once the model is saved.
+        """
+        runId = self.id_fields.runId
+        with self.timers.time('train'):
+            # load data to train model
+            trainPats = []
+            trainLabels = []
+            for bgRef in trainCfg.blkGrpRefs:
+                bgRef = StructDict(bgRef)
+                try:
+                    bg = self.getPrevBlkGrp(self.id_fields.sessionId, bgRef.run, bgRef.phase)
+                except Exception as err:
+                    raise StateError("Error: getPrevBlkGrp(%r, %r, %r): %r" %
+                                     (self.id_fields.sessionId, bgRef.run, bgRef.phase, err))
+                trainIdx = utils.find(np.any(bg.patterns.regressor, axis=0))
+                trainLabels.append(np.transpose(bg.patterns.regressor[:, trainIdx]))  # the labels of those indices
+                trainPats.append(bg.patterns.raw_sm_filt_z[trainIdx, :])  # the patterns of those indices
+            pending = StructDict()
+            pending.trainPats = np.concatenate(trainPats)
+            pending.trainLabels = np.concatenate(trainLabels).astype(np.uint8)
+            pending.validationModel = self.run.validationModel
+            pending.trainRef = self.executor.trainModel(pending.trainPats, pending.trainLabels)
+            self.pendingModels[runId] = pending
+        return []
+
+    def trainResult(self, runId):
+        """Return the output lines of the model training of runId, waiting for
+        the training to finish if it is still running.
+        """
+        if runId in self.pendingModels:
+            self.collectTrainedModel(runId)
+        result = self.trainResults.pop(runId, None)
+        if result is None:
+            raise StateError("TrainModelResult: no model training for run %r" % (runId))
+        if result.error is not None:
+            raise StateError(result.error)
+        return result.outputlns
+
+    def collectTrainedModels(self):
+        for runId in list(self.pendingModels.keys()):
+            self.collectTrainedModel(runId)
+
+    def collectTrainedModel(self, runId):
+        """Wait for the model training of runId, then cache, validate and save the model.
+        The training output is kept for trainResult.
+        """
+        pending = self.pendingModels.pop(runId)
+        result = StructDict({'outputlns': [], 'error': None})
+        with self.timers.time('train'):
+            weights, biases, trainingOnlyTime = self.executor.get(pending.trainRef)
+        newTrainedModel = utils.MatlabStructDict({}, 'trainedModel')
+        newTrainedModel.trainedModel = StructDict({})
+        newTrainedModel.trainedModel.weights = weights
+        newTrainedModel.trainedModel.biases = biases
+        newTrainedModel.trainPats = pending.trainPats
+        newTrainedModel.trainLabels = pending.trainLabels
+        newTrainedModel.FWHM = self.session.FWHM
+        newTrainedModel.cutoff = self.session.cutoff
+        newTrainedModel.gitCodeId = utils.getGitCodeId()
+
+        # print training timing and results
+        result.outputlns.append('Model training completed')
+        outStr = 'Model training time: \t{:.3f}'.format(trainingOnlyTime)
+        result.outputlns.append(outStr)
+        if newTrainedModel.biases is not None:
+            outStr = 'Model biases: \t{:.3f}\t{:.3f}'.format(
+                newTrainedModel.biases[0, 0], newTrainedModel.biases[0, 1])
+            result.outputlns.append(outStr)
+
+        # cache the trained model
+        self.modelCache[runId] = newTrainedModel
+
+        if self.session.validate:
+            try:
+                self.validateModel(newTrainedModel, pending.validationModel, result.outputlns)
+            except Exception as err:
+                # Just log that an error happened during validation
+                logging.error("validateModel: %r", err)
+                pass
+        # write trained model to a file
+        filename = getModelFilename(self.id_fields.sessionId, runId)
+        trainedModel_fn = os.path.join(self.dirs.dataDir, filename)
+        with self.timers.time('persist'):
+            try:
+                sio.savemat(trainedModel_fn, newTrainedModel, appendmat=False)
+            except Exception as err:
+                result.error = "Error: Unable to save trainedModel %s: %s" % (filename, str(err))
+        self.trainResults[runId] = result
+
+    def getDataFilename(self, fileInfo):
+        """The full path of a data file to retrieve, the newest file matching
+        fileInfo.findNewestPattern if set.
+        """
+        # a model still training is saved first
+        self.collectTrainedModels()
+        dataDir = getSubjectDataDir(self.session.serverDataDir, fileInfo.subjectNum, fileInfo.subjectDay)
+        fullFileName = os.path.join(dataDir, fileInfo.filename)
+        if fileInfo.findNewestPattern not in (None, ''):
+            fullFileName = utils.findNewestFile(dataDir, fileInfo.findNewestPattern)
+            if fullFileName is None:
+                raise RequestError("FindNewestFile failed: %s: no matches found" % (fullFileName))
+        return fullFileName
+
+    def deleteData(self, filePattern):
+        """Delete data files matching the supplied pattern"""
+        outputlns = []
+        # check that pattern is in the server directory
+        if not filePattern.startswith(self.dirs.dataDir):
+            # invalid filepattern
+            raise ValidationError("Invalid filepattern: Must start with session directory %s"
+                                  % (self.dirs.dataDir))
+        outputlns.append("Deleted:")
+        for filename in glob.glob(filePattern):
+            if os.path.isfile(filename):
+                outputlns.append(filename)
+                os.remove(filename)
+        return outputlns
+
+    def getRunPatterns(self, firstVol, nTRs):
+        """The per volume patterns of the run with one row per volume. Each block
+        group's patterns are views of its rows, so the predict phase reads the
+        phase 1 rows in place. Allocated once and refilled for each run.
+        """
+        nVols = firstVol + nTRs
+        if self.run.nVols is not None:
+            nVols = max(nVols, self.run.nVols)
+        runPatterns = self.runPatterns
+        if runPatterns is None or runPatterns.raw.shape != (nVols, self.session.nVoxels):
+            runPatterns = StructDict()
+            runPatterns.raw = np.full((nVols, self.session.nVoxels), np.nan)
+            runPatterns.raw_sm = np.full((nVols, self.session.nVoxels), np.nan)
+            runPatterns.raw_sm_filt = np.full((nVols, self.session.nVoxels), np.nan)
+            runPatterns.raw_sm_filt_z = np.full((nVols, self.session.nVoxels), np.nan)
+            runPatterns.categoryseparation = np.full((1, nVols), np.nan)
+            self.runPatterns = runPatterns
+        elif runPatterns.released:
+            for field in runPatternsFields:
+                runPatterns[field].fill(np.nan)
+        runPatterns.released = False
+        return runPatterns
+
+    def releaseRunPatterns(self):
+        """Copy the rows of the block groups cached past their run out of the
+        run patterns, so the run patterns can be refilled for the next run.
+        """
+        runPatterns = self.runPatterns
+        if runPatterns is None:
+            return
+        for blkGrp in self.blkGrpCache.memoryValues():
+            if not np.may_share_memory(blkGrp.patterns.raw, runPatterns.raw):
+                continue
+            for field in runPatternsFields:
+                blkGrp.patterns[field] = np.copy(blkGrp.patterns[field])
+            if blkGrp.combined_raw_sm is not None:
+                blkGrp.combined_raw_sm = np.copy(blkGrp.combined_raw_sm)
+                blkGrp.combined_catsep = np.copy(blkGrp.combined_catsep)
+        # the last block group of the run holds views too
+        self.blkGrp = None
+        runPatterns.released = True
+
+    def collectSmoothedTRs(self):
+        """Set the raw_sm rows of the block group's deferred training TRs"""
+        if len(self.smoothRefs) > 0:
+            with self.timers.time('smooth'):
+                trIds = list(self.smoothRefs.keys())
+                self.blkGrp.patterns.raw_sm[trIds, :] = self.executor.get(list(self.smoothRefs.values()))
+        self.smoothRefs = {}
+
+    def getPrevBlkGrp(self, sessionId, runId, blkGrpId):
+        """Retrieve a block group patterns data, first see if it is cached
+        in memory, if not load it from file and add it to the cache.
+        """
+        bgKey = getBlkGrpKey(runId, blkGrpId)
+        prev_bg = self.blkGrpCache.get(bgKey, None)
+        if prev_bg is None:
+            # load it from file
+            logging.info("blkGrpCache miss on <runId, blkGrpId> %s", bgKey)
+            fname = os.path.join(self.dirs.dataDir, getBlkGrpFilename(sessionId, runId, blkGrpId))
+            if self.session.useSessionTimestamp is True:
+                sessionWildcard = re.sub('T.*', 'T*', sessionId)
+                filePattern = getBlkGrpFilename(sessionWildcard, runId, blkGrpId)
+                fname = utils.findNewestFile(self.dirs.dataDir, filePattern)
+            prev_bg = utils.loadMatFile(fname)
+            # loadMatFile should either raise an exception or return a value
+            if prev_bg is None:
+                raise StateError("Load blkGrp returned None: {}".format(fname))
+            if sessionId == self.id_fields.sessionId:
+                self.blkGrpCache[bgKey] = prev_bg
+        return prev_bg
+
+    def getTrainedModel(self, sessionId, runId):
+        """Retrieve a ML model trained in a previous run (runId). First see if it
+        is cached in memory, a hit marks it recently used, if not load it from
+        file and add it to the cache.
+        """
+        if runId in self.pendingModels:
+            # wait for the model's training
+            self.collectTrainedModel(runId)
+        model = self.modelCache.get(runId, None)
+        if model is None:
+            # load it from file
+            logging.info("modelCache miss on runId %d", runId)
+            fname = os.path.join(self.dirs.dataDir, getModelFilename(sessionId, runId))
+            if self.session.useSessionTimestamp is True:
+                sessionWildcard = re.sub('T.*', 'T*', sessionId)
+                filePattern = getModelFilename(sessionWildcard, runId)
+                fname = utils.findNewestFile(self.dirs.dataDir, filePattern)
+            model = utils.loadMatFile(fname)
+            # loadMatFile should either raise an exception or return a value
+            if model is None:
+                raise StateError("Load model returned None: {}".format(fname))
+            if sessionId == self.id_fields.sessionId:
+                self.modelCache[runId] = model
+        return model
+
+    def trimCache(self, oldestRunId):
+        """Remove any cached elements older than oldestRunId
+        """
+        # trim blkGrpCache
+        rm_keys = []
+        for bgKey in self.blkGrpCache.keys():
+            cache_runId, cache_blkGrpId = bgKey.split('.')
+            if int(cache_runId) < oldestRunId:
+                rm_keys.append(bgKey)
+        for key in rm_keys:
+            del(self.blkGrpCache[key])
+        # trim modelCache
+        rm_keys = [runId for runId in self.modelCache.keys() if runId < oldestRunId]
+        for key in rm_keys:
+            del(self.modelCache[key])
+
+    def validateTrainBlkGrp(self, target_i1, target_i2, outputlns):
+        """Compare the block group patterns file created in this run with that of
+         a previous run (i.e. using the Matlab software) but having the same raw input
+        """
+        patterns = MatlabStructDict(self.blkGrp.patterns)
+        # load the replay file for target outcomes
+        target_patternsdata = utils.loadMatFile(self.run.validationDataFile)
+        target_patterns = target_patternsdata.patterns
+        strip_patterns(target_patterns, range(target_i1, target_i2))
+        cmp_fields = ['raw', 'raw_sm', 'raw_sm_filt', 'raw_sm_filt_z',
+                      'phase1Mean', 'phase1Y', 'phase1Std', 'phase1Var', 'regressor']
+        # the pearson correlation for raw_sm_filt_z is computed in the same comparison pass
+        res = vutils.compareMatStructs(patterns, target_patterns, field_list=cmp_fields,
+                                       pearson_fields=['raw_sm_filt_z'])
+        res_means = {key: value['mean'] for key, value in res.items()}
+        outputlns.append("Validation Means: {}".format(res_means))
+        pearson_mean = res['raw_sm_filt_z']['pearson']
+        outputlns.append("Phase1 sm_filt_z mean pearsons correlation {}".format(pearson_mean))
+        if pearson_mean < .995:
+            # assert pearson_mean > .995, "Pearsons mean {} too low".format(pearson_mean)
+            logging.warn("Pearson mean for raw_sm_filt_z low, %f", pearson_mean)
+
+    def validateTestBlkGrp(self, target_i1, target_i2, outputlns):
+        """Compare the block group patterns file created in this run with that of
+         a previous run (i.e. using the Matlab software) but having the same raw input
+        """
+        patterns = MatlabStructDict(self.blkGrp.patterns)
+        # load the replay file for target outcomes
+        target_patternsdata = utils.loadMatFile(self.run.validationDataFile)
+        target_patterns = target_patternsdata.patterns
+        strip_patterns(target_patterns, range(target_i1, target_i2))
+        cmp_fields = ['raw', 'raw_sm', 'raw_sm_filt', 'raw_sm_filt_z',
+                      'phase1Mean', 'phase1Y', 'phase1Std', 'phase1Var',
+                      'categoryseparation', 'regressor']
+        res = vutils.compareMatStructs(patterns, target_patterns, field_list=cmp_fields,
+                                       pearson_fields=['categoryseparation', 'raw_sm_filt_z'])
+        res_means = {key: value['mean'] for key, value in res.items()}
+        outputlns.append("Validation Means: {}".format(res_means))
+        # Make sure the predict array values are identical
+        # Predict values are (1, 2) in matlab, (0, 1) in python because it
+        # Check if we need to convert from matlab to python values
+        if (not np.all(np.isnan(target_patterns.predict))) and\
+                np.nanmax(target_patterns.predict) > 1:
+            # convert target.predict to zero based indexing
+            target_patterns.predict = target_patterns.predict-1
+        predictions_match = np.allclose(target_patterns.predict, patterns.predict, rtol=0, atol=0, equal_nan=True)
+        if predictions_match:
+            outputlns.append("All predictions match: {}".format(predictions_match))
+        else:
+            mask = ~np.isnan(target_patterns.predict)
+            miss_count = np.sum(patterns.predict[mask] != target_patterns.predict[mask])
+            outputlns.append("WARNING: predictions differ in {} TRs".format(miss_count))
+        # the pearson correlation for categoryseparation
+        pearson_mean = res['categoryseparation']['pearson']
+        outputlns.append("Phase2 categoryseparation mean pearsons correlation {}".format(pearson_mean))
+        if pearson_mean < .995:
+            outputlns.append("WARN: Pearson mean for categoryseparation low, {}".format(pearson_mean))
+        # the pearson correlation for raw_sm_filt_z
+        pearson_mean = res['raw_sm_filt_z']['pearson']
+        outputlns.append("Phase2 sm_filt_z mean pearsons correlation {}".format(pearson_mean))
+        if pearson_mean < .995:
+            # assert pearson_mean > .995, "Pearsons mean {} too low".format(pearson_mean)
+            outputlns.append("WARN: Pearson mean for raw_sm_filt_z low, {}".format(pearson_mean))
+
+    def validateModel(self, newTrainedModel, validationModel, outputlns):
+        """Compare the trained model for this block group to a trained model
+        created from a previous run using the same data (i.e. from the Matlab version)
+        """
+        target_model = utils.loadMatFile(validationModel)
+        cmp_fields = ['trainLabels', 'weights', 'biases', 'trainPats']
+        res = vutils.compareMatStructs(newTrainedModel, target_model, field_list=cmp_fields,
+                                       pearson_fields=['trainPats', 'weights'])
+        res_means = {key: value['mean'] for key, value in res.items()}
+        outputlns.append("TrainModel Validation Means: {}".format(res_means))
+        # the pearson correlation for trainPats
+        pearson_mean = res['trainPats']['pearson']
+        outputlns.append("trainPats mean pearsons correlation {}".format(pearson_mean))
+        if pearson_mean < .995:
+            # assert pearson_mean > .995, "Pearsons mean {} too low".format(pearson_mean)
+            logging.warn("Pearson mean for trainPats low, %f", pearson_mean)
+        # the pearson correlation for model weights
+        pearson_mean = res['weights']['pearson']
+        outputlns.append("trainedWeights mean pearsons correlation {}".format(pearson_mean))
+        if pearson_mean < .995:
+            # assert pearson_mean > .99, "Pearsons mean {} too low".format(pearson_mean)
+            outputlns.append("WARN: Pearson mean for trainWeights low, {}".format(pearson_mean))
+
+
+class LocalExecutor():
+    """Runs the engine's smoothing, between runs highpass and model training in
+    this process as they are requested. Its handles are the results themselves.
+    An executor running tasks returns handles of the tasks instead, resolved by
+    get, and sets asyncTasks so the engine collects them only when needed.
+    """
+    asyncTasks = False
+
+    def put(self, value):
+        """A handle of a value read by the tasks"""
+        return value
+
+    def get(self, handle):
+        """The result of a handle, or the results of a list of handles"""
+        return handle
+
+    def smooth(self, data, roiDims, roiIndsRef, FWHM):
+        return smooth(data, roiDims, roiIndsRef, FWHM)
+
+    def smoothVolumes(self, data, roiDims, roiIndsRef, FWHM):
+        return smoothVolumes(data, roiDims, roiIndsRef, FWHM)
+
+    def highPassBetweenRuns(self, raw_sm, TRTime, cutoff):
+        """Returns the result, not a handle, the block group needs it right away"""
+        return highPassBetweenRuns(raw_sm, TRTime, cutoff)
+
+    def trainModel(self, trainPats, trainLabels):
+        return trainModel(trainPats, trainLabels)
+
+
+class StageTimers():
+    """The wall time of the pipeline stages, the count, total and max secs of each"""
+    def __init__(self, stages=pipelineStages):
+        self.stages = stages
+        self.reset()
+
+    def reset(self):
+        self.stats = {stage: StructDict({'count': 0, 'total': 0.0, 'max': 0.0}) for stage in self.stages}
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        stime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - stime)
+
+    def add(self, stage, secs):
+        stat = self.stats[stage]
+        stat.count += 1
+        stat.total += secs
+        stat.max = max(stat.max, secs)
+
+    def outputLine(self):
+        """The stage times as an output line, 'stage count mean max' with the times in ms"""
+        stageStrs = ['{} {} {:.2f} {:.2f}'.format(stage, stat.count, stat.total / max(stat.count, 1) * 1000,
+                                                  stat.max * 1000) for stage, stat in self.stats.items()]
+        return 'Stage times (count, mean ms, max ms): ' + ', '.join(stageStrs)
+
+
+def trainModel(trainPats, trainLabels):
+    """Train the model's weights and biases, returns them and the training time"""
+    # sklearn (and the pandas it loads) is imported on first use to keep server start fast
+    from sklearn.linear_model import LogisticRegression  # type: ignore
+    trainStart = time.time()
+    # sklearn LogisticRegression takes on set of labels and returns one set of weights.
+    # The version implemented in Matlab can take multple sets of labels and return multiple weights.
+    # To reproduct that behavior here, we will use a LogisticRegression instance for each set of lables (2 in this case)
+    lrc1 = LogisticRegression(solver='saga', penalty='l2', max_iter=300)
+    lrc2 = LogisticRegression(solver='saga', penalty='l2', max_iter=300)
+    lrc1.fit(trainPats, trainLabels[:, 0])
+    lrc2.fit(trainPats, trainLabels[:, 1])
+    weights = np.concatenate((lrc1.coef_.T, lrc2.coef_.T), axis=1)
+    biases = np.concatenate((lrc1.intercept_, lrc2.intercept_)).reshape(1, 2)
+    return weights, biases, time.time() - trainStart
+
+
+# the block group patterns that are views of the run patterns
+runPatternsFields = ('raw', 'raw_sm', 'raw_sm_filt', 'raw_sm_filt_z', 'categoryseparation')
+
+
+def setTrData(patterns, trId, data):
+    """Given a new TR data vector, only use the data if there are no NaN values.
+    If there are NaN values, find the last known good TR (with no NaNs) and use
+    that again for this TR. Otherwise if there are no NaNs then set the patterns.raw
+    to this new data. Update the fileload array to indicate if this data was
+    used (file was loaded) or not.
+    """
+    TRsLoaded = np.where(patterns.fileload.squeeze() == 1)
+    if np.any(np.isnan(data)) and len(TRsLoaded[0]) > 0:
+        # data has NaN in it so load the last good data
+        patterns.fileload[0, trId] = 0
+        indLastValidPattern = np.max(TRsLoaded)
+        patterns.raw[trId, :] = patterns.raw[indLastValidPattern, :]
+    else:
+        patterns.fileload[0, trId] = 1
+        patterns.raw[trId, :] = data
+
+
+# memory budget of each of the block group and model caches, can be set by session.cacheMaxMB
+cacheMaxMB = 2048
+
+
+def getSubjectDataDir(dataDir, subjectNum, subjectDay):
+    """The data directory is structured by subjectNum/subjectDay.
+    Return that sub-directory.
+    """
+    subjectDayDir = os.path.join(dataDir, "subject{}/day{}".format(subjectNum, subjectDay))
+    return subjectDayDir
+
+
+def getRunDir(dataDir, subjectNum, subjectDay, runId):
+    """The data directory is structured by subjectNum/subjectDay.
+    Return that sub-directory.
+    """
+    subjectDayDir = getSubjectDataDir(dataDir, subjectNum, subjectDay)
+    runDataDir = os.path.join(subjectDayDir, 'run' + str(runId))
+    return runDataDir
+
+
+def getBlkGrpFilename(sessionId, runId, blkGrpId):
+    """Return block group filename given session, run and blkgrp IDs.
+    """
+    filename = "blkGroup_r{}_p{}_{}_py.mat".format(runId, blkGrpId, sessionId)
+    return filename
+
+
+def getModelFilename(sessionId, runId):
+    """Return trained model filename given session, run IDs.
+    """
+    filename = "trainedModel_r{}_{}_py.mat".format(runId, sessionId)
+    return filename
+
+
+def getBlkGrpKey(runId, blkGrpId):
+    """This generates the key for accessing the block group data cache.
+    The key is a combination of the run and block group IDs.
+    """
+    return'{}.{}'.format(runId, blkGrpId)
+
+
+def strip_patterns(patterns, prange):
+    """Modify the patterns data to restrict it to values in the range (prange)
+    This is needed for example in validation where we might have patterns data for
+    an entire run, but want to compare the data only for a specific block group.
+    """
+    patterns.raw = patterns.raw[prange, :]
+    patterns.raw_sm = patterns.raw_sm[prange, :]
+    patterns.raw_sm_filt = patterns.raw_sm_filt[prange, :]
+    patterns.raw_sm_filt_z = patterns.raw_sm_filt_z[prange, :]
+    patterns.categoryseparation = patterns.categoryseparation[0, prange]
+    patterns.regressor = patterns.regressor[:, prange]
+    tmp_predict = np.full((1, len(prange)), np.nan)
+    if patterns.predict is not None:
+        # sometime predict array will be a few short because no prediction on final trials
+        if patterns.predict.shape[1] < prange[-1]:
+            newrange = range(prange[0], patterns.predict.shape[1])
+            tmp_predict[:, 0:len(newrange)] = patterns.predict[:, newrange]
+        else:
+            tmp_predict[:, 0:len(prange)] = patterns.predict[:, prange]
+        mask = np.where(tmp_predict == 0)
+        tmp_predict[mask] = np.nan
+    patterns.predict = tmp_predict
+
+
+@unique
+class BlockType(Enum):
+    Train = 1
+    Predict = 2
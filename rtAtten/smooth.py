@@ -43,3 +43,39 @@ def smooth(data, dims, inds, fwhm, voxel_size=3):
     result = resultVol.flat[inds]
 
     return result
+
+
+def smoothVolumes(data, dims, inds, fwhm, voxel_size=3):
+    """smoothVolumes
+
+    Smooth a batch of patterns, giving the same result as calling smooth on each
+    row. The volumes are filtered together and the normalizing array is only
+    smoothed once.
+
+    :param data: 2D np.array of patterns [TRs x voxels]
+    :param dims: roi dimensions [mask width x mask height x slices]
+    :param inds: roi indices [= np.flatnonzero(mask)]
+    :param fwhm: full-width half-max of gaussian
+    :param voxel_size: voxel size in mm
+    """
+    mask = np.full(dims, np.nan)
+    mask.flat[inds] = 1
+    norm = mask.copy()
+    norm[np.isnan(mask)] = 0
+
+    nTRs = data.shape[0]
+    vols = np.zeros((nTRs,) + tuple(dims), dtype=float)
+    vols.reshape(nTRs, -1)[:, inds] = data
+
+    sigma = (fwhm / voxel_size) / (2 * math.sqrt(2 * math.log(2)))
+    # no smoothing across the TR axis
+    volsSmooth = scipy.ndimage.filters.gaussian_filter(vols, (0,) + (sigma,) * len(dims))
+    normSmooth = scipy.ndimage.filters.gaussian_filter(norm, sigma)
+    normSmooth[np.where(normSmooth == 0)] = 1
+
+    resultVols = volsSmooth / normSmooth
+    resultVols[:, np.isnan(mask)] = np.nan
+
+    result = resultVols.reshape(nTRs, -1)[:, inds]
+
+    return result
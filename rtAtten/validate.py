@@ -1,5 +1,8 @@
 import os
+import time
 import argparse
+import multiprocessing
+import concurrent.futures
 import numpy as np  # type: ignore
 import sys
 # Add current working dir so main can be run from the top level rtAttenPenn directory
@@ -14,21 +17,80 @@ from sklearn.linear_model import LogisticRegression
 from rtfMRI.StructDict import StructDict, MatlabStructDict
 from sklearn.metrics import roc_auc_score
 
-def validateMatlabPython(configFile):
+# .mat files loaded by a validation, each is loaded once. Fold fit workers
+#   forked by the validation share the files loaded before they start.
+matFileCache = {}  # type: ignore
+nfold = 4
+
+
+def validateMatlabPython(configFile, jobs=1):
     cfg = loadConfigFile(configFile)
+    validateSession(cfg, jobs=jobs)
+
+
+def validateSession(cfg, pyDataDir=None, jobs=1):
+    """Compare the python outputs of a session, in pyDataDir when they aren't
+    in the session's matlab data directory, to the matlab outputs. The fold fits
+    of the cross-validation run in jobs worker processes while the outputs are
+    compared. Returns the cross-validation ROC array of [fold, matlab/python, run],
+    saved to xvalresults.npy as each fit completes.
+    """
     matDataDir = getSubjectDataDir(cfg.session.dataDir, cfg.session.subjectNum, cfg.session.subjectDay)
-    pyDataDir = matDataDir
-    all_ROC = np.zeros((4,2,len(cfg.session.Runs)))
-    for runId in cfg.session.Runs:
-        print("EXECUTING ANALYSES FOR RUN {}".format(runId))
-        validatePatternsData(matDataDir, pyDataDir, runId)
-        validateFileprocessingTxt(matDataDir, pyDataDir, runId)
-        mat_roc,py_roc = crossvalidateModels(matDataDir,pyDataDir,runId)
-        all_ROC[:,0,runId-1] = mat_roc
-        all_ROC[:,1,runId-1] = py_roc
-    fullfilename = matDataDir + '/' + 'xvalresults.npy'
+    if pyDataDir is None:
+        pyDataDir = matDataDir
+    times = StructDict({'load': 0.0, 'patterns': 0.0, 'fileprocessing': 0.0, 'fits': 0.0})
+    sessionStartTime = time.time()
+    fullfilename = pyDataDir + '/' + 'xvalresults.npy'
     print("saving to %s\n" % fullfilename)
-    np.save(fullfilename,all_ROC)
+    all_ROC = np.lib.format.open_memmap(fullfilename, mode='w+', shape=(nfold, 2, len(cfg.session.Runs)))
+    all_ROC[:] = np.nan
+    all_ROC.flush()
+    foldFits = None
+    try:
+        # load the models before the fit workers start
+        stime = time.time()
+        tasks = []
+        for runIdx, runId in enumerate(cfg.session.Runs):
+            tasks += createFoldTasks(matDataDir, pyDataDir, runId, runIdx)
+        times.load = time.time() - stime
+        foldFits = FoldFits(tasks, jobs)
+        for runId in cfg.session.Runs:
+            print("EXECUTING ANALYSES FOR RUN {}".format(runId))
+            stime = time.time()
+            validatePatternsData(matDataDir, pyDataDir, runId)
+            times.patterns += time.time() - stime
+            stime = time.time()
+            validateFileprocessingTxt(matDataDir, pyDataDir, runId)
+            times.fileprocessing += time.time() - stime
+        for task, roc, fitTime in foldFits.results():
+            all_ROC[task.fold, task.modelIdx, task.runIdx] = roc
+            all_ROC.flush()
+            times.fits += fitTime
+        for runIdx, runId in enumerate(cfg.session.Runs):
+            print("RUN {} AVG AUC MAT,PY is: {:.2f},{:.2f}".format(
+                  runId, np.mean(all_ROC[:, 0, runIdx]), np.mean(all_ROC[:, 1, runIdx])))
+    finally:
+        if foldFits is not None:
+            foldFits.close()
+        matFileCache.clear()
+    print("Validation times: load {:.2f}s, patterns {:.2f}s, fileprocessing {:.2f}s, "
+          "{} fold fits {:.2f}s summed over {} jobs, total {:.2f}s".format(
+              times.load, times.patterns, times.fileprocessing, len(tasks), times.fits, jobs,
+              time.time() - sessionStartTime))
+    return np.array(all_ROC)
+
+
+def loadMatFileCached(filename):
+    """loadMatFile, returning the file loaded earlier while it is unchanged"""
+    if filename is None or not os.path.isfile(filename):
+        return utils.loadMatFile(filename)
+    key = (os.path.abspath(filename), os.stat(filename).st_mtime_ns)
+    data = matFileCache.get(key)
+    if data is None:
+        data = utils.loadMatFile(filename)
+        matFileCache[key] = data
+    return data
+
 
 def validatePatternsData(matDataDir, pyDataDir, runId):
     runDir = 'run'+str(runId)+'/'
@@ -38,9 +100,9 @@ def validatePatternsData(matDataDir, pyDataDir, runId):
     pyBlkGrp2Fn = utils.findNewestFile(pyDataDir, 'blkGroup_r'+str(runId)+'_p2_*_py.mat')
     print("Validating patternrs: Matlab {}, Python {} {}".format(matPatternsFn, pyBlkGrp1Fn, pyBlkGrp2Fn))
 
-    matPatterns = utils.loadMatFile(matPatternsFn)
-    pyBlkGrp1 = utils.loadMatFile(pyBlkGrp1Fn)
-    pyBlkGrp2 = utils.loadMatFile(pyBlkGrp2Fn)
+    matPatterns = loadMatFileCached(matPatternsFn)
+    pyBlkGrp1 = loadMatFileCached(pyBlkGrp1Fn)
+    pyBlkGrp2 = loadMatFileCached(pyBlkGrp2Fn)
     mat_nTRs = matPatterns.raw.shape[0]
     pyp1_nTRs = pyBlkGrp1.raw.shape[0]
     pyp2_nTRs = pyBlkGrp2.raw.shape[0]
@@ -62,10 +124,9 @@ def validatePatternsData(matDataDir, pyDataDir, runId):
         raise ValidationError("Pearson correlation low for raw_sm_filt_z: {}".format(corr))
 
     # Check how well the models match
-    matModelFn = utils.findNewestFile(matDataDir, runDir+'trainedModel_'+str(runId)+'*.mat')
-    pyModelFn = utils.findNewestFile(pyDataDir, 'trainedModel_r'+str(runId)+'*_py.mat')
-    matModel = utils.loadMatFile(matModelFn)
-    pyModel = utils.loadMatFile(pyModelFn)
+    matModelFn, pyModelFn = findModelFiles(matDataDir, pyDataDir, runId)
+    matModel = loadMatFileCached(matModelFn)
+    pyModel = loadMatFileCached(pyModelFn)
     corr = vutils.pearsons_mean_corr(matModel.weights, pyModel.weights)
     print("model weights correlation: {}".format(corr))
     if corr < 0.99:
@@ -135,56 +196,97 @@ def validateFileprocessingTxt(matDataDir, pyDataDir, runId):
     return
 
 
-def crossvalidateModels(matDataDir, pyDataDir, runId):
+def findModelFiles(matDataDir, pyDataDir, runId):
     runDir = 'run'+str(runId)+'/'
     matModelFn = utils.findNewestFile(matDataDir, runDir+'trainedModel_'+str(runId)+'*.mat')
     pyModelFn = utils.findNewestFile(pyDataDir, 'trainedModel_r'+str(runId)+'*_py.mat')
-    matModel = utils.loadMatFile(matModelFn)
-    pyModel = utils.loadMatFile(pyModelFn)
-    selector = np.concatenate((0*np.ones((50)),1*np.ones((50)),2*np.ones((50)),3*np.ones((50))),axis=0)
-    X = np.array([1,2,3,4])
-    nfold = 4
-    kf = KFold(nfold)
+    return matModelFn, pyModelFn
+
+
+def crossvalidateModels(matDataDir, pyDataDir, runId, jobs=1):
+    tasks = createFoldTasks(matDataDir, pyDataDir, runId)
     mat_roc = np.zeros((nfold))
     py_roc = np.zeros((nfold))
-    i = 0
-    for train_index, test_index in kf.split(X):
-        print("TRAIN:", train_index, "TEST:", test_index)
-        trTrain = np.in1d(selector,train_index)
-        trTest = np.in1d(selector,test_index)
-        # matlab first
-        mat_lrc = LogisticRegression(solver='sag', penalty='l2', max_iter=300)
-        categoryTrainLabels = np.argmax(matModel.trainLabels[trTrain,:],axis=1)
-        mat_lrc.fit(matModel.trainPats[trTrain,:], categoryTrainLabels)
-        mat_predict = mat_lrc.predict_proba(matModel.trainPats[trTest,:])
-        categ_sep = -1*np.diff(mat_predict,axis=1)
-        C0 = np.argwhere(np.argmax(matModel.trainLabels[trTest,:],axis=1)==0)
-        C1 = np.argwhere(np.argmax(matModel.trainLabels[trTest,:],axis=1)==1)
-        correctLabels = np.ones((len(categ_sep)))
-        correctLabels[C1] = -1
-        mat_roc[i] = roc_auc_score(correctLabels, categ_sep)
-        print("MAT AUC for iteration %i is: %.2f" %(i,mat_roc[i]))
-        # python second
-        py_lrc = LogisticRegression(solver='sag', penalty='l2', max_iter=300)
-        categoryTrainLabels = np.argmax(pyModel.trainLabels[trTrain,:],axis=1)
-        py_lrc.fit(pyModel.trainPats[trTrain,:], categoryTrainLabels)
-        py_predict = py_lrc.predict_proba(pyModel.trainPats[trTest,:])
-        categ_sep = -1*np.diff(py_predict,axis=1)
-        C0 = np.argwhere(np.argmax(pyModel.trainLabels[trTest,:],axis=1)==0)
-        C1 = np.argwhere(np.argmax(pyModel.trainLabels[trTest,:],axis=1)==1)
-        correctLabels = np.ones((len(categ_sep)))
-        correctLabels[C1] = -1
-        py_roc[i] = roc_auc_score(correctLabels, categ_sep)
-        print("PY AUC for iteration %i is: %.2f\n" %(i,py_roc[i]))
-        i+= 1
+    foldFits = FoldFits(tasks, jobs)
+    try:
+        for task, roc, _ in foldFits.results():
+            if task.modelIdx == 0:
+                mat_roc[task.fold] = roc
+            else:
+                py_roc[task.fold] = roc
+    finally:
+        foldFits.close()
     print("AVG AUC MAT,PY is: %.2f,%.2f\n" %(np.mean(mat_roc),np.mean(py_roc)))
-    #mat_mean = np.mean(mat_roc)
-    #py_mean = np.mean(py_roc)
-    #all_ROC = np.concatenate((mat_roc[:,np.newaxis],py_roc[:,np.newaxis]),axis=1)
-    #fullfilename = matDataDir + '/' + 'xvalresults.npy'
-    #print("saving to %s\n" % fullfilename)
-    #np.save(fullfilename,all_ROC)
     return mat_roc,py_roc
+
+
+def createFoldTasks(matDataDir, pyDataDir, runId, runIdx=0):
+    """The fold fits of the matlab and python models of a run, loading the models"""
+    tasks = []
+    for modelIdx, modelFn in enumerate(findModelFiles(matDataDir, pyDataDir, runId)):
+        loadMatFileCached(modelFn)
+        kf = KFold(nfold)
+        for fold, (train_index, test_index) in enumerate(kf.split(np.arange(nfold))):
+            tasks.append(StructDict({'runId': runId, 'runIdx': runIdx, 'modelIdx': modelIdx, 'fold': fold,
+                                     'args': (modelFn, train_index, test_index)}))
+    return tasks
+
+
+def fitFold(modelFn, train_index, test_index):
+    """Fit and test the classifier of a cross-validation fold of a model's training
+    patterns. Returns the AUC and the fit time.
+    """
+    stime = time.time()
+    model = loadMatFileCached(modelFn)
+    selector = np.concatenate((0*np.ones((50)),1*np.ones((50)),2*np.ones((50)),3*np.ones((50))),axis=0)
+    trTrain = np.in1d(selector,train_index)
+    trTest = np.in1d(selector,test_index)
+    lrc = LogisticRegression(solver='sag', penalty='l2', max_iter=300)
+    categoryTrainLabels = np.argmax(model.trainLabels[trTrain,:],axis=1)
+    lrc.fit(model.trainPats[trTrain,:], categoryTrainLabels)
+    predict = lrc.predict_proba(model.trainPats[trTest,:])
+    categ_sep = -1*np.diff(predict,axis=1)
+    C1 = np.argwhere(np.argmax(model.trainLabels[trTest,:],axis=1)==1)
+    correctLabels = np.ones((len(categ_sep)))
+    correctLabels[C1] = -1
+    roc = roc_auc_score(correctLabels, categ_sep)
+    return roc, time.time() - stime
+
+
+class FoldFits():
+    """Runs the fold fit tasks, in a pool of jobs worker processes started when
+    created, or one after another as the results are read when jobs is 1.
+    """
+    def __init__(self, tasks, jobs):
+        self.tasks = tasks
+        self.executor = None
+        self.futures = {}  # type: ignore
+        if jobs > 1 and len(tasks) > 0:
+            # forked workers share the loaded models
+            mpContext = None
+            if 'fork' in multiprocessing.get_all_start_methods():
+                mpContext = multiprocessing.get_context('fork')
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=mpContext)
+            self.futures = {self.executor.submit(fitFold, *task.args): task for task in tasks}
+
+    def results(self):
+        """Yields (task, roc, fitTime) as the fits complete"""
+        if self.executor is None:
+            results = ((task, fitFold(*task.args)) for task in self.tasks)
+        else:
+            results = ((self.futures[future], future.result())
+                       for future in concurrent.futures.as_completed(self.futures))
+        for task, (roc, fitTime) in results:
+            print("%s AUC for run %d iteration %i is: %.2f" % (('MAT', 'PY')[task.modelIdx], task.runId,
+                                                               task.fold, roc))
+            yield task, roc, fitTime
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+
 def main():
     descStr = 'Compare and validate that python and matlab output agree. Specify '\
         'either a config file or a directory and runID to test'
@@ -192,10 +294,13 @@ def main():
     parser.add_argument('-e', action="store", dest="cfg")
     parser.add_argument('-d', action="store", dest="dir")
     parser.add_argument('-r', action="store", dest="runId", type=int)
+    parser.add_argument('--jobs', '-j', action="store", dest="jobs", type=int, default=1,
+                        help='worker processes for the cross-validation fold fits, default 1 runs them '
+                             'serially. More jobs are only faster on a machine with several CPUs')
     args = parser.parse_args()
     if args.cfg is not None:
         print("Validating using config file {}".format(args.cfg))
-        validateMatlabPython(args.cfg)
+        validateMatlabPython(args.cfg, args.jobs)
     elif args.dir is not None:
         if args.runId is None:
             print("Usage: must specify both a directory and runId")
@@ -204,7 +309,7 @@ def main():
         print("Validating using dir {}: runId {}".format(args.dir, args.runId))
         validatePatternsData(args.dir, args.dir, args.runId)
         validateFileprocessingTxt(args.dir, args.dir, args.runId)
-        crossvalidateModels(args.dir,args,dir,args.runId)
+        crossvalidateModels(args.dir, args.dir, args.runId, args.jobs)
     else:
         parser.print_help()
         return
@@ -10,104 +10,60 @@ An experiment is comprised as follows:
 """
 import os
 import logging
-from rtfMRI.Errors import ValidationError, RequestError
+from rtfMRI.Errors import RequestError
 from rtfMRI.StructDict import StructDict
+from rtfMRI.ModelState import ModelState
+from rtfMRI.MsgTypes import MsgEvent
 
 maxFileTransferSize = 1024**3  # 1 GB
 
+# the actor methods are the events of the messages to the TCP server
+Event = MsgEvent
 
-class Event:
-    NoneType        = 35
-    RetrieveData    = 36
-    DeleteData      = 37
-    StartSession    = 38
-    EndSession      = 39
-    StartRun        = 40
-    EndRun          = 41
-    TrainModel      = 42
-    StartBlockGroup = 43
-    EndBlockGroup   = 44
-    StartBlock      = 45
-    EndBlock        = 46
-    TRData          = 47
-    MaxType         = 48
-
-
-class BaseModel_Ray():
-    def __init__(self):
-        self.id_fields = StructDict()
-        self.id_fields.experimentId = 0
-        self.id_fields.sessionId = -1
-        self.id_fields.runId = -1
-        self.id_fields.blkGrpId = -1
-        self.id_fields.blockId = -1
-        self.id_fields.trId = -1
-        self.blockType = -1
-
-    def resetState(self):
-        self.id_fields.experimentId = -1
-        self.id_fields.sessionId = -1
-        self.id_fields.runId = -1
-        self.id_fields.blkGrpId = -1
-        self.id_fields.blockId = -1
-        self.id_fields.trId = -1
-        self.blockType = -1
 
+class BaseModel_Ray(ModelState):
     def StartSession(self, sessionId):
-        self.resetState()
-        self.id_fields.sessionId = sessionId
-        logging.info("Start Session: %s", self.id_fields.sessionId)
+        self.startSession(-1, sessionId)
         reply = makeReply(True)
         return reply
 
     def EndSession(self):
-        self.resetState()
+        self.endSession()
         reply = makeReply(True)
         return reply
 
     def StartRun(self, runId):
-        self.id_fields.runId = runId
-        self.id_fields.blkGrpId = -1
-        logging.info("Start Run: %s", self.id_fields.runId)
+        self.startRun(runId)
         reply = makeReply(True)
         return reply
 
     def EndRun(self):
-        self.id_fields.runId = -1
+        self.endRun()
         reply = makeReply(True)
         return reply
 
     def StartBlockGroup(self, blkGrpId):
-        self.id_fields.blkGrpId = blkGrpId
-        self.id_fields.blockId = -1
-        logging.info("Start BlockGroup: %s", self.id_fields.blkGrpId)
+        self.startBlockGroup(blkGrpId)
         reply = makeReply(True)
         return reply
 
     def EndBlockGroup(self):
-        self.id_fields.blkGrpId = -1
+        self.endBlockGroup()
         reply = makeReply(True)
         return reply
 
     def StartBlock(self, id_fields):
-        self.id_fields.blockId = id_fields.blockId
-        self.id_fields.trId = -1
-        logging.info("Start Block: %s", self.id_fields.blockId)
+        self.startBlock(id_fields.blockId)
         reply = makeReply(True)
         return reply
 
     def EndBlock(self):
-        self.id_fields.blockId = -1
+        self.endBlock()
         reply = makeReply(True)
         return reply
 
     def TRData(self, trId):
-        self.id_fields.trId = trId
-        logging.debug("Trial: %s", self.id_fields.trId)
-        # if self.blockType == BlockType.Train:
-        #     reply = self.model.TrainingData(msg)
-        # elif msg.event_type == BlockType.Predict:
-        #     reply = self.model.Predict(msg)
+        self.startTR(trId)
         reply = makeReply(True)
         return reply
 
@@ -137,30 +93,7 @@ class BaseModel_Ray():
         return errorReply
 
     def validateMsg(self, event_type, id_fields):
-        if event_type > Event.StartSession:
-            if id_fields.experimentId != self.id_fields.experimentId:
-                raise ValidationError("experimentId mismatch {} {}"
-                                      .format(self.id_fields.experimentId,
-                                              id_fields.experimentId))
-            if id_fields.sessionId != self.id_fields.sessionId:
-                raise ValidationError("sessionId mismatch {} {}"
-                                      .format(self.id_fields.sessionId,
-                                              id_fields.sessionId))
-        if event_type > Event.StartRun:
-            if id_fields.runId != self.id_fields.runId:
-                raise ValidationError("runId mismatch {} {}"
-                                      .format(self.id_fields.runId, id_fields.runId))
-        if event_type > Event.StartBlockGroup:
-            if id_fields.blkGrpId != self.id_fields.blkGrpId:
-                raise ValidationError("blkGrpId mismatch {} {}"
-                                      .format(self.id_fields.blockId,
-                                              id_fields.blockId))
-        if event_type > Event.StartBlock:
-            if id_fields.blockId != self.id_fields.blockId:
-                raise ValidationError("blockId mismatch {} {}"
-                                      .format(self.id_fields.blockId,
-                                              id_fields.blockId))
-        return
+        self.validateIds(event_type, id_fields)
 
 
 def makeReply(success):
@@ -16,16 +16,18 @@ rootPath = os.path.join(scriptPath, "../")
 sys.path.append(rootPath)
 import rtfMRI.utils as utils
 import rtfMRI.ReadDicom as ReadDicom
-from rtfMRI.StructDict import StructDict
+from rtfMRI.StructDict import StructDict, copy_toplevel
 from rtfMRI.RtfMRIClient import loadConfigFile, validateSessionCfg, validateRunCfg
 from rtfMRI.Errors import InvocationError, ValidationError
 import rtAtten.PatternsDesign2Config as Pats
+from rtAtten.PatternsDesign2Config import getRunIndex
 from rtAttenRay.RtAttenModel_Ray import RtAttenModel_Ray, getSubjectDataDir, getBlkGrpFilename, getModelFilename
 import ray
 
 
 def ClientMain(config: str, rayremote: str):
-    ray.init(redis_address=rayremote)
+    # with no address a local ray cluster is started
+    ray.init(address=rayremote)
     RtAttenModel_Remote = ray.remote(RtAttenModel_Ray)
 
     rtatten = RtAttenModel_Remote.remote()
@@ -34,8 +36,8 @@ def ClientMain(config: str, rayremote: str):
     client.start_session(cfg)
     subjectDataDir = getSubjectDataDir(cfg.session.dataDir, cfg.session.subjectNum, cfg.session.subjectDay)
     for runId in cfg.session.Runs:
-        patterns, _ = Pats.getLocalPatternsFile(cfg.session, subjectDataDir, runId)
-        run = Pats.createRunConfig(cfg.session, patterns, runId)
+        runSchedule, _ = Pats.getLocalRunSchedule(cfg.session, subjectDataDir, runId)
+        run = Pats.createRunConfigFromSchedule(cfg.session, runSchedule, runId)
         validateRunCfg(run)
         client.do_run(run)
     client.end_session()
@@ -54,6 +56,8 @@ class LocalClient():
         self.logtimeFile = None
         self.id_fields = StructDict()
         self.rtatten = rtatten
+        # the run whose model is still training and that run's open output file
+        self.pendingTrain = None
 
     def start_session(self, cfg):
         self.cfg = cfg
@@ -70,10 +74,19 @@ class LocalClient():
         # Set Directories
         self.dirs.dataDir = getSubjectDataDir(cfg.session.dataDir, cfg.session.subjectNum, cfg.session.subjectDay)
         print("Mask and patterns files being read from: {}".format(self.dirs.dataDir))
-        self.dirs.serverDataDir = os.path.join(cfg.session.serverDataDir, subjectDayDir)
+        # the run output files, apart from the session's input files when reprocessing
+        self.dirs.outputDataDir = self.dirs.dataDir
+        if cfg.session.outputDataDir is not None:
+            self.dirs.outputDataDir = getSubjectDataDir(cfg.session.outputDataDir, cfg.session.subjectNum,
+                                                        cfg.session.subjectDay)
+        self.dirs.serverDataDir = getSubjectDataDir(cfg.session.serverDataDir, cfg.session.subjectNum,
+                                                    cfg.session.subjectDay)
         if not os.path.exists(self.dirs.serverDataDir):
             os.makedirs(self.dirs.serverDataDir)
-        if cfg.session.buildImgPath:
+        if cfg.session.replayMatFileMode and not cfg.session.rtData:
+            # replaying the runs' patterns data, no images to watch for
+            self.dirs.imgDir = None
+        elif cfg.session.buildImgPath:
             imgDirDate = datetime.datetime.now()
             dateStr = cfg.session.date.lower()
             if dateStr != 'now' and dateStr != 'today':
@@ -89,13 +102,16 @@ class LocalClient():
             self.dirs.imgDir = os.path.join(cfg.session.imgDir, imgDirName)
         else:
             self.dirs.imgDir = cfg.session.imgDir
-        if not os.path.exists(self.dirs.imgDir):
-            os.makedirs(self.dirs.imgDir)
-        print("fMRI files being read from: {}".format(self.dirs.imgDir))
-        self.initFileNotifier(self.dirs.imgDir, cfg.session.watchFilePattern)
+        if self.dirs.imgDir is not None:
+            if not os.path.exists(self.dirs.imgDir):
+                os.makedirs(self.dirs.imgDir)
+            print("fMRI files being read from: {}".format(self.dirs.imgDir))
+            self.initFileNotifier(self.dirs.imgDir, cfg.session.watchFilePattern)
 
         # Open file for logging processing time measurements
-        logtimeFilename = os.path.join(self.dirs.dataDir, "logtime.txt")
+        if not os.path.exists(self.dirs.outputDataDir):
+            os.makedirs(self.dirs.outputDataDir)
+        logtimeFilename = os.path.join(self.dirs.outputDataDir, "logtime.txt")
         self.logtimeFile = open(logtimeFilename, "a", 1)  # linebuffered=1
         initLogStr = "## Start Session: date:{} subNum:{} subDay:{} ##\n".format(
                      datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
@@ -116,25 +132,54 @@ class LocalClient():
         print("Using mask {}".format(maskFileName))
         replyId = self.rtatten.StartSession.remote(cfg.session)
         reply = ray.get(replyId)
-        assert reply.success is True
+        assert reply.success is True, reply.errorMsg
 
     def end_session(self):
-        pass
+        self.collectTrainResult()
+        replyId = self.rtatten.EndSession.remote()
+        reply = ray.get(replyId)
+        assert reply.success is True, reply.errorMsg
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer = None
+        if self.logtimeFile is not None:
+            self.logtimeFile.close()
+            self.logtimeFile = None
+
+    def collectTrainResult(self):
+        """Write the output of the previous run's model training, done in a task
+        overlapping this run, to the previous run's output file.
+        """
+        if self.pendingTrain is None:
+            return
+        runId, outputFile = self.pendingTrain
+        self.pendingTrain = None
+        replyId = self.rtatten.TrainModelResult.remote(runId)
+        reply = ray.get(replyId)
+        assert reply.success is True, reply.errorMsg
+        outputReplyLines(reply.outputlns, outputFile)
+        outputFile.close()
+        if self.cfg.session.retrieveServerFiles:
+            self.retrieveFile(getModelFilename(self.id_fields.sessionId, runId))
 
     def do_run(self, run):
         # Setup output directory and output file
-        runDataDir = os.path.join(self.dirs.dataDir, 'run' + str(run.runId))
+        runDataDir = os.path.join(self.dirs.outputDataDir, 'run' + str(run.runId))
         if not os.path.exists(runDataDir):
             os.makedirs(runDataDir)
         classOutputDir = os.path.join(runDataDir, 'classoutput')
         if not os.path.exists(classOutputDir):
             os.makedirs(classOutputDir)
         outputFile = open(os.path.join(runDataDir, 'fileprocessing_py.txt'), 'w+')
-
-        replyId = self.rtatten.StartRun.remote(run)
-        reply = ray.get(replyId)
-        assert reply.success is True
-        outputReplyLines(reply.outputlns, outputFile)
+        replay = self.cfg.session.replayMatFileMode and not self.cfg.session.rtData
+        if replay or self.cfg.session.validate:
+            idx = getRunIndex(self.cfg.session, run.runId)
+            if idx < 0 or len(self.cfg.session.validationModels) <= idx or \
+                    len(self.cfg.session.validationData) <= idx:
+                raise ValidationError("Insufficient config runs, validationModels or validationData specified: "
+                                      "runId {}, idx {}".format(run.runId, idx))
+            run.validationModel = os.path.join(self.dirs.dataDir, self.cfg.session.validationModels[idx])
+            run.validationDataFile = os.path.join(self.dirs.dataDir, self.cfg.session.validationData[idx])
 
         # ** Experimental Parameters ** #
         run.seed = time.time()
@@ -143,53 +188,74 @@ class LocalClient():
         else:
             run.rtfeedback = 0
 
+        # the run's schedule and block groups stay with the client
+        replyId = self.rtatten.StartRun.remote(copy_toplevel(run))
+        reply = ray.get(replyId)
+        assert reply.success is True, reply.errorMsg
+        outputReplyLines(reply.outputlns, outputFile)
+        if replay:
+            # load previous patterns data for this run
+            run.replay_data = utils.loadMatFile(run.validationDataFile).patterns.raw
+
         for blockGroup in run.blockGroups:
-            replyId = self.rtatten.StartBlockGroup.remote(blockGroup)
+            if blockGroup.type == 2:
+                # the predict phase waits for the previous run's model anyway
+                self.collectTrainResult()
+            replyId = self.rtatten.StartBlockGroup.remote(copy_toplevel(blockGroup))
             reply = ray.get(replyId)
-            assert reply.success is True
+            assert reply.success is True, reply.errorMsg
             outputReplyLines(reply.outputlns, outputFile)
             for block in blockGroup.blocks:
-                replyId = self.rtatten.StartBlock.remote(block)
+                replyId = self.rtatten.StartBlock.remote(copy_toplevel(block))
                 reply = ray.get(replyId)
-                assert reply.success is True
+                assert reply.success is True, reply.errorMsg
                 outputReplyLines(reply.outputlns, outputFile)
+                # The actor runs the TRs in the order sent, so the next TR is read
+                # while it processes the previous ones. Replies are collected at the end
+                # of the block, or right away for feedback in a real-time predict phase.
+                waitEachTR = self.cfg.session.rtData and blockGroup.type == 2
+                replyIds = []
                 for TR in block.TRs:
-                    # Assuming the output file volumes are still 1's based
-                    fileNum = TR.vol + run.disdaqs // run.TRTime
-                    trVolumeData = self.getNextTRData(run, fileNum)
-                    TR.data = ReadDicom.applyMask(trVolumeData, self.cfg.session.roiInds)
-                    replyId = self.rtatten.TRData.remote(TR)
-                    reply = ray.get(replyId)
-                    assert reply.success is True
-                    outputReplyLines(reply.outputlns, outputFile)
-                    outputPredictionFile(reply.predict, classOutputDir)
+                    if replay:
+                        # TR.vol is 1's based to match matlab, so we want vol-1 for zero based indexing
+                        TR.data = run.replay_data[TR.vol-1]
+                    else:
+                        # Assuming the output file volumes are still 1's based
+                        fileNum = TR.vol + run.disdaqs // run.TRTime
+                        trVolumeData = self.getNextTRData(run, fileNum)
+                        TR.data = ReadDicom.applyMask(trVolumeData, self.cfg.session.roiInds)
+                    replyIds.append(self.rtatten.TRData.remote(TR))
+                    if waitEachTR:
+                        outputTRReplies(replyIds, outputFile, classOutputDir)
+                outputTRReplies(replyIds, outputFile, classOutputDir)
                 replyId = self.rtatten.EndBlock.remote()
                 reply = ray.get(replyId)
-                assert reply.success is True
+                assert reply.success is True, reply.errorMsg
                 outputReplyLines(reply.outputlns, outputFile)
             replyId = self.rtatten.EndBlockGroup.remote()
             reply = ray.get(replyId)
-            assert reply.success is True
+            assert reply.success is True, reply.errorMsg
             outputReplyLines(reply.outputlns, outputFile)
         trainCfg = makeTrainCfg(run)
         replyId = self.rtatten.TrainModel.remote(trainCfg)
         reply = ray.get(replyId)
-        assert reply.success is True
+        assert reply.success is True, reply.errorMsg
         outputReplyLines(reply.outputlns, outputFile)
         replyId = self.rtatten.EndRun.remote()
         reply = ray.get(replyId)
-        assert reply.success is True
+        assert reply.success is True, reply.errorMsg
         outputReplyLines(reply.outputlns, outputFile)
         if self.cfg.session.retrieveServerFiles:
             self.retrieveRunFiles(run.runId)
+        # the model trains while the next run starts, its output and model file are
+        # collected at the next run's predict phase or the end of the session
+        self.pendingTrain = (run.runId, outputFile)
 
     def retrieveRunFiles(self, runId):
         blkGrp1_filename = getBlkGrpFilename(self.id_fields.sessionId, runId, 1)
         self.retrieveFile(blkGrp1_filename)
         blkGrp2_filename = getBlkGrpFilename(self.id_fields.sessionId, runId, 2)
         self.retrieveFile(blkGrp2_filename)
-        model_filename = getModelFilename(self.id_fields.sessionId, runId)
-        self.retrieveFile(model_filename)
 
     def retrieveFile(self, filename):
         print("Retrieving data for {}... ".format(filename), end='')
@@ -200,7 +266,7 @@ class LocalClient():
         stime = time.time()
         replyId = self.rtatten.RetrieveData.remote(fileInfo)
         reply = ray.get(replyId)
-        assert reply.success is True
+        assert reply.success is True, reply.errorMsg
         print("took {:.2f} secs".format(time.time() - stime))
         clientFile = os.path.join(self.dirs.dataDir, filename)
         writeFile(clientFile, reply.data)
@@ -285,6 +351,15 @@ def makeTrainCfg(run):
     return trainCfg
 
 
+def outputTRReplies(replyIds, outputFile, classOutputDir):
+    """Wait for the TRData replies sent so far and output them in order"""
+    for reply in ray.get(replyIds):
+        assert reply.success is True, reply.errorMsg
+        outputReplyLines(reply.outputlns, outputFile)
+        outputPredictionFile(reply.predict, classOutputDir)
+    replyIds.clear()
+
+
 def outputPredictionFile(predict, classOutputDir):
     if predict is None or predict.vol is None:
         return
@@ -9,34 +9,25 @@ An experiment is comprised as follows:
               - Trial (1 or more data scans recieved per block)
 """
 import os
+import hashlib
 import logging
+from . import utils
+from .dirIndex import getDirIndex
 from .Messaging import Message
 from .MsgTypes import MsgType, MsgEvent, MsgResult
-from .Errors import ValidationError, RequestError
-from .StructDict import StructDict
+from .Errors import RequestError
+from .ModelState import ModelState
 
 maxFileTransferSize = 1024**3  # 1 GB
+maxChunkSize = 64 * 1024**2  # 64 MB, largest RetrieveSession chunk
+streamChunkSize = 4 * 1024**2  # 4 MB, RetrieveData file chunk replies
 
 
-class BaseModel():
+class BaseModel(ModelState):
     def __init__(self):
-        self.id_fields = StructDict()
-        self.id_fields.experimentId = -1
-        self.id_fields.sessionId = -1
-        self.id_fields.runId = -1
-        self.id_fields.blkGrpId = -1
-        self.id_fields.blockId = -1
-        self.id_fields.trId = -1
-        self.blockType = -1
-
-    def resetState(self):
-        self.id_fields.experimentId = -1
-        self.id_fields.sessionId = -1
-        self.id_fields.runId = -1
-        self.id_fields.blkGrpId = -1
-        self.id_fields.blockId = -1
-        self.id_fields.trId = -1
-        self.blockType = -1
+        super().__init__()
+        # md5 of files listed by RetrieveSession, keyed by filename with the size and mtime hashed
+        self.fileHashCache = {}  # type: ignore
 
     def handleMessage(self, msg):
         """Handle client request and create reply
@@ -64,10 +55,14 @@ class BaseModel():
             reply = self.EndBlock(msg)
         elif msg.event_type == MsgEvent.TRData:
             reply = self.TRData(msg)
+        elif msg.event_type == MsgEvent.BatchTRData:
+            reply = self.BatchTRData(msg)
         elif msg.event_type == MsgEvent.TrainModel:
             reply = self.TrainModel(msg)
         elif msg.event_type == MsgEvent.RetrieveData:
             reply = self.RetrieveData(msg)
+        elif msg.event_type == MsgEvent.RetrieveSession:
+            reply = self.RetrieveSession(msg)
         elif msg.event_type == MsgEvent.DeleteData:
             reply = self.DeleteData(msg)
         else:
@@ -77,30 +72,7 @@ class BaseModel():
         return reply
 
     def validateMsg(self, msg):
-        if msg.event_type > MsgEvent.StartSession:
-            if msg.fields.ids.experimentId != self.id_fields.experimentId:
-                raise ValidationError("experimentId mismatch {} {}"
-                                      .format(self.id_fields.experimentId,
-                                              msg.fields.ids.experimentId))
-            if msg.fields.ids.sessionId != self.id_fields.sessionId:
-                raise ValidationError("sessionId mismatch {} {}"
-                                      .format(self.id_fields.sessionId,
-                                              msg.fields.ids.sessionId))
-        if msg.event_type > MsgEvent.StartRun:
-            if msg.fields.ids.runId != self.id_fields.runId:
-                raise ValidationError("runId mismatch {} {}"
-                                      .format(self.id_fields.runId, msg.fields.ids.runId))
-        if msg.event_type > MsgEvent.StartBlockGroup:
-            if msg.fields.ids.blkGrpId != self.id_fields.blkGrpId:
-                raise ValidationError("blkGrpId mismatch {} {}"
-                                      .format(self.id_fields.blockId,
-                                              msg.fields.ids.blockId))
-        if msg.event_type > MsgEvent.StartBlock:
-            if msg.fields.ids.blockId != self.id_fields.blockId:
-                raise ValidationError("blockId mismatch {} {}"
-                                      .format(self.id_fields.blockId,
-                                              msg.fields.ids.blockId))
-        return
+        self.validateIds(msg.event_type, msg.fields.ids)
 
     def createReplyMessage(self, msg, result_type):
         rmsg = Message()
@@ -117,55 +89,44 @@ class BaseModel():
         return rmsg
 
     def StartSession(self, msg):
-        self.resetState()
-        self.id_fields.experimentId = msg.fields.ids.experimentId
-        self.id_fields.sessionId = msg.fields.ids.sessionId
-        logging.info("Start Session: %s", self.id_fields.sessionId)
+        self.startSession(msg.fields.ids.experimentId, msg.fields.ids.sessionId)
         return self.createReplyMessage(msg, MsgResult.Success)
 
     def EndSession(self, msg):
-        self.resetState()
+        self.endSession()
         return self.createReplyMessage(msg, MsgResult.Success)
 
     def StartRun(self, msg):
-        self.id_fields.runId = msg.fields.ids.runId
-        self.id_fields.blkGrpId = -1
-        logging.info("Start Run: %s", self.id_fields.runId)
+        self.startRun(msg.fields.ids.runId)
         return self.createReplyMessage(msg, MsgResult.Success)
 
     def EndRun(self, msg):
-        logging.info("End Run: %s", self.id_fields.runId)
-        self.id_fields.runId = -1
+        self.endRun()
         return self.createReplyMessage(msg, MsgResult.Success)
 
     def StartBlockGroup(self, msg):
-        self.id_fields.blkGrpId = msg.fields.ids.blkGrpId
-        self.id_fields.blockId = -1
-        logging.info("Start BlockGroup: %s", self.id_fields.blkGrpId)
+        self.startBlockGroup(msg.fields.ids.blkGrpId)
         return self.createReplyMessage(msg, MsgResult.Success)
 
     def EndBlockGroup(self, msg):
-        logging.info("End BlockGroup: %s", self.id_fields.blkGrpId)
-        self.id_fields.blkGrpId = -1
+        self.endBlockGroup()
         return self.createReplyMessage(msg, MsgResult.Success)
 
     def StartBlock(self, msg):
-        self.id_fields.blockId = msg.fields.ids.blockId
-        self.id_fields.trId = -1
-        logging.info("Start Block: %s", self.id_fields.blockId)
+        self.startBlock(msg.fields.ids.blockId)
         return self.createReplyMessage(msg, MsgResult.Success)
 
     def EndBlock(self, msg):
-        self.id_fields.blockId = -1
+        self.endBlock()
         return self.createReplyMessage(msg, MsgResult.Success)
 
     def TRData(self, msg):
+        self.startTR(msg.fields.ids.trId)
+        return self.createReplyMessage(msg, MsgResult.Success)
+
+    def BatchTRData(self, msg):
         self.id_fields.trId = msg.fields.ids.trId
-        logging.debug("Trial: %s", self.id_fields.trId)
-        # if self.blockType == BlockType.Train:
-        #     reply = self.model.TrainingData(msg)
-        # elif msg.event_type == BlockType.Predict:
-        #     reply = self.model.Predict(msg)
+        logging.debug("Trials: %s", [TR.trId for TR in msg.fields.cfg.TRs])
         return self.createReplyMessage(msg, MsgResult.Success)
 
     def TrainModel(self, msg):
@@ -173,21 +134,102 @@ class BaseModel():
         return self.createReplyMessage(msg, MsgResult.Success)
 
     def RetrieveData(self, msg):
+        """Retrieve file msg.fields.cfg. The reply gives the file size and is followed
+        by a stream of replies with the file data in chunks, see streamFile.
+        """
         filename = msg.fields.cfg
-        data = None
         try:
             filesize = os.path.getsize(filename)
             if filesize > maxFileTransferSize:
                 raise RequestError("file %s, size %d exceeds max size %d" % (filename, filesize, maxFileTransferSize))
             logging.info("Reading file %s, size %d" % (filename, filesize))
-            with open(filename, 'rb') as fh:
-                data = fh.read()
+            fh = open(filename, 'rb')
             reply = self.createReplyMessage(msg, MsgResult.Success)
-            reply.data = data
+            reply.fields.size = filesize
+            reply.stream = self.streamFile(msg, fh)
         except Exception as err:
             reply = self.createReplyMessage(msg, MsgResult.Error)
             reply.data = "Error reading file: %s: %s" % (filename, str(err))
         return reply
 
+    def streamFile(self, msg, fh):
+        """Yields replies with the file data in chunks of streamChunkSize and then a
+        trailer reply, fields.trailer set, with the size and md5 of the data sent.
+        A read error ends the stream with an error trailer.
+        """
+        md5 = hashlib.md5()
+        offset = 0
+        try:
+            while True:
+                data = fh.read(streamChunkSize)
+                if len(data) == 0:
+                    break
+                md5.update(data)
+                reply = self.createReplyMessage(msg, MsgResult.Success)
+                reply.fields.offset = offset
+                reply.data = data
+                offset += len(data)
+                yield reply
+            trailer = self.createReplyMessage(msg, MsgResult.Success)
+            trailer.fields.size = offset
+            trailer.fields.md5 = md5.hexdigest()
+        except Exception as err:
+            trailer = self.createReplyMessage(msg, MsgResult.Error)
+            trailer.data = "Error reading file: %s: %s" % (fh.name, str(err))
+        finally:
+            fh.close()
+        trailer.fields.trailer = True
+        yield trailer
+
+    def RetrieveSession(self, msg):
+        """Bulk retrieval of the files in directory cfg.dataDir. A 'manifest' request lists
+        the files matching cfg.filePatterns with their size and md5, only the newest match
+        of each pattern if cfg.findNewest is set. A 'chunk' request returns cfg.size bytes
+        of file cfg.filename starting at cfg.offset.
+        """
+        fileInfo = msg.fields.cfg
+        try:
+            if fileInfo.op == 'manifest':
+                reply = self.createReplyMessage(msg, MsgResult.Success)
+                reply.fields.manifest = self.getManifest(fileInfo.dataDir, fileInfo.filePatterns,
+                                                         fileInfo.findNewest)
+            elif fileInfo.op == 'chunk':
+                if os.path.basename(fileInfo.filename) != fileInfo.filename:
+                    raise RequestError("file %s not in the data directory" % (fileInfo.filename))
+                if fileInfo.size > maxChunkSize:
+                    raise RequestError("chunk size %d exceeds max size %d" % (fileInfo.size, maxChunkSize))
+                with open(os.path.join(fileInfo.dataDir, fileInfo.filename), 'rb') as fh:
+                    fh.seek(fileInfo.offset)
+                    data = fh.read(fileInfo.size)
+                reply = self.createReplyMessage(msg, MsgResult.Success)
+                reply.data = data
+            else:
+                raise RequestError("unknown op %s" % (fileInfo.op))
+        except Exception as err:
+            reply = self.createReplyMessage(msg, MsgResult.Error)
+            reply.data = "Error retrieving session files: %s" % (str(err))
+        return reply
+
+    def getManifest(self, dataDir, filePatterns, findNewest=False):
+        manifest = []
+        listed = set()
+        for pattern in filePatterns:
+            if findNewest is True:
+                filename = utils.findNewestFile(dataDir, pattern)
+                filenames = [] if filename is None else [filename]
+            else:
+                filenames = sorted(getDirIndex().getMatches(os.path.join(dataDir, pattern)))
+            for filename in filenames:
+                if filename in listed or not os.path.isfile(filename):
+                    continue
+                listed.add(filename)
+                stat = os.stat(filename)
+                cached = self.fileHashCache.get(filename)
+                if cached is None or cached[:2] != (stat.st_size, stat.st_mtime_ns):
+                    cached = (stat.st_size, stat.st_mtime_ns, utils.fileMd5(filename))
+                    self.fileHashCache[filename] = cached
+                manifest.append({'filename': os.path.basename(filename), 'size': stat.st_size, 'md5': cached[2]})
+        return manifest
+
     def DeleteData(self, msg):
         return self.createReplyMessage(msg, MsgResult.Error)
@@ -7,7 +7,7 @@ import os
 import struct
 import logging
 import pyarrow as pa
-from .StructDict import StructDict
+from .StructDict import StructDict, TRView
 from .MsgTypes import MsgType, MsgEvent, MsgResult
 from .Errors import MessageError, ValidationError
 
@@ -27,6 +27,7 @@ HDR_MAGIC = 0xFEEDFEED
 
 MAX_META_SIZE = 64 * 1024
 MAX_TR_SIZE = 1024**2  # 1 MB
+MAX_BATCH_TR_SIZE = 256 * 1024**2  # 256 MB
 MAX_SESSION_SIZE = 1024**2  # 1 MB
 MAX_DATA_SIZE = 1024**3  # 1 GB
 
@@ -44,6 +45,8 @@ class Message():
         self.id = -1
         self.fields = StructDict()
         self.data = b''
+        # replies the server sends following this one, e.g. file data chunks, not serialized
+        self.stream = None
 
     def __repr__(self):
         data_len = 0 if self.data is None else len(self.data)
@@ -87,6 +90,14 @@ def _deserialize_StructDict(data):
     return StructDict(data)
 
 
+def _serialize_TRView(tr):
+    return tr.values()
+
+
+def _deserialize_TRView(data):
+    return TRView(*data)
+
+
 pyarrow_context = pa.SerializationContext()
 pyarrow_context.register_type(Message, 'Message',
                       custom_serializer=_serialize_Message,
@@ -94,6 +105,9 @@ pyarrow_context.register_type(Message, 'Message',
 pyarrow_context.register_type(StructDict, 'StructDict',
                       custom_serializer=_serialize_StructDict,
                       custom_deserializer=_deserialize_StructDict)
+pyarrow_context.register_type(TRView, 'TRView',
+                      custom_serializer=_serialize_TRView,
+                      custom_deserializer=_deserialize_TRView)
 
 
 class RtMessagingClient:
@@ -218,12 +232,15 @@ def validateHeader(msg_type, msg_event_type, msg_size):
     elif msg_event_type < MsgEvent.NoneType or msg_event_type >= MsgEvent.MaxType:
         raise MessageError("Invalid event_type {}".format(msg_event_type))
 
-    if msg_event_type == MsgEvent.RetrieveData:
+    if msg_event_type in (MsgEvent.RetrieveData, MsgEvent.RetrieveSession):
         if msg_size > MAX_DATA_SIZE:
             raise MessageError("RetrieveData Message size {} exceeded {}".format(msg_size, MAX_DATA_SIZE))
     elif msg_event_type == MsgEvent.TRData:
         if msg_size > MAX_TR_SIZE:
             raise MessageError("TRData Message size {} exceeded {}".format(msg_size, MAX_TR_SIZE))
+    elif msg_event_type == MsgEvent.BatchTRData:
+        if msg_size > MAX_BATCH_TR_SIZE:
+            raise MessageError("BatchTRData Message size {} exceeded {}".format(msg_size, MAX_BATCH_TR_SIZE))
     elif msg_event_type == MsgEvent.StartSession:
         if msg_size > MAX_SESSION_SIZE:
             raise MessageError("StartSession Message size {} exceeded {}".format(msg_size, MAX_SESSION_SIZE))
@@ -233,19 +250,20 @@ def validateHeader(msg_type, msg_event_type, msg_size):
 
 def recvall(conn, count):
     """Read 'count' bytes from a socket connection. Will loop and continue
-    reading until all count bytes are read.
+    reading until all count bytes are read. Reads into a preallocated buffer
+    so a large message isn't held twice while being assembled.
     Returns: byte buffer
     Exceptions: None
     """
-    packetByteList = []
+    buf = bytearray(count)
+    view = memoryview(buf)
     while count:
         # socket.recv no longer can throw InterruptedError as of python 3.5
-        packet = conn.recv(count)
-        if not packet:
+        numBytes = conn.recv_into(view, count)
+        if numBytes == 0:
             raise socket.error("recvall: disconnected")
-        packetByteList.append(packet)
-        count -= len(packet)
-    buf = b''.join(packetByteList)
+        view = view[numBytes:]
+        count -= numBytes
     return buf
 
 
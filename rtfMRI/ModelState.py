@@ -0,0 +1,92 @@
+"""
+ModelState - The experiment ids a model is at, kept the same way by the models
+of all backends (the TCP server BaseModel and the Ray BaseModel_Ray).
+See BaseModel for how an experiment is comprised.
+"""
+import logging
+from .MsgTypes import MsgEvent
+from .Errors import ValidationError
+from .StructDict import StructDict
+
+
+class ModelState():
+    def __init__(self):
+        self.id_fields = StructDict()
+        self.resetState()
+
+    def resetState(self):
+        self.id_fields.experimentId = -1
+        self.id_fields.sessionId = -1
+        self.id_fields.runId = -1
+        self.id_fields.blkGrpId = -1
+        self.id_fields.blockId = -1
+        self.id_fields.trId = -1
+        self.blockType = -1
+
+    def startSession(self, experimentId, sessionId):
+        self.resetState()
+        self.id_fields.experimentId = experimentId
+        self.id_fields.sessionId = sessionId
+        logging.info("Start Session: %s", self.id_fields.sessionId)
+
+    def endSession(self):
+        self.resetState()
+
+    def startRun(self, runId):
+        self.id_fields.runId = runId
+        self.id_fields.blkGrpId = -1
+        logging.info("Start Run: %s", self.id_fields.runId)
+
+    def endRun(self):
+        logging.info("End Run: %s", self.id_fields.runId)
+        self.id_fields.runId = -1
+
+    def startBlockGroup(self, blkGrpId):
+        self.id_fields.blkGrpId = blkGrpId
+        self.id_fields.blockId = -1
+        logging.info("Start BlockGroup: %s", self.id_fields.blkGrpId)
+
+    def endBlockGroup(self):
+        logging.info("End BlockGroup: %s", self.id_fields.blkGrpId)
+        self.id_fields.blkGrpId = -1
+
+    def startBlock(self, blockId):
+        self.id_fields.blockId = blockId
+        self.id_fields.trId = -1
+        logging.info("Start Block: %s", self.id_fields.blockId)
+
+    def endBlock(self):
+        self.id_fields.blockId = -1
+
+    def startTR(self, trId):
+        self.id_fields.trId = trId
+        logging.debug("Trial: %s", self.id_fields.trId)
+
+    def validateIds(self, event_type, ids):
+        """Check the ids of a request of type event_type (a MsgEvent) against the
+        current state. Raises ValidationError on a mismatch.
+        """
+        if event_type > MsgEvent.StartSession:
+            if ids.experimentId != self.id_fields.experimentId:
+                raise ValidationError("experimentId mismatch {} {}"
+                                      .format(self.id_fields.experimentId,
+                                              ids.experimentId))
+            if ids.sessionId != self.id_fields.sessionId:
+                raise ValidationError("sessionId mismatch {} {}"
+                                      .format(self.id_fields.sessionId,
+                                              ids.sessionId))
+        if event_type > MsgEvent.StartRun:
+            if ids.runId != self.id_fields.runId:
+                raise ValidationError("runId mismatch {} {}"
+                                      .format(self.id_fields.runId, ids.runId))
+        if event_type > MsgEvent.StartBlockGroup:
+            if ids.blkGrpId != self.id_fields.blkGrpId:
+                raise ValidationError("blkGrpId mismatch {} {}"
+                                      .format(self.id_fields.blkGrpId,
+                                              ids.blkGrpId))
+        if event_type > MsgEvent.StartBlock:
+            if ids.blockId != self.id_fields.blockId:
+                raise ValidationError("blockId mismatch {} {}"
+                                      .format(self.id_fields.blockId,
+                                              ids.blockId))
+        return
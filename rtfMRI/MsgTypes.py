@@ -12,6 +12,7 @@ class MsgType:
 
 class MsgEvent:
     NoneType        = 31
+    RetrieveSession = 33
     FeedSync        = 34
     Ping            = 35
     SyncClock       = 36
@@ -27,7 +28,8 @@ class MsgEvent:
     StartBlock      = 46
     EndBlock        = 47
     TRData          = 48
-    MaxType         = 49
+    BatchTRData     = 49
+    MaxType         = 50
 
 class MsgResult:
     NoneType = 0
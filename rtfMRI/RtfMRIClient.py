@@ -9,12 +9,15 @@ import pathlib
 import time
 import re
 import logging
+from collections import deque
 from .StructDict import StructDict, recurseCreateStructDict
 from .Messaging import RtMessagingClient, Message
 from .utils import getGitCodeId
 from .MsgTypes import MsgType, MsgEvent, MsgResult
 from .Errors import ValidationError, RequestError, InvocationError, StateError
 
+clockSyncMaxAge = 600  # seconds a clock sync is reused for by sessions on the same connection
+
 
 class RtfMRIClient():
     """
@@ -26,6 +29,7 @@ class RtfMRIClient():
         self.cfg = None
         self.msg_id = 0
         self.messaging = None
+        self.clockSync = None
         self.id_fields = StructDict()
 
     def __del__(self):
@@ -55,7 +59,7 @@ class RtfMRIClient():
         msg.set(self.msg_id, msg_type, msg_event)
         return msg
 
-    def runSession(self, addr, port, cfg):
+    def runSession(self, addr, port, cfg, keepConnection=False):
         try:
             if self.messaging is None:
                 self.connect(addr, port)
@@ -66,7 +70,8 @@ class RtfMRIClient():
             logging.log(logging.ERROR, "Client exception: %s", str(err))
             raise err
         finally:
-            self.close()
+            if not keepConnection:
+                self.close()
 
     def initSession(self, cfg):
         self.cfg = cfg
@@ -74,8 +79,18 @@ class RtfMRIClient():
         self.modelName = cfg.experiment.model
         self.initModel(self.modelName)
 
-        # calculate clockSkew and round-trip time
-        self.calculateclockSkew()
+        # calculate clockSkew and round-trip time, or reuse a recent one from this connection
+        maxAge = clockSyncMaxAge
+        if cfg.session.clockSyncMaxAge is not None:
+            maxAge = cfg.session.clockSyncMaxAge
+        if self.clockSync is not None and time.time() - self.clockSync.time < maxAge:
+            self.cfg.minRTT = self.clockSync.minRTT
+            self.cfg.maxRTT = self.clockSync.maxRTT
+            self.cfg.clockSkew = self.clockSync.clockSkew
+            logging.info("Reusing clock sync from {:.0f}s ago, ClockSkew {:.3f}s".format(
+                         time.time() - self.clockSync.time, self.cfg.clockSkew))
+        else:
+            self.calculateclockSkew()
 
         self.id_fields = StructDict()
         self.id_fields.experimentId = cfg.experiment.experimentId
@@ -103,12 +118,22 @@ class RtfMRIClient():
         self.messaging.sendRequest(msg)
 
     def sendExpectSuccess(self, msg_type, msg_event, msg_fields, data=None):
+        msg = self.sendRequestMsg(msg_type, msg_event, msg_fields, data)
+        return self.getReplyExpectSuccess(msg)
+
+    def sendRequestMsg(self, msg_type, msg_event, msg_fields, data=None):
         msg = self.message(msg_type, msg_event)
         msg.fields.ids = self.id_fields
         msg.fields.cfg = msg_fields
         msg.data = data
         self.messaging.sendRequest(msg)
-        reply = self.messaging.getReply()
+        return msg
+
+    def getReplyExpectSuccess(self, msg, reply=None):
+        msg_type = msg.type
+        msg_event = msg.event_type
+        if reply is None:
+            reply = self.messaging.getReply()
         if reply.type != MsgType.Reply:
             raise StateError('sendExpectSuccess: reply message wrong type {}'.
                              format(reply.type))
@@ -150,6 +175,55 @@ class RtfMRIClient():
     def sendCmdExpectSuccess(self, msg_event, msg_fields, data=None):
         return self.sendExpectSuccess(MsgType.Command, msg_event, msg_fields, data)
 
+    def sendCmdsPipelined(self, msg_event, msgFieldsList, maxInFlight):
+        """Send a command for each of msgFieldsList keeping up to maxInFlight requests
+        sent ahead of their replies, so a series of requests isn't paced by the round trip.
+        The server handles requests in order. Yields (msg_fields, reply) in request order.
+        """
+        pending = deque()  # type: ignore
+        try:
+            for msg_fields in msgFieldsList:
+                if len(pending) >= maxInFlight:
+                    msg, prevFields = pending.popleft()
+                    yield prevFields, self.getReplyExpectSuccess(msg)
+                pending.append((self.sendRequestMsg(MsgType.Command, msg_event, msg_fields), msg_fields))
+            while len(pending) > 0:
+                msg, prevFields = pending.popleft()
+                yield prevFields, self.getReplyExpectSuccess(msg)
+        finally:
+            # if stopped early read the replies still on their way, so the
+            #   connection is left in step for the next request
+            try:
+                for _ in pending:
+                    self.messaging.getReply()
+            except Exception as err:
+                logging.warning('sendCmdsPipelined: {}'.format(err))
+
+    def sendCmdStreamed(self, msg_event, msg_fields):
+        """Send a command whose reply is followed by a stream of replies, such as
+        RetrieveData. Yields the reply and then each streamed reply, the last being
+        the trailer with fields.trailer set. An error reply ends the stream.
+        """
+        msg = self.sendRequestMsg(MsgType.Command, msg_event, msg_fields)
+        inStream = False
+        try:
+            reply = self.getReplyExpectSuccess(msg)
+            inStream = True
+            yield reply
+            while inStream:
+                reply = self.messaging.getReply()
+                inStream = reply.result == MsgResult.Success and reply.fields.trailer is not True
+                yield self.getReplyExpectSuccess(msg, reply)
+        finally:
+            # if stopped early read the rest of the stream, so the
+            #   connection is left in step for the next request
+            try:
+                while inStream:
+                    reply = self.messaging.getReply()
+                    inStream = reply.result == MsgResult.Success and reply.fields.trailer is not True
+            except Exception as err:
+                logging.warning('sendCmdStreamed: {}'.format(err))
+
     def calculateclockSkew(self):
         RTT_list = []
         clockSkew_list = []
@@ -177,6 +251,8 @@ class RtfMRIClient():
             avgRTT = sum(RTT_list) / float(len(RTT_list))
         logging.info("MaxRTT {:.3f}s, MinRTT {:.3f}, AvgRTT {:.3f}, ClockSkew {:.3f}s".\
                      format(self.cfg.maxRTT, self.cfg.minRTT, avgRTT, self.cfg.clockSkew))
+        self.clockSync = StructDict({'minRTT': self.cfg.minRTT, 'maxRTT': self.cfg.maxRTT,
+                                     'clockSkew': self.cfg.clockSkew, 'time': time.time()})
 
     def close(self):
         self.disconnect()
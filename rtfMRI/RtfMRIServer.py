@@ -8,12 +8,12 @@ RtfMRIServer Module - Server handler for loading and running a model
 import logging
 import threading
 import time
+from collections import deque
 from .BaseModel import BaseModel
-from rtAtten.RtAttenModel import RtAttenModel
 from .StructDict import StructDict
 from .MsgTypes import MsgType, MsgEvent, MsgResult
 from .utils import getGitCodeId
-from .Messaging import RtMessagingServer, Message
+from .Messaging import RtMessagingServer, Message, pyarrow_context
 from .Errors import RequestError, StateError, VersionError, RTError, MissedDeadlineError, MissedMultipleDeadlines
 
 
@@ -21,7 +21,9 @@ class RtfMRIServer():
     """Class for event handling on the server"""
 
     def __init__(self, port):
-        self.messaging = RtMessagingServer(port)
+        self.messaging = None
+        if port is not None:
+            self.messaging = RtMessagingServer(port)
         self.model = None
         self.deadlineThread = None
         self.threadReturnValue = {}  # a map of thread return values using threadId as key
@@ -67,62 +69,109 @@ class RtfMRIServer():
             reply = None
             try:
                 msg = self.messaging.getRequest()  # can raise MessageError, PickleError
-                reply = successReply(msg)
-                if msg.type == MsgType.Init:
-                    modelType = msg.fields.cfg.modelType
-                    if modelType == 'base':
-                        logging.info("RtfMRIServer: init base model")
-                        self.model = BaseModel()
-                    elif modelType == 'rtAtten':
-                        logging.info("RtfMRIServer: init rtAtten model")
-                        self.model = RtAttenModel()
-                    else:
-                        raise RequestError(
-                            "unknown model type '{}'".
-                            format(modelType))
-                    # Check that source code versions match
-                    clientGitCodeId = msg.fields.cfg.gitCodeId
-                    serverGitCodeId = getGitCodeId()
-                    if serverGitCodeId != clientGitCodeId:
-                        raise VersionError("Mismatching gitCodeId {} {}".
-                                           format(clientGitCodeId, serverGitCodeId))
-                elif msg.type == MsgType.Command:
-                    if msg.event_type == MsgEvent.Ping:
-                        reply = successReply(msg)
-                    elif msg.event_type == MsgEvent.SyncClock:
-                        reply = successReply(msg)
-                        reply.fields = StructDict()
-                        reply.fields.serverTime = time.time()
-                    elif self.model is not None:
-                        # if deadline is supplied, start handleMessage in a thread
-                        # if no deadline supplied, run handleMessage natively
-                        if msg.fields.cfg.deadline is None:
-                            reply = self.model.handleMessage(msg)
-                        else:
-                            # run the handler in a timed thread
-                            reply = self.runThread(msg)
-                    else:
-                        raise StateError("No model object exists")
-                    if reply is None:
-                        raise RequestError("Reply is None for msg %r" % (msg.type))
-                elif msg.type == MsgType.Shutdown:
+                if msg.type == MsgType.Shutdown:
                     break
-                else:
-                    raise RequestError(
-                        "unknown request type '{}'".format(msg.type))
-            except VersionError as err:
-                # TODO - remove all input requests for web interface (remove True)
-                reply = warningReply(msg, err, True)
+                reply = self.handleRequest(msg)
             except RTError as err:
                 logging.error("RtfMRIServer:RunEventLoop: %r", err)
                 reply = errorReply(msg, err)
-            except KeyError as err:
-                logging.error("RtfMRIServer:RunEventLoop: %r", err)
-                reply = errorReply(msg, RTError(
-                    "Msg field missing: {}".format(err)))
             self.messaging.sendReply(reply)
+            if reply.stream is not None:
+                # the replies streamed after this one, e.g. RetrieveData file chunks
+                for streamReply in reply.stream:
+                    self.messaging.sendReply(streamReply)
         return True
 
+    def handleRequest(self, msg):
+        """Handle a client request other than Shutdown and return the reply"""
+        reply = None
+        try:
+            reply = successReply(msg)
+            if msg.type == MsgType.Init:
+                self.model = createModel(msg.fields.cfg.modelType)
+                # Check that source code versions match
+                clientGitCodeId = msg.fields.cfg.gitCodeId
+                serverGitCodeId = getGitCodeId()
+                if serverGitCodeId != clientGitCodeId:
+                    raise VersionError("Mismatching gitCodeId {} {}".
+                                       format(clientGitCodeId, serverGitCodeId))
+            elif msg.type == MsgType.Command:
+                if msg.event_type == MsgEvent.Ping:
+                    reply = successReply(msg)
+                elif msg.event_type == MsgEvent.SyncClock:
+                    reply = successReply(msg)
+                    reply.fields = StructDict()
+                    reply.fields.serverTime = time.time()
+                elif self.model is not None:
+                    # if deadline is supplied, start handleMessage in a thread
+                    # if no deadline supplied, run handleMessage natively
+                    if msg.fields.cfg.deadline is None:
+                        reply = self.model.handleMessage(msg)
+                    else:
+                        # run the handler in a timed thread
+                        reply = self.runThread(msg)
+                else:
+                    raise StateError("No model object exists")
+                if reply is None:
+                    raise RequestError("Reply is None for msg %r" % (msg.type))
+            else:
+                raise RequestError(
+                    "unknown request type '{}'".format(msg.type))
+        except VersionError as err:
+            # TODO - remove all input requests for web interface (remove True)
+            reply = warningReply(msg, err, True)
+        except RTError as err:
+            logging.error("RtfMRIServer:RunEventLoop: %r", err)
+            reply = errorReply(msg, err)
+        except KeyError as err:
+            logging.error("RtfMRIServer:RunEventLoop: %r", err)
+            reply = errorReply(msg, RTError(
+                "Msg field missing: {}".format(err)))
+        return reply
+
+
+class LocalMessagingClient():
+    """Stands in for RtMessagingClient to run a session with the model in this
+    process, e.g. when reprocessing. Each request is handled by an RtfMRIServer
+    without a socket as it is sent. Messages are still serialized as over the
+    connection, so the client and model don't share objects.
+    """
+    def __init__(self):
+        self.server = RtfMRIServer(None)
+        self.replies = deque()  # type: ignore
+
+    def sendRequest(self, msg):
+        msg = pyarrow_context.deserialize(pyarrow_context.serialize(msg).to_buffer())
+        if msg.type == MsgType.Shutdown:
+            return
+        reply = self.server.handleRequest(msg)
+        self.replies.append(reply)
+        if reply.stream is not None:
+            self.replies.extend(reply.stream)
+
+    def getReply(self):
+        if len(self.replies) == 0:
+            raise StateError("LocalMessagingClient: no reply pending")
+        reply = self.replies.popleft()
+        return pyarrow_context.deserialize(pyarrow_context.serialize(reply).to_buffer())
+
+    def close(self):
+        self.replies.clear()
+
+
+def createModel(modelType):
+    """Create the model for an Init request. Model modules are imported here on
+    first use so that the server starts without loading their dependencies.
+    """
+    if modelType == 'base':
+        logging.info("RtfMRIServer: init base model")
+        return BaseModel()
+    elif modelType == 'rtAtten':
+        logging.info("RtfMRIServer: init rtAtten model")
+        from rtAtten.RtAttenModel import RtAttenModel
+        return RtAttenModel()
+    raise RequestError("unknown model type '{}'".format(modelType))
+
 
 def errorReply(msg, error):
     rmsg = Message()
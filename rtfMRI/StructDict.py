@@ -1,6 +1,7 @@
 """
 StructDictClass - contains classes StructDict and MatlabStructDict to make it
-    possible to access a dictionary with syntax struct.field.
+    possible to access a dictionary with syntax struct.field, and class TRView
+    which holds the fields of one TR.
 """
 
 import re
@@ -18,6 +19,9 @@ class StructDict(dict):
         try:
             val = self[key]
         except KeyError:
+            if key.startswith('__'):
+                # not a field, e.g. numpy and scipy.io.savemat probe for __array__
+                raise AttributeError(key)
             val = None
         return val
 
@@ -42,14 +46,43 @@ class StructDict(dict):
         return StructDict(super().copy())
 
 
+class TRView():
+    '''The fields of one TR sent with a TRData message. Uses slots rather than a
+       dictionary so field access in the per TR loop is a plain attribute lookup,
+       fields not set are None. It is serialized as a list of the field values.
+    '''
+    __slots__ = ('trId', 'vol', 'attCateg', 'stim', 'type', 'regressor', 'data', 'deadline', 'delay')
+
+    def __init__(self, trId=None, vol=None, attCateg=None, stim=None, type=None, regressor=None,
+                 data=None, deadline=None, delay=None):
+        self.trId = trId
+        self.vol = vol
+        self.attCateg = attCateg
+        self.stim = stim
+        self.type = type
+        self.regressor = regressor
+        self.data = data
+        self.deadline = deadline
+        self.delay = delay
+
+    def __repr__(self):
+        return "TRView(trId={}, vol={}, type={})".format(self.trId, self.vol, self.type)
+
+    def values(self):
+        return [getattr(self, field) for field in self.__slots__]
+
+
 def copy_toplevel(data):
     cptl = StructDict()
     for key, val in data.items():
         if isinstance(val, dict):
             continue
         if type(val) == list:
-            if isinstance(val[0], dict):
+            if isinstance(val[0], (dict, TRView)):
                 continue
+        if isStructuredArray(val):
+            # e.g. the run schedule, which stays with the client
+            continue
         cptl[key] = val
     return cptl
 
@@ -107,6 +140,8 @@ class MatlabStructDict(StructDict):
         try:
             val = struct[key]
         except KeyError:
+            if key.startswith('__'):
+                raise AttributeError(key)
             val = None
         # flatten numpy arrays
         while isinstance(val, np.ndarray) and val.shape == (1, 1):
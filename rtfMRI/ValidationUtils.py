@@ -5,8 +5,7 @@ For example in testing and comparing to a known-good run from matlab.
 
 import numbers
 import numpy as np  # type: ignore
-import scipy.stats as sstats  # type: ignore
-from .StructDict import MatlabStructDict
+from .StructDict import StructDict, MatlabStructDict
 from .utils import loadMatFile, flatten_1Ds
 
 # Globals
@@ -16,11 +15,17 @@ StatsEqual = {'mean': 0, 'count': 1, 'min': 0, 'max': 0, 'stddev': 0,
               'histocounts': None, 'histobins': None, 'histopct': None}
 StatsNotEqual = {'mean': 1, 'count': 1, 'min': 1, 'max': 1, 'stddev': 1,
                  'histocounts': None, 'histobins': None, 'histopct': None}
+compareHistoBins = [0, 0.005, .01, .02, .03, .04, .05, .06, .07, .09, .1, 1]
+# bound on the float64 size of the array chunks compared at a time
+compareChunkBytes = 16 * 2**20
 
 
-def compareArrays(A: np.ndarray, B: np.ndarray) -> dict:
+def compareArrays(A: np.ndarray, B: np.ndarray, pearson=False) -> dict:
     """Compute element-wise percent difference between A and B
-       Return the mean, max, stddev, histocounts, histobins in a Dict
+       Return the mean, max, stddev, histocounts, histobins in a Dict.
+       The arrays are compared in row chunks so the temporaries stay bounded
+       by compareChunkBytes. If pearson is True also return the mean column
+       pearson correlation, computed in the same pass.
     """
     assert (isinstance(A, np.ndarray) and isinstance(B, np.ndarray)),\
         "compareArrays: assert expecting ndarrays got {} {}"\
@@ -43,19 +48,133 @@ def compareArrays(A: np.ndarray, B: np.ndarray) -> dict:
             .format(A.shape, B.shape)
     if A.dtype.kind not in numpyAllNumCodes:
         # Not a numeric array
-        return StatsEqual if np.array_equal(A, B) else StatsNotEqual
+        result = StatsEqual if np.array_equal(A, B) else StatsNotEqual
+        return dict(result, pearson=np.nan) if pearson else result
     # Numeric arrays
-    if np.array_equal(A, B):
-        return StatsEqual
-    diff = abs((A / B) - 1)
-    diff = np.nan_to_num(diff)
-    histobins = [0, 0.005, .01, .02, .03, .04, .05, .06, .07, .09, .1, 1]
-    histocounts, histobins = np.histogram(diff, histobins)
-    result = {'mean': np.mean(diff), 'count': A.size,
-              'min': np.min(diff), 'max': np.max(diff), 'stddev': np.std(diff),
-              'histocounts': histocounts, 'histobins': histobins,
-              'histopct': histocounts / A.size * 100}
-    return result
+    comparison = ChunkedComparison(pearson)
+    for chunkA, chunkB in iterRowChunks(A, B):
+        comparison.addChunk(chunkA, chunkB)
+    return comparison.result()
+
+
+def iterRowChunks(A: np.ndarray, B: np.ndarray, chunkBytes=None):
+    """Yield matching 2D row chunks of A and B, each of about chunkBytes as float64.
+       Trailing dimensions are flattened into the columns and a 1D array is one column.
+    """
+    if chunkBytes is None:
+        chunkBytes = compareChunkBytes
+    numRows = A.shape[0] if A.ndim > 0 else 1
+    rowSize = A.size // numRows if numRows > 0 else 0
+    chunkRows = max(1, chunkBytes // max(1, rowSize * 8))
+    for start in range(0, numRows, chunkRows):
+        if A.ndim == 0:
+            yield A.reshape(1, 1), B.reshape(1, 1)
+        else:
+            rows = slice(start, start + chunkRows)
+            chunkA = A[rows]
+            chunkB = B[rows]
+            yield chunkA.reshape(chunkA.shape[0], -1), chunkB.reshape(chunkB.shape[0], -1)
+
+
+class ChunkedComparison:
+    """Accumulates the percent difference stats, and optionally the column
+       pearson correlations, of two arrays over row chunks in one pass.
+       The squared deviations and co-moments of each chunk are combined
+       pairwise so the stddev and correlations don't lose precision.
+    """
+    def __init__(self, pearson=False):
+        self.allEqual = True
+        self.count = 0
+        self.sum = 0.0
+        self.sumSqDev = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.histobins = np.array(compareHistoBins)
+        self.histocounts = np.zeros(len(compareHistoBins) - 1, dtype=np.int64)
+        self.pearson = pearson
+        # per column valid count, means and co-moments for the correlations
+        self.colStats = None
+
+    def addChunk(self, A: np.ndarray, B: np.ndarray):
+        if self.pearson:
+            self.addColumnStats(A, B)
+        if np.array_equal(A, B):
+            diff = np.zeros(A.size)
+        else:
+            self.allEqual = False
+            with np.errstate(divide='ignore', invalid='ignore'):
+                diff = np.true_divide(A, B)
+            diff -= 1
+            np.abs(diff, out=diff)
+            diff = np.nan_to_num(diff, copy=False)
+        if diff.size == 0:
+            return
+        chunkSum = np.sum(diff)
+        chunkSumSqDev = np.sum(np.square(diff - chunkSum / diff.size))
+        if self.count > 0:
+            delta = chunkSum / diff.size - self.sum / self.count
+            chunkSumSqDev += delta * delta * self.count * diff.size / (self.count + diff.size)
+        self.sum += chunkSum
+        self.sumSqDev += chunkSumSqDev
+        self.count += diff.size
+        self.min = min(self.min, np.min(diff))
+        self.max = max(self.max, np.max(diff))
+        self.histocounts += np.histogram(diff, self.histobins)[0]
+
+    def addColumnStats(self, A: np.ndarray, B: np.ndarray):
+        valid = ~(np.isnan(A) | np.isnan(B))
+        count = np.sum(valid, axis=0)
+        A = np.where(valid, A, 0)
+        B = np.where(valid, B, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            meanA = np.where(count > 0, np.sum(A, axis=0) / count, 0)
+            meanB = np.where(count > 0, np.sum(B, axis=0) / count, 0)
+        devA = np.where(valid, A - meanA, 0)
+        devB = np.where(valid, B - meanB, 0)
+        chunkStats = StructDict({'count': count, 'meanA': meanA, 'meanB': meanB,
+                                 'AA': np.sum(devA * devA, axis=0), 'BB': np.sum(devB * devB, axis=0),
+                                 'AB': np.sum(devA * devB, axis=0)})
+        if self.colStats is None:
+            self.colStats = chunkStats
+            return
+        stats = self.colStats
+        total = stats.count + chunkStats.count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.where(total > 0, chunkStats.count / total, 0)
+            scale = np.where(total > 0, stats.count * chunkStats.count / total, 0)
+        deltaA = chunkStats.meanA - stats.meanA
+        deltaB = chunkStats.meanB - stats.meanB
+        stats.AA += chunkStats.AA + deltaA * deltaA * scale
+        stats.BB += chunkStats.BB + deltaB * deltaB * scale
+        stats.AB += chunkStats.AB + deltaA * deltaB * scale
+        stats.meanA += deltaA * weight
+        stats.meanB += deltaB * weight
+        stats.count = total
+
+    def pearsonMean(self):
+        """Mean pearson correlation of the columns, ignoring NaN values and all NaN columns"""
+        if self.colStats is None:
+            return np.nan
+        cols = self.colStats.count > 0
+        if not np.any(cols):
+            return np.nan
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = self.colStats.AB[cols] / np.sqrt(self.colStats.AA[cols] * self.colStats.BB[cols])
+        return np.mean(np.clip(corr, -1, 1))
+
+    def result(self) -> dict:
+        if self.allEqual:
+            result = StatsEqual
+        else:
+            # nan_to_num maps divide by zero to the largest float, the sums can overflow
+            sumSqDev = np.inf if np.isnan(self.sumSqDev) else self.sumSqDev
+            result = {'mean': self.sum / self.count, 'count': self.count,
+                      'min': self.min, 'max': self.max, 'stddev': np.sqrt(sumSqDev / self.count),
+                      'histocounts': self.histocounts, 'histobins': self.histobins,
+                      'histopct': self.histocounts / self.count * 100}
+        if self.pearson:
+            result = dict(result, pearson=self.pearsonMean())
+        return result
 
 
 def areArraysClose(A: np.ndarray, B: np.ndarray,
@@ -77,10 +196,12 @@ class StructureMismatchError(ValueError):
 
 
 def compareMatStructs(A: MatlabStructDict, B: MatlabStructDict,
-                      field_list=None) -> dict:
+                      field_list=None, pearson_fields=()) -> dict:
     '''For each field, not like __*__, walk the fields and compare the values.
        If a field is missing from one of the structs raise an exception.
        If field_list is supplied, then only compare those fields.
+       The stat_results of array fields in pearson_fields also include the
+       'pearson' mean column correlation.
        Return a dict with {fieldname: stat_results}.'''
     result = {}
     if field_list is None:
@@ -100,11 +221,11 @@ def compareMatStructs(A: MatlabStructDict, B: MatlabStructDict,
                 "field {} has different types {}, {}"
                 .format(key, type(valA), type(valB)))
         if isinstance(valA, MatlabStructDict):
-            stats = compareMatStructs(valA, valB)
+            stats = compareMatStructs(valA, valB, pearson_fields=pearson_fields)
             for subkey, subresult in stats.items():
                 result[subkey] = subresult
         elif isinstance(valA, np.ndarray):
-            stats = compareArrays(valA, valB)
+            stats = compareArrays(valA, valB, pearson=(key in pearson_fields))
             result[key] = stats
         else:
             diff = 0
@@ -150,7 +271,7 @@ def compareMatFiles(filename1: str, filename2: str) -> dict:
 
 
 def pearsons_mean_corr(A: np.ndarray, B: np.ndarray):
-    pearsonsList = []
+    """Mean pearson correlation of the columns of A and B, ignoring NaN values"""
     if A.shape != B.shape:
         A = flatten_1Ds(A)
         B = flatten_1Ds(B)
@@ -159,18 +280,7 @@ def pearsons_mean_corr(A: np.ndarray, B: np.ndarray):
     if len(B.shape) == 1:
         B = B.reshape(B.shape[0], 1)
     assert(A.shape == B.shape)
-    num_cols = A.shape[1]
-    for col in range(num_cols):
-        A_col = A[:, col]
-        B_col = B[:, col]
-        # ignore NaN values
-        nans = np.logical_or(np.isnan(A_col), np.isnan(B_col))
-        if np.all(nans == True):  # noqa - np.all needs == comparision not 'is'
-            continue
-        pearcol = sstats.pearsonr(A_col[~nans], B_col[~nans])
-        pearsonsList.append(pearcol)
-    pearsons = np.array(pearsonsList)
-    if len(pearsons) == 0:
-        return np.nan
-    pearsons_mean = np.mean(pearsons[:, 0])
-    return pearsons_mean
+    comparison = ChunkedComparison(pearson=True)
+    for chunkA, chunkB in iterRowChunks(A, B):
+        comparison.addColumnStats(chunkA, chunkB)
+    return comparison.pearsonMean()
@@ -0,0 +1,261 @@
+"""
+DirIndex - cached directory listings for finding the newest files matching a pattern
+"""
+import os
+import sys
+import glob
+import time
+import struct
+import fnmatch
+import logging
+import threading
+from collections import OrderedDict
+from .StructDict import StructDict
+
+# inotify event header: watch descriptor, mask, cookie, name length
+inotifyEventStruct = struct.Struct('iIII')
+
+
+class DirIndex():
+    '''Index of directory listings shared by the findNewestFile lookups. The names in
+    each directory are cached from os.scandir, and the matches of each pattern are
+    cached sorted by ctime, newest first. Where inotify is available the changes it
+    reports are applied to the cached names and matches. Otherwise a directory is
+    rescanned when its mtime changes, or once its listing is maxAge seconds old since
+    the mtime has a coarse granularity and can be cached on network mounts. Inotify
+    doesn't see changes made by other hosts to a network mount, so a watched
+    directory is also rescanned once its listing is inotifyMaxAge seconds old.
+    '''
+    maxAge = 1.0  # seconds
+    inotifyMaxAge = 30.0  # seconds
+    maxDirs = 256
+
+    def __init__(self, useInotify=True):
+        self.dirs = OrderedDict()  # type: ignore
+        self.watches = {}  # type: ignore
+        self.lock = threading.Lock()
+        self.scanCount = 0
+        self.pid = os.getpid()
+        self.inotifyFd = None
+        if useInotify and sys.platform in ("linux", "linux2"):
+            try:
+                import inotify.calls
+                import inotify.constants as ic
+                self.inotifyCalls = inotify.calls
+                self.inotifyMask = (ic.IN_CREATE | ic.IN_DELETE | ic.IN_MOVED_FROM | ic.IN_MOVED_TO |
+                                    ic.IN_CLOSE_WRITE | ic.IN_ATTRIB | ic.IN_DELETE_SELF | ic.IN_MOVE_SELF)
+                # events after which the directory is rescanned
+                self.inotifyRescanMask = (ic.IN_Q_OVERFLOW | ic.IN_DELETE_SELF | ic.IN_MOVE_SELF |
+                                          ic.IN_IGNORED)
+                self.inotifyIgnored = ic.IN_IGNORED
+                self.inotifyFd = inotify.calls.inotify_init()
+                os.set_blocking(self.inotifyFd, False)
+            except Exception as err:
+                logging.info("DirIndex: inotify not available: {}".format(err))
+                self.inotifyFd = None
+
+    def __del__(self):
+        if self.inotifyFd is not None:
+            os.close(self.inotifyFd)
+            self.inotifyFd = None
+
+    def findNewest(self, pathPattern):
+        '''Newest file by ctime matching the glob pattern, None if there are no matches'''
+        matches = self.getMatches(pathPattern, maxMatches=1)
+        if len(matches) == 0:
+            return None
+        return matches[0]
+
+    def getMatches(self, pathPattern, maxMatches=None):
+        '''Paths matching the glob pattern sorted by ctime, newest first'''
+        dirname, pattern = os.path.split(pathPattern)
+        if glob.has_magic(dirname) or pattern == '':
+            # only patterns within one directory are indexed
+            return sorted(glob.glob(pathPattern), key=os.path.getctime, reverse=True)[:maxMatches]
+        self.lock.acquire()
+        try:
+            entry = self.getDirEntry(os.path.abspath(dirname or os.curdir))
+            if entry is None:
+                return []
+            matches = entry.matches.get(pattern)
+            if matches is None:
+                matches = self.sortByCtime(entry, pattern)
+                entry.matches[pattern] = matches
+            names = [name for _, name in matches[:maxMatches]]
+        finally:
+            self.lock.release()
+        return [os.path.join(dirname, name) for name in names]
+
+    def getDirEntry(self, dirPath):
+        self.readEvents()
+        entry = self.dirs.get(dirPath)
+        if entry is not None and entry.wd is not None and entry.rescan is False and \
+                time.time() - entry.fullScanTime < self.inotifyMaxAge:
+            # kept up to date from the inotify events
+            self.applyChanges(entry)
+            self.dirs.move_to_end(dirPath)
+            return entry
+        try:
+            # the mtime is taken before the scan so a change during the scan is seen
+            mtime = os.stat(dirPath).st_mtime_ns
+            now = time.time()
+            if entry is not None and entry.rescan is False and now - entry.fullScanTime < self.maxAge:
+                if mtime == entry.mtime and now - entry.scanTime < self.maxAge:
+                    self.dirs.move_to_end(dirPath)
+                    return entry
+                # only the files added or removed are updated, the files
+                #   listed before are checked again by the next full scan
+                entry.changed = set(self.scanNames(dirPath)).symmetric_difference(entry.names)
+                self.applyChanges(entry)
+            else:
+                if entry is None:
+                    # watched before the scan, so a file added during the scan is reported
+                    entry = StructDict({'path': dirPath, 'wd': self.addWatch(dirPath)})
+                entry.names = self.scanNames(dirPath)
+                entry.matches = {}
+                entry.changed = set()
+                entry.rescan = False
+                entry.fullScanTime = now
+                self.scanCount += 1
+        except OSError:
+            if entry is not None:
+                self.dirs[dirPath] = entry
+            self.removeDir(dirPath)
+            return None
+        entry.mtime = mtime
+        entry.scanTime = now
+        if entry.wd is None and now - mtime / 1e9 < self.maxAge:
+            # the directory changed within the mtime granularity, it may change
+            #   again without a new mtime
+            entry.scanTime -= self.maxAge
+        self.dirs[dirPath] = entry
+        self.dirs.move_to_end(dirPath)
+        while len(self.dirs) > self.maxDirs:
+            self.removeDir(next(iter(self.dirs)))
+        return entry
+
+    def scanNames(self, dirPath):
+        with os.scandir(dirPath) as dirEntries:
+            return dict.fromkeys(dirEntry.name for dirEntry in dirEntries)
+
+    def sortByCtime(self, entry, pattern):
+        names = self.filterNames(entry.names, pattern)
+        matches = []
+        for name in names:
+            ctime = self.getCtime(entry, name)
+            if ctime is not None:
+                matches.append((ctime, name))
+        # a stable sort, files with the same ctime keep their directory order as with glob
+        matches.sort(key=lambda match: match[0], reverse=True)
+        return matches
+
+    def filterNames(self, names, pattern):
+        names = fnmatch.filter(names, pattern)
+        if not pattern.startswith('.'):
+            # as glob, hidden files only match patterns starting with '.'
+            names = [name for name in names if not name.startswith('.')]
+        return names
+
+    def getCtime(self, entry, name):
+        try:
+            return os.stat(os.path.join(entry.path, name)).st_ctime
+        except OSError:
+            # removed since the scan or a broken link
+            return None
+
+    def applyChanges(self, entry):
+        '''Update the names and matches for the changed files'''
+        for name in entry.changed:
+            ctime = self.getCtime(entry, name)
+            listed = name in entry.names
+            if ctime is None and os.path.lexists(os.path.join(entry.path, name)) is False:
+                entry.names.pop(name, None)
+            else:
+                entry.names[name] = None
+            for pattern, matches in entry.matches.items():
+                if listed:
+                    matches[:] = [match for match in matches if match[1] != name]
+                if ctime is None or len(self.filterNames([name], pattern)) == 0:
+                    continue
+                # most often a new file, the newest match
+                pos = 0
+                while pos < len(matches) and matches[pos][0] >= ctime:
+                    pos += 1
+                matches.insert(pos, (ctime, name))
+        entry.changed = set()
+
+    def addWatch(self, dirPath):
+        if self.inotifyFd is None:
+            return None
+        try:
+            wd = self.inotifyCalls.inotify_add_watch(self.inotifyFd, dirPath.encode('utf-8'), self.inotifyMask)
+        except self.inotifyCalls.InotifyError as err:
+            # e.g. the inotify watch limit is reached
+            logging.info("DirIndex: no inotify watch for {}: {}".format(dirPath, err))
+            return None
+        self.watches[wd] = dirPath
+        return wd
+
+    def removeDir(self, dirPath):
+        entry = self.dirs.pop(dirPath, None)
+        if entry is None or entry.wd is None:
+            return
+        if self.watches.pop(entry.wd, None) is not None:
+            try:
+                self.inotifyCalls.inotify_rm_watch(self.inotifyFd, entry.wd)
+            except self.inotifyCalls.InotifyError:
+                # the watch was already removed with the directory
+                pass
+
+    def readEvents(self):
+        '''Record the files inotify reported changes to, the directories are
+        updated when next looked up
+        '''
+        if self.inotifyFd is None:
+            return
+        while True:
+            try:
+                buf = os.read(self.inotifyFd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, nameLen = inotifyEventStruct.unpack_from(buf, offset)
+                offset += inotifyEventStruct.size
+                name = buf[offset:offset + nameLen].rstrip(b'\0').decode('utf-8', 'surrogateescape')
+                offset += nameLen
+                if wd == -1:
+                    # the event queue overflowed and events were dropped
+                    for entry in self.dirs.values():
+                        entry.rescan = True
+                    continue
+                dirPath = self.watches.get(wd)
+                entry = None if dirPath is None else self.dirs.get(dirPath)
+                if entry is None:
+                    continue
+                if mask & self.inotifyRescanMask:
+                    entry.rescan = True
+                    if mask & self.inotifyIgnored:
+                        # the directory was removed, its watch is gone
+                        del self.watches[wd]
+                        entry.wd = None
+                elif name != '':
+                    entry.changed.add(name)
+
+
+dirIndex = None
+dirIndexLock = threading.Lock()
+
+
+def getDirIndex():
+    '''The DirIndex shared by the lookups in this process'''
+    global dirIndex
+    dirIndexLock.acquire()
+    try:
+        if dirIndex is None or dirIndex.pid != os.getpid():
+            # a forked child shares the parent's inotify fd and reads its events,
+            #   it gets its own index
+            dirIndex = DirIndex()
+        return dirIndex
+    finally:
+        dirIndexLock.release()
@@ -3,14 +3,24 @@ import sys
 import time
 import logging
 import threading
+import fnmatch
+import statistics
+from collections import deque
 from queue import Queue, Empty
 from watchdog.events import PatternMatchingEventHandler  # type: ignore
 from rtfMRI.utils import DebugLevels, demoDelay
-from rtfMRI.Errors import StateError
+from rtfMRI.Errors import StateError, InvocationError
 
 
 class FileWatcher():
-    def __new__(cls):
+    def __new__(cls, watcherType=None):
+        if watcherType == 'polling':
+            # scandir based polling, for network mounts where no events are generated
+            newcls = PollingFileWatcher.__new__(PollingFileWatcher)
+            newcls.__init__()
+            return newcls
+        elif watcherType is not None and watcherType not in ('default', 'inotify', 'watchdog'):
+            raise InvocationError("Unsupported fileWatcher type %s" % (watcherType))
         if sys.platform in ("linux", "linux2"):
             # create linux version
             newcls = InotifyFileWatcher.__new__(InotifyFileWatcher)
@@ -26,7 +36,7 @@ class FileWatcher():
             logging.log(logging.ERROR, "Unsupported os type %s" % (sys.platform))
             return None
 
-    def __init__(self):
+    def __init__(self, watcherType=None):
         logging.log(logging.ERROR, "FileWatcher is abstract class. __init__ not implemented")
 
     def __del__(self):
@@ -254,3 +264,173 @@ class InotifyFileWatcher():
                     self.fileNotifyQ.put((fullpath, time.time()))
                 else:
                     self.fileNotifyQ.put(('', time.time()))
+
+
+# Version of FileWatcher that polls the directory, for use on SMB/NFS mounts
+#  where inotify and watchdog events are never generated.
+class PollingFileWatcher():
+    minPollInterval = 0.01  # seconds, poll rate around the expected arrival
+    maxPollInterval = 0.25  # seconds, poll rate when no file is expected
+    rescanInterval = 1.0  # rescan at least every second, dir mtime may be cached
+    numRecentPeriods = 7  # arrival periods the TR period is the median of
+
+    def __init__(self):
+        self.watchDir = None
+        self.filePattern = '*'
+        self.minFileSize = 0
+        self.demoStep = 0
+        self.prevEventTime = 0
+        # cached directory snapshot of filenames matching filePattern
+        self.snapshot = set()
+        self.snapshotMtime = 0
+        self.snapshotTime = 0
+        self.scanCount = 0
+        self.resetArrivals()
+
+    def __del__(self):
+        pass
+
+    def resetArrivals(self):
+        # arrival history used to predict when the next file will land
+        self.lastArrivalTime = 0
+        self.lastArrivalMtime = 0
+        self.recentPeriods = deque(maxlen=self.numRecentPeriods)  # type: deque
+        self.trPeriod = None
+        # offset between the file server clock and the local clock
+        self.clockOffset = None
+
+    def initFileNotifier(self, dir, filePattern, minFileSize, demoStep=0):
+        self.demoStep = demoStep
+        self.minFileSize = minFileSize
+        if dir is None:
+            raise StateError('initFileNotifier: dir is None')
+        if not os.path.exists(dir):
+            raise NotADirectoryError("No such directory: %s" % (dir))
+        if filePattern is None or filePattern == '':
+            filePattern = '*'
+        if dir != self.watchDir or filePattern != self.filePattern:
+            self.watchDir = dir
+            self.filePattern = filePattern
+            self.resetArrivals()
+            self.rescanDir()
+
+    def waitForFile(self, specificFileName, timeout=0):
+        fileDir, fileName = os.path.split(specificFileName)
+        inWatchDir = (self.watchDir is not None and
+                      os.path.normpath(fileDir) == os.path.normpath(self.watchDir) and
+                      fnmatch.fnmatch(fileName, self.filePattern))
+        fileExists = self.checkForFile(specificFileName, fileName, inWatchDir)
+        if not fileExists:
+            if self.watchDir is None:
+                raise FileNotFoundError("No fileNotifier and dicom file not found %s" % (specificFileName))
+            else:
+                logStr = "FileWatcher: Waiting for file {}, timeout {}s ".format(specificFileName, timeout)
+                logging.log(DebugLevels.L6, logStr)
+        pollCount = 0
+        startTime = time.time()
+        while not fileExists:
+            now = time.time()
+            if timeout > 0 and now > (startTime + timeout):
+                return None
+            pollCount += 1
+            sleepTime = self.nextPollInterval(now, pollCount)
+            if timeout > 0:
+                sleepTime = min(sleepTime, max(startTime + timeout - now, 0))
+            time.sleep(sleepTime)
+            fileExists = self.checkForFile(specificFileName, fileName, inWatchDir)
+        foundTime = time.time()
+        self.recordArrival(specificFileName, foundTime)
+
+        # wait for the full file to be written, wait at most 300 ms
+        waitIncrement = 0.01
+        totalWriteWait = 0.0
+        fileSize = os.path.getsize(specificFileName)
+        while fileSize < self.minFileSize and totalWriteWait < 0.3:
+            time.sleep(waitIncrement)
+            totalWriteWait += waitIncrement
+            fileSize = os.path.getsize(specificFileName)
+        logging.log(DebugLevels.L6,
+                    "File avail: pollCount %d, writeWaitTime %.3f, trPeriod %s, "
+                    "scanCount %d, fileName %s, foundTime %.5f",
+                    pollCount, totalWriteWait, self.trPeriod,
+                    self.scanCount, specificFileName, foundTime)
+        if self.demoStep is not None and self.demoStep > 0:
+            self.prevEventTime = demoDelay(self.demoStep, self.prevEventTime)
+        return specificFileName
+
+    def checkForFile(self, specificFileName, fileName, inWatchDir):
+        if not inWatchDir:
+            return os.path.exists(specificFileName)
+        if fileName in self.snapshot:
+            return True
+        now = time.time()
+        try:
+            dirMtime = os.stat(self.watchDir).st_mtime
+        except OSError:
+            return os.path.exists(specificFileName)
+        if dirMtime != self.snapshotMtime or now - self.snapshotTime > self.rescanInterval:
+            # directory changed, refresh the cached snapshot
+            self.rescanDir(dirMtime)
+            return fileName in self.snapshot
+        # The directory mtime has a coarse granularity on some file systems and
+        #   can be cached by network clients, so a single lookup of the file
+        #   is still needed. It is much cheaper than rescanning the directory.
+        if os.path.exists(specificFileName):
+            self.snapshot.add(fileName)
+            return True
+        return False
+
+    def rescanDir(self, dirMtime=None):
+        if dirMtime is None:
+            dirMtime = os.stat(self.watchDir).st_mtime
+        snapshot = set()
+        with os.scandir(self.watchDir) as entries:
+            for entry in entries:
+                if fnmatch.fnmatch(entry.name, self.filePattern):
+                    snapshot.add(entry.name)
+        self.snapshot = snapshot
+        self.snapshotMtime = dirMtime
+        self.snapshotTime = time.time()
+        self.scanCount += 1
+
+    def recordArrival(self, filename, foundTime):
+        """Use the file modification times to track the arrival period, the
+           mtimes aren't delayed by the poll interval. The file server clock
+           can differ from the local clock so track the offset between them,
+           the smallest offset seen is the closest to the actual clock offset.
+           The TR period is the median of the recent periods, so neither the
+           gaps between runs nor files landing in a burst throw it off.
+        """
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
+            return
+        offset = foundTime - mtime
+        if self.clockOffset is None or offset < self.clockOffset:
+            self.clockOffset = offset
+        if mtime <= self.lastArrivalMtime:
+            # a file that was already present, not a new arrival
+            return
+        if self.lastArrivalMtime > 0:
+            self.recentPeriods.append(mtime - self.lastArrivalMtime)
+            self.trPeriod = statistics.median(self.recentPeriods)
+        self.lastArrivalMtime = mtime
+        self.lastArrivalTime = mtime + self.clockOffset
+
+    def nextPollInterval(self, now, pollCount):
+        """Poll at the fast rate when a file is expected (last arrival plus
+           the TR period), otherwise back off toward the slow poll rate.
+        """
+        if self.trPeriod is None:
+            # No arrival history, start fast and back off
+            return min(self.minPollInterval * (2 ** min(pollCount, 10)), self.maxPollInterval)
+        expectedTime = self.lastArrivalTime + self.trPeriod
+        guardTime = max(0.1 * self.trPeriod, 2 * self.minPollInterval)
+        if now < expectedTime - guardTime:
+            # too early, sleep until the start of the expected arrival window
+            return min(expectedTime - guardTime - now, self.maxPollInterval)
+        elif now < expectedTime + self.trPeriod:
+            return self.minPollInterval
+        # late arrival, back off gradually
+        lateTime = now - expectedTime - self.trPeriod
+        return min(self.minPollInterval + lateTime / 10, self.maxPollInterval)
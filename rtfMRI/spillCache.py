@@ -0,0 +1,214 @@
+"""
+SpillCache - a memory budgeted LRU cache that spills evicted entries to disk
+"""
+import os
+import sys
+import json
+import shutil
+import logging
+import tempfile
+import numpy as np  # type: ignore
+from collections import OrderedDict
+from .StructDict import StructDict, MatlabStructDict
+
+
+class SpillCache():
+    '''Cache of block group patterns and trained models keyed by run. Once the
+    arrays held in memory exceed maxBytes the least recently used entries are
+    written to .npy files in a temporary directory and removed from memory. A
+    spilled entry is reloaded by the next get() with its arrays memory mapped, so
+    unlike reloading the .mat file only the arrays used are read. Entries larger
+    than maxBytes are still kept in memory until another entry is added.
+    '''
+    def __init__(self, maxBytes, name='cache'):
+        self.maxBytes = maxBytes
+        self.name = name
+        self.entries = OrderedDict()  # type: ignore
+        self.sizes = {}  # type: ignore
+        self.spilled = {}  # type: ignore
+        self.memBytes = 0
+        self.spillDir = None
+        self.stats = StructDict({'hits': 0, 'spillHits': 0, 'misses': 0, 'spills': 0})
+
+    def __del__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self.entries) + len(self.spilled)
+
+    def __contains__(self, key):
+        return key in self.entries or key in self.spilled
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.removeEntry(key)
+        self.entries[key] = value
+        self.sizes[key] = entrySize(value)
+        self.memBytes += self.sizes[key]
+        self.evict()
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.removeEntry(key)
+
+    def keys(self):
+        '''Keys of the entries in memory and spilled'''
+        return list(self.entries.keys()) + list(self.spilled.keys())
+
+    def memoryValues(self):
+        '''Entries held in memory, least recently used first'''
+        return list(self.entries.values())
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            self.stats.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if key in self.spilled:
+            entryDir = self.spilled.pop(key)
+            try:
+                value = loadEntry(entryDir)
+            except Exception as err:
+                logging.warning("%s: unable to reload spilled entry %s: %r", self.name, key, err)
+                self.stats.misses += 1
+                return default
+            finally:
+                # the mapped arrays stay valid after their files are removed
+                shutil.rmtree(entryDir, ignore_errors=True)
+            self.stats.spillHits += 1
+            self[key] = value
+            return value
+        self.stats.misses += 1
+        return default
+
+    def clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+        self.spilled.clear()
+        self.memBytes = 0
+        if self.spillDir is not None:
+            shutil.rmtree(self.spillDir, ignore_errors=True)
+            self.spillDir = None
+
+    def logStats(self):
+        logging.info("%s: %d hits, %d spill hits, %d misses, %d spills, %d entries %.1f MB in memory, "
+                     "%d spilled", self.name, self.stats.hits, self.stats.spillHits, self.stats.misses,
+                     self.stats.spills, len(self.entries), self.memBytes / 2**20, len(self.spilled))
+
+    def removeEntry(self, key):
+        if key in self.entries:
+            del self.entries[key]
+            self.memBytes -= self.sizes.pop(key)
+        entryDir = self.spilled.pop(key, None)
+        if entryDir is not None:
+            shutil.rmtree(entryDir, ignore_errors=True)
+
+    def evict(self):
+        # the most recently added entry is kept even if it alone exceeds maxBytes
+        while self.memBytes > self.maxBytes and len(self.entries) > 1:
+            key, value = self.entries.popitem(last=False)
+            self.memBytes -= self.sizes.pop(key)
+            entryDir = None
+            try:
+                if self.spillDir is None:
+                    self.spillDir = tempfile.mkdtemp(prefix='spillCache_')
+                entryDir = os.path.join(self.spillDir, '{}_{}'.format(self.stats.spills, key))
+                saveEntry(entryDir, value)
+            except Exception as err:
+                # dropped, the next get() is a miss
+                logging.warning("%s: unable to spill entry %s: %r", self.name, key, err)
+                if entryDir is not None:
+                    shutil.rmtree(entryDir, ignore_errors=True)
+                continue
+            self.spilled[key] = entryDir
+            self.stats.spills += 1
+            logging.info("%s: spilled %s, %.1f MB in memory", self.name, key, self.memBytes / 2**20)
+
+
+def entrySize(value):
+    '''Bytes held by the arrays of a (nested) dictionary entry'''
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(entrySize(val) for val in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(entrySize(val) for val in value)
+    return sys.getsizeof(value)
+
+
+def saveEntry(entryDir, value):
+    '''Save a nested dictionary of arrays to a directory with a .npy file per array,
+    and the structure and plain values as json. Values json doesn't return as they
+    were, such as tuples, dictionaries with non-string keys and lists of arrays,
+    are pickled in an object array.
+    '''
+    os.makedirs(entryDir)
+    arrays = []  # type: ignore
+
+    def describe(val):
+        if isinstance(val, dict) and all(isinstance(key, str) for key in val):
+            node = {'fields': {key: describe(fieldVal) for key, fieldVal in val.items()}}
+            if isinstance(val, MatlabStructDict):
+                node['dict'] = 'MatlabStructDict'
+                node['name'] = val.__name__
+            elif isinstance(val, StructDict):
+                node['dict'] = 'StructDict'
+            else:
+                node['dict'] = 'dict'
+            return node
+        if isinstance(val, (np.ndarray, np.generic)):
+            arrays.append(np.asarray(val))
+            return {'array': len(arrays) - 1, 'scalar': isinstance(val, np.generic)}
+        try:
+            if json.loads(json.dumps(val)) == val:
+                return {'value': val}
+        except (TypeError, ValueError):
+            pass
+        # a 0-d array, np.array() would turn a list of equal shape arrays into one array
+        arr = np.empty((), dtype=object)
+        arr[()] = val
+        arrays.append(arr)
+        return {'array': len(arrays) - 1, 'scalar': True}
+    structure = describe(value)
+    for idx, arr in enumerate(arrays):
+        np.save(os.path.join(entryDir, '{}.npy'.format(idx)), arr)
+    with open(os.path.join(entryDir, 'structure.json'), 'w') as fp:
+        json.dump(structure, fp)
+
+
+def loadEntry(entryDir):
+    '''Load an entry saved by saveEntry. The arrays are mapped copy on write, so
+    only the parts read are loaded and changes aren't written back.
+    '''
+    with open(os.path.join(entryDir, 'structure.json')) as fp:
+        structure = json.load(fp)
+
+    def build(node):
+        if 'fields' in node:
+            fields = {key: build(fieldNode) for key, fieldNode in node['fields'].items()}
+            if node['dict'] == 'MatlabStructDict':
+                val = MatlabStructDict({}, node['name'])
+                # set directly, MatlabStructDict attribute setting repacks ints
+                dict.update(val, fields)
+                return val
+            if node['dict'] == 'StructDict':
+                return StructDict(fields)
+            return fields
+        if 'array' in node:
+            filename = os.path.join(entryDir, '{}.npy'.format(node['array']))
+            try:
+                arr = np.load(filename, mmap_mode='c')
+            except (ValueError, OSError):
+                # python objects and empty arrays can't be mapped, the files are only written by saveEntry
+                arr = np.load(filename, allow_pickle=True)
+            if node['scalar']:
+                return arr[()]
+            return arr
+        return node['value']
+    return build(structure)
@@ -8,11 +8,13 @@ import re
 import time
 import glob
 import shutil
+import hashlib
 import subprocess
 import logging
 import numpy as np  # type: ignore
 import scipy.io as sio  # type: ignore
 from .StructDict import MatlabStructDict, isStructuredArray
+from .dirIndex import getDirIndex
 
 
 class TooManySubStructsError(ValueError):
@@ -83,10 +85,8 @@ def findNewestFile(filepath, filepattern):
         # for now concatenate them also
         full_path_pattern = os.path.join(filepath, filepattern)
 
-    try:
-        return max(glob.iglob(full_path_pattern), key=os.path.getctime)
-    except ValueError:
-        return None
+    # the directory listings and matches are cached in an index shared by the lookups
+    return getDirIndex().findNewest(full_path_pattern)
 
 
 def flatten_1Ds(M):
@@ -122,6 +122,15 @@ def writeFile(filename, data):
             raise InterruptedError("Write file %s wrote %d of %d bytes" % (filename, bytesWritten, len(data)))
 
 
+def fileMd5(filename, blockSize=4*1024**2):
+    '''md5 hex digest of a file, read in blocks so large files aren't held in memory'''
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(blockSize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
 def runCmdCheckOutput(cmd, outputRegex):
     match = False
     proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
@@ -204,19 +213,56 @@ def installLoggers(consoleLevel, fileLevel, filename=None):
 
 # define as global variable
 gitCodeId = None
+# the code id is written here by setup.py at install time for installs without a .git directory
+gitCodeIdFile = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'gitCodeId')
+gitShortIdLen = 7
 
 
 def getGitCodeId():
+    """Returns 'branch:commitId' of the code. Reads the .git directory of the
+    source tree, or the id cached at install time, before falling back to running git.
+    """
     global gitCodeId
+    if gitCodeId is None:
+        gitCodeId = readGitDir(os.path.join(os.path.dirname(gitCodeIdFile), '..', '.git'))
+    if gitCodeId is None and os.path.exists(gitCodeIdFile):
+        with open(gitCodeIdFile, 'r') as fp:
+            gitCodeId = fp.read().strip()
     if gitCodeId is None:
         branchB = subprocess.check_output(['bash', '-c', 'git symbolic-ref --short -q HEAD'])
         branchName = branchB.decode("utf-8").rstrip()
-        commitB = subprocess.check_output(['bash', '-c', 'git rev-parse --short HEAD'])
+        commitB = subprocess.check_output(['bash', '-c', 'git rev-parse --short={} HEAD'.format(gitShortIdLen)])
         commitId = commitB.decode("utf-8").rstrip()
         gitCodeId = branchName + ":" + commitId
     return gitCodeId
 
 
+def readGitDir(gitDir):
+    """Returns 'branch:commitId' from the HEAD and refs files of a .git directory,
+    or None if they can't be read.
+    """
+    try:
+        with open(os.path.join(gitDir, 'HEAD'), 'r') as fp:
+            head = fp.read().strip()
+        if not head.startswith('ref: '):
+            # detached head
+            return ':' + head[:gitShortIdLen]
+        ref = head[len('ref: '):]
+        branchName = re.sub('^refs/heads/', '', ref)
+        refFile = os.path.join(gitDir, ref)
+        if os.path.exists(refFile):
+            with open(refFile, 'r') as fp:
+                return branchName + ':' + fp.read().strip()[:gitShortIdLen]
+        with open(os.path.join(gitDir, 'packed-refs'), 'r') as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == ref:
+                    return branchName + ':' + fields[0][:gitShortIdLen]
+    except OSError:
+        pass
+    return None
+
+
 '''
 import inspect  # type: ignore
 def xassert(bool_val, message):
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Benchmark an end to end replayMatFileMode session, the client replaying saved
+patterns data to a local server, sending a TRData message per TR compared to a
+BatchTRData message per block (session.batchReplay). The solver is seeded the
+same for both sessions, and the saved block group patterns and the prediction
+files of the two sessions are compared.
+Run from the top level directory (needs the certs directory):
+Usage: python scripts/benchBatchReplay.py -r 3 -v 5000
+"""
+import os
+import sys
+import glob
+import time
+import shutil
+import socket
+import logging
+import argparse
+import threading
+import numpy as np  # type: ignore
+import scipy.io as sio  # type: ignore
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+import ServerMain
+from rtfMRI.utils import loadMatFile
+from rtfMRI.StructDict import StructDict
+from rtAtten.RtAttenClient import RtAttenClient
+from rtAtten.RtAttenModel import getSubjectDataDir
+
+benchDir = '/tmp/benchBatchReplay'
+patternsDir = os.path.join(rootPath, 'webInterface/rtAtten/patterns')
+roiDims = (64, 64, 36)
+port = 5231
+
+
+def createSessionData(dataDir, runIds, nVoxels, rng):
+    '''Mask, patterns design and replay patterns data files for the runs'''
+    os.makedirs(dataDir)
+    mask = np.zeros(roiDims, dtype=np.uint8)
+    mask.flat[rng.choice(mask.size, nVoxels, replace=False)] = 1
+    sio.savemat(os.path.join(dataDir, 'mask_1_1.mat'), {'mask': mask})
+    for runId in runIds:
+        patternsFile = glob.glob(os.path.join(patternsDir, 'patternsdesign_{}_*.mat'.format(runId)))[0]
+        shutil.copy(patternsFile, dataDir)
+        nVols = loadMatFile(patternsFile).block.shape[1]
+        raw = rng.standard_normal((nVols, nVoxels)) + 100
+        sio.savemat(os.path.join(dataDir, 'patternsdata_{}.mat'.format(runId)), {'patterns': {'raw': raw}})
+
+
+def createCfg(sessionId, dataDir, runIds, batchReplay):
+    patternsFiles = [os.path.basename(glob.glob(os.path.join(dataDir, 'patternsdesign_{}_*.mat'.format(runId)))[0])
+                     for runId in runIds]
+    session = StructDict({'sessionId': sessionId, 'date': '01/01/2018', 'subjectName': 'bench',
+                          'subjectNum': 1, 'subjectDay': 1, 'dataDir': benchDir,
+                          'serverDataDir': os.path.join(benchDir, 'server', sessionId),
+                          'imgDir': os.path.join(benchDir, 'img'), 'useSessionTimestamp': False,
+                          'rtData': False, 'replayMatFileMode': True, 'batchReplay': batchReplay,
+                          'findNewestPatterns': False, 'patternsDesignFiles': patternsFiles,
+                          'validationData': ['patternsdata_{}.mat'.format(runId) for runId in runIds],
+                          'validationModels': ['model_{}.mat'.format(runId) for runId in runIds],
+                          'Runs': runIds, 'ScanNums': runIds, 'watchFilePattern': '*.dcm',
+                          'minExpectedDicomSize': 0, 'legacyRun1Phase2Mode': True, 'validate': False,
+                          'calcClockSkewIters': 1, 'FWHM': 5, 'cutoff': 112})
+    return StructDict({'experiment': StructDict({'model': 'rtAtten', 'experimentId': 1}), 'session': session})
+
+
+def runSession(cfg):
+    # the LogisticRegression saga solver draws from the global numpy random state
+    np.random.seed(0)
+    client = RtAttenClient()
+    stime = time.time()
+    client.runSession('127.0.0.1', port, cfg)
+    elapsed = time.time() - stime
+    client.ttlPulseClient.close()
+    return elapsed
+
+
+def compareSessions(sessionIds):
+    '''The block group patterns saved by the two sessions'''
+    diffs = []
+    serverDirs = [os.path.join(benchDir, 'server', sessionId) for sessionId in sessionIds]
+    filenames = sorted(glob.glob(os.path.join(serverDirs[0], '**', 'blkGroup_*.mat'), recursive=True))
+    for filename in filenames:
+        other = filename.replace(serverDirs[0], serverDirs[1]).replace(sessionIds[0], sessionIds[1])
+        bg1, bg2 = loadMatFile(filename), loadMatFile(other)
+        for field in ('raw', 'raw_sm', 'raw_sm_filt', 'raw_sm_filt_z', 'categoryseparation', 'predict'):
+            if not np.array_equal(bg1.patterns[field], bg2.patterns[field], equal_nan=True):
+                diffs.append('{} {}'.format(os.path.basename(filename), field))
+    return len(filenames), diffs
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--numRuns', '-r', default=3, type=int,
+                           help='runs in the session')
+    argParser.add_argument('--numVoxels', '-v', default=5000, type=int,
+                           help='voxels in the roi')
+    args = argParser.parse_args()
+    logging.disable(logging.INFO)
+
+    if os.path.exists(benchDir):
+        shutil.rmtree(benchDir)
+    runIds = list(range(1, args.numRuns + 1))
+    dataDir = getSubjectDataDir(benchDir, 1, 1)
+    createSessionData(dataDir, runIds, args.numVoxels, np.random.default_rng(0))
+    serverThread = threading.Thread(name='server', target=ServerMain.ServerMain, args=(port, 30))
+    serverThread.setDaemon(True)
+    serverThread.start()
+    for i in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+
+    sessionIds = ('20180101T000001', '20180101T000002')
+    times = []
+    predictions = []
+    for sessionId, batchReplay in zip(sessionIds, (False, True)):
+        times.append(runSession(createCfg(sessionId, dataDir, runIds, batchReplay)))
+        classFiles = sorted(glob.glob(os.path.join(dataDir, 'run*', 'classoutput', '*.txt')))
+        predictions.append({os.path.relpath(f, dataDir): open(f).read() for f in classFiles})
+        for f in classFiles:
+            os.remove(f)
+    client = RtAttenClient()
+    client.connect('127.0.0.1', port)
+    client.sendShutdownServer()
+    client.close()
+    client.ttlPulseClient.close()
+
+    numFiles, diffs = compareSessions(sessionIds)
+    print("{} runs, {} voxels".format(args.numRuns, args.numVoxels))
+    print("{:>20} {:>10}".format('', 'session s'))
+    print("{:>20} {:>10.2f}".format('TRData per TR', times[0]))
+    print("{:>20} {:>10.2f}".format('BatchTRData', times[1]))
+    print("block group files compared {}, differing fields {}".format(numFiles, diffs))
+    print("prediction files {}, identical {}".format(len(predictions[0]), predictions[0] == predictions[1]))
+    shutil.rmtree(benchDir)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Benchmark the time from a run being requested to the first TR result being output,
+for spawning a new ClientMain process per run compared to a warm client worker
+that was started ahead of time and is reused across runs. Uses the synthetic data
+test configuration with a local rtfMRI server.
+Run from the top level directory (needs the certs directory):
+Usage: python scripts/benchClientWorker.py -n 3
+"""
+import os
+import re
+import sys
+import time
+import toml
+import shlex
+import argparse
+import threading
+import subprocess
+import numpy as np  # type: ignore
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+import tests.rtfMRI.simfmri.generate_data as gd
+from webInterface.WebServer import makeSocketPipe, handleSocketRequests, resignalSocketThreadExit
+from webInterface.rtAtten.RtAttenWeb import RtAttenWeb
+from webInterface.rtAtten.ClientWorkerPool import ClientWorkerPool
+
+defaultCfgFile = os.path.join(rootPath, 'tests/rtfMRI/syntheticDataCfg.toml')
+trLinePattern = re.compile(r'^\d+\t\d+\t\d+\t')
+
+
+def benchCallback(request):
+    # subject feedback and other webpipe requests from the client
+    return {'status': 200}
+
+
+def firstTRSpawned(cfgFile, port):
+    webpipes = makeSocketPipe()
+    socketThread = threading.Thread(name='socketThread', target=handleSocketRequests,
+                                    args=(webpipes, benchCallback))
+    socketThread.setDaemon(True)
+    socketThread.start()
+    stime = time.time()
+    cmdStr = 'python -u ClientMain.py -l -p {} -e {} --websock {}'.format(port, cfgFile, webpipes.sockname)
+    proc = subprocess.Popen(shlex.split(cmdStr), cwd=rootPath, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, stdin=subprocess.PIPE)
+    firstTR = None
+    for bline in iter(proc.stdout.readline, b''):
+        if trLinePattern.match(bline.decode('utf-8')):
+            firstTR = time.time() - stime
+            break
+    # stop the run as the web server does
+    proc.stdin.close()
+    proc.wait()
+    resignalSocketThreadExit(socketThread, webpipes)
+    return firstTR
+
+
+def firstTRWorker(pool, cfgFile):
+    # the worker has been idle waiting for the run request
+    worker = pool.acquire()
+    stime = time.time()
+    worker.startSession(cfgFile)
+    firstTR = None
+    while True:
+        line = worker.nextLine(timeout=1)
+        if line is None:
+            break
+        if firstTR is None and trLinePattern.match(line):
+            firstTR = time.time() - stime
+    pool.release(worker)
+    return firstTR
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--experiment', '-e', default=defaultCfgFile, type=str,
+                           help='experiment file, the first run is used')
+    argParser.add_argument('--numRuns', '-n', default=3, type=int,
+                           help='number of runs per mode')
+    argParser.add_argument('--idleTime', '-i', default=3, type=float,
+                           help='seconds between runs')
+    argParser.add_argument('--port', '-p', default=5217, type=int,
+                           help='local rtfMRI server port')
+    args = argParser.parse_args()
+
+    gd.generate_data(args.experiment)
+    cfg = toml.load(args.experiment)
+    cfg['session']['Runs'] = cfg['session']['Runs'][:1]
+    cfg['session']['ScanNums'] = cfg['session']['ScanNums'][:1]
+    cfgFile = '/tmp/benchClientWorker.toml'
+    with open(cfgFile, 'w') as fp:
+        toml.dump(cfg, fp)
+
+    spawnTimes = []
+    for i in range(args.numRuns):
+        spawnTimes.append(firstTRSpawned(cfgFile, args.port))
+        time.sleep(args.idleTime)
+    pool = ClientWorkerPool('python -u ClientMain.py -l -p {}'.format(args.port), rootPath,
+                            benchCallback, RtAttenWeb.procOutputReader)
+    pool.start()
+    workerTimes = []
+    for i in range(args.numRuns):
+        time.sleep(args.idleTime)
+        workerTimes.append(firstTRWorker(pool, cfgFile))
+    pool.shutdown()
+    print("spawned: request to first TR {} mean {:.2f}s".format(
+          ', '.join('{:.2f}s'.format(t) for t in spawnTimes), np.mean(spawnTimes)))
+    print(" worker: request to first TR {} mean {:.2f}s".format(
+          ', '.join('{:.2f}s'.format(t) for t in workerTimes), np.mean(workerTimes)))
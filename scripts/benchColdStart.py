@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Benchmark the cold start of the ServerMain and ClientMain entry points. Reports the
+cumulative module import time from 'python -X importtime' with the slowest
+packages loaded, and the time from starting the process until it is listening, for
+ServerMain until its port accepts connections and for a ClientMain worker with a
+local server until it prints the worker ready line.
+Run from the top level directory:
+Usage: python scripts/benchColdStart.py -n 5
+"""
+import os
+import re
+import sys
+import time
+import socket
+import argparse
+import subprocess
+import numpy as np  # type: ignore
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+from webInterface.rtAtten.RtAttenWeb import RtAttenWeb
+from webInterface.rtAtten.ClientWorkerPool import ClientWorker
+
+importTimePattern = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|\s+(\S+)')
+
+
+def benchCallback(request):
+    return {'status': 200}
+
+
+def importTimes(module):
+    '''Cumulative import time in ms of the module and of each package it loads'''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                          cwd=rootPath, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    times = {}
+    for line in proc.stderr.decode('utf-8').splitlines():
+        match = importTimePattern.match(line)
+        if match is not None:
+            times[match.group(3)] = int(match.group(2)) / 1000
+    return times
+
+
+def serverListening(port):
+    stime = time.time()
+    proc = subprocess.Popen([sys.executable, 'ServerMain.py', '-p', str(port), '-g', '30'],
+                            cwd=rootPath, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elapsed = None
+    while proc.poll() is None:
+        try:
+            sock = socket.create_connection(('localhost', port), timeout=1)
+            elapsed = time.time() - stime
+            sock.close()
+            break
+        except OSError:
+            time.sleep(0.005)
+    proc.kill()
+    proc.wait()
+    return elapsed
+
+
+def clientListening(port):
+    stime = time.time()
+    worker = ClientWorker('{} -u ClientMain.py -l -p {}'.format(sys.executable, port), rootPath,
+                          benchCallback, RtAttenWeb.procOutputReader)
+    elapsed = None
+    if worker.waitReady(timeout=60):
+        elapsed = time.time() - stime
+    worker.close()
+    return elapsed
+
+
+def report(name, times):
+    print("{:>10}: {} mean {:.0f}ms".format(
+          name, ', '.join('{:.0f}ms'.format(t * 1000) for t in times), np.mean(times) * 1000))
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--numRuns', '-n', default=5, type=int,
+                           help='number of process starts per entry point')
+    argParser.add_argument('--topImports', '-t', default=5, type=int,
+                           help='number of slowest packages to list')
+    argParser.add_argument('--port', '-p', default=5219, type=int,
+                           help='rtfMRI server port')
+    args = argParser.parse_args()
+
+    for module in ('ServerMain', 'ClientMain'):
+        totals = []
+        for i in range(args.numRuns):
+            times = importTimes(module)
+            totals.append(times[module])
+        print("{:>10}: import time mean {:.0f}ms, min {:.0f}ms".format(module, np.mean(totals), np.min(totals)))
+        slowest = sorted(((t, name) for name, t in times.items() if name != module and '.' not in name),
+                         reverse=True)
+        for t, name in slowest[:args.topImports]:
+            print("{:>10}    {:>6.0f}ms {}".format('', t, name))
+
+    report('ServerMain', [serverListening(args.port) for i in range(args.numRuns)])
+    report('ClientMain', [clientListening(args.port) for i in range(args.numRuns)])
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Benchmark the block group validation comparison of whole brain sized patterns.
+Compares compareMatStructs followed by pearsons_mean_corr calls as they were,
+comparing the full arrays at once, with the chunked comparison computing the
+stats and the pearson correlations in one pass. Reports time and peak memory.
+Usage: python scripts/benchCompare.py -t 400 -v 50000
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np  # type: ignore
+import scipy.stats as sstats  # type: ignore
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+import rtfMRI.ValidationUtils as vutils
+from rtfMRI.StructDict import MatlabStructDict
+
+cmpFields = ['raw', 'raw_sm', 'raw_sm_filt', 'raw_sm_filt_z', 'categoryseparation']
+
+
+def legacyCompareArrays(A, B):
+    '''compareArrays as it was, with full size temporaries'''
+    if np.array_equal(A, B):
+        return vutils.StatsEqual
+    diff = abs((A / B) - 1)
+    diff = np.nan_to_num(diff)
+    histocounts, histobins = np.histogram(diff, vutils.compareHistoBins)
+    return {'mean': np.mean(diff), 'count': A.size,
+            'min': np.min(diff), 'max': np.max(diff), 'stddev': np.std(diff),
+            'histocounts': histocounts, 'histobins': histobins,
+            'histopct': histocounts / A.size * 100}
+
+
+def legacyPearsonsMeanCorr(A, B):
+    '''pearsons_mean_corr as it was, a scipy call per column'''
+    pearsonsList = []
+    for col in range(A.shape[1]):
+        nans = np.logical_or(np.isnan(A[:, col]), np.isnan(B[:, col]))
+        if np.all(nans):
+            continue
+        pearsonsList.append(sstats.pearsonr(A[~nans, col], B[~nans, col])[0])
+    return np.mean(pearsonsList) if len(pearsonsList) > 0 else np.nan
+
+
+def legacyValidate(patterns, target_patterns):
+    res = {key: legacyCompareArrays(patterns[key], target_patterns[key]) for key in cmpFields}
+    pearsons = [legacyPearsonsMeanCorr(patterns.categoryseparation, target_patterns.categoryseparation),
+                legacyPearsonsMeanCorr(patterns.raw_sm_filt_z, target_patterns.raw_sm_filt_z)]
+    return res, pearsons
+
+
+def chunkedValidate(patterns, target_patterns):
+    res = vutils.compareMatStructs(patterns, target_patterns, field_list=cmpFields,
+                                   pearson_fields=['categoryseparation', 'raw_sm_filt_z'])
+    return res, [res['categoryseparation']['pearson'], res['raw_sm_filt_z']['pearson']]
+
+
+def createPatterns(nTRs, nVoxels, rng):
+    patterns = MatlabStructDict({'patterns': MatlabStructDict({})}, 'patterns')
+    target_patterns = MatlabStructDict({'patterns': MatlabStructDict({})}, 'patterns')
+    for field in cmpFields:
+        shape = (nTRs, 1) if field == 'categoryseparation' else (nTRs, nVoxels)
+        target = rng.standard_normal(shape)
+        target[nTRs // 2:] = np.nan
+        setattr(target_patterns, field, target)
+        setattr(patterns, field, target * (1 + 0.01 * rng.standard_normal(shape)))
+    return patterns, target_patterns
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--numTRs', '-t', default=400, type=int, help='TRs in the block group')
+    argParser.add_argument('--numVoxels', '-v', default=50000, type=int, help='voxels in the patterns')
+    args = argParser.parse_args()
+
+    patterns, target_patterns = createPatterns(args.numTRs, args.numVoxels, np.random.default_rng(0))
+    print("{} fields of {} TRs by {} voxels, {:.0f} MB per array".format(
+        len(cmpFields), args.numTRs, args.numVoxels, patterns.raw.nbytes / 2**20))
+    print("{:>10} {:>10} {:>14}".format('', 'time s', 'peak extra MB'))
+    results = []
+    for name, validate in (('as it was', legacyValidate), ('chunked', chunkedValidate)):
+        tracemalloc.start()
+        stime = time.time()
+        res, pearsons = validate(patterns, target_patterns)
+        elapsed = time.time() - stime
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append((res, pearsons))
+        print("{:>10} {:>10.2f} {:>14.1f}".format(name, elapsed, peak / 2**20))
+    (legacyRes, legacyPearsons), (res, pearsons) = results
+    print("max mean difference {:.2e}, max pearson difference {:.2e}".format(
+        max(abs(legacyRes[key]['mean'] - res[key]['mean']) for key in cmpFields),
+        np.max(np.abs(np.array(legacyPearsons) - np.array(pearsons)))))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Benchmark findNewestFile on a data directory holding thousands of files from prior
+sessions. Compares the previous glob and ctime lookup of every match against the
+DirIndex lookups, for a pattern matching most of the files and for a pattern
+matching one run's files, with the directory unchanged and after a new file.
+Usage: python scripts/benchDirIndex.py -n 10000
+"""
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+from rtfMRI.dirIndex import DirIndex
+
+namePattern = 'patternsdata_{}_20180101T{:06d}_py.mat'
+
+
+def globNewestFile(pathPattern):
+    '''The findNewestFile lookup before the index'''
+    try:
+        return max(glob.iglob(pathPattern), key=os.path.getctime)
+    except ValueError:
+        return None
+
+
+def timeLookups(findNewest, pathPattern, iters, addFile=None):
+    findNewest(pathPattern)
+    elapsed = 0.0
+    for i in range(iters):
+        if addFile is not None:
+            addFile(i)
+        stime = time.perf_counter()
+        findNewest(pathPattern)
+        elapsed += time.perf_counter() - stime
+    return elapsed / iters * 1000
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--dir', '-d', default='/tmp/benchDirIndex', type=str,
+                           help='directory to create the test files in')
+    argParser.add_argument('--numFiles', '-n', default=10000, type=int,
+                           help='number of files in the directory')
+    argParser.add_argument('--iters', '-i', default=20, type=int,
+                           help='lookups per measurement')
+    args = argParser.parse_args()
+
+    if os.path.exists(args.dir):
+        shutil.rmtree(args.dir)
+    os.makedirs(args.dir)
+    for i in range(args.numFiles):
+        # 10 runs, 10 files per run per session
+        with open(os.path.join(args.dir, namePattern.format(i % 10, i)), 'w') as fp:
+            fp.write('data')
+
+    newFiles = []
+
+    def addFile(i):
+        newFiles.append(namePattern.format(0, args.numFiles + len(newFiles)))
+        with open(os.path.join(args.dir, newFiles[-1]), 'w') as fp:
+            fp.write('data')
+
+    print("{} files in {}, lookup times in ms".format(args.numFiles, args.dir))
+    print("{:>22} {:>10} {:>10} {:>10}".format('pattern', 'glob', 'index', 'inotify'))
+    for pattern in ('patternsdata_*', 'patternsdata_3_*'):
+        pathPattern = os.path.join(args.dir, pattern)
+        pollIndex = DirIndex(useInotify=False)
+        inotifyIndex = DirIndex()
+        assert globNewestFile(pathPattern) == pollIndex.findNewest(pathPattern) == inotifyIndex.findNewest(pathPattern)
+        time.sleep(DirIndex.maxAge)
+        times = [timeLookups(findNewest, pathPattern, args.iters)
+                 for findNewest in (globNewestFile, pollIndex.findNewest, inotifyIndex.findNewest)]
+        print("{:>22} {:>10.3f} {:>10.3f} {:>10.3f}".format(pattern, *times))
+        times = [timeLookups(findNewest, pathPattern, args.iters, addFile)
+                 for findNewest in (globNewestFile, pollIndex.findNewest, inotifyIndex.findNewest)]
+        print("{:>22} {:>10.3f} {:>10.3f} {:>10.3f}".format('  after a new file', *times))
+    shutil.rmtree(args.dir)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Compare bandwidth and per-TR latency of fetching full dicom files from the
+remote fileWatcher against fetching only the masked roi voxels, over a
+simulated slow link between the control room and the cloud.
+Run from the top level directory (needs the certs directory):
+Usage: python scripts/benchEdgeMasking.py -b 10 -v 3000 -n 20
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+import websocket
+import numpy as np  # type: ignore
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+from rtfMRI.ReadDicom import readDicomFromFile, parseDicomVolume, applyMask
+from webInterface.WebServer import Web
+from webInterface.webSocketFileWatcher import WebSocketFileWatcher
+import webInterface.WebClientUtils as wcutils
+
+defaultDicomFile = os.path.join(rootPath, 'tests/rtfMRI/test_input/001_000001_000001.dcm')
+sliceDim = 64
+
+
+def throttleSend(bytesPerSec):
+    '''Delay each websocket send by its transfer time over the simulated link'''
+    origSend = websocket.WebSocketApp.send
+
+    def send(self, data, opcode=websocket.ABNF.OPCODE_TEXT):
+        time.sleep(len(data) / bytesPerSec)
+        return origSend(self, data, opcode)
+    websocket.WebSocketApp.send = send
+
+
+def benchFetch(filename, roiInds, numTRs, masked):
+    latencies = []
+    numBytes = 0
+    for i in range(numTRs):
+        stime = time.time()
+        cmd = wcutils.watchFileReqStruct(filename, masked=masked)
+        response = Web.sendDataMsgFromThread(cmd, timeout=30)
+        assert response['status'] == 200
+        numBytes += len(response['data'])
+        if masked:
+            trData = np.frombuffer(response['data'], dtype=np.float32).astype(np.float64)
+        else:
+            dicomImg = wcutils.formatFileData(filename, response['data'])
+            trData = applyMask(parseDicomVolume(dicomImg, sliceDim), roiInds)
+        assert trData.size == roiInds.size
+        latencies.append(time.time() - stime)
+    latencies = np.array(latencies) * 1000
+    print("{:>6}: {} TRs, {:.1f} KB per TR, latency mean {:.1f}ms, p95 {:.1f}ms"
+          .format('masked' if masked else 'full', numTRs, numBytes / numTRs / 1024,
+                  np.mean(latencies), np.percentile(latencies, 95)))
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--file', '-f', default=defaultDicomFile, type=str,
+                           help='dicom file to use for each TR')
+    argParser.add_argument('--bandwidth', '-b', default=10, type=float,
+                           help='simulated link bandwidth in Mbit/s')
+    argParser.add_argument('--voxels', '-v', default=3000, type=int,
+                           help='number of voxels in the roi mask')
+    argParser.add_argument('--numTRs', '-n', default=20, type=int,
+                           help='number of TRs to fetch per mode')
+    argParser.add_argument('--port', '-p', default=8926, type=int,
+                           help='web server port')
+    args = argParser.parse_args()
+    filename = os.path.abspath(args.file)
+    volume = parseDicomVolume(readDicomFromFile(filename), sliceDim)
+    roiInds = np.sort(np.random.choice(volume.size, min(args.voxels, volume.size), replace=False))
+
+    throttleSend(args.bandwidth * 1e6 / 8)
+    webThread = threading.Thread(name='webThread', target=Web.start,
+                                 kwargs={'htmlDir': 'rtAtten/web/html', 'port': args.port, 'test': True})
+    webThread.setDaemon(True)
+    webThread.start()
+    time.sleep(1)
+    watchThread = threading.Thread(name='fileThread', target=WebSocketFileWatcher.runFileWatcher,
+                                   args=('localhost:{}'.format(args.port),),
+                                   kwargs={'retryInterval': 0.5,
+                                           'allowedDirs': [os.path.dirname(filename)],
+                                           'allowedTypes': ['.dcm', '.mat'],
+                                           'username': 'test', 'password': 'test'})
+    watchThread.setDaemon(True)
+    watchThread.start()
+    while Web.wsDataConn is None:
+        time.sleep(0.1)
+
+    cmd = wcutils.initWatchReqStruct(os.path.dirname(filename), '*.dcm', 0,
+                                     roiInds=roiInds, sliceDim=sliceDim)
+    response = Web.sendDataMsgFromThread(cmd, timeout=30)
+    assert response['status'] == 200
+    print("Link {} Mbit/s, roi voxels {}, file size {}".format(
+          args.bandwidth, roiInds.size, os.path.getsize(filename)))
+    benchFetch(filename, roiInds, args.numTRs, False)
+    benchFetch(filename, roiInds, args.numTRs, True)
+    Web.stop()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Benchmark the latency from a classification result arriving at the web server to
+the feedback image being received on the subject websocket. Compares reading and
+decoding the face and scene jpegs from disk each TR, as was done before, against
+the in-memory FeedbackRenderer, with and without pre-rendering the next TR's
+frames by quantized alpha.
+Run from the top level directory (needs the certs directory):
+Usage: python scripts/benchFeedbackImage.py -n 200 -s 0.02 -c 48 -t 0.1
+"""
+import os
+import io
+import sys
+import time
+import json
+import math
+import random
+import argparse
+import threading
+import websocket
+import numpy as np  # type: ignore
+from base64 import b64encode
+from PIL import Image, ImageDraw
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+from webInterface.WebServer import Web
+from webInterface.rtAtten.RtAttenWeb import RtAttenWeb
+from webInterface.rtAtten.FeedbackRenderer import FeedbackRenderer
+import webInterface.WebClientUtils as wcutils
+
+
+def diskFeedbackImage(vol, catsep):
+    '''Feedback image rendered from files on disk each TR, as before the FeedbackRenderer'''
+    renderer = RtAttenWeb.feedbackRenderer
+    if vol == 'train':
+        alpha = 0.4
+        faceImagesDir = renderer.faceNeutralImageDir
+        numFaceFiles = renderer.numFaceNeutralFiles
+    else:
+        alpha = 0.9 / (1 + math.exp(-2.3*(catsep-0.2))) + 0.12
+        faceImagesDir = renderer.faceNegativeImageDir
+        numFaceFiles = renderer.numFaceNegativeFiles
+    for imageDir in (renderer.sceneImageDir, renderer.faceNeutralImageDir, renderer.faceNegativeImageDir):
+        assert os.path.exists(imageDir)
+    faceFilename = os.path.join(faceImagesDir, '{}.jpg'.format(random.randint(1, numFaceFiles)))
+    sceneFilename = os.path.join(renderer.sceneImageDir, '{}.jpg'.format(random.randint(1, renderer.numSceneFiles)))
+    blendImg = Image.blend(Image.open(faceFilename), Image.open(sceneFilename), alpha=alpha)
+    width, height = blendImg.size
+    radius = 3
+    draw = ImageDraw.Draw(blendImg)
+    draw.ellipse((width/2-radius, height/2-radius, width/2+radius, height/2+radius),
+                 fill="black", outline="black")
+    jpgBuf = io.BytesIO()
+    blendImg.save(jpgBuf, format='jpeg')
+    return b64encode(jpgBuf.getvalue()).decode('utf-8')
+
+
+def benchFeedback(name, renderFunc, subjWs, numTRs, trInterval):
+    RtAttenWeb.createFeedbackImage = staticmethod(renderFunc)
+    latencies = []
+    for i in range(numTRs):
+        # rest of the TR, when pre-rendering of the next frames happens
+        time.sleep(trInterval)
+        catsep = random.uniform(-1, 1)
+        request = {'cmd': 'classificationResult', 'value': {'catsep': catsep, 'vol': i}, 'runId': 1}
+        stime = time.time()
+        RtAttenWeb.webPipeCallback(request)
+        msg = json.loads(subjWs.recv())
+        latencies.append(time.time() - stime)
+        assert msg['cmd'] == 'subjectDisplay'
+    latencies = np.array(latencies) * 1000
+    print("{:>9}: result to subject window mean {:.2f}ms, median {:.2f}ms, p95 {:.2f}ms"
+          .format(name, np.mean(latencies), np.median(latencies), np.percentile(latencies, 95)))
+
+
+def benchRender(name, renderFunc, numTRs):
+    stime = time.time()
+    for i in range(numTRs):
+        renderFunc(i, random.uniform(-1, 1))
+    print("{:>9}: render mean {:.2f}ms".format(name, (time.time() - stime) / numTRs * 1000))
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--feedbackdir', '-f', default='webInterface/images', type=str,
+                           help='Directory with feedback image files')
+    argParser.add_argument('--numTRs', '-n', default=200, type=int,
+                           help='number of classification results per mode')
+    argParser.add_argument('--alphaStep', '-s', default=0.02, type=float,
+                           help='alpha quantization step for pre-rendered frames')
+    argParser.add_argument('--prerenderFrames', '-c', default=48, type=int,
+                           help='max pre-rendered frames per TR')
+    argParser.add_argument('--trInterval', '-t', default=0.1, type=float,
+                           help='seconds between classification results')
+    argParser.add_argument('--port', '-p', default=8928, type=int,
+                           help='web server port')
+    args = argParser.parse_args()
+
+    stime = time.time()
+    RtAttenWeb.feedbackRenderer = FeedbackRenderer(args.feedbackdir)
+    RtAttenWeb.feedbackRenderer.preload()
+    print("Preloaded {} images, {:.1f}MB, in {:.2f}s".format(
+          len(RtAttenWeb.feedbackRenderer.imageCache),
+          RtAttenWeb.feedbackRenderer.cacheBytes / 2**20, time.time() - stime))
+    webThread = threading.Thread(name='webThread', target=Web.start,
+                                 kwargs={'htmlDir': 'rtAtten/web/html',
+                                         'port': args.port, 'test': True})
+    webThread.setDaemon(True)
+    webThread.start()
+    time.sleep(1)
+    serverAddr = 'localhost:{}'.format(args.port)
+    sessionCookie = wcutils.login(serverAddr, 'test', 'test')
+    subjWs = websocket.create_connection('wss://{}/wsSubject'.format(serverAddr),
+                                         cookie='login=' + sessionCookie,
+                                         sslopt={"ca_certs": wcutils.certFile})
+    while len(Web.wsSubjConns) == 0:
+        time.sleep(0.1)
+
+    renderer = RtAttenWeb.feedbackRenderer
+    benchRender('disk', diskFeedbackImage, args.numTRs)
+    benchRender('memory', renderer.createFeedbackImage, args.numTRs)
+    benchFeedback('disk', diskFeedbackImage, subjWs, args.numTRs, args.trInterval)
+    benchFeedback('memory', renderer.createFeedbackImage, subjWs, args.numTRs, args.trInterval)
+    prerenderer = FeedbackRenderer(args.feedbackdir, alphaStep=args.alphaStep,
+                                   prerenderFrames=args.prerenderFrames)
+    prerenderer.preload()
+    prerenderer.startPrerender()
+    benchFeedback('prerender', prerenderer.createFeedbackImage, subjWs, args.numTRs, args.trInterval)
+    print("prerender: {} hits, {} misses".format(prerenderer.numPrerenderHits,
+                                                 prerenderer.numPrerenderMisses))
+    subjWs.close()
+    Web.stop()
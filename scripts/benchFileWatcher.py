@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Benchmark the file watchers on a directory holding thousands of prior DICOMs.
+Measures the latency from a file being written to waitForFile() returning,
+and the cpu time used while waiting, for the default (inotify/watchdog) and
+polling file watchers.
+Usage: python scripts/benchFileWatcher.py -n 5000 -t 0.5 -c 20
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import threading
+import numpy as np  # type: ignore
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+from rtfMRI.fileWatcher import FileWatcher
+from rtfMRI.utils import findNewestFile
+
+fileSize = 300000
+namePattern = '001_0000{:02d}_{:06d}.dcm'
+
+
+def makePriorFiles(benchDir, numFiles):
+    data = os.urandom(fileSize)
+    for i in range(numFiles):
+        filename = os.path.join(benchDir, namePattern.format(1, i))
+        with open(filename, 'wb') as fp:
+            fp.write(data)
+
+
+def writerThread(benchDir, scanNum, count, trPeriod, writeTimes):
+    data = os.urandom(fileSize)
+    for i in range(count):
+        time.sleep(trPeriod)
+        filename = os.path.join(benchDir, namePattern.format(scanNum, i))
+        with open(filename, 'wb') as fp:
+            fp.write(data)
+        writeTimes[filename] = time.time()
+
+
+def benchWatcher(watcherType, benchDir, scanNum, count, trPeriod):
+    fileWatcher = FileWatcher(watcherType)
+    fileWatcher.initFileNotifier(benchDir, '*.dcm', fileSize)
+    writeTimes = {}
+    writer = threading.Thread(name='writer', target=writerThread,
+                              args=(benchDir, scanNum, count, trPeriod, writeTimes))
+    writer.setDaemon(True)
+    latencies = []
+    startCpu = time.process_time()
+    writer.start()
+    for i in range(count):
+        filename = os.path.join(benchDir, namePattern.format(scanNum, i))
+        retVal = fileWatcher.waitForFile(filename, timeout=10 * trPeriod)
+        foundTime = time.time()
+        if retVal is None:
+            print("{}: timeout waiting for {}".format(watcherType, filename))
+            continue
+        latencies.append(foundTime - writeTimes.get(filename, foundTime))
+    cpuTime = time.process_time() - startCpu
+    writer.join()
+    latencies = np.array(latencies) * 1000
+    print("{:>8}: files {}, latency mean {:.1f}ms, max {:.1f}ms, cpu {:.3f}s"
+          .format(watcherType, len(latencies), np.mean(latencies),
+                  np.max(latencies), cpuTime))
+
+
+def benchFindNewest(benchDir, iters):
+    stime = time.time()
+    for i in range(iters):
+        findNewestFile(benchDir, '*.dcm')
+    globTime = (time.time() - stime) / iters
+    fileWatcher = FileWatcher('polling')
+    fileWatcher.initFileNotifier(benchDir, '*.dcm', 0)
+    missingName = namePattern.format(99, 0)
+    missingFile = os.path.join(benchDir, missingName)
+    stime = time.time()
+    for i in range(iters):
+        fileWatcher.checkForFile(missingFile, missingName, True)
+    pollTime = (time.time() - stime) / iters
+    stime = time.time()
+    for i in range(iters):
+        fileWatcher.rescanDir()
+    scanTime = (time.time() - stime) / iters
+    print("findNewestFile glob+stat {:.2f}ms, polling check {:.3f}ms, polling rescan {:.2f}ms"
+          .format(globTime * 1000, pollTime * 1000, scanTime * 1000))
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--dir', '-d', default='/tmp/benchFileWatcher', type=str,
+                           help='directory to create the test files in')
+    argParser.add_argument('--numFiles', '-n', default=5000, type=int,
+                           help='number of prior dicom files in the directory')
+    argParser.add_argument('--trPeriod', '-t', default=0.5, type=float,
+                           help='seconds between new files')
+    argParser.add_argument('--count', '-c', default=20, type=int,
+                           help='number of new files to wait for per watcher')
+    args = argParser.parse_args()
+
+    if os.path.exists(args.dir):
+        shutil.rmtree(args.dir)
+    os.makedirs(args.dir)
+    print("Creating {} prior files in {}".format(args.numFiles, args.dir))
+    makePriorFiles(args.dir, args.numFiles)
+    benchFindNewest(args.dir, 10)
+    benchWatcher('default', args.dir, 2, args.count, args.trPeriod)
+    benchWatcher('polling', args.dir, 3, args.count, args.trPeriod)
+    shutil.rmtree(args.dir)
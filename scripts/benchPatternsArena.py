@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Benchmark the patterns memory of RtAttenModel over a session of synthetic runs. The
+model handles the session messages in process, without a server. Reports per run the
+numpy arrays the model allocates with np.full, np.concatenate and np.copy and their
+total size, the peak traced memory and the traced memory still held at the end of
+the run (the cached block groups), traced from the session start, the peak RSS and
+the run time.
+Usage: python scripts/benchPatternsArena.py -r 3 -n 240 -v 10000
+"""
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import tracemalloc
+import numpy as np  # type: ignore
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+import rtAtten.RtAttenEngine as RtAttenEngineModule
+from rtAtten.RtAttenModel import RtAttenModel
+from rtfMRI.StructDict import StructDict
+from rtfMRI.Messaging import Message
+from rtfMRI.MsgTypes import MsgType, MsgEvent, MsgResult
+
+benchDir = '/tmp/benchPatternsArena'
+
+
+class CountingNumpy():
+    '''Stands in for numpy in the model module, counting the arrays allocated'''
+    def __init__(self):
+        self.count = 0
+        self.nbytes = 0
+
+    def __getattr__(self, name):
+        return getattr(np, name)
+
+    def full(self, *args, **kwargs):
+        return self.counted(np.full(*args, **kwargs))
+
+    def concatenate(self, *args, **kwargs):
+        return self.counted(np.concatenate(*args, **kwargs))
+
+    def copy(self, *args, **kwargs):
+        return self.counted(np.copy(*args, **kwargs))
+
+    def counted(self, arr):
+        self.count += 1
+        self.nbytes += arr.nbytes
+        return arr
+
+
+def peakRSS():
+    with open('/proc/self/status') as fp:
+        return int(re.search(r'VmHWM:\s+(\d+) kB', fp.read()).group(1)) * 1024
+
+
+def resetPeakRSS():
+    with open('/proc/self/clear_refs', 'w') as fp:
+        fp.write('5')
+
+
+class ModelDriver():
+    def __init__(self, model):
+        self.model = model
+        self.ids = StructDict({'experimentId': 1, 'sessionId': '20180101T000000'})
+
+    def send(self, event, cfg):
+        msg = Message()
+        msg.type = MsgType.Command
+        msg.event_type = event
+        msg.fields.ids = self.ids.copy()
+        msg.fields.cfg = cfg
+        reply = self.model.handleMessage(msg)
+        if reply.result != MsgResult.Success:
+            raise RuntimeError("{}: {}".format(event, reply.data))
+        return reply
+
+
+def createRunCfg(runId, nVols, rng):
+    run = StructDict({'runId': runId, 'scanNum': runId, 'TRTime': 2, 'disdaqs': 0, 'nVols': nVols,
+                      'rtfeedback': int(runId > 1), 'blockGroups': []})
+    firstVolPhase2 = nVols // 2
+    for blkGrpId, tr_range in ((1, range(firstVolPhase2)), (2, range(firstVolPhase2, nVols))):
+        blkGrp = StructDict({'blkGrpId': blkGrpId, 'type': blkGrpId, 'firstVol': tr_range[0],
+                             'nTRs': len(tr_range), 'blocks': []})
+        blockTRs = 20
+        for i in range(0, len(tr_range), blockTRs):
+            block = StructDict({'blockId': len(blkGrp.blocks) + 1 + (blkGrpId - 1) * 100, 'TRs': []})
+            attCateg = int(rng.integers(1, 3))
+            for iTR in tr_range[i:i + blockTRs]:
+                regressor = [0, 0]
+                if iTR - i - tr_range[0] >= 2:
+                    regressor[attCateg - 1] = 1
+                block.TRs.append(StructDict({'trId': iTR - tr_range[0], 'vol': iTR + 1, 'type': blkGrpId,
+                                             'attCateg': attCateg, 'stim': attCateg,
+                                             'regressor': regressor}))
+            blkGrp.blocks.append(block)
+        run.blockGroups.append(blkGrp)
+    return run
+
+
+def runRun(driver, run, rng, nVoxels):
+    driver.ids.runId = run.runId
+    driver.send(MsgEvent.StartRun, StructDict({k: v for k, v in run.items() if k != 'blockGroups'}))
+    for blkGrp in run.blockGroups:
+        driver.ids.blkGrpId = blkGrp.blkGrpId
+        driver.send(MsgEvent.StartBlockGroup, StructDict({k: v for k, v in blkGrp.items() if k != 'blocks'}))
+        for block in blkGrp.blocks:
+            driver.ids.blockId = block.blockId
+            driver.send(MsgEvent.StartBlock, StructDict({'blockId': block.blockId}))
+            for TR in block.TRs:
+                driver.ids.trId = TR.trId
+                TR.data = rng.standard_normal(nVoxels) + 100 + np.array(TR.regressor).sum()
+                driver.send(MsgEvent.TRData, TR)
+            del driver.ids.trId
+            driver.send(MsgEvent.EndBlock, StructDict({'blockId': block.blockId}))
+        del driver.ids.blockId
+        driver.send(MsgEvent.EndBlockGroup, StructDict({'blkGrpId': blkGrp.blkGrpId}))
+    del driver.ids.blkGrpId
+    if run.runId == 1:
+        blkGrpRefs = [{'run': 1, 'phase': 1}, {'run': 1, 'phase': 2}]
+    else:
+        blkGrpRefs = [{'run': run.runId - 1, 'phase': 1}, {'run': run.runId, 'phase': 1}]
+    driver.send(MsgEvent.TrainModel, StructDict({'blkGrpRefs': blkGrpRefs}))
+    driver.send(MsgEvent.EndRun, StructDict({'runId': run.runId}))
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--numRuns', '-r', default=3, type=int,
+                           help='number of runs in the session')
+    argParser.add_argument('--numVols', '-n', default=240, type=int,
+                           help='volumes per run, half in each block group')
+    argParser.add_argument('--numVoxels', '-v', default=10000, type=int,
+                           help='voxels in the roi')
+    args = argParser.parse_args()
+
+    rng = np.random.default_rng(0)
+    roiDims = (64, 64, 36)
+    roiInds = np.sort(rng.choice(np.prod(roiDims), args.numVoxels, replace=False))
+    if os.path.exists(benchDir):
+        shutil.rmtree(benchDir)
+    session = StructDict({'sessionId': '20180101T000000', 'serverDataDir': benchDir,
+                          'subjectNum': 1, 'subjectDay': 1, 'nVoxels': args.numVoxels,
+                          'roiDims': roiDims, 'roiInds': roiInds, 'FWHM': 5, 'cutoff': 112,
+                          'legacyRun1Phase2Mode': True, 'validate': False, 'useSessionTimestamp': False})
+    counter = CountingNumpy()
+    RtAttenEngineModule.np = counter  # type: ignore
+    tracemalloc.start()
+    driver = ModelDriver(RtAttenModel())
+    driver.send(MsgEvent.StartSession, session)
+    runs = [createRunCfg(runId, args.numVols, rng) for runId in range(1, args.numRuns + 1)]
+
+    print("{} runs of {} volumes, {} voxels".format(args.numRuns, args.numVols, args.numVoxels))
+    print("{:>4} {:>8} {:>10} {:>12} {:>12} {:>12} {:>8}".format(
+          'run', 'arrays', 'alloc MB', 'traced MB', 'retained MB', 'peak RSS MB', 'time s'))
+    for run in runs:
+        counter.count, counter.nbytes = 0, 0
+        tracemalloc.reset_peak()
+        resetPeakRSS()
+        stime = time.time()
+        runRun(driver, run, rng, args.numVoxels)
+        elapsed = time.time() - stime
+        retained, tracedPeak = tracemalloc.get_traced_memory()
+        print("{:>4} {:>8} {:>10.1f} {:>12.1f} {:>12.1f} {:>12.1f} {:>8.2f}".format(
+              run.runId, counter.count, counter.nbytes / 2**20, tracedPeak / 2**20,
+              retained / 2**20, peakRSS() / 2**20, elapsed))
+    driver.send(MsgEvent.EndSession, StructDict())
+    shutil.rmtree(benchDir)
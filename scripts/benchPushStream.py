@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Benchmark the latency from a dicom file being closed on the scanner computer to
+its data being ready in the client process, for per-TR watchFile long-polls
+compared to a subscribe push stream. Requests go through the webpipe fifos and
+the RtAttenWeb routing, with a simulated one way network delay on the data
+websocket in each direction.
+Run from the top level directory (needs the certs directory):
+Usage: python scripts/benchPushStream.py -d 20 -t 1.0 -c 0.3 -n 20
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import threading
+import websocket
+import numpy as np  # type: ignore
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+from rtfMRI.StructDict import StructDict
+from webInterface.WebServer import Web, makeFifo, handleFifoRequests
+from webInterface.webSocketFileWatcher import WebSocketFileWatcher
+from webInterface.rtAtten.RtAttenWeb import RtAttenWeb
+import webInterface.WebClientUtils as wcutils
+
+defaultDicomFile = os.path.join(rootPath, 'tests/rtfMRI/test_input/001_000001_000001.dcm')
+namePattern = '001_0000{:02d}_{:06d}.dcm'
+
+
+def simulateNetworkDelay(delay):
+    '''Delay messages in both directions between the web server and fileWatcher'''
+    origSend = websocket.WebSocketApp.send
+    origOnMessage = WebSocketFileWatcher.on_message
+
+    def send(self, data, opcode=websocket.ABNF.OPCODE_TEXT):
+        time.sleep(delay)
+        return origSend(self, data, opcode)
+
+    def on_message(client, message):
+        time.sleep(delay)
+        origOnMessage(client, message)
+    websocket.WebSocketApp.send = send
+    WebSocketFileWatcher.on_message = staticmethod(on_message)
+
+
+def writerThread(srcFile, filenames, trPeriod, closeTimes):
+    for filename in filenames:
+        time.sleep(trPeriod)
+        shutil.copy(srcFile, filename)
+        closeTimes[filename] = time.time()
+
+
+def benchStream(clientPipes, srcFile, benchDir, scanNum, args, push):
+    filenames = [os.path.join(benchDir, namePattern.format(scanNum, i)) for i in range(args.numTRs)]
+    if push:
+        cmd = wcutils.subscribeReqStruct(filenames)
+        retVals = wcutils.clientWebpipeCmd(clientPipes, cmd)
+        assert retVals.statusCode == 200
+    closeTimes = {}
+    writer = threading.Thread(name='writer', target=writerThread,
+                              args=(srcFile, filenames, args.trPeriod, closeTimes))
+    writer.setDaemon(True)
+    writer.start()
+    latencies = []
+    for filename in filenames:
+        statusCode = 408
+        while statusCode == 408:
+            if push:
+                cmd = wcutils.getPushedFileReqStruct(filename)
+            else:
+                cmd = wcutils.watchFileReqStruct(filename)
+            retVals = wcutils.clientWebpipeCmd(clientPipes, cmd)
+            statusCode = retVals.statusCode
+        assert statusCode == 200
+        latencies.append(time.time() - closeTimes[filename])
+        # model the per-TR processing before the client asks for the next volume
+        time.sleep(args.processTime)
+    writer.join()
+    if push:
+        wcutils.clientWebpipeCmd(clientPipes, wcutils.unsubscribeReqStruct())
+    latencies = np.array(latencies) * 1000
+    print("{:>9}: TRs {}, close to ready latency mean {:.1f}ms, median {:.1f}ms, max {:.1f}ms"
+          .format('push' if push else 'watchFile', len(latencies), np.mean(latencies),
+                  np.median(latencies), np.max(latencies)))
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--file', '-f', default=defaultDicomFile, type=str,
+                           help='dicom file written for each TR')
+    argParser.add_argument('--dir', default='/tmp/benchPushStream', type=str,
+                           help='directory the scanner files are written to')
+    argParser.add_argument('--delay', '-d', default=20, type=float,
+                           help='simulated one way network delay in ms')
+    argParser.add_argument('--trPeriod', '-t', default=1.0, type=float,
+                           help='seconds between new files')
+    argParser.add_argument('--processTime', '-c', default=0.3, type=float,
+                           help='client seconds of processing per TR')
+    argParser.add_argument('--numTRs', '-n', default=20, type=int,
+                           help='number of TRs per mode')
+    argParser.add_argument('--port', '-p', default=8927, type=int,
+                           help='web server port')
+    args = argParser.parse_args()
+    if os.path.exists(args.dir):
+        shutil.rmtree(args.dir)
+    os.makedirs(args.dir)
+
+    simulateNetworkDelay(args.delay / 1000)
+    webThread = threading.Thread(name='webThread', target=Web.start,
+                                 kwargs={'htmlDir': 'rtAtten/web/html', 'port': args.port, 'test': True})
+    webThread.setDaemon(True)
+    webThread.start()
+    time.sleep(1)
+    watchThread = threading.Thread(name='fileThread', target=WebSocketFileWatcher.runFileWatcher,
+                                   args=('localhost:{}'.format(args.port),),
+                                   kwargs={'retryInterval': 0.5,
+                                           'allowedDirs': [args.dir],
+                                           'allowedTypes': ['.dcm'],
+                                           'username': 'test', 'password': 'test'})
+    watchThread.setDaemon(True)
+    watchThread.start()
+    while Web.wsDataConn is None:
+        time.sleep(0.1)
+
+    # client side of the webpipes, routed by RtAttenWeb as for ClientMain
+    webpipes = makeFifo()
+    fifoThread = threading.Thread(name='fifoThread', target=handleFifoRequests,
+                                  args=(webpipes, RtAttenWeb.webPipeCallback))
+    fifoThread.setDaemon(True)
+    fifoThread.start()
+    clientPipes = StructDict()
+    clientPipes.fd_in = open(webpipes.name_out, mode='rb')
+    clientPipes.fd_out = open(webpipes.name_in, mode='w', buffering=1)
+
+    cmd = wcutils.initWatchReqStruct(args.dir, '*.dcm', 0)
+    retVals = wcutils.clientWebpipeCmd(clientPipes, cmd)
+    assert retVals.statusCode == 200
+    print("One way delay {}ms, TR {}s, processing {}s".format(args.delay, args.trPeriod, args.processTime))
+    benchStream(clientPipes, args.file, args.dir, 1, args, False)
+    benchStream(clientPipes, args.file, args.dir, 2, args, True)
+    clientPipes.fd_out.close()
+    clientPipes.fd_in.close()
+    Web.stop()
+    shutil.rmtree(args.dir)
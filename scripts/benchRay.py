@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Benchmark replaying a session with the Ray backend on a local ray.init() cluster
+against the TCP server path, a local server with RtAttenClient sending a TRData
+message per TR and with batchReplay. The Ray actor smooths the training TRs and
+runs the between runs highpass as tasks, and trains each model in a task that
+overlaps the next run. Compares the block group patterns of the two paths.
+Run from the top level directory (needs the certs directory):
+Usage: python scripts/benchRay.py -r 3 -v 5000
+"""
+import os
+import sys
+import glob
+import time
+import shutil
+import socket
+import logging
+import argparse
+import threading
+import toml  # type: ignore
+import numpy as np  # type: ignore
+import scipy.io as sio  # type: ignore
+import ray
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+import ServerMain
+import ReprocessMain
+import rtAtten.PatternsDesign2Config as Pats
+from rtfMRI.utils import loadMatFile
+from rtfMRI.RtfMRIClient import loadConfigFile, validateRunCfg
+from rtAtten.RtAttenClient import RtAttenClient
+from rtAtten.RtAttenModel import getSubjectDataDir, getBlkGrpFilename
+from rtAttenRay.RtAttenModel_Ray import RtAttenModel_Ray
+from rtAttenRay.RtAttenClient_Ray import LocalClient
+
+benchDir = '/tmp/benchRay'
+patternsDir = os.path.join(rootPath, 'webInterface/rtAtten/patterns')
+port = 5233
+
+
+def createSession(dataDir, runIds, nVoxels, rng):
+    '''An archived session, the mask, patterns design and patterns data files of the runs'''
+    subjectDir = getSubjectDataDir(dataDir, 1, 1)
+    os.makedirs(subjectDir)
+    mask = np.zeros((64, 64, 36), dtype=np.uint8)
+    mask.flat[rng.choice(mask.size, nVoxels, replace=False)] = 1
+    sio.savemat(os.path.join(subjectDir, 'mask_1_1.mat'), {'mask': mask})
+    cfg = toml.load(os.path.join(rootPath, 'conf/example.toml'))
+    cfg['session'].update({'dataDir': dataDir, 'subjectNum': 1, 'subjectDay': 1, 'Runs': runIds,
+                           'ScanNums': runIds, 'findNewestPatterns': False, 'patternsDesignFiles': [],
+                           'validationData': [], 'validationModels': [], 'calcClockSkewIters': 1})
+    for runId in runIds:
+        patternsFile = glob.glob(os.path.join(patternsDir, 'patternsdesign_{}_*.mat'.format(runId)))[0]
+        shutil.copy(patternsFile, subjectDir)
+        nVols = loadMatFile(patternsFile).block.shape[1]
+        sio.savemat(os.path.join(subjectDir, 'patternsdata_{}.mat'.format(runId)),
+                    {'patterns': {'raw': rng.standard_normal((nVols, nVoxels)) + 100}})
+        cfg['session']['patternsDesignFiles'].append(os.path.basename(patternsFile))
+        cfg['session']['validationData'].append('patternsdata_{}.mat'.format(runId))
+        cfg['session']['validationModels'].append('trainedModel_{}.mat'.format(runId))
+    cfgFile = os.path.join(benchDir, 'session.toml')
+    with open(cfgFile, 'w') as fp:
+        toml.dump(cfg, fp)
+    return cfgFile
+
+
+def runTcpSession(cfg):
+    '''The session against a local server, as ClientMain -l'''
+    serverThread = threading.Thread(name='server', target=ServerMain.ServerMain, args=(port, 30))
+    serverThread.setDaemon(True)
+    serverThread.start()
+    for i in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    client = RtAttenClient()
+    client.runSession('127.0.0.1', port, cfg, keepConnection=True)
+    client.sendShutdownServer()
+    client.close()
+    client.ttlPulseClient.close()
+    serverThread.join(timeout=5)
+
+
+def runRaySession(cfg):
+    '''The session with the Ray actor, as rtAttenRay/RtAttenClient_Ray.py'''
+    rtatten = ray.remote(RtAttenModel_Ray).remote()
+    client = LocalClient(rtatten)
+    client.start_session(cfg)
+    subjectDataDir = getSubjectDataDir(cfg.session.dataDir, cfg.session.subjectNum, cfg.session.subjectDay)
+    for runId in cfg.session.Runs:
+        runSchedule, _ = Pats.getLocalRunSchedule(cfg.session, subjectDataDir, runId)
+        run = Pats.createRunConfigFromSchedule(cfg.session, runSchedule, runId)
+        validateRunCfg(run)
+        client.do_run(run)
+    client.end_session()
+    ray.kill(rtatten)
+
+
+def blkGrpPatterns(outDir, sessionId, runIds):
+    subjectDir = getSubjectDataDir(outDir, 1, 1)
+    return [loadMatFile(os.path.join(subjectDir, getBlkGrpFilename(sessionId, runId, blkGrpId))).patterns
+            for runId in runIds for blkGrpId in (1, 2)]
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--numRuns', '-r', default=3, type=int, help='runs in the session')
+    argParser.add_argument('--numVoxels', '-v', default=5000, type=int, help='voxels in the roi')
+    argParser.add_argument('--cpus', '-c', default=None, type=int, help='cpus of the local ray cluster')
+    args = argParser.parse_args()
+    logging.disable(logging.WARNING)
+
+    if os.path.exists(benchDir):
+        shutil.rmtree(benchDir)
+    os.makedirs(benchDir)
+    runIds = list(range(1, args.numRuns + 1))
+    cfgFile = createSession(os.path.join(benchDir, 'data'), runIds, args.numVoxels, np.random.default_rng(0))
+
+    results = []
+    stime = time.time()
+    ray.init(num_cpus=args.cpus, include_dashboard=False, logging_level=logging.ERROR)
+    rayInitTime = time.time() - stime
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            for name, batchReplay in (('tcp per TR', False), ('tcp batchReplay', True), ('ray', None)):
+                outDir = os.path.join(benchDir, name.replace(' ', '_'))
+                cfg = ReprocessMain.reprocessConfig(loadConfigFile(cfgFile), 5, 200, outDir)
+                cfg.session.batchReplay = batchReplay
+                np.random.seed(0)
+                stime = time.time()
+                if batchReplay is None:
+                    runRaySession(cfg)
+                else:
+                    runTcpSession(cfg)
+                results.append((name, time.time() - stime, blkGrpPatterns(outDir, cfg.session.sessionId, runIds)))
+        finally:
+            sys.stdout = stdout
+    ray.shutdown()
+    print("{} runs, {} voxels, {} cpus, ray.init {:.1f}s".format(args.numRuns, args.numVoxels, os.cpu_count(),
+                                                                  rayInitTime))
+    print("{:>16} {:>10} {:>10}".format('', 'session s', 's per run'))
+    for name, elapsed, _ in results:
+        print("{:>16} {:>10.1f} {:>10.1f}".format(name, elapsed, elapsed / args.numRuns))
+    tcpPatterns, rayPatterns = results[0][2], results[2][2]
+    for field in ('raw_sm', 'raw_sm_filt_z', 'categoryseparation'):
+        nanMismatch = sum(np.sum(np.isnan(tcp[field]) != np.isnan(ray_[field]))
+                          for tcp, ray_ in zip(tcpPatterns, rayPatterns))
+        diff = max(np.nanmax(np.abs(tcp[field] - ray_[field]), initial=0)
+                   for tcp, ray_ in zip(tcpPatterns, rayPatterns))
+        print("{} tcp vs ray: max difference {:.2e}, {} NaN mismatches, {} values".format(
+            field, diff, nanMismatch, sum(np.sum(~np.isnan(tcp[field])) for tcp in tcpPatterns)))
+    shutil.rmtree(benchDir)
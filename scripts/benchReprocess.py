@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Benchmark reprocessing a FWHM sweep of an archived session. Compares running
+the sessions one after another each against its own local server, as running
+ClientMain -l per session did, with ReprocessMain running the model in process
+serially (-j 1) and in parallel worker processes.
+Run from the top level directory (needs the certs directory):
+Usage: python scripts/benchReprocess.py -r 2 -v 5000 -f 3,4,5,6 -j 4
+"""
+import os
+import sys
+import glob
+import time
+import shutil
+import socket
+import logging
+import argparse
+import threading
+import toml  # type: ignore
+import numpy as np  # type: ignore
+import scipy.io as sio  # type: ignore
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+import ServerMain
+import ReprocessMain
+from rtfMRI.utils import loadMatFile
+from rtfMRI.StructDict import StructDict
+from rtfMRI.RtfMRIClient import loadConfigFile
+from rtAtten.RtAttenClient import RtAttenClient
+from rtAtten.RtAttenModel import getSubjectDataDir
+
+benchDir = '/tmp/benchReprocess'
+patternsDir = os.path.join(rootPath, 'webInterface/rtAtten/patterns')
+port = 5232
+
+
+def createSession(dataDir, runIds, nVoxels, rng):
+    '''An archived session, the mask, patterns design and patterns data files of the runs'''
+    subjectDir = getSubjectDataDir(dataDir, 1, 1)
+    os.makedirs(subjectDir)
+    mask = np.zeros((64, 64, 36), dtype=np.uint8)
+    mask.flat[rng.choice(mask.size, nVoxels, replace=False)] = 1
+    sio.savemat(os.path.join(subjectDir, 'mask_1_1.mat'), {'mask': mask})
+    cfg = toml.load(os.path.join(rootPath, 'conf/example.toml'))
+    cfg['session'].update({'dataDir': dataDir, 'subjectNum': 1, 'subjectDay': 1, 'Runs': runIds,
+                           'ScanNums': runIds, 'findNewestPatterns': False, 'patternsDesignFiles': [],
+                           'validationData': [], 'validationModels': [], 'calcClockSkewIters': 1,
+                           'getMasksFromControlRoom': False, 'getPatternsFromControlRoom': False})
+    for runId in runIds:
+        patternsFile = glob.glob(os.path.join(patternsDir, 'patternsdesign_{}_*.mat'.format(runId)))[0]
+        shutil.copy(patternsFile, subjectDir)
+        nVols = loadMatFile(patternsFile).block.shape[1]
+        sio.savemat(os.path.join(subjectDir, 'patternsdata_{}.mat'.format(runId)),
+                    {'patterns': {'raw': rng.standard_normal((nVols, nVoxels)) + 100}})
+        cfg['session']['patternsDesignFiles'].append(os.path.basename(patternsFile))
+        cfg['session']['validationData'].append('patternsdata_{}.mat'.format(runId))
+        cfg['session']['validationModels'].append('trainedModel_{}.mat'.format(runId))
+    cfgFile = os.path.join(benchDir, 'reprocess.toml')
+    with open(cfgFile, 'w') as fp:
+        toml.dump(cfg, fp)
+    return cfgFile
+
+
+def runServerSessions(cfgFile, fwhms):
+    '''Each session against its own local server, as ClientMain -l'''
+    for fwhm in fwhms:
+        serverThread = threading.Thread(name='server', target=ServerMain.ServerMain, args=(port, 30))
+        serverThread.setDaemon(True)
+        serverThread.start()
+        for i in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        outDir = os.path.join(benchDir, 'server', str(fwhm))
+        cfg = ReprocessMain.reprocessConfig(loadConfigFile(cfgFile), fwhm, 200, outDir)
+        client = RtAttenClient()
+        client.runSession('127.0.0.1', port, cfg, keepConnection=True)
+        client.sendShutdownServer()
+        client.close()
+        client.ttlPulseClient.close()
+        serverThread.join(timeout=5)
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--numRuns', '-r', default=2, type=int, help='runs in the session')
+    argParser.add_argument('--numVoxels', '-v', default=5000, type=int, help='voxels in the roi')
+    argParser.add_argument('--fwhm', '-f', default='3,4,5,6', type=str, help='FWHM values of the sweep')
+    argParser.add_argument('--jobs', '-j', default=4, type=int, help='ReprocessMain parallel jobs')
+    args = argParser.parse_args()
+    logging.disable(logging.WARNING)
+
+    if os.path.exists(benchDir):
+        shutil.rmtree(benchDir)
+    os.makedirs(benchDir)
+    runIds = list(range(1, args.numRuns + 1))
+    cfgFile = createSession(os.path.join(benchDir, 'data'), runIds, args.numVoxels, np.random.default_rng(0))
+    fwhms = ReprocessMain.parseNumbers(args.fwhm)
+
+    results = []
+    stime = time.time()
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            runServerSessions(cfgFile, fwhms)
+        finally:
+            sys.stdout = stdout
+    results.append(('server per session', time.time() - stime))
+    for jobs in sorted({1, args.jobs}):
+        params = StructDict({'experiments': [cfgFile], 'sessions': [], 'baseConfig': cfgFile, 'fwhm': fwhms,
+                             'cutoff': [200], 'jobs': jobs, 'threads': 1, 'validate': False, 'seed': 0,
+                             'outDir': os.path.join(benchDir, 'reprocess{}'.format(jobs))})
+        stime = time.time()
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                sessionResults = ReprocessMain.ReprocessMain(params)
+            finally:
+                sys.stdout = stdout
+        assert all(result.status == 'ok' for result in sessionResults)
+        results.append(('ReprocessMain -j {}'.format(jobs), time.time() - stime))
+    print("{} sessions of {} runs, {} voxels, {} cpus".format(len(fwhms), args.numRuns, args.numVoxels,
+                                                               os.cpu_count()))
+    print("{:>22} {:>10} {:>14}".format('', 'total s', 's per session'))
+    for name, elapsed in results:
+        print("{:>22} {:>10.1f} {:>14.1f}".format(name, elapsed, elapsed / len(fwhms)))
+    shutil.rmtree(benchDir)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Benchmark creating the run config at the start of a run. Compares loading and
+parsing the patterns design .mat file, as each run did, against the run schedule
+cache when the schedule was prebuilt at initSession (memory hit) and when it was
+saved by an earlier session or reprocessing pass (disk hit).
+Usage: python scripts/benchRunSchedules.py -i 20
+"""
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+from rtfMRI.StructDict import StructDict
+from rtAtten.PatternsDesign2Config import getLocalPatternsFile, createRunConfig, RunScheduleCache
+from rtAtten.PatternsDesign2Config import createRunConfigFromSchedule
+
+patternsDir = os.path.join(rootPath, 'webInterface/rtAtten/patterns')
+benchDir = '/tmp/benchRunSchedules'
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--iters', '-i', default=20, type=int,
+                           help='run configs per measurement')
+    args = argParser.parse_args()
+
+    if os.path.exists(benchDir):
+        shutil.rmtree(benchDir)
+    os.makedirs(benchDir)
+    patternsFiles = sorted(glob.glob(os.path.join(patternsDir, 'patternsdesign_*.mat')))
+    runIds = [int(os.path.basename(filename).split('_')[1]) for filename in patternsFiles]
+    session = StructDict({'Runs': runIds, 'ScanNums': runIds, 'findNewestPatterns': False,
+                          'patternsDesignFiles': patternsFiles})
+    cacheDir = os.path.join(benchDir, 'schedules')
+
+    def timeConfigs(createConfig):
+        stime = time.perf_counter()
+        for i in range(args.iters):
+            for runId in runIds:
+                createConfig(runId)
+        return (time.perf_counter() - stime) / (args.iters * len(runIds))
+
+    def patternsFileConfig(runId):
+        patterns, _ = getLocalPatternsFile(session, patternsDir, runId)
+        return createRunConfig(session, patterns, runId)
+
+    cache = RunScheduleCache(cacheDir)
+    for runId in runIds:
+        # prebuild, which also saves the schedules to cacheDir
+        cache.get(patternsFiles[runIds.index(runId)])
+
+    def memoryHitConfig(runId):
+        return createRunConfigFromSchedule(session, cache.get(patternsFiles[runIds.index(runId)]), runId)
+
+    def diskHitConfig(runId):
+        return createRunConfigFromSchedule(session, RunScheduleCache(cacheDir).get(
+                                           patternsFiles[runIds.index(runId)]), runId)
+
+    results = [('load patterns .mat', timeConfigs(patternsFileConfig)),
+               ('prebuilt (memory hit)', timeConfigs(memoryHitConfig)),
+               ('saved (disk hit)', timeConfigs(diskHitConfig))]
+    print("{} patterns design files, mean of {} run configs each".format(len(runIds), args.iters))
+    print("{:>24} {:>16}".format('', 'ms per run'))
+    for name, runTime in results:
+        print("{:>24} {:>16.2f}".format(name, runTime * 1000))
+    shutil.rmtree(benchDir)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Benchmark the web server's outbound messages during a run with a busy run log and
+a user window that has stopped reading, for example a tab in the background. Each
+TR the client process logs lines to the user window and sends a feedback image to
+the subject window. Compares writing each message to every connection as before
+against the per connection send queues with userLog batching, measuring the
+subject window feedback latency, the number of user frames and the memory
+buffered for the stalled user window.
+Run from the top level directory (needs the certs directory):
+Usage: python scripts/benchSendQueues.py -n 100 -l 500 -t 0.05
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import websocket
+import numpy as np  # type: ignore
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+from webInterface.WebServer import Web
+import webInterface.WebClientUtils as wcutils
+
+imageData = 'x' * 20000
+logLine = 'vol {0:04d}: classification result 0.123456, elapsed 0.456s ' * 2
+
+
+def directUserLog(logStr):
+    '''userLog as before the send queues, one frame per line written to every connection'''
+    cmd = {'cmd': 'userLog', 'value': logStr}
+    Web.ioLoopInst.add_callback(directWrite, Web.wsUserConns, json.dumps(cmd))
+
+
+def directSubjMsg(msg):
+    Web.ioLoopInst.add_callback(directWrite, Web.wsSubjConns, msg)
+
+
+def directWrite(conns, msg):
+    Web.threadLock.acquire()
+    try:
+        for client in conns:
+            client.write_message(msg)
+    finally:
+        Web.threadLock.release()
+
+
+def bufferedBytes(conns):
+    # bytes held in tornado's write buffers for the connections
+    total = 0
+    for client in conns:
+        stream = None if client.ws_connection is None else client.ws_connection.stream
+        if stream is not None and stream._write_buffer is not None:
+            total += len(stream._write_buffer)
+    return total
+
+
+def connect(serverAddr, path, sessionCookie, rcvBuf=None):
+    sockopt = ()
+    if rcvBuf is not None:
+        sockopt = ((socket.SOL_SOCKET, socket.SO_RCVBUF, rcvBuf),)
+    return websocket.create_connection('wss://{}/{}'.format(serverAddr, path),
+                                       cookie='login=' + sessionCookie, sockopt=sockopt,
+                                       sslopt={"ca_certs": wcutils.certFile})
+
+
+def benchRun(name, userLog, sendSubj, serverAddr, sessionCookie, args):
+    # the stalled user window never reads after connecting
+    stalledWs = connect(serverAddr, 'wsUser', sessionCookie, rcvBuf=4096)
+    userWs = connect(serverAddr, 'wsUser', sessionCookie)
+    subjWs = connect(serverAddr, 'wsSubject', sessionCookie)
+    while len(Web.wsUserConns) < 2 or len(Web.wsSubjConns) < 1:
+        time.sleep(0.1)
+    userFrames = [0]
+    userLines = [0]
+
+    def userReader():
+        while userLines[0] < args.numTRs * args.numLines:
+            msg = json.loads(userWs.recv())
+            userFrames[0] += 1
+            userLines[0] += len(msg['values']) if 'values' in msg else 1
+    readerThread = threading.Thread(name='userReader', target=userReader)
+    readerThread.setDaemon(True)
+    readerThread.start()
+    latencies = []
+    maxBuffered = 0
+    for vol in range(args.numTRs):
+        for i in range(args.numLines):
+            userLog(logLine.format(vol))
+        stime = time.time()
+        sendSubj(json.dumps({'cmd': 'subjectDisplay', 'data': imageData}))
+        json.loads(subjWs.recv())
+        latencies.append(time.time() - stime)
+        maxBuffered = max(maxBuffered, bufferedBytes(Web.wsUserConns))
+        time.sleep(args.trInterval)
+    readerThread.join(timeout=10)
+    latencies = np.array(latencies) * 1000
+    print("{:>6}: subject feedback mean {:.2f}ms, p95 {:.2f}ms, {} user frames for {} lines, "
+          "max buffered for user windows {:.0f}KB".format(
+              name, np.mean(latencies), np.percentile(latencies, 95), userFrames[0], userLines[0],
+              maxBuffered / 1000))
+    if userLog is Web.userLog:
+        for stats in Web.sendQueueStats().user:
+            print("{:>6}: user window send queue depth {}, max depth {}, sent {}, dropped {}".format(
+                  name, stats.depth, stats.maxDepth, stats.numSent, stats.numDropped))
+    for ws in (stalledWs, userWs, subjWs):
+        ws.close()
+    while len(Web.wsUserConns) > 0 or len(Web.wsSubjConns) > 0:
+        time.sleep(0.1)
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--numTRs', '-n', default=100, type=int,
+                           help='number of TRs per mode')
+    argParser.add_argument('--numLines', '-l', default=500, type=int,
+                           help='run log lines per TR')
+    argParser.add_argument('--trInterval', '-t', default=0.05, type=float,
+                           help='seconds between TRs')
+    argParser.add_argument('--port', '-p', default=8929, type=int,
+                           help='web server port')
+    args = argParser.parse_args()
+
+    webThread = threading.Thread(name='webThread', target=Web.start,
+                                 kwargs={'htmlDir': 'rtAtten/web/html',
+                                         'port': args.port, 'test': True})
+    webThread.setDaemon(True)
+    webThread.start()
+    time.sleep(1)
+    serverAddr = 'localhost:{}'.format(args.port)
+    sessionCookie = wcutils.login(serverAddr, 'test', 'test')
+    benchRun('direct', directUserLog, directSubjMsg, serverAddr, sessionCookie, args)
+    benchRun('queued', Web.userLog, Web.sendSubjMsgFromThread, serverAddr, sessionCookie, args)
+    Web.stop()
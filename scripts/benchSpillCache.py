@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Benchmark reloading a block group evicted from the model's SpillCache. Compares a
+cache miss, which reloads the block group .mat file with loadMatFile, against
+reloading the .npy files the cache spilled it to, for a whole brain sized mask.
+Times the reload and the reload plus reading the patterns TrainModel uses.
+Usage: python scripts/benchSpillCache.py -v 100000 -n 115
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import numpy as np  # type: ignore
+import scipy.io as sio  # type: ignore
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+from rtfMRI import utils
+from rtfMRI.StructDict import StructDict
+from rtfMRI.spillCache import SpillCache
+
+benchDir = '/tmp/benchSpillCache'
+
+
+def createBlkGrp(nTRs, nVoxels):
+    blkGrp = StructDict({'blkGrpId': 1, 'type': 1, 'firstVol': 0, 'nTRs': nTRs, 'gitCodeId': 'master:0000000'})
+    blkGrp.patterns = StructDict()
+    for field in ('raw', 'raw_sm', 'raw_sm_filt', 'raw_sm_filt_z'):
+        blkGrp.patterns[field] = np.random.standard_normal((nTRs, nVoxels))
+    for field in ('phase1Mean', 'phase1Y', 'phase1Std', 'phase1Var', 'runStd'):
+        blkGrp.patterns[field] = np.random.standard_normal((1, nVoxels))
+    for field in ('categoryseparation', 'predict', 'attCateg', 'stim', 'type'):
+        blkGrp.patterns[field] = np.full((1, nTRs), np.nan)
+    blkGrp.patterns.regressor = np.zeros((2, nTRs))
+    return blkGrp
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--numVoxels', '-v', default=100000, type=int,
+                           help='voxels in the mask')
+    argParser.add_argument('--numTRs', '-n', default=115, type=int,
+                           help='TRs in the block group')
+    argParser.add_argument('--iters', '-i', default=5, type=int,
+                           help='reloads per measurement')
+    args = argParser.parse_args()
+
+    if os.path.exists(benchDir):
+        shutil.rmtree(benchDir)
+    os.makedirs(benchDir)
+    blkGrp = createBlkGrp(args.numTRs, args.numVoxels)
+    matFilename = os.path.join(benchDir, 'blkGroup_r1_p1_py.mat')
+    sio.savemat(matFilename, blkGrp, appendmat=False)
+    entryMB = os.path.getsize(matFilename) / 2**20
+
+    # TrainModel reads the raw_sm_filt_z patterns of a cached block group
+    matTimes = [0.0, 0.0]
+    for i in range(args.iters):
+        stime = time.time()
+        entry = utils.loadMatFile(matFilename)
+        matTimes[0] += time.time() - stime
+        np.sum(entry.patterns.raw_sm_filt_z)
+        matTimes[1] += time.time() - stime
+
+    # room for one block group, each get spills the other
+    cache = SpillCache(entryMB * 1.5 * 2**20, 'benchCache')
+    cache['1.1'] = blkGrp
+    cache['2.1'] = createBlkGrp(args.numTRs, args.numVoxels)
+    spillTimes = [0.0, 0.0]
+    for i in range(args.iters):
+        key = ('1.1', '2.1')[i % 2]
+        stime = time.time()
+        entry = cache.get(key)
+        spillTimes[0] += time.time() - stime
+        np.sum(entry.patterns.raw_sm_filt_z)
+        spillTimes[1] += time.time() - stime
+    assert cache.stats.spillHits == args.iters
+    print("block group of {} TRs x {} voxels, {:.0f} MB, times in s".format(
+          args.numTRs, args.numVoxels, entryMB))
+    print("{:>32} {:>8} {:>20}".format('', 'reload', 'read raw_sm_filt_z'))
+    print("{:>32} {:>8.3f} {:>20.3f}".format('loadMatFile', matTimes[0] / args.iters, matTimes[1] / args.iters))
+    print("{:>32} {:>8.3f} {:>20.3f}".format('spill reload (spilling the other)', spillTimes[0] / args.iters,
+                                             spillTimes[1] / args.iters))
+    cache.clear()
+    shutil.rmtree(benchDir)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Benchmark the python overhead per TR of the run schedule, outside of the image
+processing. Compares the per TR StructDicts the run config used to be built from
+against the structured array schedule and its TRView records. Times building the
+block group TR configs for a run, and per TR on the client setting the data and
+deadline and serializing the TRData message. The server side is deserializing the message and
+the TR field reads done by RtAttenModel.TRData and Predict.
+Usage: python scripts/benchTRSchedule.py -v 10000 -i 20
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+import numpy as np  # type: ignore
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+from rtfMRI.utils import loadMatFile
+from rtfMRI.StructDict import StructDict
+from rtfMRI.Messaging import Message, pyarrow_context
+from rtfMRI.MsgTypes import MsgType, MsgEvent
+from rtAtten.PatternsDesign2Config import createRunConfig, createRunSchedule, createBlockGroupConfig
+
+patternsDir = os.path.join(rootPath, 'webInterface/rtAtten/patterns')
+
+
+def legacyBlockGroupConfig(tr_range, patterns):
+    '''The block group config with a StructDict per TR, as built before the run schedule'''
+    blkGrp = StructDict()
+    blkGrp.blocks = []
+    blkGrp.type = 0
+    blkGrp.firstVol = tr_range[0]
+    block = StructDict()
+    blockNum = -1
+    for iTR in tr_range:
+        if patterns.block[0, iTR] > 0 and patterns.block[0, iTR] != blockNum:
+            if blockNum >= 0:
+                blkGrp.blocks.append(block)
+            blockNum = int(patterns.block[0, iTR])
+            block = StructDict()
+            block.blockId = blockNum
+            block.TRs = []
+        tr = StructDict()
+        tr.trId = iTR - blkGrp.firstVol
+        tr.vol = iTR + 1
+        tr.attCateg = int(patterns.attCateg[0, iTR])
+        tr.stim = int(patterns.stim[0, iTR])
+        tr.type = int(patterns.type[0, iTR])
+        if tr.type != 0 and blkGrp.type == 0:
+            blkGrp.type = tr.type
+        tr.regressor = [int(patterns.regressor[0, iTR]), int(patterns.regressor[1, iTR])]
+        block.TRs.append(tr)
+    if len(block.TRs) > 0:
+        blkGrp.blocks.append(block)
+    return blkGrp
+
+
+def legacyBlockGroups(patterns, firstVolPhase2, nVols):
+    return [legacyBlockGroupConfig(range(firstVolPhase2), patterns),
+            legacyBlockGroupConfig(range(firstVolPhase2, nVols), patterns)]
+
+
+def scheduleBlockGroups(patterns, firstVolPhase2, nVols):
+    schedule = createRunSchedule(patterns, firstVolPhase2)
+    return [createBlockGroupConfig(schedule[:firstVolPhase2]), createBlockGroupConfig(schedule[firstVolPhase2:])]
+
+
+def clientTR(TR, data):
+    TR.data = data
+    TR.deadline = time.time() + 2
+    msg = Message()
+    msg.type = MsgType.Command
+    msg.event_type = MsgEvent.TRData
+    msg.fields.cfg = TR
+    return pyarrow_context.serialize(msg).to_buffer()
+
+
+def serverTR(buf):
+    TR = pyarrow_context.deserialize(buf).fields.cfg
+    # the TR field reads of RtAttenModel TRData and Predict
+    if TR.type not in (0, 1, 2) or TR.trId is None or TR.deadline is None:
+        raise ValueError("bad TR")
+    vals = (TR.data, TR.attCateg, TR.stim, TR.type, TR.regressor[:], TR.vol + 0, TR.trId, TR.trId,
+            TR.trId, TR.trId, TR.type, TR.type, np.array(TR.regressor), TR.trId, TR.trId, TR.trId,
+            TR.trId, TR.trId, TR.type, TR.attCateg, TR.stim)
+    return vals
+
+
+def timeRuns(createBlockGroups, run, patterns, iters, nVoxels):
+    buildTime, clientTime, serverTime, nTRs = 0.0, 0.0, 0.0, 0
+    data = np.random.standard_normal(nVoxels)
+    for i in range(iters):
+        stime = time.perf_counter()
+        blockGroups = createBlockGroups(patterns, run.firstVolPhase2, run.nVols)
+        buildTime += time.perf_counter() - stime
+        for blkGrp in blockGroups:
+            for block in blkGrp.blocks:
+                for TR in block.TRs:
+                    stime = time.perf_counter()
+                    buf = clientTR(TR, data)
+                    clientTime += time.perf_counter() - stime
+                    stime = time.perf_counter()
+                    serverTR(buf)
+                    serverTime += time.perf_counter() - stime
+                    nTRs += 1
+    return buildTime / iters, clientTime / nTRs, serverTime / nTRs, nTRs // iters
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--numVoxels', '-v', default=10000, type=int,
+                           help='voxels in the TR data')
+    argParser.add_argument('--iters', '-i', default=20, type=int,
+                           help='runs per measurement')
+    args = argParser.parse_args()
+
+    patterns = loadMatFile(sorted(glob.glob(os.path.join(patternsDir, 'patternsdesign_1_*.mat')))[0])
+    session = StructDict({'Runs': [1], 'ScanNums': [1]})
+    run = createRunConfig(session, patterns, 1)
+    # warm up
+    timeRuns(scheduleBlockGroups, run, patterns, 1, args.numVoxels)
+    results = [('StructDict TRs', timeRuns(legacyBlockGroups, run, patterns, args.iters, args.numVoxels)),
+               ('schedule + TRView', timeRuns(scheduleBlockGroups, run, patterns, args.iters, args.numVoxels))]
+    print("{} TRs per run, {} voxels, mean of {} runs".format(results[0][1][3], args.numVoxels, args.iters))
+    print("{:>18} {:>16} {:>16} {:>16}".format('', 'TR config ms/run', 'client us/TR', 'server us/TR'))
+    for name, (buildTime, clientTime, serverTime, _) in results:
+        print("{:>18} {:>16.2f} {:>16.1f} {:>16.1f}".format(name, buildTime * 1000, clientTime * 1e6,
+                                                           serverTime * 1e6))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Benchmark uploading a scan's dicom files from the fileWatcher to the web server, as
+RtAttenWeb.uploadImages does for registration. A local fileWatcher stands in for the
+scanner computer and delays each reply to simulate the network round trip. Compares
+requesting the files one at a time, as before, against Web.uploadFilesFromThread with
+several requests in flight, and a repeated upload that resumes with all files present.
+Run from the top level directory (needs the certs directory):
+Usage: python scripts/benchUploadImages.py -n 200 -l 0.02 -w 1,4,8,16
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import threading
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+import webInterface.WebServer as WebServer
+from webInterface.WebServer import Web
+from webInterface.webSocketFileWatcher import WebSocketFileWatcher
+from webInterface.WebClientUtils import getFileReqStruct
+from rtfMRI.Errors import RequestError
+
+benchDir = '/tmp/benchUploadImages'
+scanDir = os.path.join(benchDir, 'scan')
+outputDir = os.path.join(benchDir, 'output/')
+dicomFile = os.path.join(rootPath, 'tests/rtfMRI/test_input/001_000001_000001.dcm')
+
+
+def serialUpload(filenames):
+    '''One request at a time, as uploadImages did before'''
+    for filename in filenames:
+        response = Web.sendDataMsgFromThread(getFileReqStruct(filename, writefile=True))
+        if response['status'] != 200:
+            raise RequestError(response['error'])
+
+
+def benchUpload(name, uploadFunc, filenames, clearOutput=True):
+    if clearOutput and os.path.exists(outputDir):
+        shutil.rmtree(outputDir)
+    stime = time.time()
+    uploadFunc(filenames)
+    elapsed = time.time() - stime
+    totalBytes = sum(os.path.getsize(filename) for filename in filenames)
+    print("{:>12}: {} files in {:.2f}s, {:.1f} files/s, {:.1f}MB/s".format(
+          name, len(filenames), elapsed, len(filenames) / elapsed, totalBytes / elapsed / 2**20))
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--numFiles', '-n', default=200, type=int,
+                           help='number of dicom files in the scan')
+    argParser.add_argument('--latency', '-l', default=0.02, type=float,
+                           help='seconds the fileWatcher delays each reply')
+    argParser.add_argument('--windows', '-w', default='1,4,8,16', type=str,
+                           help='comma separated numbers of requests in flight')
+    argParser.add_argument('--port', '-p', default=8930, type=int,
+                           help='web server port')
+    args = argParser.parse_args()
+    windows = [int(x) for x in args.windows.split(',')]
+
+    if os.path.exists(benchDir):
+        shutil.rmtree(benchDir)
+    os.makedirs(scanDir)
+    with open(dicomFile, 'rb') as fp:
+        data = fp.read()
+    filenames = [os.path.join(scanDir, '001_000001_{:06d}.dcm'.format(i)) for i in range(1, args.numFiles+1)]
+    for i, filename in enumerate(filenames):
+        with open(filename, 'wb') as fp:
+            fp.write(data + i.to_bytes(4, 'big'))
+    WebServer.CommonOutputDir = outputDir
+
+    # the stand-in fileWatcher replies after the simulated round trip time
+    handleRequest = WebSocketFileWatcher.handleRequest
+
+    def delayedHandleRequest(client, request):
+        time.sleep(args.latency)
+        handleRequest(client, request)
+    WebSocketFileWatcher.handleRequest = staticmethod(delayedHandleRequest)
+    WebSocketFileWatcher.numWorkers = max(windows)
+
+    webThread = threading.Thread(name='webThread', target=Web.start,
+                                 kwargs={'htmlDir': 'rtAtten/web/html',
+                                         'port': args.port, 'test': True})
+    webThread.setDaemon(True)
+    webThread.start()
+    time.sleep(1)
+    fileThread = threading.Thread(name='fileThread', target=WebSocketFileWatcher.runFileWatcher,
+                                  args=('localhost:{}'.format(args.port),),
+                                  kwargs={'retryInterval': 0.5, 'allowedDirs': [benchDir],
+                                          'allowedTypes': ['.dcm'], 'username': 'test', 'password': 'test'})
+    fileThread.setDaemon(True)
+    fileThread.start()
+    while Web.wsDataConn is None:
+        time.sleep(0.1)
+
+    print("{} files of {:.0f}KB, {:.0f}ms simulated round trip".format(
+          args.numFiles, len(data) / 1000, args.latency * 1000))
+    benchUpload('serial', serialUpload, filenames)
+    for window in windows:
+        Web.uploadWindow = window
+        benchUpload('window {}'.format(window), Web.uploadFilesFromThread, filenames)
+    benchUpload('resume', Web.uploadFilesFromThread, filenames, clearOutput=False)
+    Web.stop()
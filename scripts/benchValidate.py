@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Benchmark validate.validateSession on synthetic matlab and python outputs of a
+session. Compares the serial validation as it was, loading the models again for
+the cross-validation and fitting the folds one after another, with the cached
+loads and the fold fits run in worker processes.
+Usage: python scripts/benchValidate.py -r 3 -v 5000 -j 4
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import numpy as np  # type: ignore
+import scipy.io as sio  # type: ignore
+from sklearn.model_selection import KFold  # type: ignore
+from sklearn.linear_model import LogisticRegression  # type: ignore
+from sklearn.metrics import roc_auc_score  # type: ignore
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+import rtfMRI.utils as utils
+import rtAtten.validate as validate
+from rtfMRI.StructDict import StructDict
+from rtAtten.RtAttenModel import getSubjectDataDir
+
+benchDir = '/tmp/benchValidate'
+
+
+def createRunOutputs(matDataDir, pyDataDir, runId, nVoxels, rng):
+    nTRs = 200
+    runDir = os.path.join(matDataDir, 'run{}'.format(runId))
+    os.makedirs(runDir)
+    os.makedirs(os.path.join(pyDataDir, 'run{}'.format(runId)), exist_ok=True)
+    raw = rng.standard_normal((nTRs, nVoxels))
+    raw_sm_filt_z = rng.standard_normal((nTRs, nVoxels))
+    sio.savemat(os.path.join(runDir, 'patternsdata_{}_20180101T_1000.mat'.format(runId)),
+                {'patterns': {'raw': raw, 'raw_sm_filt_z': raw_sm_filt_z}})
+    for phase, rows in ((1, slice(0, 100)), (2, slice(100, 200))):
+        sio.savemat(os.path.join(pyDataDir, 'blkGroup_r{}_p{}_20180101T000000_py.mat'.format(runId, phase)),
+                    {'patterns': {'raw': raw[rows], 'raw_sm_filt_z': raw_sm_filt_z[rows]}})
+    labels = rng.integers(0, 2, nTRs)
+    trainLabels = np.eye(2)[labels]
+    trainPats = rng.standard_normal((nTRs, nVoxels)) + 0.1 * labels[:, np.newaxis]
+    weights = rng.standard_normal((nVoxels, 2))
+    for filename in (os.path.join(runDir, 'trainedModel_{}_20180101T_1000.mat'.format(runId)),
+                     os.path.join(pyDataDir, 'trainedModel_r{}_20180101T000000_py.mat'.format(runId))):
+        sio.savemat(filename, {'trainedModel': {'weights': weights, 'trainLabels': trainLabels,
+                                                'trainPats': trainPats}})
+    lines = ['{}\t1\t{}\t1\t1\t1\t{}\t1\t{:.3f}\tnan\n'.format(runId, i, i + 1, rng.standard_normal())
+             for i in range(100)]
+    for filename in (os.path.join(runDir, 'fileprocessing.txt'),
+                     os.path.join(pyDataDir, 'run{}'.format(runId), 'fileprocessing_py.txt')):
+        with open(filename, 'w') as fp:
+            fp.writelines(lines)
+
+
+def legacyCrossvalidateModels(matDataDir, pyDataDir, runId):
+    '''The cross-validation as it was, the models loaded again and the folds fit serially'''
+    matModelFn, pyModelFn = validate.findModelFiles(matDataDir, pyDataDir, runId)
+    rocs = []
+    for modelFn in (matModelFn, pyModelFn):
+        model = utils.loadMatFile(modelFn)
+        selector = np.concatenate((0*np.ones((50)), 1*np.ones((50)), 2*np.ones((50)), 3*np.ones((50))), axis=0)
+        roc = np.zeros(4)
+        for i, (train_index, test_index) in enumerate(KFold(4).split(np.array([1, 2, 3, 4]))):
+            trTrain = np.in1d(selector, train_index)
+            trTest = np.in1d(selector, test_index)
+            lrc = LogisticRegression(solver='sag', penalty='l2', max_iter=300)
+            lrc.fit(model.trainPats[trTrain, :], np.argmax(model.trainLabels[trTrain, :], axis=1))
+            categ_sep = -1*np.diff(lrc.predict_proba(model.trainPats[trTest, :]), axis=1)
+            correctLabels = np.ones((len(categ_sep)))
+            correctLabels[np.argwhere(np.argmax(model.trainLabels[trTest, :], axis=1) == 1)] = -1
+            roc[i] = roc_auc_score(correctLabels, categ_sep)
+        rocs.append(roc)
+    return rocs
+
+
+def legacyValidateSession(cfg, pyDataDir):
+    matDataDir = getSubjectDataDir(cfg.session.dataDir, cfg.session.subjectNum, cfg.session.subjectDay)
+    all_ROC = np.zeros((4, 2, len(cfg.session.Runs)))
+    for runIdx, runId in enumerate(cfg.session.Runs):
+        validate.validatePatternsData(matDataDir, pyDataDir, runId)
+        # each file was loaded by each comparison
+        validate.matFileCache.clear()
+        validate.validateFileprocessingTxt(matDataDir, pyDataDir, runId)
+        all_ROC[:, 0, runIdx], all_ROC[:, 1, runIdx] = legacyCrossvalidateModels(matDataDir, pyDataDir, runId)
+        np.save(os.path.join(pyDataDir, 'xvalresults.npy'), all_ROC)
+    return all_ROC
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--numRuns', '-r', default=3, type=int, help='runs in the session')
+    argParser.add_argument('--numVoxels', '-v', default=5000, type=int, help='voxels in the roi')
+    argParser.add_argument('--jobs', '-j', default=4, type=int, help='fold fit worker processes')
+    args = argParser.parse_args()
+
+    if os.path.exists(benchDir):
+        shutil.rmtree(benchDir)
+    rng = np.random.default_rng(0)
+    dataDir = os.path.join(benchDir, 'data')
+    matDataDir = getSubjectDataDir(dataDir, 1, 1)
+    pyDataDir = getSubjectDataDir(os.path.join(benchDir, 'py'), 1, 1)
+    runIds = list(range(1, args.numRuns + 1))
+    for runId in runIds:
+        createRunOutputs(matDataDir, pyDataDir, runId, args.numVoxels, rng)
+    cfg = StructDict({'session': StructDict({'dataDir': dataDir, 'subjectNum': 1, 'subjectDay': 1,
+                                             'Runs': runIds})})
+
+    results = []
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            np.random.seed(0)
+            stime = time.time()
+            legacy_ROC = legacyValidateSession(cfg, pyDataDir)
+            results.append(('serial, as it was', time.time() - stime))
+            for jobs in sorted({1, args.jobs}):
+                np.random.seed(0)
+                stime = time.time()
+                all_ROC = validate.validateSession(cfg, pyDataDir, jobs)
+                results.append(('validateSession -j {}'.format(jobs), time.time() - stime))
+        finally:
+            sys.stdout = stdout
+    print("{} runs, {} voxels, {} cpus".format(args.numRuns, args.numVoxels, os.cpu_count()))
+    print("{:>24} {:>10}".format('', 'total s'))
+    for name, elapsed in results:
+        print("{:>24} {:>10.2f}".format(name, elapsed))
+    print("max ROC difference from serial {:.3f}".format(np.max(np.abs(all_ROC - legacy_ROC))))
+    shutil.rmtree(benchDir)
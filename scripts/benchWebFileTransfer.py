@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Benchmark per-file latency of remote file requests from the client process,
+through the webpipe fifos, web server and data websocket to the fileWatcher.
+Compares binary frames against base64 encoded JSON text frames.
+Run from the top level directory (needs the certs directory):
+Usage: python scripts/benchWebFileTransfer.py -f <dicomFile> -n 100
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import threading
+import numpy as np  # type: ignore
+from base64 import b64decode
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+from rtfMRI.StructDict import StructDict
+from webInterface.WebServer import Web, makeFifo, handleFifoRequests
+from webInterface.webSocketFileWatcher import WebSocketFileWatcher
+import webInterface.WebClientUtils as wcutils
+
+defaultDicomFile = os.path.join(rootPath, 'tests/rtfMRI/test_input/001_000001_000001.dcm')
+
+
+def webPipeCallback(request):
+    return Web.sendDataMsgFromThread(request, timeout=10)
+
+
+def requestFile(webpipes, filename, binaryData):
+    cmd = wcutils.getFileReqStruct(filename)
+    if binaryData:
+        retVals = wcutils.clientWebpipeCmd(webpipes, cmd)
+        assert retVals.statusCode == 200
+        return retVals.data
+    # base64 in JSON end to end, as before binary frames
+    cmd['binaryData'] = False
+    webpipes.fd_out.write(json.dumps(cmd) + os.linesep)
+    response = wcutils.readPipeResponse(webpipes.fd_in)
+    assert response['status'] == 200
+    return wcutils.formatFileData(response['filename'], b64decode(response['data']))
+
+
+def benchTransfer(webpipes, filename, numFiles, binaryData):
+    latencies = []
+    for i in range(numFiles):
+        stime = time.time()
+        requestFile(webpipes, filename, binaryData)
+        latencies.append(time.time() - stime)
+    latencies = np.array(latencies) * 1000
+    print("{:>7}: files {}, latency mean {:.2f}ms, median {:.2f}ms, p95 {:.2f}ms"
+          .format('binary' if binaryData else 'base64', numFiles, np.mean(latencies),
+                  np.median(latencies), np.percentile(latencies, 95)))
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--file', '-f', default=defaultDicomFile, type=str,
+                           help='dicom file to transfer')
+    argParser.add_argument('--numFiles', '-n', default=100, type=int,
+                           help='number of file requests per protocol')
+    argParser.add_argument('--port', '-p', default=8925, type=int,
+                           help='web server port')
+    args = argParser.parse_args()
+    filename = os.path.abspath(args.file)
+
+    webThread = threading.Thread(name='webThread', target=Web.start,
+                                 kwargs={'htmlDir': 'rtAtten/web/html', 'port': args.port, 'test': True})
+    webThread.setDaemon(True)
+    webThread.start()
+    time.sleep(1)
+    watchThread = threading.Thread(name='fileThread', target=WebSocketFileWatcher.runFileWatcher,
+                                   args=('localhost:{}'.format(args.port),),
+                                   kwargs={'retryInterval': 0.5,
+                                           'allowedDirs': [os.path.dirname(filename)],
+                                           'allowedTypes': ['.dcm', '.mat'],
+                                           'username': 'test', 'password': 'test'})
+    watchThread.setDaemon(True)
+    watchThread.start()
+    while Web.wsDataConn is None:
+        time.sleep(0.1)
+
+    # client side of the webpipes, opened in the same order as ClientMain
+    webpipes = makeFifo()
+    fifoThread = threading.Thread(name='fifoThread', target=handleFifoRequests,
+                                  args=(webpipes, webPipeCallback))
+    fifoThread.setDaemon(True)
+    fifoThread.start()
+    clientPipes = StructDict()
+    clientPipes.fd_in = open(webpipes.name_out, mode='rb')
+    clientPipes.fd_out = open(webpipes.name_in, mode='w', buffering=1)
+
+    print("File {}, size {}".format(filename, os.path.getsize(filename)))
+    # warm up
+    benchTransfer(clientPipes, filename, 5, True)
+    benchTransfer(clientPipes, filename, args.numFiles, False)
+    benchTransfer(clientPipes, filename, args.numFiles, True)
+    clientPipes.fd_out.close()
+    clientPipes.fd_in.close()
+    Web.stop()
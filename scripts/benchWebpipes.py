@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Benchmark the client process to web server webpipe channels, the JSON line
+named pipes against the binary framed unix domain socket. Measures small
+request latency, file transfer time, how long the client is blocked sending
+feedback commands, and request throughput with several threads making requests
+that each wait on a simulated fileWatcher round trip.
+Usage: python scripts/benchWebpipes.py -n 500 -r 20 -w 10
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+import numpy as np  # type: ignore
+# fix up search path
+currPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(currPath, "../")
+sys.path.append(rootPath)
+from rtfMRI.StructDict import StructDict
+from webInterface.WebServer import makeFifo, handleFifoRequests, resignalFifoThreadExit
+from webInterface.WebServer import makeSocketPipe, handleSocketRequests, resignalSocketThreadExit
+import webInterface.WebClientUtils as wcutils
+
+fileData = os.urandom(200000)
+renderTime = 0.02
+watchTime = 0.01
+
+
+def benchCallback(request):
+    cmd = request['cmd']
+    if cmd == 'getFile':
+        return {'status': 200, 'filename': request['filename'], 'data': fileData}
+    elif cmd == 'classificationResult':
+        # model rendering the subject feedback image
+        time.sleep(renderTime)
+    elif cmd == 'watchFile':
+        # model the round trip to the fileWatcher
+        time.sleep(watchTime)
+    return {'status': 200}
+
+
+def openFifoPipes():
+    webpipes = makeFifo()
+    fifoThread = threading.Thread(name='fifoThread', target=handleFifoRequests,
+                                  args=(webpipes, benchCallback))
+    fifoThread.setDaemon(True)
+    fifoThread.start()
+    clientPipes = StructDict()
+    clientPipes.fd_in = open(webpipes.name_out, mode='rb')
+    clientPipes.fd_out = open(webpipes.name_in, mode='w', buffering=1)
+    # the named pipes carry one request at a time
+    clientPipes.lock = threading.Lock()
+    return webpipes, fifoThread, clientPipes
+
+
+def openSocketPipes():
+    webpipes = makeSocketPipe()
+    socketThread = threading.Thread(name='socketThread', target=handleSocketRequests,
+                                    args=(webpipes, benchCallback))
+    socketThread.setDaemon(True)
+    socketThread.start()
+    clientPipes = wcutils.connectSocketPipe(webpipes.sockname)
+    return webpipes, socketThread, clientPipes
+
+
+def webpipeCmd(clientPipes, cmd):
+    if clientPipes.lock is not None:
+        with clientPipes.lock:
+            return wcutils.clientWebpipeCmd(clientPipes, cmd)
+    return wcutils.clientWebpipeCmd(clientPipes, cmd)
+
+
+def timeCmds(clientPipes, cmd, count):
+    times = []
+    for i in range(count):
+        stime = time.time()
+        webpipeCmd(clientPipes, dict(cmd))
+        times.append(time.time() - stime)
+    return np.array(times) * 1000
+
+
+def benchThroughput(clientPipes, numThreads, count):
+    def requester():
+        for i in range(count):
+            webpipeCmd(clientPipes, {'cmd': 'watchFile', 'filename': 'bench.dcm'})
+    threads = [threading.Thread(name='requester', target=requester) for i in range(numThreads)]
+    stime = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return numThreads * count / (time.time() - stime)
+
+
+def benchChannel(name, clientPipes, args):
+    pingTimes = timeCmds(clientPipes, {'cmd': 'ping'}, args.numRequests)
+    fileTimes = timeCmds(clientPipes, {'cmd': 'getFile', 'filename': 'bench.bin'}, args.numRequests // 5)
+    feedbackCmd = {'cmd': 'classificationResult', 'value': {'catsep': 0.5, 'vol': 1}, 'runId': 1}
+    feedbackTimes = timeCmds(clientPipes, feedbackCmd, 20)
+    reqRate = benchThroughput(clientPipes, args.threads, 20)
+    print("{:>6}: ping mean {:.3f}ms p95 {:.3f}ms, {}KB file mean {:.2f}ms, "
+          "feedback send blocks {:.2f}ms, {} threads {:.0f} req/s"
+          .format(name, np.mean(pingTimes), np.percentile(pingTimes, 95), len(fileData) // 1000,
+                  np.mean(fileTimes), np.mean(feedbackTimes), args.threads, reqRate))
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--numRequests', '-n', default=500, type=int,
+                           help='number of small requests to time per channel')
+    argParser.add_argument('--renderTime', '-r', default=20, type=float,
+                           help='ms the web server takes to handle a feedback command')
+    argParser.add_argument('--watchTime', '-w', default=10, type=float,
+                           help='ms round trip to the fileWatcher for throughput requests')
+    argParser.add_argument('--threads', '-t', default=4, type=int,
+                           help='number of client threads making requests at once')
+    args = argParser.parse_args()
+    renderTime = args.renderTime / 1000
+    watchTime = args.watchTime / 1000
+
+    webpipes, fifoThread, clientPipes = openFifoPipes()
+    benchChannel('fifo', clientPipes, args)
+    clientPipes.fd_out.close()
+    clientPipes.fd_in.close()
+    resignalFifoThreadExit(fifoThread, webpipes)
+
+    webpipes, socketThread, clientPipes = openSocketPipes()
+    benchChannel('socket', clientPipes, args)
+    # let queued feedback commands finish before closing
+    time.sleep(20 * renderTime)
+    clientPipes.sockClient.close()
+    resignalSocketThreadExit(socketThread, webpipes)
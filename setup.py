@@ -1,3 +1,4 @@
+import subprocess
 from setuptools import setup, find_packages, Extension
 from setuptools.command.build_ext import build_ext as _build_ext
 
@@ -10,6 +11,21 @@ class build_ext(_build_ext):
         import numpy
         self.include_dirs.append(numpy.get_include())
 
+    def run(self):
+        writeGitCodeId()
+        super().run()
+
+
+def writeGitCodeId():
+    # cache the code id read by rtfMRI.utils.getGitCodeId so it doesn't run git at startup
+    try:
+        branchName = subprocess.check_output(['git', 'symbolic-ref', '--short', '-q', 'HEAD'])
+        commitId = subprocess.check_output(['git', 'rev-parse', '--short=7', 'HEAD'])
+    except (OSError, subprocess.CalledProcessError):
+        return
+    with open('rtfMRI/gitCodeId', 'w') as fp:
+        fp.write(branchName.decode('utf-8').strip() + ':' + commitId.decode('utf-8').strip())
+
 
 setup(
     name='rtfMRI',
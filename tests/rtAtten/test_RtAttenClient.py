@@ -1,11 +1,26 @@
 import pytest
 import os
+import re
 import sys
+import glob
 scriptPath = os.path.dirname(os.path.realpath(__file__))
 rootPath = os.path.join(scriptPath, "../..")
 sys.path.append(rootPath)
+import time
+import shutil
+import socket
+import threading
+import numpy as np  # type: ignore
+import scipy.io as sio  # type: ignore
+import ServerMain
+import rtAtten.RtAttenClient as rtAttenClientModule
 from rtfMRI.StructDict import StructDict
+from rtfMRI.utils import fileMd5, loadMatFile
+from rtfMRI.RtfMRIClient import RtfMRIClient
+from rtfMRI.Errors import RTError, RequestError
 from rtAtten.RtAttenClient import RtAttenClient
+from rtAtten.RtAttenModel import getSubjectDataDir, getBlkGrpFilename, getModelFilename
+from rtAtten.PatternsDesign2Config import RunScheduleCache, createRunConfig, createRunConfigFromSchedule
 
 
 def test_createRegConfig():
@@ -55,6 +70,52 @@ def test_createRegConfig():
     assert checkCfg(client, cfg) is False
 
 
+def test_runScheduleCache(tmpdir):
+    patternsFilename = os.path.join(str(tmpdir), 'patternsdesign_1_20180301T000000.mat')
+    shutil.copy(os.path.join(rootPath, 'webInterface/rtAtten/patterns/patternsdesign_1_20180301T000000.mat'),
+                patternsFilename)
+    cacheDir = os.path.join(str(tmpdir), 'schedules')
+    session = StructDict({'Runs': [1], 'ScanNums': [3]})
+    cache = RunScheduleCache(cacheDir)
+    runSchedule = cache.get(patternsFilename)
+    assert cache.get(patternsFilename) is runSchedule
+    assert (cache.stats.misses, cache.stats.hits) == (1, 1)
+    assert len(os.listdir(cacheDir)) == 1
+
+    # a new cache, e.g. of a reprocessing session, loads the saved schedule
+    cache = RunScheduleCache(cacheDir)
+    run = createRunConfigFromSchedule(session, cache.get(patternsFilename), 1)
+    assert cache.stats.diskHits == 1
+    expected = createRunConfig(session, loadMatFile(patternsFilename), 1)
+    assert {k: v for k, v in run.items() if k not in ('schedule', 'blockGroups')} == \
+        {k: v for k, v in expected.items() if k not in ('schedule', 'blockGroups')}
+    assert run.scanNum == 3
+    assert (run.schedule == expected.schedule).all()
+    runTRs = [TR.values() for blkGrp in run.blockGroups for block in blkGrp.blocks for TR in block.TRs]
+    expectedTRs = [TR.values() for blkGrp in expected.blockGroups for block in blkGrp.blocks for TR in block.TRs]
+    assert runTRs == expectedTRs
+    # TRs of each run config are separate
+    run.blockGroups[0].blocks[0].TRs[0].data = 1
+    run = createRunConfigFromSchedule(session, cache.get(patternsFilename), 1)
+    assert run.blockGroups[0].blocks[0].TRs[0].data is None
+
+    # a changed patterns file is parsed again
+    stat = os.stat(patternsFilename)
+    os.utime(patternsFilename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    cache.get(patternsFilename)
+    assert cache.stats.misses == 1
+    cache = RunScheduleCache(cacheDir)
+    cache.get(patternsFilename)
+    assert cache.stats.diskHits == 1
+
+    # the cache dir is private to the user, saved schedules in a dir others can write to aren't used
+    assert os.stat(cacheDir).st_mode & 0o077 == 0
+    os.chmod(cacheDir, 0o777)
+    cache = RunScheduleCache(cacheDir)
+    cache.get(patternsFilename)
+    assert (cache.stats.diskHits, cache.stats.misses) == (0, 1)
+
+
 def checkCfg(client, cfg):
     try:
         ret = client.cfgValidation(cfg)
@@ -62,3 +123,245 @@ def checkCfg(client, cfg):
     except Exception as err:
         # print('Exception: {}'.format(err))
         return False
+
+
+def startServer(port):
+    serverThread = threading.Thread(name='server', target=ServerMain.ServerMain, args=(port, 30))
+    serverThread.setDaemon(True)
+    serverThread.start()
+    for i in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return serverThread
+
+
+def startClientSession(port, sessionId, serverDataDir, clientDataDir):
+    cfg = StructDict({'experiment': StructDict({'model': 'rtAtten', 'experimentId': 1}),
+                      'session': StructDict({'sessionId': sessionId, 'subjectNum': 2, 'subjectDay': 3,
+                                             'serverDataDir': serverDataDir, 'rtData': True,
+                                             'calcClockSkewIters': 1, 'useSessionTimestamp': False})})
+    client = RtAttenClient()
+    # retrieval is skipped for a server on 'localhost'
+    client.connect('127.0.0.1', port)
+    RtfMRIClient.initSession(client, cfg)
+    client.dirs.dataDir = getSubjectDataDir(clientDataDir, 2, 3)
+    client.dirs.serverDataDir = client.dirs.dataDir
+    os.makedirs(client.dirs.dataDir)
+    return client
+
+
+def stopClientSession(client, serverThread):
+    client.endSession()
+    client.sendShutdownServer()
+    client.close()
+    client.ttlPulseClient.close()
+    serverThread.join(timeout=5)
+
+
+def test_retrieveSessionFiles(tmpdir, monkeypatch):
+    port = 5220
+    serverThread = startServer(port)
+    monkeypatch.setattr(rtAttenClientModule, 'retrieveChunkSize', 64 * 1024)
+
+    sessionId = '20180101T000000'
+    serverDir = getSubjectDataDir(str(tmpdir.join('server')), 2, 3)
+    os.makedirs(serverDir)
+    serverFiles = [getBlkGrpFilename(sessionId, runId, blkGrpId) for runId in (1, 2) for blkGrpId in (1, 2)]
+    serverFiles += [getModelFilename(sessionId, runId) for runId in (1, 2)]
+    for i, filename in enumerate(serverFiles):
+        with open(os.path.join(serverDir, filename), 'wb') as fp:
+            fp.write(os.urandom(100000 * i))
+    client = startClientSession(port, sessionId, str(tmpdir.join('server')), str(tmpdir.join('client')))
+    chunkRequests = []
+    sendCmdsPipelined = client.sendCmdsPipelined
+
+    def countingSendCmdsPipelined(msg_event, msgFieldsList, maxInFlight):
+        chunkRequests.extend(msgFieldsList)
+        return sendCmdsPipelined(msg_event, msgFieldsList, maxInFlight)
+    client.sendCmdsPipelined = countingSendCmdsPipelined
+
+    def checkFiles():
+        for filename in serverFiles:
+            with open(os.path.join(serverDir, filename), 'rb') as fp1:
+                with open(os.path.join(client.dirs.dataDir, filename), 'rb') as fp2:
+                    assert fp1.read() == fp2.read()
+
+    client.retrieveSessionFiles([1, 2])
+    checkFiles()
+    assert len(chunkRequests) == 26
+    # nothing is transferred again
+    chunkRequests.clear()
+    client.retrieveSessionFiles([1, 2])
+    assert len(chunkRequests) == 0
+
+    # an interrupted transfer resumes from the partial file, a changed file is transferred again
+    with open(os.path.join(client.dirs.dataDir, serverFiles[5]), 'rb') as fp:
+        data = fp.read()
+    os.remove(os.path.join(client.dirs.dataDir, serverFiles[5]))
+    entry = {'filename': serverFiles[5], 'md5': fileMd5(os.path.join(serverDir, serverFiles[5]))}
+    with open(client.partFilename(entry), 'wb') as fp:
+        fp.write(data[:3 * 64 * 1024])
+    with open(os.path.join(serverDir, serverFiles[1]), 'wb') as fp:
+        fp.write(os.urandom(1000))
+    chunkRequests.clear()
+    client.retrieveSessionFiles([1, 2])
+    checkFiles()
+    assert [(chunk.filename, chunk.offset) for chunk in chunkRequests] == \
+        [(serverFiles[1], 0)] + [(serverFiles[5], 64 * 1024 * i) for i in range(3, 8)]
+    assert not os.path.exists(client.partFilename(entry))
+
+    stopClientSession(client, serverThread)
+
+
+def peakMemory():
+    with open('/proc/self/status') as fp:
+        return int(re.search(r'VmHWM:\s+(\d+) kB', fp.read()).group(1)) * 1024
+
+
+def test_retrieveDataMemory(tmpdir):
+    # both ends run in this process, the peak memory while retrieving a
+    #   500 MB file should stay far below the file size
+    if not os.path.exists('/proc/self/clear_refs'):
+        pytest.skip('peak memory reset not supported')
+    port = 5221
+    fileSize = 500 * 1024**2
+    serverThread = startServer(port)
+    sessionId = '20180101T000000'
+    serverDir = getSubjectDataDir(str(tmpdir.join('server')), 2, 3)
+    os.makedirs(serverDir)
+    filename = getModelFilename(sessionId, 1)
+    with open(os.path.join(serverDir, filename), 'wb') as fp:
+        fp.write(os.urandom(1024))
+        fp.seek(fileSize - 1024)
+        fp.write(os.urandom(1024))
+    client = startClientSession(port, sessionId, str(tmpdir.join('server')), str(tmpdir.join('client')))
+
+    with open('/proc/self/clear_refs', 'w') as fp:
+        fp.write('5')
+    startMemory = peakMemory()
+    client.retrieveFile(filename)
+    memoryUsed = peakMemory() - startMemory
+    print("peak memory used retrieving {:.0f} MB file: {:.0f} MB".format(fileSize / 2**20, memoryUsed / 2**20))
+    assert memoryUsed < 100 * 1024**2
+    clientFile = os.path.join(client.dirs.dataDir, filename)
+    assert os.path.getsize(clientFile) == fileSize
+    assert fileMd5(clientFile) == fileMd5(os.path.join(serverDir, filename))
+    assert not os.path.exists(clientFile + '.part')
+    stopClientSession(client, serverThread)
+
+
+def test_batchReplay(tmpdir):
+    # replayMatFileMode runs sent a block at a time give the same patterns and predictions
+    port = 5222
+    serverThread = startServer(port)
+    dataDir = getSubjectDataDir(str(tmpdir), 1, 1)
+    os.makedirs(dataDir)
+    rng = np.random.RandomState(0)
+    mask = np.zeros((64, 64, 36), dtype=np.uint8)
+    mask.flat[rng.choice(mask.size, 200, replace=False)] = 1
+    sio.savemat(os.path.join(dataDir, 'mask_1_1.mat'), {'mask': mask})
+    patternsFiles = []
+    for runId in (1, 2):
+        patternsFile = glob.glob(os.path.join(rootPath, 'webInterface/rtAtten/patterns',
+                                              'patternsdesign_{}_*.mat'.format(runId)))[0]
+        shutil.copy(patternsFile, dataDir)
+        patternsFiles.append(os.path.basename(patternsFile))
+        nVols = loadMatFile(patternsFile).block.shape[1]
+        sio.savemat(os.path.join(dataDir, 'patternsdata_{}.mat'.format(runId)),
+                    {'patterns': {'raw': rng.randn(nVols, 200) + 100}})
+
+    sessionIds = ('20180101T000001', '20180101T000002')
+    outputs = []
+    for sessionId, batchReplay in zip(sessionIds, (False, True)):
+        cfg = StructDict({'experiment': StructDict({'model': 'rtAtten', 'experimentId': 1}),
+                          'session': StructDict({'sessionId': sessionId, 'subjectNum': 1, 'subjectDay': 1,
+                                                 'subjectName': 'test', 'date': '01/01/2018',
+                                                 'dataDir': str(tmpdir),
+                                                 'serverDataDir': str(tmpdir.join('server', sessionId)),
+                                                 'imgDir': str(tmpdir.join('img')), 'useSessionTimestamp': False,
+                                                 'rtData': False, 'replayMatFileMode': True,
+                                                 'batchReplay': batchReplay, 'findNewestPatterns': False,
+                                                 'patternsDesignFiles': patternsFiles,
+                                                 'validationData': ['patternsdata_1.mat', 'patternsdata_2.mat'],
+                                                 'validationModels': ['model_1.mat', 'model_2.mat'],
+                                                 'Runs': [1, 2], 'ScanNums': [1, 2],
+                                                 'watchFilePattern': '*.dcm', 'minExpectedDicomSize': 0,
+                                                 'legacyRun1Phase2Mode': True, 'validate': False,
+                                                 'calcClockSkewIters': 1, 'FWHM': 5, 'cutoff': 112})})
+        # the model training solver draws from the global random state
+        np.random.seed(0)
+        client = RtAttenClient()
+        client.runSession('127.0.0.1', port, cfg)
+        client.ttlPulseClient.close()
+        output = StructDict()
+        classFiles = sorted(glob.glob(os.path.join(dataDir, 'run2', 'classoutput', '*.txt')))
+        output.predictions = [open(filename).read() for filename in classFiles]
+        for filename in classFiles:
+            os.remove(filename)
+        output.lines = []
+        for runId in (1, 2):
+            with open(os.path.join(dataDir, 'run{}'.format(runId), 'fileprocessing_py.txt')) as fp:
+                output.lines += [line for line in fp if 'time' not in line.lower()]
+        outputs.append(output)
+    assert len(outputs[0].predictions) > 0
+    assert outputs[0].predictions == outputs[1].predictions
+    assert outputs[0].lines == outputs[1].lines
+    for runId in (1, 2):
+        for blkGrpId in (1, 2):
+            blkGrps = [loadMatFile(os.path.join(getSubjectDataDir(str(tmpdir.join('server', sessionId)), 1, 1),
+                                                getBlkGrpFilename(sessionId, runId, blkGrpId)))
+                       for sessionId in sessionIds]
+            for field in ('raw_sm', 'raw_sm_filt_z', 'categoryseparation', 'predict'):
+                assert np.array_equal(blkGrps[0].patterns[field], blkGrps[1].patterns[field], equal_nan=True)
+
+    client = RtAttenClient()
+    client.connect('127.0.0.1', port)
+    client.sendShutdownServer()
+    client.close()
+    client.ttlPulseClient.close()
+    serverThread.join(timeout=5)
+
+
+def test_pushStreamSubscribe(tmpdir, monkeypatch):
+    # a fileWatcher without subscribe falls back to watchFile, and a pushing
+    #   fileWatcher is unsubscribed also when the run is aborted
+    dataDir = str(tmpdir.join('data'))
+    os.makedirs(dataDir)
+    patternsFile = glob.glob(os.path.join(rootPath, 'webInterface/rtAtten/patterns', 'patternsdesign_1_*.mat'))[0]
+    shutil.copy(patternsFile, dataDir)
+    client = RtAttenClient()
+    client.cfg = StructDict({'session': StructDict({'rtData': True, 'pushVolumes': True, 'findNewestPatterns': False,
+                                                    'patternsDesignFiles': [os.path.basename(patternsFile)],
+                                                    'Runs': [1], 'ScanNums': [1],
+                                                    'dicomNamePattern': '001_0000{}_000{}.dcm'})})
+    client.dirs = StructDict({'outputDataDir': str(tmpdir.join('output')), 'dataDir': dataDir,
+                              'remoteDataDir': dataDir, 'imgDir': str(tmpdir.join('img'))})
+    client.setWeb(StructDict(), True)
+    client.sendCmdExpectSuccess = lambda event, cfg: StructDict({'fields': StructDict({'outputlns': []})})
+    webpipeCmds = []
+
+    def clientWebpipeCmd(webpipes, cmd):
+        webpipeCmds.append(cmd['cmd'])
+        if cmd['cmd'] == 'subscribe' and subscribeStatus != 200:
+            raise RequestError('clientWebpipeCmd: status {}'.format(subscribeStatus))
+        return StructDict({'statusCode': 200})
+    monkeypatch.setattr(rtAttenClientModule.wcutils, 'clientWebpipeCmd', clientWebpipeCmd)
+    pushStreams = []
+
+    def runBlockGroups(run, outputInfo, batchReplay):
+        pushStreams.append(client.webPushStream)
+        raise RTError('run aborted')
+    client.runBlockGroups = runBlockGroups
+
+    for subscribeStatus, pushStream in ((400, False), (200, True)):
+        webpipeCmds.clear()
+        with pytest.raises(RTError):
+            client.runRun(1)
+        assert pushStreams[-1] is pushStream
+        assert client.webPushStream is False
+        expectedCmds = ['subscribe', 'unsubscribe'] if pushStream else ['subscribe']
+        assert webpipeCmds == expectedCmds
+    client.ttlPulseClient.close()
@@ -0,0 +1,182 @@
+import os
+import sys
+import functools
+scriptPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(scriptPath, "../..")
+sys.path.append(rootPath)
+import numpy as np  # type: ignore
+from rtfMRI.StructDict import StructDict
+from rtfMRI.ModelState import ModelState
+from rtfMRI.utils import loadMatFile
+from rtfMRI.spillCache import SpillCache
+from rtAtten.RtAttenEngine import RtAttenEngine, LocalExecutor, pipelineStages
+from rtAtten.RtAttenEngine import getSubjectDataDir, getBlkGrpFilename, getModelFilename
+
+sessionId = '20180101T000000'
+nVoxels = 100
+nVols = 60
+
+
+class DeferredExecutor(LocalExecutor):
+    '''Defers the smoothing and training until their results are collected,
+    as the tasks of the Ray executor are.
+    '''
+    asyncTasks = True
+
+    def __init__(self):
+        self.numDeferred = 0
+
+    def get(self, handle):
+        if isinstance(handle, list):
+            return [h() for h in handle]
+        return handle()
+
+    def smooth(self, data, roiDims, roiIndsRef, FWHM):
+        return self.deferred(super().smooth, data.copy(), roiDims, roiIndsRef, FWHM)
+
+    def smoothVolumes(self, data, roiDims, roiIndsRef, FWHM):
+        return self.deferred(super().smoothVolumes, data.copy(), roiDims, roiIndsRef, FWHM)
+
+    def trainModel(self, trainPats, trainLabels):
+        return self.deferred(super().trainModel, trainPats, trainLabels)
+
+    def deferred(self, func, *args):
+        self.numDeferred += 1
+        return functools.partial(func, *args)
+
+
+def createRunCfg(runId, rng):
+    run = StructDict({'runId': runId, 'scanNum': runId, 'TRTime': 2, 'disdaqs': 0, 'nVols': nVols,
+                      'rtfeedback': int(runId > 1), 'blockGroups': []})
+    for blkGrpId, tr_range in ((1, range(nVols // 2)), (2, range(nVols // 2, nVols))):
+        blkGrp = StructDict({'blkGrpId': blkGrpId, 'type': blkGrpId, 'firstVol': tr_range[0],
+                             'nTRs': len(tr_range), 'blocks': []})
+        for i in range(0, len(tr_range), 10):
+            block = StructDict({'blockId': len(blkGrp.blocks) + 1 + (blkGrpId - 1) * 100, 'TRs': []})
+            attCateg = len(blkGrp.blocks) % 2 + 1
+            for iTR in tr_range[i:i + 10]:
+                regressor = [0, 0]
+                if iTR - i - tr_range[0] >= 2:
+                    regressor[attCateg - 1] = 1
+                block.TRs.append(StructDict({'trId': iTR - tr_range[0], 'vol': iTR + 1, 'type': blkGrpId,
+                                             'attCateg': attCateg, 'stim': attCateg, 'regressor': regressor,
+                                             'data': rng.randn(nVoxels) + 100 + attCateg * sum(regressor)}))
+            blkGrp.blocks.append(block)
+        run.blockGroups.append(blkGrp)
+    return run
+
+
+def runSession(dataDir, executor, numRuns=2):
+    '''Drive the engine through a session as the models do, returns the engine
+    and the output lines of the TRs and of the end of each run
+    '''
+    np.random.seed(0)
+    rng = np.random.RandomState(1)
+    roiDims = (8, 8, 8)
+    session = StructDict({'sessionId': sessionId, 'serverDataDir': dataDir,
+                          'subjectNum': 1, 'subjectDay': 1, 'nVoxels': nVoxels, 'roiDims': roiDims,
+                          'roiInds': np.sort(rng.choice(np.prod(roiDims), nVoxels, replace=False)),
+                          'FWHM': 5, 'cutoff': 112, 'legacyRun1Phase2Mode': True, 'validate': False})
+    state = ModelState()
+    engine = RtAttenEngine(state.id_fields, executor)
+    state.startSession(1, sessionId)
+    engine.startSession(session)
+    trOutputlns = []
+    endRunOutputlns = []
+    for runId in range(1, numRuns + 1):
+        run = createRunCfg(runId, rng)
+        state.startRun(runId)
+        engine.startRun(StructDict({k: v for k, v in run.items() if k != 'blockGroups'}))
+        for blkGrp in run.blockGroups:
+            state.startBlockGroup(blkGrp.blkGrpId)
+            engine.startBlockGroup(StructDict({k: v for k, v in blkGrp.items() if k != 'blocks'}))
+            for block in blkGrp.blocks:
+                state.startBlock(block.blockId)
+                for TR in block.TRs:
+                    state.startTR(TR.trId)
+                    predict_result, outputlns = engine.trData(TR, TR.data)
+                    assert (predict_result is not None) == engine.isPredictTR(TR)
+                    trOutputlns.extend(outputlns)
+                state.endBlock()
+            engine.endBlockGroup()
+            state.endBlockGroup()
+        if runId == 1:
+            blkGrpRefs = [{'run': 1, 'phase': 1}, {'run': 1, 'phase': 2}]
+        else:
+            blkGrpRefs = [{'run': runId - 1, 'phase': 1}, {'run': runId, 'phase': 1}]
+        engine.trainModel(StructDict({'blkGrpRefs': blkGrpRefs}))
+        if not executor.asyncTasks:
+            assert 'Model training completed' in engine.trainResult(runId)
+        endRunOutputlns.extend(engine.endRun())
+        state.endRun()
+    engine.endSession()
+    state.endSession()
+    return engine, trOutputlns, endRunOutputlns
+
+
+def test_executors(tmpdir):
+    '''The deferred executor gives the same patterns, predictions and models as the local one'''
+    localDir = str(tmpdir.join('local'))
+    deferredDir = str(tmpdir.join('deferred'))
+    _, localTrOutputlns, _ = runSession(localDir, LocalExecutor())
+    executor = DeferredExecutor()
+    _, deferredTrOutputlns, _ = runSession(deferredDir, executor)
+    assert executor.numDeferred > 0
+    assert len(localTrOutputlns) == 2 * nVols
+    assert localTrOutputlns == deferredTrOutputlns
+    localDir = getSubjectDataDir(localDir, 1, 1)
+    deferredDir = getSubjectDataDir(deferredDir, 1, 1)
+    for runId in (1, 2):
+        for phase in (1, 2):
+            filename = getBlkGrpFilename(sessionId, runId, phase)
+            localBlkGrp = loadMatFile(os.path.join(localDir, filename))
+            deferredBlkGrp = loadMatFile(os.path.join(deferredDir, filename))
+            for field in ('raw_sm', 'raw_sm_filt_z', 'categoryseparation', 'predict'):
+                assert np.array_equal(localBlkGrp.patterns[field], deferredBlkGrp.patterns[field], equal_nan=True)
+        filename = getModelFilename(sessionId, runId)
+        localModel = loadMatFile(os.path.join(localDir, filename))
+        deferredModel = loadMatFile(os.path.join(deferredDir, filename))
+        assert np.array_equal(localModel.trainedModel.weights, deferredModel.trainedModel.weights)
+        assert np.array_equal(localModel.trainedModel.biases, deferredModel.trainedModel.biases)
+
+
+def test_stageTimers(tmpdir):
+    '''Each run's stage times count the TRs and block groups of all the pipeline stages'''
+    engine, _, endRunOutputlns = runSession(str(tmpdir), LocalExecutor())
+    assert endRunOutputlns[0] == 'End Run 1'
+    assert endRunOutputlns[2] == 'End Run 2'
+    for line in (endRunOutputlns[1], endRunOutputlns[3]):
+        assert line.startswith('Stage times')
+        for stage in pipelineStages:
+            assert stage in line
+    stats = engine.timers.stats
+    assert stats['ingest'].count == nVols
+    assert stats['smooth'].count == nVols
+    # run 2 predicts its second block group
+    assert stats['predict'].count == nVols // 2
+    assert stats['train'].count >= 1
+    for stage in pipelineStages:
+        assert stats[stage].count > 0
+        assert stats[stage].max <= stats[stage].total
+
+
+def test_trainedModelCacheHit(tmpdir, monkeypatch):
+    '''A cached model is returned without adding it to the cache again'''
+    state = ModelState()
+    engine = RtAttenEngine(state.id_fields)
+    state.startSession(1, sessionId)
+    engine.startSession(StructDict({'sessionId': sessionId, 'serverDataDir': str(tmpdir),
+                                    'subjectNum': 1, 'subjectDay': 1, 'roiInds': np.arange(nVoxels)}))
+    model = StructDict({'weights': np.zeros((nVoxels, 2)), 'biases': np.zeros(2)})
+    engine.modelCache[1] = model
+    numSets = []
+    cacheSetItem = SpillCache.__setitem__
+
+    def countingSetItem(cache, key, value):
+        numSets.append(key)
+        cacheSetItem(cache, key, value)
+    monkeypatch.setattr(SpillCache, '__setitem__', countingSetItem)
+    for i in range(3):
+        assert engine.getTrainedModel(sessionId, 1) is model
+    assert numSets == []
+    assert engine.modelCache.stats.hits == 3
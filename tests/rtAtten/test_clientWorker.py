@@ -0,0 +1,71 @@
+import pytest
+import os
+import sys
+import time
+import toml
+scriptPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(scriptPath, "../..")
+sys.path.append(rootPath)
+from webInterface.rtAtten.RtAttenWeb import RtAttenWeb
+from webInterface.rtAtten.ClientWorkerPool import ClientWorkerPool
+
+baseCfgFile = os.path.join(rootPath, 'tests/baseExpCfg.toml')
+
+
+@pytest.fixture(scope="module")
+def cfgFile():  # type: ignore
+    # one short block of the base experiment per session
+    cfg = toml.load(baseCfgFile)
+    run = cfg['runs'][0]
+    run['blockGroups'] = run['blockGroups'][:1]
+    run['blockGroups'][0]['blocks'] = run['blockGroups'][0]['blocks'][:1]
+    cfg['runs'] = [run]
+    filename = '/tmp/clientWorkerCfg.toml'
+    with open(filename, 'w') as fp:
+        toml.dump(cfg, fp)
+    return filename
+
+
+def webPipeCallback(request):
+    return {'status': 200}
+
+
+def runWorkerSession(worker):
+    lines = []
+    while True:
+        line = worker.nextLine(timeout=1)
+        if line is None:
+            return lines
+        lines.append(line)
+
+
+def test_clientWorker(cfgFile):
+    pool = ClientWorkerPool('python -u ClientMain.py -l -p 5218', rootPath,
+                            webPipeCallback, RtAttenWeb.procOutputReader)
+    pool.start()
+    worker = pool.acquire()
+    workerPid = worker.proc.pid
+    # sessions run one after the other on the same worker process
+    for i in range(2):
+        worker.startSession(cfgFile)
+        runWorkerSession(worker)
+        assert worker.ready is True
+        pool.release(worker)
+        worker = pool.acquire()
+        assert worker.proc.pid == workerPid
+
+    # stopping a session exits the worker, the pool starts a new one
+    worker.startSession(cfgFile)
+    time.sleep(0.5)
+    worker.stop()
+    runWorkerSession(worker)
+    assert worker.isAlive() is False
+    pool.release(worker)
+    worker = pool.acquire()
+    assert worker.proc.pid != workerPid
+    worker.startSession(cfgFile)
+    runWorkerSession(worker)
+    assert worker.ready is True
+    pool.release(worker)
+    pool.shutdown()
+    assert pool.worker is None
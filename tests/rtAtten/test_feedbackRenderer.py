@@ -0,0 +1,91 @@
+import pytest
+import os
+import io
+import sys
+import time
+import numpy as np  # type: ignore
+from base64 import b64decode
+from PIL import Image
+scriptPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(scriptPath, "../..")
+sys.path.append(rootPath)
+from webInterface.rtAtten.FeedbackRenderer import FeedbackRenderer, feedbackAlpha
+
+feedbackDir = os.path.join(rootPath, 'webInterface/images')
+
+
+def test_blend():
+    renderer = FeedbackRenderer(feedbackDir)
+    faceFile = os.path.join(renderer.faceNegativeImageDir, '1.jpg')
+    sceneFile = os.path.join(renderer.sceneImageDir, '1.jpg')
+    faceImg = Image.open(faceFile)
+    sceneImg = Image.open(sceneFile)
+    for alpha in (0.0, 0.12, 0.4, 0.5, 0.77, 1.0):
+        blendImg = renderer.blend(renderer.getImage(faceFile), renderer.getImage(sceneFile), alpha)
+        pilBlend = np.asarray(Image.blend(faceImg, sceneImg, alpha=alpha))
+        assert np.max(np.abs(blendImg.astype(int) - pilBlend.astype(int))) <= 1
+
+
+def test_createFeedbackImage():
+    renderer = FeedbackRenderer(feedbackDir)
+    renderer.preload()
+    numFiles = renderer.numSceneFiles + renderer.numFaceNeutralFiles + renderer.numFaceNegativeFiles
+    assert len(renderer.imageCache) == numFiles
+    for vol, catsep in (('train', 0), (5, 0.8), (6, -0.9)):
+        b64Str = renderer.createFeedbackImage(vol, catsep)
+        img = Image.open(io.BytesIO(b64decode(b64Str)))
+        assert img.format == 'JPEG'
+        assert img.size == (256, 256)
+        # fixation dot in the center
+        assert np.asarray(img)[128, 128] < 20
+
+
+def test_memoryBudget():
+    imageBytes = 256 * 256
+    renderer = FeedbackRenderer(feedbackDir, memoryBudget=3 * imageBytes)
+    renderer.preload()
+    assert len(renderer.imageCache) == 3
+    assert renderer.cacheBytes == 3 * imageBytes
+    firstFile = next(iter(renderer.imageCache))
+    secondFile = list(renderer.imageCache)[1]
+    # using an image moves it to the end, a new image evicts the least recently used
+    renderer.getImage(firstFile)
+    renderer.getImage(os.path.join(renderer.sceneImageDir, '1.jpg'))
+    assert len(renderer.imageCache) == 3
+    assert firstFile in renderer.imageCache
+    assert secondFile not in renderer.imageCache
+    # rendering still works for images not in the cache
+    b64Str = renderer.createFeedbackImage(5, 0.5)
+    assert len(b64Str) > 0
+    assert renderer.cacheBytes <= 3 * imageBytes
+
+
+def test_prerender():
+    alphaStep = 0.02
+    renderer = FeedbackRenderer(feedbackDir, alphaStep=alphaStep, prerenderFrames=48)
+    renderer.preload()
+    renderer.startPrerender()
+    numKeys = len(renderer.prerenderKeys())
+    for i in range(50):
+        if len(renderer.prerendered) == numKeys:
+            break
+        time.sleep(0.1)
+    assert len(renderer.prerendered) == numKeys
+    # the result is sent as the pre-rendered frame with the nearest alpha
+    pair = renderer.nextPair
+    b64Str = renderer.createFeedbackImage(5, 0.5)
+    assert renderer.numPrerenderHits == 1
+    quantAlpha = renderer.alphaIndex(feedbackAlpha(5, 0.5)) * alphaStep
+    assert b64Str == renderer.renderFrame(pair, False, quantAlpha)
+    # the next TR gets a new pair, rendered directly if not pre-rendered yet
+    assert renderer.nextPair is not pair
+    b64Str = renderer.createFeedbackImage('train', 0)
+    assert len(b64Str) > 0
+    assert renderer.numPrerenderHits + renderer.numPrerenderMisses == 2
+
+    # limited frames are centered on the last result
+    renderer.prerenderFrames = 5
+    renderer.lastAlphaKey = 20
+    assert renderer.prerenderKeys() == [20, 19, 21, 18, 22]
+    renderer.lastAlphaKey = 'train'
+    assert renderer.prerenderKeys()[0] == 'train'
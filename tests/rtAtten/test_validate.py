@@ -0,0 +1,75 @@
+import os
+import sys
+scriptPath = os.path.dirname(os.path.realpath(__file__))
+rootPath = os.path.join(scriptPath, "../..")
+sys.path.append(rootPath)
+import numpy as np  # type: ignore
+import scipy.io as sio  # type: ignore
+import rtfMRI.utils as utils
+import rtAtten.validate as validate
+from rtfMRI.StructDict import StructDict
+from rtAtten.RtAttenModel import getSubjectDataDir
+
+
+def createRunOutputs(matDataDir, pyDataDir, runId, rng):
+    '''Matlab and python outputs of a run that agree'''
+    nTRs, nVoxels = 200, 40
+    runDir = os.path.join(matDataDir, 'run{}'.format(runId))
+    os.makedirs(runDir)
+    os.makedirs(os.path.join(pyDataDir, 'run{}'.format(runId)), exist_ok=True)
+    raw = rng.randn(nTRs, nVoxels)
+    raw_sm_filt_z = rng.randn(nTRs, nVoxels)
+    sio.savemat(os.path.join(runDir, 'patternsdata_{}_20180101T_1000.mat'.format(runId)),
+                {'patterns': {'raw': raw, 'raw_sm_filt_z': raw_sm_filt_z}})
+    for phase, rows in ((1, slice(0, 100)), (2, slice(100, 200))):
+        sio.savemat(os.path.join(pyDataDir, 'blkGroup_r{}_p{}_20180101T000000_py.mat'.format(runId, phase)),
+                    {'patterns': {'raw': raw[rows], 'raw_sm_filt_z': raw_sm_filt_z[rows] + 1e-4}})
+    labels = rng.randint(0, 2, nTRs)
+    trainLabels = np.eye(2)[labels]
+    trainPats = rng.randn(nTRs, nVoxels) + labels[:, np.newaxis]
+    weights = rng.randn(nVoxels, 2)
+    sio.savemat(os.path.join(runDir, 'trainedModel_{}_20180101T_1000.mat'.format(runId)),
+                {'trainedModel': {'weights': weights, 'trainLabels': trainLabels, 'trainPats': trainPats}})
+    sio.savemat(os.path.join(pyDataDir, 'trainedModel_r{}_20180101T000000_py.mat'.format(runId)),
+                {'trainedModel': {'weights': weights + 1e-4, 'trainLabels': trainLabels,
+                                  'trainPats': trainPats + 1e-3}})
+    lines = ['{}\t1\t{}\t1\t1\t1\t{}\t1\t{:.3f}\tnan\n'.format(runId, i, i + 1, rng.randn()) for i in range(10)]
+    with open(os.path.join(runDir, 'fileprocessing.txt'), 'w') as fp:
+        fp.writelines(lines)
+    with open(os.path.join(pyDataDir, 'run{}'.format(runId), 'fileprocessing_py.txt'), 'w') as fp:
+        fp.writelines(lines)
+
+
+def test_validateSession(tmpdir, monkeypatch):
+    rng = np.random.RandomState(0)
+    dataDir = str(tmpdir.join('data'))
+    matDataDir = getSubjectDataDir(dataDir, 1, 1)
+    pyDataDir = getSubjectDataDir(str(tmpdir.join('py')), 1, 1)
+    for runId in (1, 2):
+        createRunOutputs(matDataDir, pyDataDir, runId, rng)
+    cfg = StructDict({'session': StructDict({'dataDir': dataDir, 'subjectNum': 1, 'subjectDay': 1,
+                                             'Runs': [1, 2]})})
+    loadedFiles = []
+    loadMatFile = utils.loadMatFile
+
+    def countingLoadMatFile(filename):
+        loadedFiles.append(filename)
+        return loadMatFile(filename)
+    monkeypatch.setattr(utils, 'loadMatFile', countingLoadMatFile)
+
+    # sag fits draw from the global random state, in order when run serially
+    np.random.seed(0)
+    all_ROC = validate.validateSession(cfg, pyDataDir)
+    assert all_ROC.shape == (4, 2, 2)
+    assert not np.isnan(all_ROC).any()
+    # each patterns and model file loaded once
+    assert len(loadedFiles) == len(set(loadedFiles)) == 10
+    assert len(validate.matFileCache) == 0
+    assert np.array_equal(np.load(os.path.join(pyDataDir, 'xvalresults.npy')), all_ROC)
+
+    loadedFiles.clear()
+    parallel_ROC = validate.validateSession(cfg, pyDataDir, jobs=2)
+    # the fit workers use the models loaded before they started
+    assert len(loadedFiles) == 10
+    assert np.allclose(parallel_ROC, all_ROC, atol=0.02)
+    assert np.array_equal(np.load(os.path.join(pyDataDir, 'xvalresults.npy')), parallel_ROC)
@@ -1,8 +1,10 @@
 import unittest
 import threading
+import numpy as np  # type: ignore
 from rtfMRI.MsgTypes import MsgType, MsgEvent, MsgResult  # type: ignore
 from rtfMRI.Messaging import RtMessagingServer, Message   # type: ignore
-from rtfMRI.Messaging import RtMessagingClient
+from rtfMRI.Messaging import RtMessagingClient, pyarrow_context
+from rtfMRI.StructDict import StructDict, TRView, copy_toplevel
 
 
 class Test_Messaging(unittest.TestCase):
@@ -57,5 +59,26 @@ class Test_Messaging(unittest.TestCase):
         client.close()
 
 
+class Test_TRView(unittest.TestCase):
+    def test_serializeTRView(self):
+        TR = TRView(trId=3, vol=4, attCateg=1, stim=2, type=1, regressor=[0, 1])
+        TR.data = np.arange(5, dtype=float)
+        TR.deadline = 10.5
+        msg = Message()
+        msg.fields.cfg = TR
+        msg = pyarrow_context.deserialize(pyarrow_context.serialize(msg).to_buffer())
+        TR2 = msg.fields.cfg
+        self.assertTrue(isinstance(TR2, TRView))
+        self.assertEqual(TR2.values()[:6], [3, 4, 1, 2, 1, [0, 1]])
+        self.assertTrue(np.array_equal(TR2.data, TR.data))
+        self.assertEqual(TR2.deadline, 10.5)
+        self.assertTrue(TR2.delay is None)
+
+    def test_copyToplevel(self):
+        block = StructDict({'blockId': 1, 'TRs': [TRView(trId=0)],
+                            'schedule': np.zeros(2, dtype=[('trId', np.int32)])})
+        self.assertEqual(copy_toplevel(block), {'blockId': 1})
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,92 @@
+import pytest
+import os
+import time
+import threading
+from glob import iglob
+from queue import Queue, Empty
+from rtfMRI.fileWatcher import FileWatcher, PollingFileWatcher
+from rtfMRI.Errors import InvocationError
+
+testDir = '/tmp/pollwatch'
+
+
+def test_pollingFileWatcher():
+    if not os.path.exists(testDir):
+        os.makedirs(testDir)
+
+    # remove any existing testfiles
+    for filename in iglob(os.path.join(testDir, "test*.poll")):
+        os.remove(filename)
+
+    fileWatcher = FileWatcher('polling')
+    assert isinstance(fileWatcher, PollingFileWatcher)
+    fileWatcher.initFileNotifier(testDir, "*.poll", 1)
+
+    # a file that never arrives should time out
+    missingFile = os.path.join(testDir, "missing.poll")
+    assert fileWatcher.waitForFile(missingFile, timeout=0.5) is None
+
+    watchQ = Queue()
+    foundQ = Queue()
+    watch_thread = threading.Thread(name='watchThread', target=watchThread,
+                                    args=(fileWatcher, watchQ, foundQ,))
+    watch_thread.setDaemon(True)
+    watch_thread.start()
+
+    for i in range(5):
+        filename = os.path.join(testDir, "test{}.poll".format(i))
+        watchQ.put(filename)
+        time.sleep(0.25)
+        with open(filename, "w") as f:
+            f.write("hello {}".format(i))
+        try:
+            foundFile = foundQ.get(block=True, timeout=1)
+        except Empty as err:
+            print('foundQ timed out waiting for {}'.format(filename))
+            assert False
+        assert foundFile == filename
+
+    # arrival period should have been learned from the file arrivals
+    assert fileWatcher.trPeriod is not None
+    assert abs(fileWatcher.trPeriod - 0.25) < 0.2
+
+    # a file already present is returned without waiting
+    assert fileWatcher.waitForFile(os.path.join(testDir, "test0.poll"), timeout=0.1) is not None
+
+    watchQ.put('end')
+    watch_thread.join(timeout=1)
+
+
+def watchThread(fileWatcher, watchQ, foundQ):
+    req = watchQ.get(block=True)
+    while req != 'end':
+        filename = fileWatcher.waitForFile(req)
+        foundQ.put(filename)
+        req = watchQ.get(block=True)
+
+
+def test_pollingTrPeriod(tmpdir):
+    '''The TR period is learned when the first files land in a burst, and isn't
+       thrown off by the gap between runs
+    '''
+    fileWatcher = FileWatcher('polling')
+    fileWatcher.initFileNotifier(str(tmpdir), "*.poll", 1)
+    startTime = time.time() - 100
+    # two files in the same burst, then a file every 2 seconds, a gap and again every 2 seconds
+    mtimes = [0, 0.001, 2.001, 4.001, 6.001, 8.001, 38.001, 40.001, 42.001]
+    for i, mtime in enumerate(mtimes):
+        filename = os.path.join(str(tmpdir), "test{}.poll".format(i))
+        with open(filename, "w") as f:
+            f.write("hello {}".format(i))
+        os.utime(filename, (startTime + mtime, startTime + mtime))
+        fileWatcher.recordArrival(filename, time.time())
+        if i == 4:
+            assert abs(fileWatcher.trPeriod - 2) < 0.01
+    assert abs(fileWatcher.trPeriod - 2) < 0.01
+    # the next file is expected 2 seconds after the last one
+    assert fileWatcher.nextPollInterval(fileWatcher.lastArrivalTime + 2, 1) == fileWatcher.minPollInterval
+
+
+def test_unknownWatcherType():
+    with pytest.raises(InvocationError):
+        FileWatcher('nosuchwatcher')
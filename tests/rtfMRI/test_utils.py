@@ -6,12 +6,15 @@ import copy
 import time
 import random
 import pathlib
+import subprocess
 import scipy.io as sio  # type: ignore
 import numpy as np  # type: ignore
 from glob import iglob
 import rtfMRI.utils as utils  # type: ignore
 import rtfMRI.ValidationUtils as vutils  # type: ignore
 from rtfMRI.StructDict import StructDict, MatlabStructDict  # type: ignore
+from rtfMRI.dirIndex import DirIndex, getDirIndex  # type: ignore
+from rtfMRI.spillCache import SpillCache  # type: ignore
 
 
 @pytest.fixture(scope="module")
@@ -69,6 +72,158 @@ class TestFindNewestFile:
         assert filename is None
 
 
+class TestDirIndex:
+    def makeFiles(self, dirPath, names):
+        for name in names:
+            with open(os.path.join(dirPath, name), 'w') as fp:
+                fp.write(name)
+            # ctime resolution of some file systems
+            time.sleep(0.01)
+
+    @pytest.mark.parametrize("useInotify", [True, False])
+    def test_findNewest(self, tmpdir, useInotify):
+        dirPath = str(tmpdir)
+        index = DirIndex(useInotify=useInotify)
+        self.makeFiles(dirPath, ['a_1.mat', 'a_2.mat', '.a_3.mat', 'b_1.mat'])
+        if not useInotify:
+            # a recently changed directory is rescanned, the mtime granularity is coarse
+            time.sleep(index.maxAge)
+        assert index.findNewest(os.path.join(dirPath, 'a_*')) == os.path.join(dirPath, 'a_2.mat')
+        assert index.getMatches(os.path.join(dirPath, '*.mat')) == \
+            [os.path.join(dirPath, name) for name in ('b_1.mat', 'a_2.mat', 'a_1.mat')]
+        assert index.findNewest(os.path.join(dirPath, '.a_*')) == os.path.join(dirPath, '.a_3.mat')
+        assert index.findNewest(os.path.join(dirPath, 'c_*')) is None
+        assert index.findNewest(os.path.join(dirPath, 'nodir/a_*')) is None
+        # the directory is scanned once for the lookups
+        assert index.scanCount == 1
+        # a new file is found
+        self.makeFiles(dirPath, ['a_0.mat'])
+        assert index.findNewest(os.path.join(dirPath, 'a_*')) == os.path.join(dirPath, 'a_0.mat')
+        # a rewritten file is seen by inotify, or after maxAge without it
+        self.makeFiles(dirPath, ['a_1.mat'])
+        if not useInotify:
+            time.sleep(index.maxAge)
+        assert index.findNewest(os.path.join(dirPath, 'a_*')) == os.path.join(dirPath, 'a_1.mat')
+        os.remove(os.path.join(dirPath, 'a_1.mat'))
+        assert index.findNewest(os.path.join(dirPath, 'a_*')) == os.path.join(dirPath, 'a_0.mat')
+
+    def test_matchesGlob(self, tmpdir):
+        dirPath = str(tmpdir)
+        os.makedirs(os.path.join(dirPath, 'run1'))
+        self.makeFiles(dirPath, ['x_1.txt', 'x_2.txt', 'run1/x_3.txt'])
+        index = DirIndex()
+        for pattern in ('x_*', 'x_1.txt', 'x_[12].txt', 'run1/x_*', 'run*/x_*', '*'):
+            pathPattern = os.path.join(dirPath, pattern)
+            assert index.getMatches(pathPattern) == sorted(iglob(pathPattern), key=os.path.getctime, reverse=True)
+
+
+    def test_missedEvents(self, tmpdir, monkeypatch):
+        dirPath = str(tmpdir)
+        index = DirIndex()
+        if index.inotifyFd is None:
+            pytest.skip("inotify not available")
+        self.makeFiles(dirPath, ['a_1.mat'])
+        pattern = os.path.join(dirPath, 'a_*')
+        assert index.findNewest(pattern) == os.path.join(dirPath, 'a_1.mat')
+        # changes inotify doesn't report are seen by the periodic full scan
+        monkeypatch.setattr(index, 'readEvents', lambda: None)
+        self.makeFiles(dirPath, ['a_2.mat'])
+        assert index.findNewest(pattern) == os.path.join(dirPath, 'a_1.mat')
+        index.inotifyMaxAge = 0
+        assert index.findNewest(pattern) == os.path.join(dirPath, 'a_2.mat')
+
+    def test_forkedChild(self, tmpdir):
+        dirPath = str(tmpdir)
+        self.makeFiles(dirPath, ['a_1.mat'])
+        assert utils.findNewestFile(dirPath, 'a_*') == os.path.join(dirPath, 'a_1.mat')
+        goRead, goWrite = os.pipe()
+        resultRead, resultWrite = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # the child looks up the new file once the parent has read its events
+            status = 1
+            try:
+                os.read(goRead, 1)
+                filename = utils.findNewestFile(dirPath, 'a_*')
+                os.write(resultWrite, str(filename).encode())
+                status = 0
+            finally:
+                os._exit(status)
+        os.close(resultWrite)
+        self.makeFiles(dirPath, ['a_2.mat'])
+        assert utils.findNewestFile(dirPath, 'a_*') == os.path.join(dirPath, 'a_2.mat')
+        os.write(goWrite, b'x')
+        result = os.read(resultRead, 4096).decode()
+        _, status = os.waitpid(pid, 0)
+        for fd in (goRead, goWrite, resultRead):
+            os.close(fd)
+        assert status == 0
+        assert result == os.path.join(dirPath, 'a_2.mat')
+        assert getDirIndex().pid == os.getpid()
+
+
+class TestSpillCache:
+    def createEntry(self, val):
+        entry = StructDict({'runId': val, 'name': 'blkGrp', 'scale': np.float64(val)})
+        entry.patterns = StructDict({'raw': np.full((10, 100), val, dtype=np.float64)})
+        entry.model = MatlabStructDict({'weights': np.arange(4).reshape(2, 2)}, 'model')
+        return entry
+
+    def test_spill(self):
+        # room for two entries
+        cache = SpillCache(2 * 8000 + 1000, 'testCache')
+        for i in range(4):
+            cache[i] = self.createEntry(i)
+        assert len(cache) == 4 and sorted(cache.keys()) == [0, 1, 2, 3]
+        assert len(cache.memoryValues()) == 2 and cache.stats.spills == 2
+        spillDir = cache.spillDir
+        assert len(os.listdir(spillDir)) == 2
+        # a spilled entry is reloaded and spills the least recently used
+        entry = cache.get(0)
+        assert cache.stats.spillHits == 1 and cache.stats.spills == 3
+        assert type(entry) is StructDict and type(entry.patterns) is StructDict
+        assert entry.runId == 0 and entry.name == 'blkGrp' and entry.scale == np.float64(0)
+        assert np.array_equal(entry.patterns.raw, np.full((10, 100), 0))
+        assert type(entry.model) is MatlabStructDict and entry.model.__name__ == 'model'
+        assert np.array_equal(entry.model.weights, np.arange(4).reshape(2, 2))
+        assert cache.get(3) is not None and cache.stats.hits == 1
+        assert cache.get(5) is None and cache.stats.misses == 1
+        del cache[1]
+        assert 1 not in cache and len(os.listdir(spillDir)) == 1
+        cache.clear()
+        assert len(cache) == 0 and not os.path.exists(spillDir)
+
+    def test_largeEntry(self):
+        cache = SpillCache(1000, 'testCache')
+        cache['a'] = self.createEntry(1)
+        assert len(cache.memoryValues()) == 1 and cache.stats.spills == 0
+        cache['b'] = self.createEntry(2)
+        assert len(cache.memoryValues()) == 1 and cache.stats.spills == 1
+        assert cache['a'].runId == 1
+        cache.clear()
+
+
+    def test_roundTrip(self):
+        cache = SpillCache(1000, 'testCache')
+        entry = self.createEntry(1)
+        entry.runs = {1: 'run1', (2, 3): 'run2'}
+        entry.shape = (10, 100)
+        entry.trs = [np.zeros(3), np.ones(3)]
+        entry.info = StructDict({'ids': [1, 2], 'fwhm': float('nan'), 'blkGrp': (1, [2, 3])})
+        cache['a'] = entry
+        cache['b'] = self.createEntry(2)
+        assert cache.stats.spills == 1
+        value = cache['a']
+        assert cache.stats.spillHits == 1
+        assert value.runs == {1: 'run1', (2, 3): 'run2'}
+        assert value.shape == (10, 100) and type(value.shape) is tuple
+        assert type(value.trs) is list and len(value.trs) == 2
+        assert np.array_equal(value.trs[0], np.zeros(3)) and np.array_equal(value.trs[1], np.ones(3))
+        assert type(value.info) is StructDict and value.info.ids == [1, 2]
+        assert np.isnan(value.info.fwhm) and value.info.blkGrp == (1, [2, 3])
+        assert np.array_equal(value.patterns.raw, entry.patterns.raw)
+        cache.clear()
+
 class TestMatlabStructDict:
     @pytest.fixture(scope="class")
     def testStruct(cls, matTestFilename):  # type: ignore
@@ -126,6 +281,17 @@ class TestStructDict:
         a.sub = StructDict()
         a.sub.left = 'corner'
         assert a.top == 1 and a.bottom == 3 and a.sub.left == 'corner'
+        assert a.missing is None
+
+    def test_saveMatFile(self, tmpdir):
+        a = StructDict()
+        a.top = 1
+        a.sub = StructDict()
+        a.sub.data = np.arange(6).reshape(2, 3)
+        filename = str(tmpdir.join('structdict.mat'))
+        sio.savemat(filename, a, appendmat=False)
+        b = utils.loadMatFile(filename)
+        assert np.array_equal(b.sub.data, a.sub.data)
 
 
 class TestCompareArrays:
@@ -155,6 +321,21 @@ class TestCompareArrays:
         assert vutils.areArraysClose(self.B, self.A, mean_limit=max_mean)
         return
 
+    def test_compareArraysChunked(self, monkeypatch):
+        B = self.B.copy()
+        B[0, 0, :5] = 0
+        B[1, 2, :] = np.nan
+        whole = vutils.compareArrays(B, self.A)
+        # compare a few rows at a time
+        monkeypatch.setattr(vutils, 'compareChunkBytes', 3 * 50 * 60 * 8)
+        chunked = vutils.compareArrays(B, self.A, pearson=True)
+        for key in ('mean', 'min', 'max', 'stddev', 'histopct'):
+            assert np.allclose(chunked[key], whole[key], rtol=1e-10)
+        assert chunked['count'] == self.A.size
+        assert np.array_equal(chunked['histocounts'], whole['histocounts'])
+        assert chunked['pearson'] > 0.99
+        assert vutils.compareArrays(self.A, self.A.copy()) == vutils.StatsEqual
+
 
 class TestCompareMatStructs:
     A = None
@@ -219,6 +400,56 @@ class TestPearsonsMeanCorr:
         res = vutils.pearsons_mean_corr(n1t, n2t)
         assert res > 0.999
 
+    def test_pearsonsInComparison(self, monkeypatch):
+        import scipy.stats as sstats  # type: ignore
+        A = np.random.randn(100, 8)
+        B = A + np.random.randn(100, 8)
+        B[np.random.random(B.shape) < 0.1] = np.nan
+        B[:, 2] = np.nan
+        expected = np.mean([sstats.pearsonr(A[~np.isnan(B[:, col]), col], B[~np.isnan(B[:, col]), col])[0]
+                            for col in range(8) if col != 2])
+        monkeypatch.setattr(vutils, 'compareChunkBytes', 7 * 8 * 8)
+        assert np.isclose(vutils.pearsons_mean_corr(A, B), expected)
+        structA = MatlabStructDict({'patterns': MatlabStructDict({'z': A, 'raw': A})}, 'patterns')
+        structB = MatlabStructDict({'patterns': MatlabStructDict({'z': B, 'raw': A})}, 'patterns')
+        res = vutils.compareMatStructs(structA, structB, pearson_fields=['z'])
+        assert np.isclose(res['z']['pearson'], expected)
+        assert 'pearson' not in res['raw']
+
+
+class TestGitCodeId:
+    def test_readGitDir(self, tmpdir):
+        commitId = 'a1b2c3d4e5f60718293a4b5c6d7e8f9012345678'
+        gitDir = str(tmpdir)
+        os.makedirs(os.path.join(gitDir, 'refs/heads'))
+        with open(os.path.join(gitDir, 'HEAD'), 'w') as fp:
+            fp.write('ref: refs/heads/master\n')
+        assert utils.readGitDir(gitDir) is None
+        with open(os.path.join(gitDir, 'packed-refs'), 'w') as fp:
+            fp.write('# pack-refs with: peeled fully-peeled sorted\n')
+            fp.write('{} refs/heads/master\n'.format(commitId))
+        assert utils.readGitDir(gitDir) == 'master:a1b2c3d'
+        with open(os.path.join(gitDir, 'refs/heads/master'), 'w') as fp:
+            fp.write('0' * 40 + '\n')
+        assert utils.readGitDir(gitDir) == 'master:0000000'
+        with open(os.path.join(gitDir, 'HEAD'), 'w') as fp:
+            fp.write(commitId + '\n')
+        assert utils.readGitDir(gitDir) == ':a1b2c3d'
+
+    def test_getGitCodeId(self):
+        branchName = subprocess.check_output(['git', 'symbolic-ref', '--short', '-q', 'HEAD'])
+        commitId = subprocess.check_output(['git', 'rev-parse', '--short=7', 'HEAD'])
+        gitCodeId = branchName.decode('utf-8').strip() + ':' + commitId.decode('utf-8').strip()
+        assert utils.getGitCodeId() == gitCodeId
+
+
+def test_serverLazyImports():
+    # the server loads model dependencies when a model is created, not at startup
+    rootPath = os.path.join(os.path.dirname(__file__), '../..')
+    cmd = "import sys, ServerMain; print('sklearn' in sys.modules, 'rtAtten.RtAttenModel' in sys.modules)"
+    output = subprocess.check_output(['python', '-c', cmd], cwd=rootPath)
+    assert output.decode('utf-8').split() == ['False', 'False']
+
 
 if __name__ == "__main__":
     print("PYTEST MAIN:")
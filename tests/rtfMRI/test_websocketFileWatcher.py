@@ -2,12 +2,23 @@ import pytest
 import os
 import threading
 import time
+import shutil
+import json
 import logging
+import hashlib
+import websocket
+import numpy as np  # type: ignore
+from concurrent.futures import Future
 from base64 import b64decode
+import rtfMRI.utils as utils
 from rtfMRI.utils import installLoggers
+from rtfMRI.Errors import RequestError
 from webInterface.webSocketFileWatcher import WebSocketFileWatcher
-from webInterface.WebServer import Web
+from webInterface.WebServer import Web, SendQueue, writePipeResponse
+from webInterface.WebServer import makeSocketPipe, handleSocketRequests, resignalSocketThreadExit
+import webInterface.WebServer as WebServer
 import webInterface.WebClientUtils as wcutils
+from rtfMRI.ReadDicom import readDicomFromFile, parseDicomVolume, applyMask
 
 
 testDir = os.path.dirname(__file__)
@@ -104,20 +115,24 @@ class TestFileWatcher:
         cmd = wcutils.watchFileReqStruct(dicomTestFilename)
         response = Web.sendDataMsgFromThread(cmd)
         assert response['status'] == 200
-        responseData = b64decode(response['data'])
-        assert responseData == data
+        assert response['data'] == data
 
         cmd = wcutils.getFileReqStruct(dicomTestFilename)
         response = Web.sendDataMsgFromThread(cmd)
         assert response['status'] == 200
-        responseData = b64decode(response['data'])
-        assert responseData == data
+        assert response['data'] == data
 
         cmd = wcutils.getNewestFileReqStruct(dicomTestFilename)
         response = Web.sendDataMsgFromThread(cmd)
         assert response['status'] == 200
-        responseData = b64decode(response['data'])
-        assert responseData == data
+        assert response['data'] == data
+
+        # Request base64 data in a text frame as older servers do
+        cmd = wcutils.getFileReqStruct(dicomTestFilename)
+        cmd['binaryData'] = False
+        response = Web.sendDataMsgFromThread(cmd)
+        assert response['status'] == 200
+        assert response['data'] == data
 
         # Try to get a non-allowed file
         cmd = wcutils.getFileReqStruct('/tmp/file.nope')
@@ -128,3 +143,395 @@ class TestFileWatcher:
         cmd = wcutils.getFileReqStruct('/nope/file.dcm')
         response = Web.sendDataMsgFromThread(cmd)
         assert(response['status'] == 400)
+
+    def test_maskedWatchFile(cls, dicomTestFilename):
+        print("test_maskedWatchFile")
+        assert Web.wsDataConn is not None
+        # Masked request without a mask set should fail
+        cmd = wcutils.initWatchReqStruct(testDir, '*', 0)
+        response = Web.sendDataMsgFromThread(cmd)
+        assert response['status'] == 200
+        cmd = wcutils.watchFileReqStruct(dicomTestFilename, masked=True)
+        response = Web.sendDataMsgFromThread(cmd)
+        assert response['status'] == 400
+
+        sliceDim = 64
+        dicomImg = readDicomFromFile(dicomTestFilename)
+        volume = parseDicomVolume(dicomImg, sliceDim)
+        roiInds = np.sort(np.random.choice(volume.size, 2000, replace=False))
+        cmd = wcutils.initWatchReqStruct(testDir, '*', 0, roiInds=roiInds, sliceDim=sliceDim)
+        response = Web.sendDataMsgFromThread(cmd)
+        assert response['status'] == 200
+        assert 'roiInds' not in response
+
+        cmd = wcutils.watchFileReqStruct(dicomTestFilename, masked=True)
+        response = Web.sendDataMsgFromThread(cmd)
+        assert response['status'] == 200
+        assert response['dataFormat'] == wcutils.maskedDataFormat
+        maskedData = np.frombuffer(response['data'], dtype=np.float32)
+        assert np.array_equal(maskedData, applyMask(volume, roiInds))
+
+        # unmasked requests still return the full file
+        cmd = wcutils.watchFileReqStruct(dicomTestFilename)
+        response = Web.sendDataMsgFromThread(cmd)
+        assert response['status'] == 200
+        assert len(response['data']) == os.path.getsize(dicomTestFilename)
+
+    def test_concurrentRequests(cls):
+        print("test_concurrentRequests")
+        assert Web.wsDataConn is not None
+        cmd = wcutils.initWatchReqStruct(testDir, '*', 0)
+        response = Web.sendDataMsgFromThread(cmd)
+        assert response['status'] == 200
+
+        # start a watchFile for a file that won't arrive
+        watchResponses = []
+        watchTimeout = 3
+
+        def watchNoFile():
+            cmd = wcutils.watchFileReqStruct(os.path.join(testDir, 'nofile.dcm'), timeout=watchTimeout)
+            watchResponses.append(Web.sendDataMsgFromThread(cmd, timeout=watchTimeout + 5))
+        watchThread = threading.Thread(name='watchThread', target=watchNoFile)
+        watchThread.setDaemon(True)
+        watchThread.start()
+        time.sleep(0.5)
+
+        # putTextFile and ping replies shouldn't wait for the pending watchFile
+        textFilename = '/tmp/fileWatcherTest/concurrent.txt'
+        for i in range(5):
+            stime = time.time()
+            cmd = wcutils.putTextFileReqStruct(textFilename, 'hello {}'.format(i))
+            response = Web.sendDataMsgFromThread(cmd, timeout=2)
+            putTime = time.time() - stime
+            assert response['status'] == 200
+            assert putTime < 0.5
+            response = Web.sendDataMsgFromThread({'cmd': 'ping'}, timeout=2)
+            assert response['status'] == 200
+        with open(textFilename, 'r') as fp:
+            assert fp.read() == 'hello 4'
+        assert len(watchResponses) == 0
+
+        watchThread.join(timeout=watchTimeout + 5)
+        assert len(watchResponses) == 1
+        assert watchResponses[0]['status'] == 408
+
+    def test_pushStream(cls, dicomTestFilename):
+        print("test_pushStream")
+        assert Web.wsDataConn is not None
+        pushDir = '/tmp/fileWatcherTest/push'
+        if os.path.exists(pushDir):
+            shutil.rmtree(pushDir)
+        os.makedirs(pushDir)
+        with open(dicomTestFilename, 'rb') as fp:
+            data = fp.read()
+        filenames = [os.path.join(pushDir, 'push_{}.dcm'.format(i)) for i in range(5)]
+        cmd = wcutils.initWatchReqStruct(pushDir, '*.dcm', 0)
+        response = Web.sendDataMsgFromThread(cmd)
+        assert response['status'] == 200
+        cmd = wcutils.subscribeReqStruct(filenames, gapTimeout=1)
+        response = Web.sendDataMsgFromThread(cmd)
+        assert response['status'] == 200
+
+        # pushed as soon as it is written
+        shutil.copy(dicomTestFilename, filenames[0])
+        response = Web.getPushedFile(filenames[0], timeout=5)
+        assert response['status'] == 200
+        assert response['data'] == data
+        # not arrived yet
+        response = Web.getPushedFile(filenames[1], timeout=0.2)
+        assert response['status'] == 408
+
+        # file 1 is skipped by the scanner, pushed as missing once file 2 arrives
+        shutil.copy(dicomTestFilename, filenames[2])
+        response = Web.getPushedFile(filenames[1], timeout=5)
+        assert response['status'] == 404
+        response = Web.getPushedFile(filenames[2], timeout=5)
+        assert response['status'] == 200
+
+        # a lost push leaves a gap in the stream sequence, readers fall back to watchFile
+        Web.pushCallback({'cmd': 'pushFile', 'status': 200, 'streamId': Web.pushStreamId,
+                          'streamSeq': 4, 'filename': filenames[4], 'data': data})
+        shutil.copy(dicomTestFilename, filenames[3])
+        assert Web.getPushedFile(filenames[3], timeout=1) is None
+        response = Web.getPushedFile(filenames[4], timeout=1)
+        assert response['status'] == 200
+
+        # files not in the stream aren't waited for
+        assert Web.getPushedFile(dicomTestFilename, timeout=1) is None
+        cmd = wcutils.unsubscribeReqStruct()
+        response = Web.sendDataMsgFromThread(cmd)
+        assert response['status'] == 200
+        assert Web.getPushedFile(filenames[0], timeout=1) is None
+
+    def test_uploadFiles(cls, dicomTestFilename):
+        print("test_uploadFiles")
+        assert Web.wsDataConn is not None
+        uploadDir = '/tmp/fileWatcherTest/upload'
+        outputDir = '/tmp/fileWatcherTest/output/'
+        for dir in (uploadDir, outputDir):
+            if os.path.exists(dir):
+                shutil.rmtree(dir)
+        os.makedirs(uploadDir)
+        with open(dicomTestFilename, 'rb') as fp:
+            data = fp.read()
+        filenames = [os.path.join(uploadDir, '001_000001_{:06d}.dcm'.format(i)) for i in range(1, 11)]
+        for i, filename in enumerate(filenames):
+            with open(filename, 'wb') as fp:
+                fp.write(data + bytes([i]))
+
+        cmd = wcutils.getFileInfoReqStruct(filenames + [os.path.join(uploadDir, 'nofile.dcm')])
+        response = Web.sendDataMsgFromThread(cmd, timeout=2)
+        assert response['status'] == 200
+        assert response['fileInfo'] == {filename: wcutils.getFileInfo(filename) for filename in filenames}
+        cmd = wcutils.getFileInfoReqStruct(['/nope/file.dcm'])
+        response = Web.sendDataMsgFromThread(cmd, timeout=2)
+        assert response['status'] == 400
+
+        origOutputDir = WebServer.CommonOutputDir
+        WebServer.CommonOutputDir = outputDir
+        try:
+            progress = []
+            numSkipped = Web.uploadFilesFromThread(filenames, progress.append, timeout=5)
+            assert numSkipped == 0
+            assert progress == list(range(1, 11))
+            for filename in filenames:
+                with open(filename, 'rb') as fp1, open(WebServer.outputFilename(filename), 'rb') as fp2:
+                    assert fp1.read() == fp2.read()
+
+            # an interrupted upload left a partial file and didn't get to the last two
+            with open(WebServer.outputFilename(filenames[7]), 'wb') as fp:
+                fp.write(data[:100])
+            for filename in filenames[8:]:
+                os.remove(WebServer.outputFilename(filename))
+            numSkipped = Web.uploadFilesFromThread(filenames, timeout=5)
+            assert numSkipped == 7
+            for filename in filenames:
+                assert wcutils.getFileInfo(WebServer.outputFilename(filename)) == wcutils.getFileInfo(filename)
+
+            # the first failed file is reported
+            with pytest.raises(RequestError):
+                Web.uploadFilesFromThread([os.path.join(uploadDir, 'nofile.dcm')], timeout=5)
+        finally:
+            WebServer.CommonOutputDir = origOutputDir
+
+    def test_userLogBatching(cls):
+        print("test_userLogBatching")
+        serverAddr = 'localhost:8921'
+        sessionCookie = wcutils.login(serverAddr, 'test', 'test')
+        userWs = websocket.create_connection('wss://{}/wsUser'.format(serverAddr),
+                                             cookie='login=' + sessionCookie,
+                                             sslopt={"ca_certs": wcutils.certFile})
+        for i in range(50):
+            if len(Web.wsUserConns) > 0:
+                break
+            time.sleep(0.1)
+        for i in range(20):
+            Web.userLog('line {}'.format(i))
+        Web.sendUserMsgFromThread(json.dumps({'cmd': 'runStatus', 'status': 'complete'}))
+        # log lines arrive batched and before the following message
+        msg = json.loads(userWs.recv())
+        assert msg['cmd'] == 'userLog'
+        assert msg['values'] == ['line {}'.format(i) for i in range(20)]
+        msg = json.loads(userWs.recv())
+        assert msg['cmd'] == 'runStatus'
+        stats = Web.sendQueueStats()
+        assert len(stats.user) == 1
+        assert stats.user[0].numSent == 2
+        assert stats.user[0].numDropped == 0
+        userWs.close()
+
+
+class FakeConnection:
+    def __init__(self):
+        self.written = []
+        self.futures = []
+
+    def write_message(self, msg):
+        self.written.append(msg)
+        self.futures.append(Future())
+        return self.futures[-1]
+
+
+def test_sendQueue():
+    conn = FakeConnection()
+    sendQueue = SendQueue(conn, 4)
+    sendQueue.put('runStatus', 'msg0')
+    # one message is written at a time, the rest wait in the queue
+    assert conn.written == ['msg0']
+    sendQueue.put('userLog', ['a'])
+    sendQueue.put('userLog', ['b', 'c'])
+    sendQueue.put('subjectDisplay', 'image1')
+    sendQueue.put('subjectDisplay', 'image2')
+    assert sendQueue.depth() == 3
+    assert sendQueue.numDropped == 1
+    conn.futures[-1].set_result(None)
+    assert json.loads(conn.written[-1]) == {'cmd': 'userLog', 'values': ['a', 'b', 'c']}
+    conn.futures[-1].set_result(None)
+    assert conn.written[-1] == 'image2'
+    # when full the oldest message is dropped
+    for i in range(6):
+        sendQueue.put('runStatus', 'status{}'.format(i))
+    assert sendQueue.depth() == 5
+    assert sendQueue.maxDepth == 5
+    assert sendQueue.numDropped == 3
+    conn.futures[-1].set_result(None)
+    assert conn.written[-1] == 'status2'
+    # a failed write closes the queue
+    conn.futures[-1].set_exception(ConnectionError('closed'))
+    assert sendQueue.closed is True
+    sendQueue.put('runStatus', 'msg')
+    assert sendQueue.depth() == 0
+    assert sendQueue.stats().numSent == 4
+
+
+def test_sendQueueOverflow(caplog):
+    conn = FakeConnection()
+    sendQueue = SendQueue(conn, 4)
+    sendQueue.put('runStatus', 'msg0')
+    sendQueue.put('subjectDisplay', 'image1')
+    sendQueue.put('subjectDisplay', 'image2')
+    assert sendQueue.numDropped == 1
+    assert sendQueue.numOverflow == 0
+    sendQueue.put('classificationResult', 'class0')
+    sendQueue.put('runStatus', 'status0')
+    sendQueue.put('userLog', ['a'])
+    # when full a replaceable or userLog message is dropped first
+    with caplog.at_level(logging.WARNING):
+        sendQueue.put('classificationResult', 'class1')
+    assert 'client not keeping up' in caplog.text
+    assert [item[1] for item in sendQueue.messages] == ['class0', 'status0', ['a'], 'class1']
+    sendQueue.put('classificationResult', 'class2')
+    assert [item[1] for item in sendQueue.messages] == ['class0', 'status0', 'class1', 'class2']
+    sendQueue.put('classificationResult', 'class3')
+    # classificationResults are never dropped
+    sendQueue.put('classificationResult', 'class4')
+    assert [item[1] for item in sendQueue.messages] == ['class0', 'class1', 'class2', 'class3', 'class4']
+    assert sendQueue.numOverflow == 3
+    assert sendQueue.stats().numDropped == 4
+
+
+def test_getFileInfo(tmpdir):
+    # the md5 is read in blocks, the same as utils.fileMd5 of the session manifest
+    filename = str(tmpdir.join('data.bin'))
+    data = os.urandom(5 * 1024**2)
+    with open(filename, 'wb') as fp:
+        fp.write(data)
+    assert wcutils.getFileInfo(filename) == {'size': len(data), 'md5': hashlib.md5(data).hexdigest()}
+    assert wcutils.getFileInfo(filename)['md5'] == utils.fileMd5(filename)
+
+
+def test_messageCmd():
+    assert WebServer.messageCmd({'cmd': 'userLog'}) == 'userLog'
+    assert WebServer.messageCmd(json.dumps({'classVal': 0.5, 'cmd': 'classificationResult'})) == \
+        'classificationResult'
+    assert WebServer.messageCmd('{"cmd":"subjectDisplay"}') == 'subjectDisplay'
+    assert WebServer.messageCmd('not json') is None
+    assert WebServer.messageCmd('[1, 2]') is None
+
+
+def test_binaryFrames(dicomTestFilename):
+    with open(dicomTestFilename, 'rb') as fp:
+        data = fp.read()
+    header = {'cmd': 'getFile', 'status': 200, 'filename': dicomTestFilename}
+    frame = wcutils.encodeBinaryFrame(header, data)
+    header2, data2 = wcutils.decodeBinaryFrame(frame)
+    assert header2 == header
+    assert data2 == data
+
+    # Round trip through a pipe with both binary and base64 encoded data
+    for binaryData in (True, False):
+        rfd, wfd = os.pipe()
+        with open(rfd, 'rb') as fd_in, open(wfd, 'wb') as fd_out:
+            response = dict(header)
+            response['data'] = data
+            # write from a thread, the file is larger than the pipe buffer
+            writeThread = threading.Thread(name='writeThread', target=pipeWriter,
+                                           args=(fd_out, response, binaryData))
+            writeThread.start()
+            response2 = wcutils.readPipeResponse(fd_in)
+            if binaryData:
+                assert response2['data'] == data
+            else:
+                assert b64decode(response2['data']) == data
+            assert response2['filename'] == dicomTestFilename
+            response3 = wcutils.readPipeResponse(fd_in)
+            assert response3 == {'status': 200}
+            writeThread.join()
+
+
+def pipeWriter(fd_out, response, binaryData):
+    writePipeResponse(fd_out, response, binaryData)
+    writePipeResponse(fd_out, {'status': 200}, binaryData)
+
+
+def test_socketPipe(dicomTestFilename):
+    with open(dicomTestFilename, 'rb') as fp:
+        data = fp.read()
+    displayed = []
+
+    def socketCallback(request):
+        cmd = request['cmd']
+        if cmd == 'getFile':
+            return {'status': 200, 'filename': request['filename'], 'data': data}
+        elif cmd == 'sleep':
+            time.sleep(request['secs'])
+            return {'status': 200, 'secs': request['secs']}
+        elif cmd == 'subjectDisplay':
+            time.sleep(0.2)
+            displayed.append(request['text'])
+            return {'status': 200}
+        raise RequestError('unknown cmd {}'.format(cmd))
+
+    webpipes = makeSocketPipe()
+    # another session's socket doesn't remove this one
+    otherPipes = makeSocketPipe()
+    assert otherPipes.sockname != webpipes.sockname
+    assert os.path.exists(webpipes.sockname)
+    otherPipes.listenSock.close()
+    os.unlink(otherPipes.sockname)
+    socketThread = threading.Thread(name='socketThread', target=handleSocketRequests,
+                                    args=(webpipes, socketCallback))
+    socketThread.setDaemon(True)
+    socketThread.start()
+    clientPipes = wcutils.connectSocketPipe(webpipes.sockname)
+    sockClient = clientPipes.sockClient
+
+    retVals = wcutils.clientWebpipeCmd(clientPipes, wcutils.getFileReqStruct(dicomTestFilename))
+    assert retVals.statusCode == 200
+    assert retVals.filename == dicomTestFilename
+    response = sockClient.sendRequest(wcutils.getFileReqStruct(dicomTestFilename))
+    assert response['data'] == data
+
+    # a quick request completes while a slow one is outstanding
+    slowResponses = []
+    slowThread = threading.Thread(name='slowThread',
+                                  target=lambda: slowResponses.append(
+                                      sockClient.sendRequest({'cmd': 'sleep', 'secs': 1})))
+    slowThread.start()
+    time.sleep(0.1)
+    stime = time.time()
+    response = sockClient.sendRequest({'cmd': 'sleep', 'secs': 0})
+    assert time.time() - stime < 0.5
+    assert response['secs'] == 0
+    assert len(slowResponses) == 0
+    slowThread.join()
+    assert slowResponses[0]['secs'] == 1
+
+    # subject display commands don't wait for a reply and are handled in order
+    stime = time.time()
+    for i in range(3):
+        retVals = wcutils.clientWebpipeCmd(clientPipes, {'cmd': 'subjectDisplay', 'text': str(i)})
+        assert retVals.statusCode == 200
+    assert time.time() - stime < 0.2
+    response = sockClient.sendRequest({'cmd': 'unknown'})
+    assert response['status'] == 400
+    for i in range(20):
+        if len(displayed) == 3:
+            break
+        time.sleep(0.1)
+    assert displayed == ['0', '1', '2']
+
+    sockClient.close()
+    socketThread.join(timeout=2)
+    assert socketThread.is_alive() is False
+    resignalSocketThreadExit(socketThread, webpipes)
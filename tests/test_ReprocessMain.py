@@ -0,0 +1,81 @@
+import os
+import shutil
+import toml  # type: ignore
+import numpy as np  # type: ignore
+import scipy.io as sio  # type: ignore
+import ReprocessMain
+from rtfMRI.utils import loadMatFile
+from rtfMRI.StructDict import StructDict
+from rtAtten.RtAttenModel import getSubjectDataDir, getBlkGrpFilename
+
+rootPath = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+
+
+def createSession(dataDir, subjectNum, rng):
+    subjectDir = getSubjectDataDir(dataDir, subjectNum, 1)
+    os.makedirs(subjectDir)
+    mask = np.zeros((64, 64, 36), dtype=np.uint8)
+    mask.flat[rng.choice(mask.size, 200, replace=False)] = 1
+    sio.savemat(os.path.join(subjectDir, 'mask_{}_1.mat'.format(subjectNum)), {'mask': mask})
+    patternsFile = os.path.join(rootPath, 'webInterface/rtAtten/patterns/patternsdesign_1_20180301T000000.mat')
+    shutil.copy(patternsFile, subjectDir)
+    nVols = loadMatFile(patternsFile).block.shape[1]
+    sio.savemat(os.path.join(subjectDir, 'patternsdata_1_20180301T_1000.mat'),
+                {'patterns': {'raw': rng.randn(nVols, 200) + 100}})
+
+
+def test_reprocessSessions(tmpdir):
+    dataDir = str(tmpdir.join('data'))
+    rng = np.random.RandomState(0)
+    for subjectNum in (1, 2):
+        createSession(dataDir, subjectNum, rng)
+    cfg = toml.load(os.path.join(rootPath, 'conf/example.toml'))
+    cfg['session'].update({'dataDir': dataDir, 'subjectNum': 1, 'subjectDay': 1, 'Runs': [1], 'ScanNums': [1],
+                           'findNewestPatterns': False,
+                           'patternsDesignFiles': ['patternsdesign_1_20180301T000000.mat'],
+                           'validationData': ['patternsdata_1_20180301T_1000.mat'],
+                           'validationModels': ['trainedModel_1.mat']})
+    cfgFile = str(tmpdir.join('reprocess.toml'))
+    with open(cfgFile, 'w') as fp:
+        toml.dump(cfg, fp)
+
+    # subject 1 from the experiment file and both subjects from the glob, swept over two FWHM
+    params = StructDict({'experiments': [cfgFile], 'sessions': [os.path.join(dataDir, 'subject*/day1')],
+                         'baseConfig': cfgFile, 'fwhm': [4, 5], 'cutoff': None, 'jobs': 2, 'threads': 1,
+                         'outDir': str(tmpdir.join('out')), 'validate': False, 'seed': 0})
+    results = ReprocessMain.ReprocessMain(params)
+    assert [result.label for result in results] == \
+        ['reprocess_s1_d1_fwhm4_cutoff200', 'reprocess_s1_d1_fwhm5_cutoff200',
+         'reprocess_s1_d1_fwhm4_cutoff200_2', 'reprocess_s1_d1_fwhm5_cutoff200_2',
+         'reprocess_s2_d1_fwhm4_cutoff200', 'reprocess_s2_d1_fwhm5_cutoff200']
+    assert all(result.status == 'ok' for result in results), [result.error for result in results]
+    assert os.path.exists(str(tmpdir.join('out', 'summary.csv')))
+    # the archived session directories are left as they were
+    assert sorted(os.listdir(getSubjectDataDir(dataDir, 2, 1))) == \
+        ['mask_2_1.mat', 'patternsdata_1_20180301T_1000.mat', 'patternsdesign_1_20180301T000000.mat']
+
+    def sessionOutputs(label):
+        outDir = getSubjectDataDir(str(tmpdir.join('out', label)), 1, 1)
+        sessionId = cfg['session']['sessionId']
+        blkGrps = [loadMatFile(os.path.join(outDir, getBlkGrpFilename(sessionId, 1, blkGrpId)))
+                   for blkGrpId in (1, 2)]
+        with open(os.path.join(outDir, 'run1', 'fileprocessing_py.txt')) as fp:
+            lines = [line for line in fp if 'time' not in line.lower()]
+        return blkGrps, lines
+
+    blkGrps, lines = sessionOutputs('reprocess_s1_d1_fwhm5_cutoff200')
+    blkGrpsFwhm4, _ = sessionOutputs('reprocess_s1_d1_fwhm4_cutoff200')
+    assert not np.array_equal(blkGrps[0].patterns.raw_sm, blkGrpsFwhm4[0].patterns.raw_sm)
+
+    # the parallel in process sessions match a session run on its own
+    shutil.rmtree(str(tmpdir.join('out')))
+    params.sessions = []
+    params.fwhm = [5]
+    params.jobs = 1
+    results = ReprocessMain.ReprocessMain(params)
+    assert [result.status for result in results] == ['ok']
+    blkGrps2, lines2 = sessionOutputs('reprocess_s1_d1_fwhm5_cutoff200')
+    assert lines == lines2
+    for blkGrp, blkGrp2 in zip(blkGrps, blkGrps2):
+        for field in ('raw', 'raw_sm', 'raw_sm_filt_z', 'categoryseparation'):
+            assert np.array_equal(blkGrp.patterns[field], blkGrp2.patterns[field], equal_nan=True)
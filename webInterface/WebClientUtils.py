@@ -2,19 +2,36 @@ import os
 import sys
 import re
 import json
+import socket
 import logging
+import struct
+import threading
 import getpass
-import requests
+import numpy as np  # type: ignore
 from pathlib import Path
 from base64 import b64decode
 import rtfMRI.utils as utils
 from rtfMRI.StructDict import StructDict
 from rtfMRI.ReadDicom import readDicomFromBuffer
 from rtfMRI.Errors import RequestError, StateError
-from requests.packages.urllib3.contrib import pyopenssl
 
 certFile = 'certs/rtAtten.crt'
 
+# Binary frames carry file data without base64 encoding it into JSON.
+# Frame will be (Magic, HeaderLength) followed by a JSON header and the raw data bytes
+binaryFrameHdr = struct.Struct("!II")  # I=unsigned int
+BINARY_FRAME_MAGIC = 0xFEEDDA7A
+# dataFormat of watchFile replies that hold only the masked roi voxels
+maskedDataFormat = 'maskedFloat32'
+# Unix socket webpipe frames are (HeaderLength) followed by a JSON header and,
+#  if the header has a dataSize field, that many raw data bytes
+socketFrameHdr = struct.Struct("!I")  # I=unsigned int
+# Webpipe commands that don't wait for a reply when sent over the unix socket,
+#  so subject feedback updates don't block the TR processing loop
+noReplyCmds = ('classificationResult', 'subjectDisplay')
+# Output line of a ClientMain worker process when it is ready for the next session
+clientWorkerReady = '## clientWorker ready'
+
 
 # Set of helper functions for creating remote file requests
 def getFileReqStruct(filename, writefile=False):
@@ -31,14 +48,17 @@ def getNewestFileReqStruct(filename, writefile=False):
     return cmd
 
 
-def watchFileReqStruct(filename, timeout=5, writefile=False):
+def watchFileReqStruct(filename, timeout=5, writefile=False, masked=False):
     cmd = {'cmd': 'watchFile', 'route': 'dataserver', 'filename': filename, 'timeout': timeout}
     if writefile is True:
         cmd['writefile'] = True
+    if masked is True:
+        # return only the roi voxels, requires initWatch with a mask
+        cmd['masked'] = True
     return cmd
 
 
-def initWatchReqStruct(dir, filePattern, minFileSize, demoStep=0):
+def initWatchReqStruct(dir, filePattern, minFileSize, demoStep=0, roiInds=None, sliceDim=None):
     cmd = {
         'cmd': 'initWatch',
         'route': 'dataserver',
@@ -48,6 +68,37 @@ def initWatchReqStruct(dir, filePattern, minFileSize, demoStep=0):
     }
     if demoStep is not None and demoStep > 0:
         cmd['demoStep'] = demoStep
+    if roiInds is not None:
+        # mask and mosaic geometry so the fileWatcher can return masked volumes
+        cmd['roiInds'] = np.asarray(roiInds).ravel().tolist()
+        cmd['sliceDim'] = sliceDim
+    return cmd
+
+
+def subscribeReqStruct(filenames, masked=False, gapTimeout=5):
+    # fileWatcher pushes each file, in order, as soon as it arrives
+    cmd = {'cmd': 'subscribe', 'route': 'dataserver', 'filenames': filenames, 'gapTimeout': gapTimeout}
+    if masked is True:
+        cmd['masked'] = True
+    return cmd
+
+
+def unsubscribeReqStruct():
+    cmd = {'cmd': 'unsubscribe', 'route': 'dataserver'}
+    return cmd
+
+
+def getPushedFileReqStruct(filename, timeout=5, masked=False):
+    # read a subscribed file from the web server cache, not routed to the fileWatcher
+    cmd = {'cmd': 'getPushedFile', 'filename': filename, 'timeout': timeout}
+    if masked is True:
+        cmd['masked'] = True
+    return cmd
+
+
+def getFileInfoReqStruct(filenames):
+    # size and md5 of each file that exists, without sending the file data
+    cmd = {'cmd': 'getFileInfo', 'route': 'dataserver', 'filenames': filenames}
     return cmd
 
 
@@ -61,17 +112,203 @@ def putTextFileReqStruct(filename, str):
     return cmd
 
 
-def clientWebpipeCmd(webpipes, cmd):
-    '''Send a web request using named pipes to the web server for handling.
-    This allows a separate client process to make requests of the web server process.
-    It writes the request on fd_out and recieves the reply on fd_in.
+def encodeBinaryFrame(header, data):
+    '''Pack a JSON header dictionary and raw data bytes into one binary frame'''
+    hdrBytes = json.dumps(header).encode('utf-8')
+    return b''.join([binaryFrameHdr.pack(BINARY_FRAME_MAGIC, len(hdrBytes)), hdrBytes, data])
+
+
+def decodeBinaryFrame(frame):
+    '''Unpack a binary frame, returns the header dictionary and the raw data bytes'''
+    if len(frame) < binaryFrameHdr.size:
+        raise StateError('decodeBinaryFrame: frame too short {}'.format(len(frame)))
+    magic, hdrLen = binaryFrameHdr.unpack_from(frame, 0)
+    if magic != BINARY_FRAME_MAGIC:
+        raise StateError('decodeBinaryFrame: invalid magic number {}'.format(magic))
+    dataOffset = binaryFrameHdr.size + hdrLen
+    header = json.loads(frame[binaryFrameHdr.size:dataOffset].decode('utf-8'))
+    data = frame[dataOffset:]
+    return header, data
+
+
+def readPipeResponse(fd_in):
+    '''Read one response from the web server fifo. The response is a JSON line,
+    if it has a dataSize field then that many raw data bytes follow the line.
     '''
-    webpipes.fd_out.write(json.dumps(cmd) + os.linesep)
-    msg = webpipes.fd_in.readline()
+    msg = fd_in.readline()
     if len(msg) == 0:
         # fifo closed
         raise StateError('WebPipe closed')
     response = json.loads(msg)
+    dataSize = response.pop('dataSize', None)
+    if dataSize is not None:
+        data = fd_in.read(dataSize)
+        if len(data) != dataSize:
+            raise StateError('WebPipe closed: read {} of {} bytes'.format(len(data), dataSize))
+        response['data'] = data
+    return response
+
+
+def sendSocketFrame(sock, msg):
+    '''Write a message dictionary as one frame, bytes in the data field are sent raw'''
+    data = msg.get('data')
+    if type(data) is bytes:
+        msg = dict(msg)
+        del msg['data']
+        msg['dataSize'] = len(data)
+    else:
+        data = b''
+    hdrBytes = json.dumps(msg).encode('utf-8')
+    sock.sendall(b''.join([socketFrameHdr.pack(len(hdrBytes)), hdrBytes, data]))
+
+
+def recvSocketFrame(sock):
+    '''Read one frame, returns the message dictionary or None if the socket closed'''
+    frameHdr = recvAll(sock, socketFrameHdr.size)
+    if frameHdr is None:
+        return None
+    hdrLen, = socketFrameHdr.unpack(frameHdr)
+    msg = json.loads(recvAll(sock, hdrLen, partial=False).decode('utf-8'))
+    dataSize = msg.pop('dataSize', None)
+    if dataSize is not None:
+        msg['data'] = recvAll(sock, dataSize, partial=False)
+    return msg
+
+
+def recvAll(sock, size, partial=True):
+    '''Read exactly size bytes. Returns None if the socket is closed before any
+    bytes are read and partial is True, raises StateError if closed part way.
+    '''
+    buf = bytearray(size)
+    view = memoryview(buf)
+    numRead = 0
+    while numRead < size:
+        count = sock.recv_into(view[numRead:])
+        if count == 0:
+            if numRead == 0 and partial is True:
+                return None
+            raise StateError('WebPipe closed: read {} of {} bytes'.format(numRead, size))
+        numRead += count
+    return bytes(buf)
+
+
+class SocketPipeClient:
+    '''Client side of the unix socket webpipe to the web server process. Requests
+    are tagged with a request id and a reader thread matches up the replies, so
+    several requests can be outstanding at once.
+    '''
+    def __init__(self, sockname):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(sockname)
+        self.sendLock = threading.Lock()
+        self.pendingLock = threading.Lock()
+        self.pending = {}  # type: ignore
+        self.nextReqId = 0
+        self.closed = False
+        self.readerThread = threading.Thread(name='socketPipeReader', target=self.readResponses)
+        self.readerThread.setDaemon(True)
+        self.readerThread.start()
+
+    def sendRequest(self, cmd, noReply=False, timeout=None):
+        '''Send a request and wait for its reply, or return None right away if noReply'''
+        waiter = None
+        self.pendingLock.acquire()
+        try:
+            if self.closed:
+                raise StateError('WebPipe closed')
+            self.nextReqId += 1
+            reqId = self.nextReqId
+            if noReply is False:
+                waiter = StructDict()
+                waiter.event = threading.Event()
+                self.pending[reqId] = waiter
+        finally:
+            self.pendingLock.release()
+        request = dict(cmd)
+        request['reqId'] = reqId
+        if noReply is True:
+            request['noReply'] = True
+        self.sendLock.acquire()
+        try:
+            sendSocketFrame(self.sock, request)
+        finally:
+            self.sendLock.release()
+        if waiter is None:
+            return None
+        if waiter.event.wait(timeout) is False:
+            self.pendingLock.acquire()
+            self.pending.pop(reqId, None)
+            self.pendingLock.release()
+            raise TimeoutError('WebPipe request timed out({}): {}'.format(timeout, cmd))
+        if waiter.response is None:
+            raise StateError('WebPipe closed')
+        return waiter.response
+
+    def readResponses(self):
+        try:
+            while True:
+                response = recvSocketFrame(self.sock)
+                if response is None:
+                    break
+                self.pendingLock.acquire()
+                try:
+                    waiter = self.pending.pop(response.get('reqId'), None)
+                finally:
+                    self.pendingLock.release()
+                if waiter is None:
+                    logging.warn('SocketPipeClient: no request for reply {}'.format(response.get('reqId')))
+                    continue
+                waiter.response = response
+                waiter.event.set()
+        except Exception as err:
+            if not self.closed:
+                logging.error('SocketPipeClient: read error {}'.format(err))
+        finally:
+            # wake up any requests still waiting for a reply
+            self.pendingLock.acquire()
+            try:
+                self.closed = True
+                for waiter in self.pending.values():
+                    waiter.event.set()
+                self.pending = {}
+            finally:
+                self.pendingLock.release()
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def connectSocketPipe(sockname):
+    '''Open the client side of a unix socket webpipe created by makeSocketPipe'''
+    webpipes = StructDict()
+    webpipes.sockname = sockname
+    webpipes.sockClient = SocketPipeClient(sockname)
+    return webpipes
+
+
+def clientWebpipeCmd(webpipes, cmd):
+    '''Send a web request using named pipes, or a unix socket, to the web server for
+    handling. This allows a separate client process to make requests of the web
+    server process. For named pipes it writes the request on fd_out and recieves
+    the reply on fd_in.
+    '''
+    # request that file data be returned as raw bytes rather than base64
+    cmd['binaryData'] = True
+    if webpipes.sockClient is not None:
+        if cmd.get('cmd') in noReplyCmds:
+            webpipes.sockClient.sendRequest(cmd, noReply=True)
+            retVals = StructDict()
+            retVals.statusCode = 200
+            return retVals
+        response = webpipes.sockClient.sendRequest(cmd)
+    else:
+        webpipes.fd_out.write(json.dumps(cmd) + os.linesep)
+        response = readPipeResponse(webpipes.fd_in)
     retVals = StructDict()
     decodedData = None
     if 'status' not in response:
@@ -81,15 +318,32 @@ def clientWebpipeCmd(webpipes, cmd):
         if 'filename' in response:
             retVals.filename = response['filename']
         if 'data' in response:
-            decodedData = b64decode(response['data'])
+            decodedData = response['data']
+            if type(decodedData) is str:
+                # web server that doesn't support binary data
+                decodedData = b64decode(decodedData)
             if retVals.filename is None:
                 raise StateError('clientWebpipeCmd: filename field is None')
-            retVals.data = formatFileData(retVals.filename, decodedData)
+            if response.get('dataFormat') == maskedDataFormat:
+                # roi voxels already extracted by the fileWatcher
+                retVals.data = np.frombuffer(decodedData, dtype=np.float32)
+            else:
+                retVals.data = formatFileData(retVals.filename, decodedData)
+    elif retVals.statusCode == 404:
+        # file missing from a push stream
+        logging.warn('WebRequest: {}'.format(response.get('error')))
     elif retVals.statusCode not in (200, 408):
         raise RequestError('WebRequest error: status {}: {}'.format(retVals.statusCode, response['error']))
     return retVals
 
 
+def getFileInfo(filename):
+    '''Size and md5 hash of a file, used to check whether a copy matches. The md5
+    is utils.fileMd5, as of the session manifest, read in blocks.
+    '''
+    return {'size': os.path.getsize(filename), 'md5': utils.fileMd5(filename)}
+
+
 def formatFileData(filename, data):
     '''Convert raw bytes to a specific memory format such as dicom or matlab data'''
     fileExtension = Path(filename).suffix
@@ -105,6 +359,8 @@ def formatFileData(filename, data):
 
 
 def login(serverAddr, username, password):
+    # requests is only needed by the web and file watcher processes, not the client
+    import requests
     loginURL = os.path.join('https://', serverAddr, 'login')
     session = requests.Session()
     session.verify = certFile
@@ -128,6 +384,7 @@ def login(serverAddr, username, password):
 
 
 def checkSSLCertAltName(certFilename, altName):
+    from requests.packages.urllib3.contrib import pyopenssl
     with open(certFilename, 'r') as fh:
         certData = fh.read()
     x509 = pyopenssl.OpenSSL.crypto.load_certificate(pyopenssl.OpenSSL.crypto.FILETYPE_PEM, certData)
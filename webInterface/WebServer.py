@@ -5,28 +5,138 @@ import time
 import ssl
 import json
 import uuid
+import socket
 import bcrypt
 import asyncio
 import threading
 import logging
 from pathlib import Path
-from base64 import b64decode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from base64 import b64decode, b64encode
 from rtfMRI.StructDict import StructDict
 from rtfMRI.Messaging import getCertPath, getKeyPath
 from rtfMRI.utils import DebugLevels, writeFile
-from rtfMRI.Errors import StateError, RTError
+from rtfMRI.Errors import StateError, RTError, RequestError
+from webInterface.WebClientUtils import decodeBinaryFrame, sendSocketFrame, recvSocketFrame
+from webInterface.WebClientUtils import getFileReqStruct, getFileInfoReqStruct, getFileInfo
 
 certsDir = 'certs'
 sslCertFile = 'rtAtten.crt'
 sslPrivateKey = 'rtAtten_private.key'
 CommonOutputDir = '/rtfmriData/'
 maxDaysLoginCookieValid = 0.5
+# A queued message with one of these cmds is replaced by a newer one, only the latest is displayed
+replaceableCmds = ('subjectDisplay',)
+# A queued message with one of these cmds is never dropped, each is a point on the run's plot
+keptCmds = ('classificationResult',)
 
 
 def defaultCallback(client, message):
     print("defaultCallback: client({}): msg({})".format(client, message))
 
 
+def messageCmd(msg):
+    '''Return the cmd of a dict or JSON string message'''
+    if type(msg) is not dict:
+        try:
+            msg = json.loads(msg)
+        except ValueError:
+            return None
+        if type(msg) is not dict:
+            return None
+    return msg.get('cmd')
+
+
+class SendQueue():
+    '''Bounded queue of messages waiting to be written to one websocket connection.
+    Messages are written from the ioLoop one at a time, the next one when the previous
+    has been flushed to the socket, so a slow browser doesn't back up the ioLoop.
+    While waiting, userLog lines are merged into one frame and replaceable messages
+    are replaced by newer ones. When full the oldest replaceable or userLog message
+    is dropped, else the oldest other message, but never a keptCmds message.
+    '''
+    def __init__(self, conn, maxSize):
+        self.conn = conn
+        self.maxSize = maxSize
+        self.messages = deque()  # type: ignore  # [cmd, msg] items
+        self.writing = False
+        self.closed = False
+        self.numSent = 0
+        self.numDropped = 0
+        self.numOverflow = 0
+        self.maxDepth = 0
+
+    def put(self, cmd, msg):
+        if self.closed:
+            return
+        if cmd == 'userLog' and len(self.messages) > 0 and self.messages[-1][0] == 'userLog':
+            self.messages[-1][1].extend(msg)
+            return
+        if cmd in replaceableCmds:
+            for item in self.messages:
+                if item[0] == cmd:
+                    self.messages.remove(item)
+                    self.numDropped += 1
+                    break
+        if len(self.messages) >= self.maxSize and self.dropOldest():
+            if self.numOverflow == 0:
+                logging.warning('SendQueue: client not keeping up, dropping oldest messages')
+            self.numOverflow += 1
+            self.numDropped += 1
+        self.messages.append([cmd, msg])
+        self.maxDepth = max(self.maxDepth, self.depth())
+        self.flush()
+
+    def dropOldest(self):
+        '''Drop the oldest replaceable or userLog message, else the oldest message
+        not in keptCmds. Returns False if all the queued messages are kept.
+        '''
+        for item in self.messages:
+            if item[0] in replaceableCmds or item[0] == 'userLog':
+                self.messages.remove(item)
+                return True
+        for item in self.messages:
+            if item[0] not in keptCmds:
+                self.messages.remove(item)
+                return True
+        return False
+
+    def flush(self):
+        if self.writing or self.closed or len(self.messages) == 0:
+            return
+        cmd, msg = self.messages.popleft()
+        if cmd == 'userLog':
+            msg = json.dumps({'cmd': 'userLog', 'values': msg})
+        try:
+            future = self.conn.write_message(msg)
+        except tornado.websocket.WebSocketClosedError:
+            self.close()
+            return
+        self.numSent += 1
+        self.writing = True
+        future.add_done_callback(self.writeDone)
+
+    def writeDone(self, future):
+        self.writing = False
+        if future.cancelled() or future.exception() is not None:
+            self.close()
+            return
+        self.flush()
+
+    def close(self):
+        self.closed = True
+        self.messages.clear()
+
+    def depth(self):
+        return len(self.messages) + (1 if self.writing else 0)
+
+    def stats(self):
+        return StructDict({'depth': self.depth(), 'maxDepth': self.maxDepth,
+                           'numSent': self.numSent, 'numDropped': self.numDropped,
+                           'numOverflow': self.numOverflow})
+
+
 class Web():
     ''' Cloud service web-interface that is the front-end to the data processing. '''
     app = None
@@ -48,6 +158,23 @@ class Web():
     dataCallbacks = {}
     dataSequenceNum = 0
     cbPruneTime = 0
+    # Files pushed by the fileWatcher for the current subscribe stream, ordered by
+    #  the stream sequence numbers, held until the client process reads them
+    pushStreamId = None
+    pushFileSeqs = {}  # type: ignore
+    pushNextSeq = 0
+    pushGaps = set()  # type: ignore
+    pushCache = {}  # type: ignore
+    pushCond = threading.Condition()
+    # Outbound messages to user and subject windows go through a SendQueue per connection,
+    #  userLog lines are batched for userLogInterval seconds before being queued
+    maxQueuedMessages = 100
+    userLogInterval = 0.1
+    userLogLines = []  # type: ignore
+    userLogScheduled = False
+    userLogLock = threading.Lock()
+    # Number of getFile requests kept in flight to the fileWatcher by uploadFilesFromThread
+    uploadWindow = 8
     # Synchronizing across threads
     threadLock = threading.Lock()
     ioLoopInst = None
@@ -55,10 +182,12 @@ class Web():
 
     @staticmethod
     def start(htmlDir='html', userCallback=defaultCallback, subjCallback=defaultCallback,
-              eventCallback=defaultCallback, port=8888, test=False):
+              eventCallback=defaultCallback, port=8888, test=False, userLogInterval=None):
         if Web.app is not None:
             raise RuntimeError("Web Server already running.")
         Web.test = test
+        if userLogInterval is not None:
+            Web.userLogInterval = userLogInterval
         Web.htmlDir = htmlDir
         Web.userWidnowCallback = userCallback
         Web.subjWindowCallback = subjCallback
@@ -143,8 +272,28 @@ class Web():
 
     @staticmethod
     def userLog(logStr):
-        cmd = {'cmd': 'userLog', 'value': logStr}
-        Web.sendUserMsgFromThread(json.dumps(cmd))
+        Web.userLogLock.acquire()
+        try:
+            Web.userLogLines.append(logStr)
+            if Web.userLogScheduled:
+                return
+            Web.userLogScheduled = True
+        finally:
+            Web.userLogLock.release()
+        # lines logged until the interval ends are sent as one frame
+        Web.ioLoopInst.add_callback(Web.ioLoopInst.call_later, Web.userLogInterval, Web.flushUserLog)
+
+    @staticmethod
+    def flushUserLog():
+        Web.userLogLock.acquire()
+        try:
+            lines = Web.userLogLines
+            Web.userLogLines = []
+            Web.userLogScheduled = False
+        finally:
+            Web.userLogLock.release()
+        if len(lines) > 0:
+            Web.queueMessage(Web.wsUserConns, 'userLog', lines)
 
     @staticmethod
     def setUserError(errStr):
@@ -165,6 +314,14 @@ class Web():
             Web.dataSequenceNum += 1
             seqNum = Web.dataSequenceNum
             cmd['seqNum'] = seqNum
+            if cmd.get('cmd') == 'subscribe':
+                # pushed files are tagged with the seqNum of the subscribe request
+                Web.resetPushStream(seqNum, cmd.get('filenames'))
+            elif cmd.get('cmd') == 'unsubscribe':
+                Web.resetPushStream(None)
+            # ask for file data in binary frames, older fileWatchers ignore this
+            #   and reply with base64 encoded data in a JSON text frame
+            cmd.setdefault('binaryData', True)
             msg = json.dumps(cmd)
             callbackStruct.seqNum = seqNum
             callbackStruct.timeStamp = time.time()
@@ -180,11 +337,22 @@ class Web():
 
     @staticmethod
     def dataCallback(client, message):
-        response = json.loads(message)
+        if type(message) is bytes:
+            # binary frame, JSON header followed by the raw file data
+            response, data = decodeBinaryFrame(message)
+            response['data'] = data
+        else:
+            response = json.loads(message)
+            if type(response.get('data')) is str:
+                # base64 encoded data from a fileWatcher without binary frame support
+                response['data'] = b64decode(response['data'])
         if 'cmd' not in response:
             raise StateError('dataCallback: cmd field missing from response: {}'.format(response))
         if 'status' not in response:
             raise StateError('dataCallback: status field missing from response: {}'.format(response))
+        if response['cmd'] == 'pushFile':
+            Web.pushCallback(response)
+            return
         if 'seqNum' not in response:
             raise StateError('dataCallback: seqNum field missing from response: {}'.format(response))
         seqNum = response['seqNum']
@@ -204,7 +372,8 @@ class Web():
             callbackStruct.response = response
             callbackStruct.status = response['status']
             if callbackStruct.status == 200:
-                if origCmd in ('ping', 'initWatch', 'putTextFile', 'dataLog'):
+                if origCmd in ('ping', 'initWatch', 'putTextFile', 'dataLog', 'subscribe', 'unsubscribe',
+                               'getFileInfo'):
                     pass
                 elif origCmd in ('getFile', 'getNewestFile', 'watchFile'):
                     if 'data' not in response:
@@ -215,6 +384,8 @@ class Web():
                 if 'error' not in response or response['error'] == '':
                     raise StateError('dataCallback: error field missing from response: {}'.format(response))
                 callbackStruct.error = response['error']
+                if origCmd == 'subscribe':
+                    Web.resetPushStream(None)
             callbackStruct.event.set()
         except Exception as err:
             logging.error('WebServer: dataCallback error: {}'.format(err))
@@ -225,6 +396,77 @@ class Web():
             Web.cbPruneTime = time.time() + 60
             Web.pruneCallbacks()
 
+    @staticmethod
+    def resetPushStream(streamId, filenames=None):
+        '''Start caching pushed files for a new stream, or stop if streamId is None'''
+        Web.pushCond.acquire()
+        try:
+            Web.pushStreamId = streamId
+            Web.pushFileSeqs = {}
+            if streamId is not None and filenames is not None:
+                Web.pushFileSeqs = {filename: seq for seq, filename in enumerate(filenames)}
+            Web.pushNextSeq = 0
+            Web.pushGaps = set()
+            Web.pushCache = {}
+            # wake any waiters so they can fall back to watchFile requests
+            Web.pushCond.notify_all()
+        finally:
+            Web.pushCond.release()
+
+    @staticmethod
+    def pushCallback(response):
+        '''Cache a file pushed by the fileWatcher, checking for gaps in the stream'''
+        streamSeq = response.get('streamSeq')
+        Web.pushCond.acquire()
+        try:
+            if response.get('streamId') != Web.pushStreamId or streamSeq is None:
+                logging.log(DebugLevels.L6, 'pushCallback: drop file from stream {}, current {}'
+                            .format(response.get('streamId'), Web.pushStreamId))
+                return
+            if streamSeq < Web.pushNextSeq:
+                logging.warn('pushCallback: duplicate stream seq {}, expected {}'
+                             .format(streamSeq, Web.pushNextSeq))
+                return
+            if streamSeq > Web.pushNextSeq:
+                # lost pushes, readers of those files fall back to watchFile requests
+                logging.warn('pushCallback: stream gap, missing seq {} to {}'
+                             .format(Web.pushNextSeq, streamSeq - 1))
+                Web.pushGaps.update(range(Web.pushNextSeq, streamSeq))
+            Web.pushNextSeq = streamSeq + 1
+            logging.log(DebugLevels.L6, "pushCallback {}: {} {}".format(
+                        streamSeq, response.get('filename'), response['status']))
+            Web.pushCache[response.get('filename')] = response
+            Web.pushCond.notify_all()
+        finally:
+            Web.pushCond.release()
+
+    @staticmethod
+    def getPushedFile(filename, timeout=None):
+        '''Wait for a file pushed by the fileWatcher. Returns the pushed response, a 408
+        response on timeout, or None if the file isn't part of an active stream and
+        should be requested with watchFile instead.
+        '''
+        endTime = None if timeout is None else time.time() + timeout
+        Web.pushCond.acquire()
+        try:
+            streamId = Web.pushStreamId
+            while filename not in Web.pushCache:
+                if Web.pushStreamId is None or Web.pushStreamId != streamId:
+                    return None
+                streamSeq = Web.pushFileSeqs.get(filename)
+                if streamSeq is None or streamSeq in Web.pushGaps:
+                    return None
+                waitTime = None
+                if endTime is not None:
+                    waitTime = endTime - time.time()
+                    if waitTime <= 0:
+                        errStr = 'GetPushedFile: 408 Timeout {}s: {}'.format(timeout, filename)
+                        return {'cmd': 'pushFile', 'status': 408, 'filename': filename, 'error': errStr}
+                Web.pushCond.wait(waitTime)
+            return Web.pushCache.pop(filename)
+        finally:
+            Web.pushCond.release()
+
     @staticmethod
     def pruneCallbacks():
         numWaitingCallbacks = len(Web.dataCallbacks)
@@ -252,20 +494,31 @@ class Web():
             Web.threadLock.release()
 
     @staticmethod
-    def sendUserMessage(msg):
+    def queueMessage(conns, cmd, msg):
         Web.threadLock.acquire()
         try:
-            for client in Web.wsUserConns:
-                client.write_message(msg)
+            for client in conns:
+                client.sendQueue.put(cmd, list(msg) if cmd == 'userLog' else msg)
         finally:
             Web.threadLock.release()
 
+    @staticmethod
+    def sendUserMessage(msg):
+        # send pending log lines first to keep the messages in order
+        Web.flushUserLog()
+        Web.queueMessage(Web.wsUserConns, messageCmd(msg), msg)
+
     @staticmethod
     def sendSubjMessage(msg):
+        Web.queueMessage(Web.wsSubjConns, messageCmd(msg), msg)
+
+    @staticmethod
+    def sendQueueStats():
+        '''Queue depth and message counts for each user and subject window connection'''
         Web.threadLock.acquire()
         try:
-            for client in Web.wsSubjConns:
-                client.write_message(msg)
+            return StructDict({'user': [client.sendQueue.stats() for client in Web.wsUserConns],
+                               'subject': [client.sendQueue.stats() for client in Web.wsSubjConns]})
         finally:
             Web.threadLock.release()
 
@@ -287,6 +540,66 @@ class Web():
             writeResponseDataToFile(callbackStruct.response)
         return callbackStruct.response
 
+    @staticmethod
+    def uploadFilesFromThread(filenames, progressCallback=None, timeout=None):
+        '''Fetch files from the fileWatcher and write them under CommonOutputDir, keeping
+        uploadWindow requests in flight and handling the replies in the order they complete.
+        Files already written with the same size and md5 as the fileWatcher's copy are
+        skipped, so an interrupted upload resumes where it stopped. progressCallback is
+        called with the number of files done after each one. Returns the number skipped.
+        '''
+        uploadFilenames = Web.filesToUpload(filenames, timeout)
+        numDone = len(filenames) - len(uploadFilenames)
+        numSkipped = numDone
+        if numSkipped > 0:
+            logging.info('uploadFiles: skipping {} files already uploaded'.format(numSkipped))
+            if progressCallback is not None:
+                progressCallback(numDone)
+        pool = ThreadPoolExecutor(max_workers=Web.uploadWindow, thread_name_prefix='uploadWorker')
+        try:
+            futures = {pool.submit(Web.sendDataMsgFromThread, getFileReqStruct(filename, writefile=True),
+                                   timeout): filename for filename in uploadFilenames}
+            for future in as_completed(futures):
+                try:
+                    response = future.result()
+                    if response['status'] != 200:
+                        raise RequestError(response['error'])
+                except Exception as err:
+                    for pending in futures:
+                        pending.cancel()
+                    raise RequestError('{}: {}'.format(futures[future], err))
+                numDone += 1
+                if progressCallback is not None:
+                    progressCallback(numDone)
+        finally:
+            pool.shutdown(wait=True)
+        return numSkipped
+
+    @staticmethod
+    def filesToUpload(filenames, timeout=None):
+        '''The files that don't have a matching copy under CommonOutputDir. All of them
+        if the fileWatcher can't report file info, e.g. an older version.
+        '''
+        try:
+            response = Web.sendDataMsgFromThread(getFileInfoReqStruct(filenames), timeout)
+        except Exception as err:
+            logging.warning('uploadFiles: getFileInfo error: {}'.format(err))
+            return list(filenames)
+        if response['status'] != 200:
+            logging.info('uploadFiles: no file info, uploading all files: {}'.format(response.get('error')))
+            return list(filenames)
+        fileInfo = response['fileInfo']
+        uploadFilenames = []
+        for filename in filenames:
+            remoteInfo = fileInfo.get(filename)
+            localFilename = outputFilename(filename)
+            if remoteInfo is not None and os.path.exists(localFilename) and \
+                    os.path.getsize(localFilename) == remoteInfo['size'] and \
+                    getFileInfo(localFilename) == remoteInfo:
+                continue
+            uploadFilenames.append(filename)
+        return uploadFilenames
+
     @staticmethod
     def sendUserMsgFromThread(msg):
         Web.ioLoopInst.add_callback(Web.sendUserMessage, msg)
@@ -415,6 +728,7 @@ class Web():
                 self.close()
                 return
             logging.log(DebugLevels.L1, "Subject WebSocket opened")
+            self.sendQueue = SendQueue(self, Web.maxQueuedMessages)
             Web.threadLock.acquire()
             try:
                 Web.wsSubjConns.append(self)
@@ -423,6 +737,9 @@ class Web():
 
         def on_close(self):
             logging.log(DebugLevels.L1, "Subject WebSocket closed")
+            if hasattr(self, 'sendQueue'):
+                logging.log(DebugLevels.L1, "Subject WebSocket send queue: {}".format(self.sendQueue.stats()))
+                self.sendQueue.close()
             Web.threadLock.acquire()
             try:
                 if self in Web.wsSubjConns:
@@ -449,6 +766,7 @@ class Web():
                 self.close()
                 return
             logging.log(DebugLevels.L1, "User WebSocket opened")
+            self.sendQueue = SendQueue(self, Web.maxQueuedMessages)
             Web.threadLock.acquire()
             try:
                 Web.wsUserConns.append(self)
@@ -457,6 +775,9 @@ class Web():
 
         def on_close(self):
             logging.log(DebugLevels.L1, "User WebSocket closed")
+            if hasattr(self, 'sendQueue'):
+                logging.log(DebugLevels.L1, "User WebSocket send queue: {}".format(self.sendQueue.stats()))
+                self.sendQueue.close()
             Web.threadLock.acquire()
             try:
                 if self in Web.wsUserConns:
@@ -535,6 +856,8 @@ class Web():
                 Web.dataCallbacks = {}
             finally:
                 Web.threadLock.release()
+            # the fileWatcher push stream ends with the connection
+            Web.resetPushStream(None)
 
         def on_message(self, message):
             Web.dataCallback(self, message)
@@ -592,7 +915,7 @@ def handleFifoRequests(webpipes, callback):
     the web server into the process.
     Listens on an fd_in pipe for requests and writes the results back on the fd_out pipe.
     '''
-    webpipes.fd_out = open(webpipes.name_out, mode='w', buffering=1)
+    webpipes.fd_out = open(webpipes.name_out, mode='wb')
     webpipes.fd_in = open(webpipes.name_in, mode='r')
     try:
         while True:
@@ -602,9 +925,10 @@ def handleFifoRequests(webpipes, callback):
                 break
             # parse command
             cmd = json.loads(msg)
+            binaryData = cmd.get('binaryData', False)
             response = callback(cmd)
             try:
-                webpipes.fd_out.write(json.dumps(response) + os.linesep)
+                writePipeResponse(webpipes.fd_out, response, binaryData)
             except BrokenPipeError:
                 print('handleFifoRequests: pipe broken')
                 break
@@ -615,6 +939,121 @@ def handleFifoRequests(webpipes, callback):
         webpipes.fd_out.close()
 
 
+def writePipeResponse(fd_out, response, binaryData):
+    '''Write a response to the client fifo as a JSON line. File data is sent as
+    raw bytes following the line, with its size in the dataSize field, when
+    the client requested binaryData, otherwise it is base64 encoded in the line.
+    '''
+    data = response.get('data')
+    if type(data) is bytes:
+        response = dict(response)
+        if binaryData:
+            del response['data']
+            response['dataSize'] = len(data)
+        else:
+            response['data'] = b64encode(data).decode('utf-8')
+            data = None
+    else:
+        data = None
+    fd_out.write((json.dumps(response) + os.linesep).encode('utf-8'))
+    if data is not None:
+        fd_out.write(data)
+    fd_out.flush()
+
+
+def makeSocketPipe():
+    '''Create a listening unix domain socket for a webpipe session, a binary
+    framed alternative to the named pipes that allows several outstanding requests.
+    '''
+    sockdir = '/tmp/pipes/'
+    if not os.path.exists(sockdir):
+        os.makedirs(sockdir)
+    # a unique name per session, the sockets of other sessions and pooled
+    # workers may still be in use. Each is removed by its handleSocketRequests.
+    sockname = os.path.join(sockdir, 'rtatten_sock_{}.sock'.format(uuid.uuid4().hex))
+    webpipes = StructDict()
+    webpipes.sockname = sockname
+    webpipes.listenSock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    webpipes.listenSock.bind(sockname)
+    webpipes.listenSock.listen(1)
+    return webpipes
+
+
+def handleSocketRequests(webpipes, callback, numWorkers=4):
+    '''A thread routine that listens for web requests on a unix socket webpipe.
+    Accepts one client connection and reads request frames from it. Each request
+    is run on a worker pool and its reply, tagged with the request id, is written
+    back when done. Requests marked noReply are run in order on their own thread
+    without a reply.
+    '''
+    conn, _ = webpipes.listenSock.accept()
+    webpipes.listenSock.close()
+    sendLock = threading.Lock()
+    workerPool = ThreadPoolExecutor(max_workers=numWorkers, thread_name_prefix='webpipeWorker')
+    noReplyQueue = ThreadPoolExecutor(max_workers=1, thread_name_prefix='webpipeNoReply')
+    try:
+        while True:
+            request = recvSocketFrame(conn)
+            if request is None:
+                # socket closed
+                break
+            if request.pop('noReply', False) is True:
+                noReplyQueue.submit(handleSocketRequest, None, None, request, callback)
+            else:
+                workerPool.submit(handleSocketRequest, conn, sendLock, request, callback)
+        # End while loop
+    except Exception as err:
+        logging.error('handleSocketRequests: error {}'.format(err))
+    finally:
+        logging.info('handleSocket thread exit')
+        # don't wait for outstanding requests, the client has gone
+        workerPool.shutdown(wait=False)
+        noReplyQueue.shutdown(wait=True)
+        conn.close()
+        if os.path.exists(webpipes.sockname):
+            os.unlink(webpipes.sockname)
+
+
+def handleSocketRequest(conn, sendLock, request, callback):
+    reqId = request.pop('reqId', None)
+    try:
+        response = callback(request)
+    except Exception as err:
+        errStr = 'handleSocketRequest: {} error {}'.format(request.get('cmd'), err)
+        logging.error(errStr)
+        response = {'status': 400, 'error': errStr}
+    if conn is None:
+        # noReply request
+        return
+    response = dict(response)
+    response['reqId'] = reqId
+    sendLock.acquire()
+    try:
+        sendSocketFrame(conn, response)
+    except OSError as err:
+        logging.warn('handleSocketRequest: socket closed: {}'.format(err))
+    finally:
+        sendLock.release()
+
+
+def resignalSocketThreadExit(socketThread, webpipes):
+    '''The socket thread exits when the client closes its connection. If the client
+    never connected the thread is blocked in accept, so connect and close to release it.
+    '''
+    if socketThread is None:
+        return
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(webpipes.sockname)
+        sock.close()
+    except OSError as err:
+        # No listener on the socket so socketThread already exited
+        pass
+    socketThread.join(timeout=1)
+    if socketThread.is_alive() is not False:
+        raise StateError('runSession: socketThread not completed')
+
+
 def resignalFifoThreadExit(fifoThread, webpipes):
     '''Under normal exit conditions the fifothread will exit when the fifo filehandles
     are closed. However if the fifo filehandles were never opened by both ends then
@@ -638,9 +1077,15 @@ def resignalFifoThreadExit(fifoThread, webpipes):
         raise StateError('runSession: fifoThread not completed')
 
 
+def outputFilename(filename):
+    '''Where a file fetched from the fileWatcher is written, under CommonOutputDir'''
+    # note: can't just use os.path.join() because if two or more elements
+    #   have an aboslute path it discards the earlier elements
+    return os.path.normpath(CommonOutputDir + filename)
+
+
 def writeResponseDataToFile(response):
     '''For responses that have writefile set, write the data to a file'''
-    global CommonOutputDir
     if response['status'] != 200:
         raise StateError('writeResponseDataToFile: status not 200')
     if 'writefile' in response and response['writefile'] is True:
@@ -651,14 +1096,14 @@ def writeResponseDataToFile(response):
             del response['data']
             raise StateError('writeResponseDataToFile: filename field not in response: {}'.format(response))
         filename = response['filename']
-        decodedData = b64decode(response['data'])
+        decodedData = response['data']
+        if type(decodedData) is str:
+            decodedData = b64decode(decodedData)
         # prepend with common output path and write out file
-        # note: can't just use os.path.join() because if two or more elements
-        #   have an aboslute path it discards the earlier elements
-        outputFilename = os.path.normpath(CommonOutputDir + filename)
-        dirName = os.path.dirname(outputFilename)
+        localFilename = outputFilename(filename)
+        dirName = os.path.dirname(localFilename)
         if not os.path.exists(dirName):
-            os.makedirs(dirName)
-        writeFile(outputFilename, decodedData)
-        response['filename'] = outputFilename
+            os.makedirs(dirName, exist_ok=True)
+        writeFile(localFilename, decodedData)
+        response['filename'] = localFilename
         del response['data']
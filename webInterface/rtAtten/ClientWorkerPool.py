@@ -0,0 +1,145 @@
+import json
+import time
+import queue
+import shlex
+import logging
+import threading
+import subprocess
+from rtfMRI.Errors import StateError
+from webInterface.WebServer import makeSocketPipe, handleSocketRequests, resignalSocketThreadExit
+from webInterface.WebClientUtils import clientWorkerReady
+
+
+class ClientWorker():
+    '''A ClientMain process started with --worker, with the webpipe socket it uses
+    and a thread reading its output lines.
+    '''
+    def __init__(self, cmdStr, cwd, webPipeCallback, outputReader):
+        self.webpipes = makeSocketPipe()
+        self.socketThread = threading.Thread(name='socketThread', target=handleSocketRequests,
+                                             args=(self.webpipes, webPipeCallback))
+        self.socketThread.setDaemon(True)
+        self.socketThread.start()
+        cmd = shlex.split(cmdStr) + ['--worker', '--websock', self.webpipes.sockname]
+        self.proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, stdin=subprocess.PIPE)
+        self.lineQueue = queue.Queue()  # type: ignore
+        self.outputThread = threading.Thread(name='outputThread', target=outputReader,
+                                             args=(self.proc, self.lineQueue))
+        self.outputThread.setDaemon(True)
+        self.outputThread.start()
+        self.ready = False
+
+    def waitReady(self, timeout):
+        '''Wait until the worker is ready for a session, False if it exited or timed out'''
+        endTime = time.time() + timeout
+        while self.ready is False:
+            line = self.nextLine(min(1, max(endTime - time.time(), 0)))
+            if line is None and self.ready is False:
+                return False
+            if line:
+                logging.info('ClientWorker: {}'.format(line.rstrip()))
+            if time.time() > endTime and self.ready is False:
+                return False
+        return True
+
+    def startSession(self, experimentFile):
+        self.ready = False
+        request = {'experiment': experimentFile}
+        self.proc.stdin.write((json.dumps(request) + '\n').encode('utf-8'))
+        self.proc.stdin.flush()
+
+    def nextLine(self, timeout):
+        '''Next output line, '' if none within the timeout. Returns None when the
+        session is done, either the worker is ready again or it exited.
+        '''
+        try:
+            line = self.lineQueue.get(block=True, timeout=timeout)
+        except queue.Empty:
+            if self.proc.poll() is not None:
+                return None
+            return ''
+        if line.rstrip() == clientWorkerReady:
+            self.ready = True
+            return None
+        return line
+
+    def stop(self):
+        '''Close stdin, the worker exits right away stopping any session'''
+        if not self.proc.stdin.closed:
+            self.proc.stdin.close()
+
+    def isAlive(self):
+        return self.proc.poll() is None
+
+    def close(self):
+        self.stop()
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.outputThread.join(timeout=1)
+        resignalSocketThreadExit(self.socketThread, self.webpipes)
+
+
+class ClientWorkerPool():
+    '''Keeps a ClientMain worker process started ahead of the next run, so a run doesn't
+    wait on module imports, the server connection and clock sync. The worker is reused
+    for the following runs and replaced if it exits or is stopped. Only one worker is
+    kept since the rtfMRI server serves one client connection at a time.
+    '''
+    def __init__(self, cmdStr, cwd, webPipeCallback, outputReader):
+        self.cmdStr = cmdStr
+        self.cwd = cwd
+        self.webPipeCallback = webPipeCallback
+        self.outputReader = outputReader
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        '''Start a worker if there isn't a running one'''
+        self.lock.acquire()
+        try:
+            if self.worker is not None and self.worker.isAlive():
+                return
+            if self.worker is not None:
+                self.worker.close()
+            self.worker = ClientWorker(self.cmdStr, self.cwd, self.webPipeCallback, self.outputReader)
+        finally:
+            self.lock.release()
+
+    def acquire(self, timeout=60):
+        '''Take the worker for a session, waiting for it to be ready'''
+        self.start()
+        self.lock.acquire()
+        try:
+            worker = self.worker
+            self.worker = None
+        finally:
+            self.lock.release()
+        if not worker.waitReady(timeout):
+            worker.close()
+            raise StateError('ClientWorkerPool: client worker failed to start')
+        return worker
+
+    def release(self, worker):
+        '''Return the worker after a session, a worker that exited is replaced'''
+        if worker.isAlive() and worker.ready:
+            self.lock.acquire()
+            try:
+                if self.worker is None:
+                    self.worker = worker
+                    return
+            finally:
+                self.lock.release()
+        worker.close()
+        self.start()
+
+    def shutdown(self):
+        self.lock.acquire()
+        try:
+            if self.worker is not None:
+                self.worker.close()
+                self.worker = None
+        finally:
+            self.lock.release()
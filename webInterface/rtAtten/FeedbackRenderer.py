@@ -0,0 +1,278 @@
+import os
+import io
+import math
+import time
+import random
+import logging
+import threading
+import numpy as np  # type: ignore
+from collections import OrderedDict
+from base64 import b64encode
+from PIL import Image, ImageDraw
+from rtfMRI.utils import DebugLevels, fileCount
+from rtfMRI.StructDict import StructDict
+from rtfMRI.Errors import StateError, InvocationError
+
+defaultMemoryBudget = 256 * 2**20  # bytes of decoded images to keep in memory
+trainAlpha = 0.4
+prerenderDelay = 0.05  # seconds to let the feedback image be sent before rendering the next frames
+
+
+class FeedbackRenderer():
+    '''Renders the subject feedback images, a face and scene image blended by the
+    classification result with a fixation dot in the center. The face and scene
+    images are decoded into memory, up to a memory budget with least recently used
+    eviction, so that rendering doesn't read or decode files from disk each TR.
+    With alphaStep and prerenderFrames set, a background thread draws the image pair
+    for the next TR ahead of time and pre-encodes frames on a grid of alpha values
+    quantized by alphaStep, so the nearest frame can be sent when the result arrives.
+    '''
+    def __init__(self, feedbackDir, memoryBudget=defaultMemoryBudget, alphaStep=0, prerenderFrames=0):
+        self.sceneImageDir = os.path.join(feedbackDir, 'SCENE')
+        self.faceNeutralImageDir = os.path.join(feedbackDir, 'FACE_NEUTRAL')
+        self.faceNegativeImageDir = os.path.join(feedbackDir, 'FACE_NEGATIVE')
+        try:
+            # Get number of jpg files in FACE and SCENE directories
+            self.numSceneFiles = fileCount(self.sceneImageDir, '*.jpg')
+            self.numFaceNeutralFiles = fileCount(self.faceNeutralImageDir, '*.jpg')
+            self.numFaceNegativeFiles = fileCount(self.faceNegativeImageDir, '*.jpg')
+        except Exception:
+            self.numSceneFiles = 0
+            self.numFaceNeutralFiles = 0
+            self.numFaceNegativeFiles = 0
+        self.memoryBudget = memoryBudget
+        self.imageCache = OrderedDict()  # type: ignore
+        self.cacheBytes = 0
+        # work buffers, fixation masks and the jpeg output buffer are reused by image shape
+        self.blendBufs = {}  # type: ignore
+        self.fixationMasks = {}  # type: ignore
+        self.jpgBuf = io.BytesIO()
+        self.lock = threading.Lock()
+        # speculative pre-rendering for the next TR
+        self.alphaStep = alphaStep
+        self.prerenderFrames = prerenderFrames
+        self.prerendered = {}  # type: ignore  # alpha grid index, or 'train', to b64 jpeg
+        self.nextPair = None
+        self.lastAlphaKey = None
+        self.prerenderGeneration = 0
+        self.prerenderLock = threading.Lock()
+        self.prerenderEvent = threading.Event()
+        self.prerenderThread = None
+        self.numPrerenderHits = 0
+        self.numPrerenderMisses = 0
+
+    def preload(self):
+        '''Decode the face and scene images into memory until the memory budget is used'''
+        imageDirs = [(self.faceNegativeImageDir, self.numFaceNegativeFiles),
+                     (self.faceNeutralImageDir, self.numFaceNeutralFiles),
+                     (self.sceneImageDir, self.numSceneFiles)]
+        for imageDir, numFiles in imageDirs:
+            for fileNum in range(1, numFiles + 1):
+                filename = os.path.join(imageDir, '{}.jpg'.format(fileNum))
+                self.lock.acquire()
+                try:
+                    if self.cacheBytes >= self.memoryBudget:
+                        break
+                    self.getImage(filename)
+                finally:
+                    self.lock.release()
+        logging.log(DebugLevels.L3, "FeedbackRenderer: preloaded %d images, %d bytes",
+                    len(self.imageCache), self.cacheBytes)
+
+    def getImage(self, filename):
+        '''Return the decoded image as a uint8 array, from the cache or decoded from disk'''
+        image = self.imageCache.get(filename)
+        if image is not None:
+            self.imageCache.move_to_end(filename)
+            return image
+        with Image.open(filename) as img:
+            if img.mode not in ('L', 'RGB'):
+                img = img.convert('RGB')
+            image = np.asarray(img)
+        if image.nbytes <= self.memoryBudget:
+            self.imageCache[filename] = image
+            self.cacheBytes += image.nbytes
+            while self.cacheBytes > self.memoryBudget:
+                _, evicted = self.imageCache.popitem(last=False)
+                self.cacheBytes -= evicted.nbytes
+        return image
+
+    def createFeedbackImage(self, vol, catsep):
+        self.checkImageDirs()
+        alpha = feedbackAlpha(vol, catsep)
+        isTrain = (vol == 'train')
+        if self.prerenderThread is None:
+            return self.renderFrame(self.choosePair(), isTrain, alpha)
+        key = 'train' if isTrain else self.alphaIndex(alpha)
+        self.prerenderLock.acquire()
+        try:
+            # use the image pair drawn for this TR, the next TR gets a new pair
+            pair = self.nextPair
+            frame = self.prerendered.get(key)
+            self.nextPair = None
+            self.prerendered = {}
+            self.lastAlphaKey = key
+            self.prerenderGeneration += 1
+        finally:
+            self.prerenderLock.release()
+        self.prerenderEvent.set()
+        if frame is not None:
+            self.numPrerenderHits += 1
+            return frame
+        self.numPrerenderMisses += 1
+        if pair is None:
+            pair = self.choosePair()
+        return self.renderFrame(pair, isTrain, alpha)
+
+    def checkImageDirs(self):
+        if not os.path.exists(self.sceneImageDir) or \
+           not os.path.exists(self.faceNeutralImageDir) or \
+           not os.path.exists(self.faceNegativeImageDir):
+            raise InvocationError('Directory for FACE or SCENE missing: {} {} {}'.
+                format(self.sceneImageDir, self.faceNeutralImageDir, self.faceNegativeImageDir))
+        if self.numSceneFiles == 0 or \
+           self.numFaceNeutralFiles == 0 or \
+           self.numFaceNegativeFiles == 0:
+            raise StateError('Image Face/Scene directory missing jpg files')
+
+    def choosePair(self):
+        '''Choose random face and scene images, the neutral face is used for training'''
+        pair = StructDict()
+        pair.trainFace = os.path.join(self.faceNeutralImageDir,
+                                      '{}.jpg'.format(random.randint(1, self.numFaceNeutralFiles)))
+        pair.face = os.path.join(self.faceNegativeImageDir,
+                                 '{}.jpg'.format(random.randint(1, self.numFaceNegativeFiles)))
+        pair.scene = os.path.join(self.sceneImageDir,
+                                  '{}.jpg'.format(random.randint(1, self.numSceneFiles)))
+        return pair
+
+    def renderFrame(self, pair, isTrain, alpha):
+        faceFilename = pair.trainFace if isTrain else pair.face
+        self.lock.acquire()
+        try:
+            faceImg = self.getImage(faceFilename)
+            sceneImg = self.getImage(pair.scene)
+            blendImg = self.blend(faceImg, sceneImg, alpha)
+            self.drawFixation(blendImg)
+            return self.encodeImage(blendImg)
+        finally:
+            self.lock.release()
+
+    def alphaIndex(self, alpha):
+        return int(round(alpha / self.alphaStep))
+
+    def prerenderKeys(self):
+        '''Alpha grid indices to pre-render, nearest to the last result first, limited
+        to prerenderFrames. The train frame is first if the last result was training.
+        '''
+        minIdx = self.alphaIndex(feedbackAlpha(None, -1))
+        maxIdx = self.alphaIndex(feedbackAlpha(None, 1))
+        lastKey = self.lastAlphaKey
+        centerIdx = lastKey if type(lastKey) is int else (minIdx + maxIdx) // 2
+        keys = sorted(range(minIdx, maxIdx + 1), key=lambda idx: abs(idx - centerIdx))
+        if lastKey == 'train':
+            keys.insert(0, 'train')
+        else:
+            keys.append('train')
+        return keys[:self.prerenderFrames]
+
+    def startPrerender(self):
+        if self.alphaStep <= 0 or self.prerenderFrames <= 0 or self.prerenderThread is not None:
+            return
+        self.checkImageDirs()
+        self.prerenderThread = threading.Thread(name='prerenderThread', target=self.prerenderLoop)
+        self.prerenderThread.setDaemon(True)
+        self.prerenderThread.start()
+        self.prerenderEvent.set()
+
+    def prerenderLoop(self):
+        '''Thread routine, renders the frames for the next TR each time a result is used'''
+        while True:
+            self.prerenderEvent.wait()
+            # don't compete with sending the current feedback image to the subject window
+            time.sleep(prerenderDelay)
+            self.prerenderEvent.clear()
+            self.prerenderLock.acquire()
+            try:
+                generation = self.prerenderGeneration
+                pair = self.choosePair()
+                self.nextPair = pair
+                keys = self.prerenderKeys()
+            finally:
+                self.prerenderLock.release()
+            try:
+                for key in keys:
+                    if key == 'train':
+                        frame = self.renderFrame(pair, True, trainAlpha)
+                    else:
+                        frame = self.renderFrame(pair, False, key * self.alphaStep)
+                    self.prerenderLock.acquire()
+                    try:
+                        if generation != self.prerenderGeneration:
+                            # result arrived, start over for the next TR
+                            break
+                        self.prerendered[key] = frame
+                    finally:
+                        self.prerenderLock.release()
+            except Exception as err:
+                logging.error('FeedbackRenderer: prerender error {}'.format(err))
+
+    def blend(self, faceImg, sceneImg, alpha):
+        '''Blend as face*(1-alpha) + scene*alpha in 8 bit fixed point, matches Image.blend to within 1.
+        When alpha is closer to 0 then the face will be more visible and conversely
+        when alpha is closer to 1 then the scene will be more visible.
+        '''
+        if faceImg.shape != sceneImg.shape:
+            raise StateError('Face and scene image shapes differ {} {}'.format(faceImg.shape, sceneImg.shape))
+        bufs = self.blendBufs.get(faceImg.shape)
+        if bufs is None:
+            bufs = (np.empty(faceImg.shape, dtype=np.uint16),
+                    np.empty(faceImg.shape, dtype=np.uint16),
+                    np.empty(faceImg.shape, dtype=np.uint8))
+            self.blendBufs[faceImg.shape] = bufs
+        faceBuf, sceneBuf, outBuf = bufs
+        sceneWeight = min(max(int(round(alpha * 256)), 0), 256)
+        np.multiply(faceImg, 256 - sceneWeight, out=faceBuf, dtype=np.uint16)
+        np.multiply(sceneImg, sceneWeight, out=sceneBuf, dtype=np.uint16)
+        np.add(faceBuf, sceneBuf, out=faceBuf)
+        np.right_shift(faceBuf, 8, out=faceBuf)
+        np.copyto(outBuf, faceBuf, casting='unsafe')
+        return outBuf
+
+    def drawFixation(self, image):
+        '''Black fixation dot in the center, the dot pixels are rendered once per image size'''
+        height, width = image.shape[:2]
+        mask = self.fixationMasks.get((height, width))
+        if mask is None:
+            maskImg = Image.new('L', (width, height), 0)
+            x_center = width / 2
+            y_center = height / 2
+            radius = 3
+            draw = ImageDraw.Draw(maskImg)
+            draw.ellipse((x_center-radius, y_center-radius, x_center+radius, y_center+radius),
+                         fill=255, outline=255)
+            mask = np.nonzero(np.asarray(maskImg))
+            self.fixationMasks[(height, width)] = mask
+        image[mask] = 0
+
+    def encodeImage(self, image):
+        '''Encode to jpeg and base64, reusing the jpeg output buffer'''
+        self.jpgBuf.seek(0)
+        self.jpgBuf.truncate()
+        Image.fromarray(image).save(self.jpgBuf, format='jpeg')
+        with self.jpgBuf.getbuffer() as jpgBytes:
+            b64Data = b64encode(jpgBytes)
+        return b64Data.decode('utf-8')
+
+
+def feedbackAlpha(vol, catsep):
+    '''Scene blend weight for the classification result'''
+    if vol == 'train':
+        # for training set image as 60% face, 40% scene
+        return trainAlpha
+    # calculate the biased alpha value
+    gain = 2.3
+    x_shift = 0.2
+    y_shift = 0.12
+    steepness = 0.9
+    return steepness / (1 + math.exp(-gain*(catsep-x_shift))) + y_shift
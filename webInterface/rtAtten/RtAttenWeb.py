@@ -5,9 +5,7 @@ import subprocess
 import psutil
 import queue
 import time
-import math
 import logging
-import random
 import json
 import re
 import toml
@@ -15,13 +13,15 @@ import shlex
 from PIL import Image, ImageDraw
 from pathlib import Path
 from base64 import b64encode
-from rtfMRI.utils import DebugLevels, copyFileWildcard, fileCount
+from rtfMRI.utils import DebugLevels, copyFileWildcard
 from rtfMRI.StructDict import StructDict, recurseCreateStructDict
-from rtfMRI.Errors import RequestError, StateError, InvocationError
+from rtfMRI.Errors import StateError
 from rtAtten.RtAttenModel import getRunDir
 from webInterface.WebServer import Web, CommonOutputDir
-from webInterface.WebServer import makeFifo, handleFifoRequests, resignalFifoThreadExit
-from webInterface.WebClientUtils import getFileReqStruct
+from webInterface.WebServer import makeSocketPipe, handleSocketRequests, resignalSocketThreadExit
+from webInterface.WebClientUtils import watchFileReqStruct
+from webInterface.rtAtten.FeedbackRenderer import FeedbackRenderer, defaultMemoryBudget
+from webInterface.rtAtten.ClientWorkerPool import ClientWorkerPool
 
 
 moduleDir = os.path.dirname(os.path.realpath(__file__))
@@ -49,12 +49,8 @@ class RtAttenWeb():
     registrationThread = None
     uploadImageThread = None
     fifoFileThread = None
-    sceneImageDir = ''
-    faceNeutralImageDir = ''
-    faceNegativeImageDir = ''
-    numSceneFiles = 0
-    numFaceNeutralFiles = 0
-    numFaceNegativeFiles = 0
+    feedbackRenderer = None
+    clientWorkerPool = None
 
     @staticmethod
     def init(params, cfg):
@@ -65,24 +61,32 @@ class RtAttenWeb():
         RtAttenWeb.cfg = cfg
         RtAttenWeb.stopRun = False
         RtAttenWeb.stopReg = False
-        RtAttenWeb.sceneImageDir = os.path.join(RtAttenWeb.feedbackdir, 'SCENE')
-        RtAttenWeb.faceNeutralImageDir = os.path.join(RtAttenWeb.feedbackdir, 'FACE_NEUTRAL')
-        RtAttenWeb.faceNegativeImageDir = os.path.join(RtAttenWeb.feedbackdir, 'FACE_NEGATIVE')
+        # decode the feedback images into memory before the session starts
+        memoryBudget = defaultMemoryBudget
+        if params.feedbackCacheMB is not None:
+            memoryBudget = int(params.feedbackCacheMB * 2**20)
+        RtAttenWeb.feedbackRenderer = FeedbackRenderer(RtAttenWeb.feedbackdir, memoryBudget)
+        RtAttenWeb.feedbackRenderer.preload()
         try:
-            # Get number of jpg files in FACE and SCENE directories
-            RtAttenWeb.numSceneFiles = fileCount(RtAttenWeb.sceneImageDir, '*.jpg')
-            RtAttenWeb.numFaceNeutralFiles = fileCount(RtAttenWeb.faceNeutralImageDir, '*.jpg')
-            RtAttenWeb.numFaceNegativeFiles = fileCount(RtAttenWeb.faceNegativeImageDir, '*.jpg')
-        except Exception:
-            RtAttenWeb.numSceneFiles = 0
-            RtAttenWeb.numFaceNeutralFiles = 0
-            RtAttenWeb.numFaceNegativeFiles = 0
+            # pre-render next TR feedback frames by quantized alpha if configured
+            RtAttenWeb.feedbackRenderer.alphaStep = cfg.session.feedbackAlphaStep or 0
+            RtAttenWeb.feedbackRenderer.prerenderFrames = cfg.session.feedbackPrerenderFrames or 0
+            RtAttenWeb.feedbackRenderer.startPrerender()
+        except Exception as err:
+            logging.warn('Feedback image pre-rendering not started: {}'.format(err))
+        if params.clientWorker is True:
+            # start a client process now so runs don't wait for it to start up
+            cmdStr = 'python -u ClientMain.py' + RtAttenWeb.clientOptions()
+            RtAttenWeb.clientWorkerPool = ClientWorkerPool(cmdStr, rootDir, RtAttenWeb.webPipeCallback,
+                                                           RtAttenWeb.procOutputReader)
+            RtAttenWeb.clientWorkerPool.start()
         RtAttenWeb.initialized = True
         RtAttenWeb.webServer.start(htmlDir=htmlDir,
                                    userCallback=RtAttenWeb.webUserCallback,
                                    subjCallback=RtAttenWeb.webSubjCallback,
                                    eventCallback=RtAttenWeb.eventCallback,
-                                   port=8888)
+                                   port=8888,
+                                   userLogInterval=params.userLogInterval)
 
     @staticmethod
     def webUserCallback(client, message):
@@ -212,6 +216,16 @@ class RtAttenWeb():
         else:
             if cmd == 'webCommonDir':
                 response.filename = CommonOutputDir
+            elif cmd == 'getPushedFile':
+                filename = request['filename']
+                timeout = request.get('timeout', 5)
+                response = RtAttenWeb.webServer.getPushedFile(filename, timeout)
+                if response is None:
+                    # not in an active push stream, watch for the file instead
+                    watchCmd = watchFileReqStruct(filename, timeout=timeout, masked=request.get('masked'))
+                    response = RtAttenWeb.webServer.sendDataMsgFromThread(watchCmd, timeout=timeout+5)
+                if response['status'] == 404:
+                    RtAttenWeb.webServer.setUserError(response['error'])
             elif cmd == 'classificationResult':
                 try:
                     predict = request['value']
@@ -268,59 +282,7 @@ class RtAttenWeb():
 
     @staticmethod
     def createFeedbackImage(vol, catsep):
-        if not os.path.exists(RtAttenWeb.sceneImageDir) or \
-           not os.path.exists(RtAttenWeb.faceNeutralImageDir) or \
-           not os.path.exists(RtAttenWeb.faceNegativeImageDir):
-            raise InvocationError('Directory for FACE or SCENE missing: {} {} {}'.
-                format(RtAttenWeb.sceneImageDir, RtAttenWeb.faceNeutralImageDir, RtAttenWeb.faceNegativeImageDir))
-        if RtAttenWeb.numSceneFiles == 0 or \
-           RtAttenWeb.numFaceNeutralFiles == 0 or \
-           RtAttenWeb.numFaceNegativeFiles == 0:
-            raise StateError('Image Face/Scene directory missing jpg files')
-        alpha = 0.5
-        sceneImagesDir = RtAttenWeb.sceneImageDir
-        numSceneFiles = RtAttenWeb.numSceneFiles
-        if vol == 'train':
-            # for training set image as 60% face, 40% scene
-            alpha = 0.4
-            faceImagesDir = RtAttenWeb.faceNeutralImageDir
-            numFaceFiles = RtAttenWeb.numFaceNeutralFiles
-        else:
-            # calculate the biased alpha value
-            gain = 2.3
-            x_shift = 0.2
-            y_shift = 0.12
-            steepness = 0.9
-            alpha = steepness / (1 + math.exp(-gain*(catsep-x_shift))) + y_shift
-            faceImagesDir = RtAttenWeb.faceNegativeImageDir
-            numFaceFiles = RtAttenWeb.numFaceNegativeFiles
-
-        # Choose random number for which images to use
-        faceRndNum = random.randint(1, numFaceFiles)
-        sceneRndNum = random.randint(1, numSceneFiles)
-        faceFilename = os.path.join(faceImagesDir, '{}.jpg'.format(faceRndNum))
-        sceneFilename = os.path.join(sceneImagesDir, '{}.jpg'.format(sceneRndNum))
-        faceImg = Image.open(faceFilename)
-        sceneImg = Image.open(sceneFilename)
-        # Blend the images together using the classification result value
-        # When alpha is closer to 0 then 1st img param (face) will be move visible
-        # and conversely when alpha is closer to 1 then 2nd img param (scene) will be more visible
-        blendImg = Image.blend(faceImg, sceneImg, alpha=alpha)
-        # add circle in center
-        width, height = blendImg.size
-        x_center = width / 2
-        y_center = height / 2
-        radius = 3
-        draw = ImageDraw.Draw(blendImg)
-        draw.ellipse((x_center-radius, y_center-radius, x_center+radius, y_center+radius),
-                     fill="black", outline="black")
-        # convert it to jpeg format and get the bytes to send
-        jpgBuf = io.BytesIO()
-        blendImg.save(jpgBuf, format='jpeg')
-        jpgBytes = jpgBuf.getvalue()
-        b64Data = b64encode(jpgBytes)
-        b64StrData = b64Data.decode('utf-8')
-        return b64StrData
+        return RtAttenWeb.feedbackRenderer.createFeedbackImage(vol, catsep)
 
     @staticmethod
     def writeRegConfigFile(regGlobals, scriptPath):
@@ -363,26 +325,21 @@ class RtAttenWeb():
                 patternsSource = os.path.join(patternsDir, 'patternsdesign_'+str(runId)+'*')
                 copyFileWildcard(patternsSource, runDataDir)
 
+        if RtAttenWeb.clientWorkerPool is not None:
+            RtAttenWeb.runWorkerSession(configFileName)
+            return
         # specify -u python option to disable buffering print commands
         cmdStr = 'python -u ClientMain.py -e {}'.format(configFileName)
-        # set options for runnings a local rtserver or connecting to remote one
-        if RtAttenWeb.rtlocal is True:
-            cmdStr += ' -l'
-        else:
-            (server, port) = RtAttenWeb.rtserver.split(':')
-            cmdStr += ' -a {} -p {}'.format(server, port)
-        # set option for remote file requests
-        if RtAttenWeb.filesremote is True:
-            cmdStr += ' -x'
+        cmdStr += RtAttenWeb.clientOptions()
         # Always create a webpipe session even if using local files so we can send
         #  classification results to the subject feedback window
-        webpipes = makeFifo()
-        cmdStr += ' --webpipe {}'.format(webpipes.fifoname)
-        # start thread listening for remote file requests on fifo queue
-        fifoThread = threading.Thread(name='fifoThread', target=handleFifoRequests,
-                                      args=(webpipes, RtAttenWeb.webPipeCallback))
-        fifoThread.setDaemon(True)
-        fifoThread.start()
+        webpipes = makeSocketPipe()
+        cmdStr += ' --websock {}'.format(webpipes.sockname)
+        # start thread listening for remote file requests on the webpipe socket
+        socketThread = threading.Thread(name='socketThread', target=handleSocketRequests,
+                                        args=(webpipes, RtAttenWeb.webPipeCallback))
+        socketThread.setDaemon(True)
+        socketThread.start()
         # print(cmdStr)
         cmd = shlex.split(cmdStr)
         proc = subprocess.Popen(cmd, cwd=rootDir, stdout=subprocess.PIPE,
@@ -416,11 +373,51 @@ class RtAttenWeb():
         outputThread.join(timeout=1)
         if outputThread.is_alive():
             print("OutputThread failed to exit")
-        # make sure fifo thread has exited
-        if fifoThread is not None:
-            resignalFifoThreadExit(fifoThread, webpipes)
+        # make sure socket thread has exited
+        if socketThread is not None:
+            resignalSocketThreadExit(socketThread, webpipes)
         return
 
+    @staticmethod
+    def runWorkerSession(configFileName):
+        try:
+            worker = RtAttenWeb.clientWorkerPool.acquire()
+        except Exception as err:
+            RtAttenWeb.webServer.setUserError('Client start error: {}'.format(err))
+            return
+        worker.startSession(configFileName)
+        # send running status to user web page
+        response = {'cmd': 'runStatus', 'status': 'running'}
+        RtAttenWeb.webServer.sendUserMsgFromThread(json.dumps(response))
+        while True:
+            if RtAttenWeb.stopRun is True:
+                # the worker exits when stdin is closed, the pool starts a new one
+                worker.stop()
+            line = worker.nextLine(timeout=1)
+            if line is None:
+                break
+            if line != '':
+                RtAttenWeb.webServer.userLog(line)
+        endStatus = 'complete \u2714'
+        if RtAttenWeb.stopRun is True:
+            endStatus = 'stopped'
+        response = {'cmd': 'runStatus', 'status': endStatus}
+        RtAttenWeb.webServer.sendUserMsgFromThread(json.dumps(response))
+        RtAttenWeb.clientWorkerPool.release(worker)
+
+    @staticmethod
+    def clientOptions():
+        # set options for runnings a local rtserver or connecting to remote one
+        if RtAttenWeb.rtlocal is True:
+            options = ' -l'
+        else:
+            (server, port) = RtAttenWeb.rtserver.split(':')
+            options = ' -a {} -p {}'.format(server, port)
+        # set option for remote file requests
+        if RtAttenWeb.filesremote is True:
+            options += ' -x'
+        return options
+
     @staticmethod
     def procOutputReader(proc, lineQueue):
         for bline in iter(proc.stdout.readline, b''):
@@ -530,28 +527,28 @@ class RtAttenWeb():
             RtAttenWeb.webServer.setUserError("Registration request missing a parameter: {}".format(err))
             return
         fileType = Path(RtAttenWeb.cfg.session.dicomNamePattern).suffix
+        filenames = [os.path.join(scanFolder, "001_{:06d}_{:06d}{}".format(scanNum, i, fileType))
+                     for i in range(1, numDicoms+1)]
         dicomsInProgressInterval = numDicoms / 4
-        intervalCount = 1
-        # send periodic progress reports to front-end
-        response = {'cmd': 'uploadProgress', 'type': uploadType, 'progress': 'in-progress'}
-        RtAttenWeb.webServer.sendUserMsgFromThread(json.dumps(response))
-        for i in range(1, numDicoms+1):
-            filename = "001_{:06d}_{:06d}{}".format(scanNum, i, fileType)
-            fullFilename = os.path.join(scanFolder, filename)
-            try:
-                cmd = getFileReqStruct(fullFilename, writefile=True)
-                response = RtAttenWeb.webServer.sendDataMsgFromThread(cmd)
-                if response['status'] != 200:
-                    raise RequestError(response['error'])
-            except Exception as err:
-                RtAttenWeb.webServer.setUserError(
-                    "Error uploading file {}: {}".format(fullFilename, str(err)))
-                return
-            if i > intervalCount * dicomsInProgressInterval:
-                val = "{:.0f}%".format(1/4 * intervalCount * 100)  # convert to a percentage
+        intervalCount = [1]
+
+        def uploadProgress(numDone):
+            # send periodic progress reports to front-end
+            while numDone > intervalCount[0] * dicomsInProgressInterval and intervalCount[0] < 4:
+                val = "{:.0f}%".format(1/4 * intervalCount[0] * 100)  # convert to a percentage
                 response = {'cmd': 'uploadProgress', 'type': uploadType, 'progress': val}
                 RtAttenWeb.webServer.sendUserMsgFromThread(json.dumps(response))
-                intervalCount += 1
+                intervalCount[0] += 1
+        response = {'cmd': 'uploadProgress', 'type': uploadType, 'progress': 'in-progress'}
+        RtAttenWeb.webServer.sendUserMsgFromThread(json.dumps(response))
+        try:
+            numSkipped = RtAttenWeb.webServer.uploadFilesFromThread(filenames, uploadProgress)
+        except Exception as err:
+            RtAttenWeb.webServer.setUserError("Error uploading file {}".format(str(err)))
+            return
+        if numSkipped > 0:
+            RtAttenWeb.webServer.userLog('Upload {}: {} of {} files already uploaded'.format(
+                                         uploadType, numSkipped, numDicoms))
         response = {'cmd': 'uploadProgress', 'type': uploadType, 'progress': 'complete \u2714'}
         RtAttenWeb.webServer.sendUserMsgFromThread(json.dumps(response))
 
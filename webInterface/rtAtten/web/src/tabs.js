@@ -352,11 +352,13 @@ class RtAtten extends React.Component {
         this.setState({config: config, filesRemote: filesremote})
         this.createRegConfig();
       } else if (cmd == 'userLog') {
-        var logItem = request['value'].trim()
-        var itemPos = this.state.logLines.length + 1
-        var newLine = elem('pre', { style: logLineStyle,  key: itemPos }, logItem)
+        // log lines are sent in batches as 'values', or a single line as 'value'
+        var logItems = ('values' in request) ? request['values'] : [request['value']]
+        var itemPos = this.state.logLines.length
+        var newLines = logItems.map(logItem =>
+          elem('pre', { style: logLineStyle,  key: ++itemPos }, logItem.trim()))
         // Need to use concat() to create a new logLines object or React won't know to re-render
-        var logLines = this.state.logLines.concat([newLine])
+        var logLines = this.state.logLines.concat(newLines)
         this.setState({logLines: logLines})
       } else if (cmd == 'regLog') {
         var logItem = request['value'].trim()
@@ -5,12 +5,16 @@ import json
 import logging
 import threading
 import websocket
+import numpy as np  # type: ignore
+from concurrent.futures import ThreadPoolExecutor
 from base64 import b64encode
 from pathlib import Path
 from rtfMRI.fileWatcher import FileWatcher
-from rtfMRI.utils import DebugLevels, findNewestFile
+from rtfMRI.utils import DebugLevels, findNewestFile, loadMatFileFromBuffer
+from rtfMRI.ReadDicom import readDicomFromBuffer, parseDicomVolume, applyMask
+from rtfMRI.StructDict import StructDict
 from rtfMRI.Errors import StateError
-from webInterface.WebClientUtils import login, certFile
+from webInterface.WebClientUtils import login, certFile, encodeBinaryFrame, maskedDataFormat, getFileInfo
 
 defaultAllowedDirs = ['/data']
 defaultAllowedTypes = ['.dcm', '.mat']
@@ -21,20 +25,40 @@ class WebSocketFileWatcher:
         cloud service requests with the file data.
     '''
     fileWatcher = FileWatcher()
+    # session roi mask, set by initWatch, used to return only the roi voxels
+    roiInds = None
+    sliceDim = None
     allowedDirs = None
     allowedTypes = None
     serverAddr = None
     sessionCookie = None
     needLogin = True
     shouldExit = False
+    # Requests are handled on a pool of worker threads so that a long running
+    #  watchFile doesn't block other requests. Commands that must stay in order
+    #  relative to each other are run on their own single thread queue.
+    numWorkers = 4
+    orderedCmds = {'initWatch': 'watch', 'watchFile': 'watch', 'subscribe': 'watch',
+                   'unsubscribe': 'watch', 'dataLog': 'dataLog'}
+    workerPool = None
+    orderedQueues = {}  # type: ignore
+    # Subscribed files are pushed as they arrive by a stream thread, without
+    #  waiting for a watchFile request per file
+    pushStream = None
+    pushPollTimeout = 0.5
+    defaultGapTimeout = 5
     # Synchronizing across threads
     clientLock = threading.Lock()
     fileWatchLock = threading.Lock()
+    executorLock = threading.Lock()
 
     @staticmethod
     def runFileWatcher(serverAddr, retryInterval=10, allowedDirs=defaultAllowedDirs,
-                       allowedTypes=defaultAllowedTypes, username=None, password=None):
+                       allowedTypes=defaultAllowedTypes, username=None, password=None,
+                       watcherType=None):
         WebSocketFileWatcher.serverAddr = serverAddr
+        if watcherType is not None:
+            WebSocketFileWatcher.fileWatcher = FileWatcher(watcherType)
         WebSocketFileWatcher.allowedDirs = allowedDirs
         for i in range(len(allowedTypes)):
             if not allowedTypes[i].startswith('.'):
@@ -60,16 +84,51 @@ class WebSocketFileWatcher:
 
     @staticmethod
     def on_message(client, message):
-        fileWatcher = WebSocketFileWatcher.fileWatcher
-        response = {'status': 400, 'error': 'unhandled request'}
         try:
             request = json.loads(message)
             cmd = request['cmd']
+        except Exception as err:
+            logging.log(logging.WARNING, "OnMessage: invalid request: {}".format(err))
+            return
+        if cmd == 'error':
+            # handle on the websocket thread, may need to exit
+            WebSocketFileWatcher.handleRequest(client, request)
+            return
+        executor = WebSocketFileWatcher.getExecutor(cmd)
+        executor.submit(WebSocketFileWatcher.handleRequest, client, request)
+
+    @staticmethod
+    def getExecutor(cmd):
+        WebSocketFileWatcher.executorLock.acquire()
+        try:
+            queueName = WebSocketFileWatcher.orderedCmds.get(cmd)
+            if queueName is None:
+                if WebSocketFileWatcher.workerPool is None:
+                    WebSocketFileWatcher.workerPool = ThreadPoolExecutor(
+                        max_workers=WebSocketFileWatcher.numWorkers, thread_name_prefix='fileWatchWorker')
+                return WebSocketFileWatcher.workerPool
+            executor = WebSocketFileWatcher.orderedQueues.get(queueName)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=queueName)
+                WebSocketFileWatcher.orderedQueues[queueName] = executor
+            return executor
+        finally:
+            WebSocketFileWatcher.executorLock.release()
+
+    @staticmethod
+    def handleRequest(client, request):
+        fileWatcher = WebSocketFileWatcher.fileWatcher
+        response = {'status': 400, 'error': 'unhandled request'}
+        cmd = request.get('cmd')
+        try:
             if cmd == 'initWatch':
                 dir = request['dir']
                 filePattern = request['filePattern']
                 minFileSize = request['minFileSize']
                 demoStep = request.get('demoStep')
+                # don't echo the mask back in the reply
+                roiInds = request.pop('roiInds', None)
+                sliceDim = request.get('sliceDim')
                 logging.log(DebugLevels.L3, "initWatch: %s, %s, %d", dir, filePattern, minFileSize)
                 if dir is None or filePattern is None or minFileSize is None:
                     errStr = "InitWatch: Missing file information: {} {}".format(dir, filePattern)
@@ -87,6 +146,12 @@ class WebSocketFileWatcher:
                     WebSocketFileWatcher.fileWatchLock.acquire()
                     try:
                         fileWatcher.initFileNotifier(dir, filePattern, minFileSize, demoStep)
+                        if roiInds is not None:
+                            WebSocketFileWatcher.roiInds = np.array(roiInds, dtype=np.int64)
+                            WebSocketFileWatcher.sliceDim = sliceDim
+                        else:
+                            WebSocketFileWatcher.roiInds = None
+                            WebSocketFileWatcher.sliceDim = None
                     finally:
                         WebSocketFileWatcher.fileWatchLock.release()
                     response = {'status': 200}
@@ -102,6 +167,10 @@ class WebSocketFileWatcher:
                     errStr = 'WatchFile: Non-allowed file {}'.format(filename)
                     response = {'status': 400, 'error': errStr}
                     logging.log(logging.WARNING, errStr)
+                elif request.get('masked') is True and WebSocketFileWatcher.roiInds is None:
+                    errStr = 'WatchFile: Masked data requested but no mask set by initWatch'
+                    response = {'status': 400, 'error': errStr}
+                    logging.log(logging.WARNING, errStr)
                 else:
                     WebSocketFileWatcher.fileWatchLock.acquire()
                     try:
@@ -118,9 +187,38 @@ class WebSocketFileWatcher:
                         #  against data size.
                         with open(filename, 'rb') as fp:
                             data = fp.read()
-                        b64Data = b64encode(data)
-                        b64StrData = b64Data.decode('utf-8')
-                        response = {'status': 200, 'filename': filename, 'data': b64StrData}
+                        response = {'status': 200, 'filename': filename, 'data': data}
+                        if request.get('masked') is True:
+                            response['data'] = WebSocketFileWatcher.maskFileData(filename, data)
+                            response['dataFormat'] = maskedDataFormat
+            elif cmd == 'subscribe':
+                # don't echo the file list back in the reply
+                filenames = request.pop('filenames', None)
+                logging.log(DebugLevels.L3, "subscribe: %d files", 0 if filenames is None else len(filenames))
+                if filenames is None or len(filenames) == 0:
+                    errStr = 'Subscribe: Missing filenames'
+                    response = {'status': 400, 'error': errStr}
+                    logging.log(logging.WARNING, errStr)
+                elif fileWatcher.watchDir is None:
+                    errStr = 'Subscribe: No watch directory set by initWatch'
+                    response = {'status': 400, 'error': errStr}
+                    logging.log(logging.WARNING, errStr)
+                elif not all(WebSocketFileWatcher.validateRequestedFile(None, filename)
+                             for filename in filenames):
+                    errStr = 'Subscribe: Non-allowed file in {}'.format(filenames)
+                    response = {'status': 400, 'error': errStr}
+                    logging.log(logging.WARNING, errStr)
+                elif request.get('masked') is True and WebSocketFileWatcher.roiInds is None:
+                    errStr = 'Subscribe: Masked data requested but no mask set by initWatch'
+                    response = {'status': 400, 'error': errStr}
+                    logging.log(logging.WARNING, errStr)
+                else:
+                    WebSocketFileWatcher.startPushStream(client, request, filenames)
+                    response = {'status': 200}
+            elif cmd == 'unsubscribe':
+                logging.log(DebugLevels.L3, "unsubscribe")
+                WebSocketFileWatcher.stopPushStream()
+                response = {'status': 200}
             elif cmd == 'getFile':
                 filename = request['filename']
                 if filename is not None and not os.path.isabs(filename):
@@ -142,9 +240,30 @@ class WebSocketFileWatcher:
                 else:
                     with open(filename, 'rb') as fp:
                         data = fp.read()
-                    b64Data = b64encode(data)
-                    b64StrData = b64Data.decode('utf-8')
-                    response = {'status': 200, 'filename': filename, 'data': b64StrData}
+                    response = {'status': 200, 'filename': filename, 'data': data}
+            elif cmd == 'getFileInfo':
+                # don't echo the file list back in the reply
+                filenames = request.pop('filenames', None)
+                logging.log(DebugLevels.L3, "getFileInfo: %d files", 0 if filenames is None else len(filenames))
+                if filenames is None:
+                    errStr = 'GetFileInfo: Missing filenames'
+                    response = {'status': 400, 'error': errStr}
+                    logging.log(logging.WARNING, errStr)
+                elif not all(WebSocketFileWatcher.validateRequestedFile(None, filename)
+                             for filename in filenames):
+                    errStr = 'GetFileInfo: Non-allowed file in {}'.format(filenames)
+                    response = {'status': 400, 'error': errStr}
+                    logging.log(logging.WARNING, errStr)
+                else:
+                    # files that don't exist are left out of the reply
+                    fileInfo = {}
+                    for filename in filenames:
+                        fullFilename = filename
+                        if not os.path.isabs(filename) and fileWatcher.watchDir is not None:
+                            fullFilename = os.path.join(fileWatcher.watchDir, filename)
+                        if os.path.exists(fullFilename):
+                            fileInfo[filename] = getFileInfo(fullFilename)
+                    response = {'status': 200, 'fileInfo': fileInfo}
             elif cmd == 'getNewestFile':
                 filename = request['filename']
                 logging.log(DebugLevels.L3, "getNewestFile: %s", filename)
@@ -169,9 +288,7 @@ class WebSocketFileWatcher:
                     else:
                         with open(filename, 'rb') as fp:
                             data = fp.read()
-                        b64Data = b64encode(data)
-                        b64StrData = b64Data.decode('utf-8')
-                        response = {'status': 200, 'filename': filename, 'data': b64StrData}
+                        response = {'status': 200, 'filename': filename, 'data': data}
             elif cmd == 'ping':
                 response = {'status': 200}
             elif cmd == 'putTextFile':
@@ -242,12 +359,117 @@ class WebSocketFileWatcher:
                 sys.exit()
         # merge response into the request dictionary
         request.update(response)
-        response = request
+        WebSocketFileWatcher.sendResponse(client, request)
+
+    @staticmethod
+    def sendResponse(client, response):
+        '''Send a reply or pushed file to the web server, returns False if the send failed'''
+        data = response.pop('data', None)
+        if data is not None and response.get('binaryData') is True:
+            # send the file data as raw bytes in a binary frame
+            frame = encodeBinaryFrame(response, data)
+            opcode = websocket.ABNF.OPCODE_BINARY
+        else:
+            if data is not None:
+                # server doesn't support binary frames, base64 encode the data
+                response['data'] = b64encode(data).decode('utf-8')
+            frame = json.dumps(response)
+            opcode = websocket.ABNF.OPCODE_TEXT
         WebSocketFileWatcher.clientLock.acquire()
         try:
-            client.send(json.dumps(response))
+            client.send(frame, opcode)
+        except Exception as err:
+            logging.log(logging.WARNING, "SendResponse: send failed: {}: {}".format(response.get('cmd'), err))
+            return False
         finally:
             WebSocketFileWatcher.clientLock.release()
+        return True
+
+    @staticmethod
+    def startPushStream(client, request, filenames):
+        '''Start a thread that pushes each of the subscribed files, in order, as it arrives'''
+        stream = StructDict()
+        stream.streamId = request.get('seqNum')
+        stream.filenames = filenames
+        stream.masked = request.get('masked') is True
+        stream.binaryData = request.get('binaryData') is True
+        stream.gapTimeout = request.get('gapTimeout', WebSocketFileWatcher.defaultGapTimeout)
+        stream.stop = False
+        WebSocketFileWatcher.stopPushStream()
+        WebSocketFileWatcher.pushStream = stream
+        pushThread = threading.Thread(name='pushThread', target=WebSocketFileWatcher.pushFiles,
+                                      args=(client, stream))
+        pushThread.setDaemon(True)
+        pushThread.start()
+
+    @staticmethod
+    def stopPushStream():
+        if WebSocketFileWatcher.pushStream is not None:
+            WebSocketFileWatcher.pushStream.stop = True
+            WebSocketFileWatcher.pushStream = None
+
+    @staticmethod
+    def pushFiles(client, stream):
+        '''Push thread routine. Each file is sent with its sequence number in the stream.
+        A file that hasn't arrived after gapTimeout seconds, while a later file in
+        the stream has, is pushed as missing with status 404 so the receiver can
+        move on without waiting for it.
+        '''
+        fileWatcher = WebSocketFileWatcher.fileWatcher
+        streamSeq = 0
+        waitStartTime = time.time()
+        while streamSeq < len(stream.filenames) and stream.stop is False:
+            filename = stream.filenames[streamSeq]
+            WebSocketFileWatcher.fileWatchLock.acquire()
+            try:
+                retVal = fileWatcher.waitForFile(filename, timeout=WebSocketFileWatcher.pushPollTimeout)
+            finally:
+                WebSocketFileWatcher.fileWatchLock.release()
+            if stream.stop is True:
+                break
+            push = {'cmd': 'pushFile', 'streamId': stream.streamId, 'streamSeq': streamSeq,
+                    'filename': filename, 'binaryData': stream.binaryData}
+            try:
+                if retVal is None:
+                    if time.time() - waitStartTime < stream.gapTimeout:
+                        continue
+                    laterFiles = stream.filenames[streamSeq + 1:]
+                    if not any(os.path.exists(laterFile) for laterFile in laterFiles):
+                        continue
+                    errStr = 'PushFile: file missing from stream: {}'.format(filename)
+                    push.update({'status': 404, 'error': errStr})
+                    logging.log(logging.WARNING, errStr)
+                else:
+                    with open(filename, 'rb') as fp:
+                        data = fp.read()
+                    push.update({'status': 200, 'data': data})
+                    if stream.masked is True:
+                        push['data'] = WebSocketFileWatcher.maskFileData(filename, data)
+                        push['dataFormat'] = maskedDataFormat
+            except Exception as err:
+                errStr = 'PushFile Exception: {}: {}'.format(filename, err)
+                push.update({'status': 400, 'error': errStr})
+                logging.log(logging.WARNING, errStr)
+            if WebSocketFileWatcher.sendResponse(client, push) is False:
+                # connection lost, web server falls back to watchFile requests
+                break
+            streamSeq += 1
+            waitStartTime = time.time()
+        logging.log(DebugLevels.L3, "pushFiles: stream %s ended at %d", stream.streamId, streamSeq)
+
+    @staticmethod
+    def maskFileData(filename, data):
+        '''Extract the roi voxels from the image file data, returns them as float32 bytes'''
+        fileExtension = Path(filename).suffix
+        if fileExtension == '.mat':
+            volume = loadMatFileFromBuffer(data).vol
+        elif fileExtension == '.dcm':
+            dicomImg = readDicomFromBuffer(data)
+            volume = parseDicomVolume(dicomImg, WebSocketFileWatcher.sliceDim)
+        else:
+            raise StateError('maskFileData: only .mat or .dcm files can be masked: {}'.format(filename))
+        maskedVolume = applyMask(volume, WebSocketFileWatcher.roiInds)
+        return maskedVolume.astype(np.float32).tobytes()
 
     @staticmethod
     def on_close(client):